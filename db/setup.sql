@@ -120,6 +120,14 @@ ALTER TABLE recordings
     ADD COLUMN presentations_per_repeat smallint;
 
 
+/* Uncommitted changes (git diffs) of code_versions, stored once each. */
+CREATE TABLE IF NOT EXISTS code_diffs (
+    /* Hex SHA-256 of the UTF-8 encoded diff (hong2p.util.code_diff_hash) */
+    diff_hash text PRIMARY KEY,
+    diff text NOT NULL
+);
+
+
 CREATE TABLE IF NOT EXISTS code_versions (
     /* TODO do i want this to be the PK? it will surely lead to duplicate rows
      * referring to the same code version, but maybe it's not worth checking to
@@ -147,6 +155,30 @@ CREATE TABLE IF NOT EXISTS code_versions (
         (git_remote is not null and git_uncommitted_changes is not null)),
     CONSTRAINT have_version CHECK (git_hash is not null or version is not null)
 );
+/* New rows reference their diff in code_diffs, rather than storing it in
+ * git_uncommitted_changes. Rows are looked up by (name, git_hash, diff_hash)
+ * (hong2p.util.upload_code_info), rather than comparing whole rows. */
+ALTER TABLE code_versions ADD COLUMN IF NOT EXISTS
+    diff_hash text REFERENCES code_diffs (diff_hash);
+ALTER TABLE code_versions DROP CONSTRAINT IF EXISTS all_git_info;
+ALTER TABLE code_versions ADD CONSTRAINT all_git_info CHECK (git_hash is null
+    or (git_remote is not null and
+    (git_uncommitted_changes is not null or diff_hash is not null))
+);
+CREATE INDEX IF NOT EXISTS code_versions_lookup
+    ON code_versions (name, git_hash, diff_hash);
+/* Moves diffs of rows from before code_diffs existed. */
+INSERT INTO code_diffs (diff_hash, diff)
+    SELECT DISTINCT encode(sha256(convert_to(git_uncommitted_changes, 'UTF8')),
+        'hex'), git_uncommitted_changes
+    FROM code_versions
+    WHERE diff_hash IS NULL AND git_uncommitted_changes IS NOT NULL
+ON CONFLICT DO NOTHING;
+UPDATE code_versions SET
+    diff_hash = encode(sha256(convert_to(git_uncommitted_changes, 'UTF8')),
+        'hex'),
+    git_uncommitted_changes = NULL
+WHERE diff_hash IS NULL AND git_uncommitted_changes IS NOT NULL;
 
 
 CREATE TABLE IF NOT EXISTS analysis_runs (
@@ -379,6 +411,19 @@ ADD CONSTRAINT cells_segmentation_run_fkey
     FOREIGN KEY (segmentation_run)
     REFERENCES segmentation_runs (run_at)
     ON DELETE CASCADE;
+/* Packed footprint (see hong2p.util.encode_footprint), replacing the three
+ * array columns above for new rows. Existing rows can be packed with
+ * scripts/pack_footprints.py. Rows with only the array columns are still read
+ * (hong2p.util.decode_footprint_columns). */
+ALTER TABLE cells ADD COLUMN IF NOT EXISTS footprint bytea;
+ALTER TABLE cells ALTER COLUMN x_coords DROP NOT NULL;
+ALTER TABLE cells ALTER COLUMN y_coords DROP NOT NULL;
+ALTER TABLE cells ALTER COLUMN weights DROP NOT NULL;
+ALTER TABLE cells DROP CONSTRAINT IF EXISTS cells_has_footprint;
+ALTER TABLE cells ADD CONSTRAINT cells_has_footprint CHECK (
+    footprint IS NOT NULL OR
+    (x_coords IS NOT NULL AND y_coords IS NOT NULL AND weights IS NOT NULL)
+);
 
 
 CREATE TABLE IF NOT EXISTS presentations (
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from os.path import join, split, abspath, normpath, dirname, getmtime
+from os.path import join, split, abspath, normpath, dirname, getmtime, exists
 import glob
 from datetime import date, datetime
 from collections import OrderedDict
@@ -8,6 +8,7 @@ from pprint import pprint
 import sys
 import argparse
 import pickle
+import hashlib
 
 from jinja2.loaders import FileSystemLoader
 from latex import build_pdf, escape, LatexBuildError
@@ -257,6 +258,22 @@ def compile_tex_to_pdf(latex_str, pdf_fname, verbose, gen_latex_msg=None):
         raise
 
 
+def report_inputs_hash(latex_str, plot_files):
+    """Returns a hash of the rendered LaTeX and the content of each plot.
+
+    Uses the input hashes recorded when the plots were saved, where available,
+    rather than reading every file.
+    """
+    h = hashlib.sha1(latex_str.encode())
+    for f in plot_files:
+        path = join(pdfdir, f)
+        file_hash = u.figure_input_hash(path)
+        if file_hash is None:
+            file_hash = u.md5(path)
+        h.update(f'{f}:{file_hash}'.encode())
+    return h.hexdigest()
+
+
 def pop_with_default(d, k, default=None):
     if k in d:
         return d.pop(k)
@@ -283,6 +300,7 @@ def main(*args, **kwargs):
     rerun_last_inputs = pop_with_default(kwargs, 'rerun_last_inputs', False)
     only_recompile_test_tex = pop_with_default(kwargs, 'only_recompile', False)
     pdf_fname = pop_with_default(kwargs, 'file')
+    force_recompile = pop_with_default(kwargs, 'force_recompile', False)
     # TODO TODO TODO add some test to check output is same w/ this as if call
     # comes as it just did from kc_mix_analysis. they seem to differ in the 
     # "Input" section now (at least in some cases)
@@ -598,7 +616,22 @@ def main(*args, **kwargs):
     # this is visible in plt.show(), but not in saved figure...
     fig.savefig('empty_placeholder.pdf')#, facecolor='red')
 
+    # Compiling is slow, so skipping it if neither the LaTeX nor any of the
+    # included figures have changed since the last time this PDF was made.
+    input_hash = report_inputs_hash(latex_str, [f
+        for _, fs in sections + paired_sections for f in fs if f is not None
+    ])
+    hash_fname = pdf_fname + '.hash'
+    if not force_recompile and exists(pdf_fname) and exists(hash_fname):
+        with open(hash_fname, 'r') as f:
+            last_input_hash = f.read().strip()
+        if last_input_hash == input_hash:
+            print(f'{pdf_fname} inputs unchanged. Not recompiling.')
+            return pdf_fname
+
     compile_tex_to_pdf(latex_str, pdf_fname, verbose, gen_latex_msg)
+    with open(hash_fname, 'w') as f:
+        f.write(input_hash)
 
     return pdf_fname
 
@@ -622,6 +655,10 @@ if __name__ == '__main__':
         'input figures under each figure inserted into the PDF. Enabled if '
         '--debug is passed.'
     )
+    parser.add_argument('-F', '--force-recompile', default=False,
+        action='store_true', help='Compiles the PDF even if the LaTeX and '
+        'all included figures are unchanged since it was last compiled.'
+    )
     # vars(...) apparently converts argparse Namespace to a regular dict
     kwargs = vars(parser.parse_args())
     main(**kwargs)
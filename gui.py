@@ -39,7 +39,6 @@ import tifffile
 import numpy as np
 import pandas as pd
 # TODO factor all of these out as much as possible
-from scipy.sparse import coo_matrix
 import cv2
 from matplotlib.backends.backend_qt5agg import (FigureCanvas,
     NavigationToolbar2QT as NavigationToolbar)
@@ -72,7 +71,25 @@ use_cached_gsheet = False
 show_inferred_paths = True
 overwrite_older_analysis = True
 
-df = u.mb_team_gsheet(use_cache=use_cached_gsheet)
+# If True, CNMF runs on a (cached) memory mapped copy of the motion corrected
+# TIFF, split into patches across a local cluster of processes (see
+# u.cnmf_n_processes), rather than on the movie held in memory here.
+cnmf_on_memmap = True
+# Half-size and overlap (in pixels) of CNMF patches, in the memmap case, when
+# the 'patch' parameters don't already set rf.
+cnmf_patch_rf = 40
+cnmf_patch_stride = 10
+
+# Recordings next to the one opened (in the data tree) are loaded in the
+# background, into a cache of at most this many MiB. 0 disables prefetching.
+recording_prefetch_mb = int(os.environ.get('HONG_2P_PREFETCH_MB', 2048))
+# Prefetching stops, and the cache is cleared, when less than this fraction of
+# system memory is available (only checked if psutil is installed).
+prefetch_min_available_memory = 0.2
+# Frames read at a time when computing recording averages.
+preview_chunk_frames = 500
+
+df = u.mb_team_gsheet(use_cache=use_cached_gsheet, background_refresh=True)
 
 # TODO probably just move this info into output of stimuli metadata generator
 # (or maybe just load either-or as-needed)
@@ -82,6 +99,70 @@ natural_odors_concentrations.set_index('name', verify_integrity=True,
     inplace=True
 )
 
+def available_memory_fraction():
+    """Returns fraction of system memory available, or None if unknown.
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    vm = psutil.virtual_memory()
+    return vm.available / vm.total
+
+
+def load_recording_preview(tiff):
+    """Returns dict with the parts of a recording `open_recording` needs.
+
+    Safe to call from a worker thread. It only reads the TIFF (no timing info,
+    which may need MATLAB). The movie is memory mapped if possible. Averages
+    are computed in one pass over the movie, in chunks of frames.
+    """
+    tiff_mtime = getmtime(tiff)
+    movie = u.memmap_tiff(tiff)
+
+    frame_sum = np.zeros(movie.shape[1:])
+    full_frame_avg_trace = np.empty(movie.shape[0])
+    for t0 in range(0, movie.shape[0], preview_chunk_frames):
+        chunk = np.asarray(movie[t0:(t0 + preview_chunk_frames)],
+            dtype=np.float64
+        )
+        frame_sum += chunk.sum(axis=0)
+        full_frame_avg_trace[t0:(t0 + len(chunk))] = \
+            u.full_frame_avg_trace(chunk)
+
+    return {
+        'tiff': tiff,
+        'tiff_mtime': tiff_mtime,
+        'movie': movie,
+        'frame_sum': frame_sum,
+        'full_frame_avg_trace': full_frame_avg_trace
+    }
+
+
+def preview_frame_range(preview, start_frame=0, stop_frame=None):
+    """Returns (movie, avg, full_frame_avg_trace) for frames in range.
+
+    The movie is a view of just those frames, in the TIFF's dtype (memory
+    mapped if the preview is). Code that needs floats converts what it uses.
+    """
+    movie = preview['movie']
+    n_frames = movie.shape[0]
+    if stop_frame is None:
+        stop_frame = n_frames
+
+    # Subtracting the (usually few) frames outside the range from the
+    # cached sum is much faster than averaging the rest again.
+    frame_sum = (preview['frame_sum']
+        - np.asarray(movie[:start_frame], dtype=np.float64).sum(axis=0)
+        - np.asarray(movie[stop_frame:], dtype=np.float64).sum(axis=0)
+    )
+    avg = (frame_sum / (stop_frame - start_frame)).astype(np.float32)
+
+    return (movie[start_frame:stop_frame], avg,
+        preview['full_frame_avg_trace'][start_frame:stop_frame]
+    )
+
+
 def show_mask_union(masks):
     # TODO either fail in / handle volumetric timeseries case
     all_footprints = np.any(masks, axis=-1).astype(np.uint8) * 255
@@ -113,11 +194,16 @@ class WorkerSignals(QObject):
     progress
         `int` indicating % progress
 
+    job_done
+        `str` upload job file and `object` traceback str (None if the job
+        succeeded), for each job of an upload queue worker
+
     '''
     finished = pyqtSignal()
     error = pyqtSignal(tuple)
     result = pyqtSignal(object)
     progress = pyqtSignal(int)
+    job_done = pyqtSignal(str, object)
 
 
 class Worker(QRunnable):
@@ -449,6 +535,14 @@ class Segmentation(QWidget):
         # TODO maybe share this across all widget classes?
         self.threadpool = QThreadPool()
 
+        # TIFF path -> output of load_recording_preview. Memory mapped movies
+        # don't count towards the limit.
+        self.recording_cache = u.LRUCache(
+            max_bytes=(recording_prefetch_mb * 2**20),
+            name='recording prefetch cache'
+        )
+        self.prefetching = set()
+
         # TODO TODO put all shorcuts in a "tools" menu at least
         self.break_tiff_shortcut = QShortcut(QKeySequence('Ctrl+b'), self)
         self.break_tiff_shortcut.activated.connect(self.save_tiff_blocks)
@@ -484,6 +578,82 @@ class Segmentation(QWidget):
         self.ACTUALLY_UPLOAD = True
         #
 
+        # Uploads are queued in a journal on disk, and run one job at a time
+        # by a single background worker (see start_upload_worker).
+        self.upload_worker_running = False
+        # Job file -> (run_at, block_num), for block uploads not yet finished.
+        # uploaded_block_info is only set once the job has succeeded.
+        self.block_upload_jobs = dict()
+        n_failed = len(u.failed_uploads())
+        if n_failed > 0:
+            warnings.warn(f'{n_failed} uploads failed previously. See '
+                f'{u.upload_queue_dir()}'
+            )
+        if self.ACTUALLY_UPLOAD and len(u.pending_uploads()) > 0:
+            print(f'Resuming {len(u.pending_uploads())} queued uploads')
+            self.start_upload_worker()
+
+
+    def start_upload_worker(self) -> None:
+        """Starts processing queued uploads, if not already doing so.
+        """
+        if self.upload_worker_running:
+            # upload_worker_finished will start another pass over the queue.
+            return
+
+        worker = Worker(u.process_upload_queue)
+        # Called from the worker thread, so only emitting signals.
+        worker.kwargs['progress_callback'] = \
+            lambda n_done, n_total, description: worker.signals.progress.emit(
+                int(round(100 * n_done / n_total))
+            )
+        worker.kwargs['job_callback'] = \
+            lambda job_file, tb: worker.signals.job_done.emit(job_file, tb)
+        worker.signals.progress.connect(self.upload_progress)
+        worker.signals.job_done.connect(self.upload_job_done)
+        worker.signals.result.connect(self.report_upload_failures)
+        worker.signals.error.connect(self.upload_worker_error)
+        worker.signals.finished.connect(self.upload_worker_finished)
+        self.upload_worker_running = True
+        self.upload_worker_errored = False
+        self.threadpool.start(worker)
+
+
+    def upload_progress(self, percent) -> None:
+        print(f'Uploading queued data: {percent}% done', flush=True)
+
+
+    def upload_job_done(self, job_file, tb) -> None:
+        if job_file not in self.block_upload_jobs:
+            return
+
+        run_at, block_num = self.block_upload_jobs.pop(job_file)
+        # Failed jobs stay un-uploaded, so they can be queued again.
+        # (the segmentation run may also have changed since it was queued)
+        if tb is None and run_at == self.run_at:
+            self.uploaded_block_info[block_num] = True
+
+
+    def report_upload_failures(self, failures) -> None:
+        for job_file, tb in failures:
+            print(f'Upload {job_file} failed:\n{tb}', file=sys.stderr)
+
+
+    def upload_worker_error(self, err) -> None:
+        # e.g. if the database can't be reached. Jobs stay queued, and are
+        # retried the next time something is uploaded (or on restart).
+        self.upload_worker_errored = True
+        print('Upload worker failed. Uploads will stay queued.',
+            file=sys.stderr
+        )
+
+
+    def upload_worker_finished(self) -> None:
+        self.upload_worker_running = False
+        # For anything queued while the worker was running.
+        if not self.upload_worker_errored and len(u.pending_uploads()) > 0:
+            self.start_upload_worker()
+
 
     def update_param_tab_index(self, param_tabs) -> None:
         si = self.param_widget_stack.currentIndex()
@@ -1094,10 +1264,11 @@ class Segmentation(QWidget):
         # close?!?
         #fig = plt.figure()
         fig = Figure()
-        for cell_row in self.footprint_df.iterrows():
-            cell = cell_row[0]
+        # Decoded all at once, and only densified one at a time below.
+        cell_footprints = u.db_footprints2sparse(self.footprint_df, frame_shape)
+        for i, cell in enumerate(self.footprint_df.index):
             # TODO this indicate some other problem?
-            footprint = u.db_row2footprint(cell_row[1], shape=frame_shape)
+            footprint = cell_footprints.to_dense(which=[i])[..., 0]
             # Looking at ijroi source code, it seems Y coordinate is first in
             # input / output arrays.
             footprint = u.py2imagej_coords(footprint)
@@ -1218,6 +1389,8 @@ class Segmentation(QWidget):
                     '''.format(pd.Timestamp(ijroi_cnmf_run)),
                     conn, index_col='cell'
                 )
+                orig_cnmf_footprints = \
+                    u.decode_footprint_columns(orig_cnmf_footprints)
                 if len(orig_cnmf_footprints) == 0:
                     warnings.warn(('No footprints found in db for CNMF run {}'
                         ).format(u.format_timestamp(ijroi_cnmf_run))
@@ -1258,7 +1431,7 @@ class Segmentation(QWidget):
         # (mpl code) / use diff code to generate them. no point always storing
         # this extra stuff if cv2 doesn't need it...
 
-        self.footprints = u.ijrois2masks(ijrois, frame_shape)
+        self.footprints = u.ijrois2masks(ijrois, frame_shape, sparse=True)
         if self.orig_cnmf_footprints is not None:
             assert self.footprints.shape == self.orig_cnmf_footprints.shape
 
@@ -1682,7 +1855,8 @@ class Segmentation(QWidget):
         # cnmf code to report progress?
         #worker.signals.progress.connect(self.progress_fn)
 
-        self.parameter_json = self.params.to_json()
+        # Including any patch parameters run_cnmf adds.
+        self.parameter_json = self.cnmf_fit_params().to_json()
         self.ijroi_file_path = None
         self.cnmf_start_seconds = time.time()
         self.run_at = datetime.fromtimestamp(self.cnmf_start_seconds)
@@ -1693,6 +1867,20 @@ class Segmentation(QWidget):
         self.threadpool.start(worker)
 
 
+    def cnmf_fit_params(self):
+        """Returns a copy of self.params, with what run_cnmf changes for the fit.
+        """
+        fit_params = deepcopy(self.params)
+        # Setting these on the copy, so the parameter widgets (and later runs)
+        # still see rf unset.
+        if cnmf_on_memmap and fit_params.get('patch', 'rf') is None:
+            fit_params.set('patch', {
+                'rf': cnmf_patch_rf,
+                'stride': cnmf_patch_stride
+            })
+        return fit_params
+
+
     def run_cnmf(self) -> None:
         print('Running CNMF ({})'.format(u.format_timestamp(self.run_at)),
             flush=True
@@ -1701,25 +1889,39 @@ class Segmentation(QWidget):
         # also probably null any ijroi related instance variables here
         # (more important too, as those may be directly uploaded)
 
-        # TODO use cm.cluster.setup_cluster?
-        # TODO what is the dview that returns as second arg?
-
         # TODO and maybe go further than just using deepcopy, to the extent that
         # deepcopy doesn't fully succeed in returning an object independent of
         # the original
         # Copying the parameters defensively, because CNMF has the bad habit of
         # changing the parameter object internally.
-        self.params_copy = deepcopy(self.params)
+        fit_params = self.cnmf_fit_params()
+        # To check CNMF doesn't change the parameters it was passed.
+        self.params_copy = deepcopy(fit_params)
         # TODO check / test that eq is actually working correctly
-        assert self.params_copy == self.params
+        assert self.params_copy == fit_params
+
+        dview = None
+        if cnmf_on_memmap:
+            # Frames of the TIFF that self.movie covers.
+            mmap_fname = u.cnmf_memmap(self.tiff_fname,
+                start_frame=self.start_frame,
+                stop_frame=(self.start_frame + self.movie.shape[0])
+            )
+            images = u.load_cnmf_memmap(mmap_fname)
+            dview, n_processes = u.start_cnmf_cluster()
+        else:
+            # self.movie is a view of the (integer) TIFF. Only the frames used
+            # are converted.
+            images = np.asarray(self.movie, dtype=np.float32)
+            # TODO i feel like this should be written to not require
+            # n_processes...
+            n_processes = 1
 
-        # TODO i feel like this should be written to not require n_processes...
-        n_processes = 1
-        self.cnm = cnmf.CNMF(n_processes, params=self.params_copy)
+        self.cnm = cnmf.CNMF(n_processes, params=fit_params, dview=dview)
 
         err_if_cnmf_changes_params = False
         if err_if_cnmf_changes_params:
-            assert self.params_copy == self.params, \
+            assert fit_params == self.params_copy, \
                 'CNMF changed params on init'
 
         # TODO what to do in case of memory error? 
@@ -1734,8 +1936,9 @@ class Segmentation(QWidget):
         try:
             # From CNMF docs, about first arg to fit:
             # "images : mapped np.ndarray of shape (t,x,y[,z])"
-            # (thought it doesn't actually need to be a memory mapped file)
-            self.cnm.fit(self.movie,
+            # (thought it doesn't actually need to be a memory mapped file,
+            # unless running on patches w/ multiple processes)
+            self.cnm.fit(images,
                 intermediate_footprints=self.plot_intermediates
             )
 
@@ -1751,6 +1954,8 @@ class Segmentation(QWidget):
 
         finally:
             self.plot_intermediates_btn.setEnabled(True)
+            if dview is not None:
+                caiman.stop_server(dview=dview)
 
         # TODO TODO TODO (actually restrict components to those passing
         # thresholds)
@@ -1802,7 +2007,7 @@ class Segmentation(QWidget):
         # TODO see which parameters are changed?
         # (and is this just a big false negative now?)
         if err_if_cnmf_changes_params:
-            assert self.params_copy == self.params, 'CNMF changed params in fit'
+            assert fit_params == self.params_copy, 'CNMF changed params in fit'
 
         # TODO maybe have a widget that shows the text output from cnmf?
 
@@ -2051,28 +2256,21 @@ class Segmentation(QWidget):
             self.comparison_dfs.append(response_df)
         print(' done', flush=True)
 
-        n_footprints = self.footprints.shape[-1]
         footprint_dfs = []
-        for cell_num in range(n_footprints):
-            # TODO could use tuple of slice objects to accomodate arbitrary dims
-            # here (x,y,Z). change all places like this.
-            sparse = coo_matrix(self.footprints[:,:,cell_num])
+        # (self.footprints can be dense or a u.SparseFootprints)
+        for cell_num, ((x_coords, y_coords), weights) in enumerate(
+            u.iter_footprint_coords(self.footprints)):
+
             footprint_dfs.append(pd.DataFrame({
                 'recording_from': [self.started_at],
                 'segmentation_run': [self.run_at],
                 'cell': [cell_num],
-                # Can be converted from lists of Python types, but apparently
-                # not from numpy arrays or lists of numpy scalar types.
-                # TODO check this doesn't transpose things
-                # TODO just move appropriate casting to my to_sql function,
-                # and allow having numpy arrays (get type info from combination
-                # of that and the database, like in other cases)
-                # TODO TODO TODO TODO was sparse.col for x_* and sparse.row for
-                # y_*. I think this was why I needed to tranpose footprints
-                # sometimes. fix everywhere.
-                'x_coords': [[int(x) for x in sparse.row.astype('int16')]],
-                'y_coords': [[int(x) for x in sparse.col.astype('int16')]],
-                'weights': [[float(x) for x in sparse.data.astype('float32')]]
+                # Packed as int16 coords + float32 weights, or run length
+                # encoded for boolean masks (e.g. from ImageJ ROIs). The old
+                # x_coords, y_coords and weights columns are no longer filled.
+                'footprint': [u.encode_footprint(x_coords, y_coords,
+                    weights=(None if weights.dtype == np.bool_ else weights)
+                )]
             }))
         self.footprint_df = pd.concat(footprint_dfs, ignore_index=True)
 
@@ -2622,7 +2820,7 @@ class Segmentation(QWidget):
             # TODO TODO write a dict pointing to this, to also include PID
             # information in another variable?? or at least stuff to index
             # the PID information?
-            comparison_df.to_pickle(df_filename)
+            u.write_trace_pickle(comparison_df, df_filename)
             print(' done', flush=True)
 
             # TODO TODO add column mapping odors to order -> sort (index) on
@@ -2942,32 +3140,27 @@ class Segmentation(QWidget):
         run = pd.DataFrame(run_info)
         run.set_index('run_at', inplace=True)
 
+        # Everything is uploaded in the background, in one transaction, by
+        # the upload queue (see start_upload_worker).
         # TODO depending on what table is in method callable, may need to make
         # pd index match sql pk?
         # TODO test that result is same w/ or w/o method in case where row did
         # not exist, and that read shows insert worked in w/ method case
-        if self.ACTUALLY_UPLOAD:
-            run.to_sql('analysis_runs', conn, if_exists='append',
-                method=u.pg_upsert
-            )
+        upload_steps = [('upsert', run, 'analysis_runs')]
 
         # TODO worth preventing (attempts to) insert code versions and
         # pairings with analysis_runs, or is that premature optimization?
 
-        # TODO nr_code_versions, rig_code_versions (both lists of dicts)
         # TODO ti_code_version (dict)
-        if self.tiff_fname.endswith('_nr.tif'):
-            mocorr_version_varname = 'nr_code_versions'
-        elif self.tiff_fname.endswith('_rig.tif'):
-            mocorr_version_varname = 'rig_code_versions'
-        else:
+        if not (self.tiff_fname.endswith('_nr.tif') or
+            self.tiff_fname.endswith('_rig.tif')):
             raise NotImplementedError
 
         # TODO TODO TODO if i'm gonna require this variable, check for it
         # in open_recording, so there are no surprises
         ti_code_version = u.get_matfile_var(self.matfile, 'ti_code_version')
-        mocorr_code_versions = u.get_matfile_var(self.matfile,
-            mocorr_version_varname, require=False
+        mocorr_code_versions = u.mocorr_code_versions(self.tiff_fname,
+            matfile=self.matfile
         )
         code_versions = [this_code_version]
         if self.parameter_json is not None:
@@ -2979,15 +3172,7 @@ class Segmentation(QWidget):
         )
         # TODO maybe impute missing mocorr version in some cases?
 
-        if self.ACTUALLY_UPLOAD:
-            u.upload_analysis_info(self.run_at, code_versions)
-
-        # TODO TODO zoom to a constant factor (+ redraw) before saving, since
-        # the zoom seems to change the way the figure looks?
-        png_buff = BytesIO()
-        self.fig.savefig(png_buff, format='png')
-        svg_buff = BytesIO()
-        self.fig.savefig(svg_buff, format='svg')
+        upload_steps.append(('analysis_info', self.run_at, code_versions))
 
         # I haven't yet figured out how to deserialize these in regular
         # interactive pyplot, but one test case did work in the same kind of Qt
@@ -2995,33 +3180,27 @@ class Segmentation(QWidget):
         fig_buff = BytesIO()
         pickle.dump(self.fig, fig_buff)
 
-        # TODO delete. for debugging.
-        '''
-        print('png_buff nbytes:', png_buff.getbuffer().nbytes)
-        print('svg_buff nbytes:', svg_buff.getbuffer().nbytes)
-        print('fig_buff nbytes:', fig_buff.getbuffer().nbytes)
-        print('png_buff sizeof:', sys.getsizeof(png_buff))
-        print('svg_buff sizeof:', sys.getsizeof(svg_buff))
-        print('fig_buff sizeof:', sys.getsizeof(fig_buff))
-        '''
-        #
-
-        # TODO TODO failed a few times on this insert, possibly b/c fig size
-        # try inserting one at a time? fallback to saving to nas and including
-        # filepath in another column?
+        # TODO TODO zoom to a constant factor (+ redraw) before saving, since
+        # the zoom seems to change the way the figure looks?
+        # Rendered here, rather than in the upload worker, since matplotlib
+        # is not thread-safe.
+        png_buff = BytesIO()
+        self.fig.savefig(png_buff, format='png')
+        svg_buff = BytesIO()
+        self.fig.savefig(svg_buff, format='svg')
+        upload_steps.append(('segmentation_run', self.run_at,
+            fig_buff.getvalue(), png_buff.getvalue(), svg_buff.getvalue(),
+            self.run_len_seconds
+        ))
 
         segmentation_run = pd.DataFrame({
             'run_at': [self.run_at],
-            'output_fig_png': png_buff.getvalue(),
-            'output_fig_svg': svg_buff.getvalue(),
             'output_fig_mpl': fig_buff.getvalue(),
             'run_len_seconds': self.run_len_seconds
         })
-        segmentation_run.set_index('run_at', inplace=True)
 
         # TODO are the reset_index calls necessary?
-        segrun_row = segmentation_run.reset_index().merge(
-            run.reset_index()).iloc[0]
+        segrun_row = segmentation_run.merge(run.reset_index()).iloc[0]
         segrun_row['blocks_accepted'] = [None] * self.n_blocks
         # TODO TODO should i also be setting self.accepted and
         # self.to_be_accepted to the same thing?
@@ -3029,10 +3208,6 @@ class Segmentation(QWidget):
         self.current_segrun_widget = self.add_segrun_widget(
             self.current_recording_widget, segrun_row)
 
-        if self.ACTUALLY_UPLOAD:
-            segmentation_run.to_sql('segmentation_runs', conn,
-                if_exists='append', method=u.pg_upsert)
-
         # TODO unless i change db to have a canonical analysis version per
         # blocks/trials, probably want to check analysis version to be set
         # canonical has at least all the same blocks accepted as the previous
@@ -3047,8 +3222,16 @@ class Segmentation(QWidget):
 
         # TODO filter out footprints less than a certain # of pixels in cnmf?
         # (is 3 pixels really reasonable?)
+        upload_steps.append(('to_sql_with_duplicates', self.footprint_df,
+            'cells'
+        ))
+
         if self.ACTUALLY_UPLOAD:
-            u.to_sql_with_duplicates(self.footprint_df, 'cells')
+            u.enqueue_upload(upload_steps, description=(
+                f'{self.recording_title} segmentation run '
+                f'{u.format_timestamp(self.run_at)}'
+            ))
+            self.start_upload_worker()
 
         self.uploaded_common_segrun_info = True
 
@@ -3114,6 +3297,10 @@ class Segmentation(QWidget):
         if self.uploaded_block_info[block_num]:
             return
 
+        if (self.run_at, block_num) in self.block_upload_jobs.values():
+            # Already queued. uploaded_block_info is set once it's done.
+            return
+
         key_cols = [
             'prep_date',
             'fly_num',
@@ -3135,36 +3322,26 @@ class Segmentation(QWidget):
                 (self.presentations_per_block * (block_num + 1))
             ]
 
-            for presentation_df, comparison_df in zip(
-                presentation_dfs, comparison_dfs):
-
-                u.to_sql_with_duplicates(presentation_df.drop(
-                    columns='temp_presentation_id'), 'presentations')
-
-                db_presentations = pd.read_sql('presentations', conn,
-                    columns=(key_cols + ['presentation_id'])
-                )
-
-                presentation_ids = (db_presentations[key_cols] ==
-                    presentation_df[key_cols].iloc[0]).all(axis=1)
-
-                assert presentation_ids.sum() == 1, \
-                    'presentation_id could not be determined uniquely'
-
-                presentation_id = db_presentations.loc[presentation_ids,
-                    'presentation_id'].iat[0]
-
-                comparison_df['presentation_id'] = presentation_id
-
-                # TODO TODO fix this bug (see first bug txt file on 5/20)
-                # sqlalchemy.exc.ProgrammingError: (psycopg2.ProgrammingError)
-                # table "temp_responses" does not exist
-                # SQL: DROP TABLE temp_responses
-                u.to_sql_with_duplicates(comparison_df.drop(
-                    columns='temp_presentation_id'), 'responses'
-                )
-
-        self.uploaded_block_info[block_num] = True
+            # TODO TODO fix this bug (see first bug txt file on 5/20)
+            # sqlalchemy.exc.ProgrammingError: (psycopg2.ProgrammingError)
+            # table "temp_responses" does not exist
+            # SQL: DROP TABLE temp_responses
+            # (may have been from concurrent uploads sharing temp tables, which
+            # the single upload worker should prevent)
+            upload_steps = [('presentation_responses',
+                presentation_df.drop(columns='temp_presentation_id'),
+                comparison_df.drop(columns='temp_presentation_id'), key_cols
+                ) for presentation_df, comparison_df in zip(presentation_dfs,
+                comparison_dfs)
+            ]
+            job_file = u.enqueue_upload(upload_steps, description=(
+                f'{self.recording_title} block {block_num} '
+                f'({u.format_timestamp(self.run_at)})'
+            ))
+            self.block_upload_jobs[job_file] = (self.run_at, block_num)
+            self.start_upload_worker()
+        else:
+            self.uploaded_block_info[block_num] = True
 
 
     # TODO maybe make all block / upload buttons gray until current upload
@@ -3521,6 +3698,7 @@ class Segmentation(QWidget):
             WHERE segmentation_run = '{}' '''.format(pd.Timestamp(self.run_at)),
             conn, index_col='cell'
         )
+        self.footprint_df = u.decode_footprint_columns(self.footprint_df)
         assert len(self.footprint_df) > 0
 
         self.accepted = u.accepted_blocks(self.run_at)
@@ -3621,6 +3799,53 @@ class Segmentation(QWidget):
     # TODO TODO TODO load last edited movie as soon as gui finishes loading
     # (or at least have a setting that can enable this)
     # TODO TODO TODO factor out the core of this fn to util
+    def prefetch_recordings(self, idx):
+        """Loads recordings before / after `idx` in the background.
+        """
+        if recording_prefetch_mb <= 0:
+            return
+
+        for i in (idx + 1, idx - 1):
+            if not (0 <= i < len(self.motion_corrected_tifs)):
+                continue
+
+            tiff = self.motion_corrected_tifs[i]
+            if tiff in self.recording_cache or tiff in self.prefetching:
+                continue
+
+            available = available_memory_fraction()
+            if (available is not None and
+                available < prefetch_min_available_memory):
+
+                print('Low on memory. Clearing prefetched recordings.')
+                self.recording_cache.clear()
+                return
+
+            worker = Worker(load_recording_preview, tiff)
+            worker.signals.result.connect(self.store_prefetched_recording)
+            # Recordings that fail to prefetch stay in self.prefetching, so
+            # they are not retried (until opened, which loads them directly).
+            self.prefetching.add(tiff)
+            self.threadpool.start(worker)
+
+
+    def store_prefetched_recording(self, preview):
+        self.recording_cache[preview['tiff']] = preview
+        self.prefetching.discard(preview['tiff'])
+
+
+    def recording_preview(self, tiff):
+        """Returns output of `load_recording_preview`, from cache if possible.
+        """
+        preview = self.recording_cache.get(tiff)
+        if preview is None or preview['tiff_mtime'] != getmtime(tiff):
+            # TODO maybe wait on a prefetch of this tiff already in progress,
+            # rather than loading it twice?
+            preview = load_recording_preview(tiff)
+            self.recording_cache[tiff] = preview
+        return preview
+
+
     def open_recording(self, recording_widget):
         # TODO TODO fix bug where block label btns stay labelled as in last
         # segrun that was open (seen after opening a recording but not analyzing
@@ -3630,7 +3855,6 @@ class Segmentation(QWidget):
         # TODO maybe use setData and data instead?
         idx = self.data_tree.indexOfTopLevelItem(recording_widget)
         tiff = self.motion_corrected_tifs[idx]
-        del idx
         # TODO TODO still want to switch view back to movie view in this case
         # (the avg trace and all). i think it's returning prematurely...
         if self.tiff_fname == tiff:
@@ -3776,10 +4000,18 @@ class Segmentation(QWidget):
         self.start_frame = drop_first_n_frames
         self.stop_frame = None
 
+        # Cached if this recording was prefetched.
+        preview = self.recording_preview(tiff)
         # TODO generalize to 3d+t case?
-        self.avg = np.mean(self.movie, axis=0)
+        self.movie, self.avg, self.full_frame_avg_trace = \
+            preview_frame_range(preview, self.start_frame, self.stop_frame)
+        del preview
         self.tiff_fname = tiff
 
+        # Only once this recording has actually opened, so recordings are not
+        # prefetched around ones that fail to load.
+        self.prefetch_recordings(self.motion_corrected_tifs.index(tiff))
+
         self.data_params = u.cnmf_metadata_from_thor(tiff)
 
         # TODO try to get rid of these here? (s.t. only made at end of cnmf run)
@@ -3832,7 +4064,7 @@ class Segmentation(QWidget):
         to_type.max * (self.movie / from_type.max)
         '''
 
-        self.plot_avg_trace()
+        self.plot_avg_trace(recalc_trace=False)
 
         # TODO maybe allow playing movie somewhere in display widget?
         self.run_cnmf_btn.setEnabled(True)
@@ -4008,10 +4240,8 @@ class ROIAnnotation(QWidget):
         # TODO move loading to some other process? QRunnable? progress bar?
         # TODO if not just going to load just comparison, keep movie loaded if
         # clicking other comparisons / until run out of memory
-        # TODO just load part of movie for this comparison
-        print('Loading TIFF {}...'.format(tiff), end='', flush=True)
-        self.movie = tifffile.imread(tiff)
-        print(' done')
+        # Only the frames used below are actually read.
+        self.movie = u.memmap_tiff(tiff)
 
         # Assumes all data between these frames is part of this comparison.
         self.first_frame = self.metadata.odor_onset_frame.min()
@@ -4036,25 +4266,29 @@ class ROIAnnotation(QWidget):
         self.background_frames = int(np.floor(fps * np.abs(
             self.metadata.from_onset.apply(lambda x: x.min()).min())))
 
-        self.full_footprints = dict()
-        for cell, data in footprint_rows[['cell','x_coords','y_coords','weights'
-            ]].set_index('cell').iterrows():
-            x_coords, y_coords, weights = data
-
-            # TODO do i have some util fn that can accomplish this now?
-            # TODO TODO TODO get this shape from thor metadata
-            # TODO allow x and y diff?
-            max_bound = 256
-            footprint = np.array(coo_matrix((weights, (x_coords, y_coords)),
-                shape=(max_bound, max_bound)).todense())
-
-            self.full_footprints[cell] = footprint
+        # TODO TODO TODO get this shape from thor metadata
+        # TODO allow x and y diff?
+        max_bound = 256
+        cell_footprints = u.db_footprints2sparse(footprint_rows,
+            (max_bound, max_bound), transpose=False
+        )
+        self.full_footprints = dict(zip(cell_footprints.names,
+            np.moveaxis(cell_footprints.to_dense(), -1, 0)
+        ))
 
-        # TODO maybe put in some spatial structure to make range searches easier
-        # first? i.e. bounding box overlap as at least a necessary condition for
-        # roi overlap?
         # (could also save space on empty parts of matrices... how serious is
         # space consumption?)
+        self.footprint_index = u.FootprintBBoxIndex(self.full_footprints)
+
+        # Computed once per comparison, so selecting a cell only needs to crop
+        # these.
+        self.trial_rows = self.metadata.sort_values('odor_onset_frame')
+        print('Computing trial dF/F images...', end='', flush=True)
+        self.trial_dff_stack = u.trial_dff_images(self.movie,
+            self.trial_rows.odor_onset_frame.values, self.background_frames,
+            self.response_frames
+        )
+        print(' done')
 
 
     def annotate_cell_comp(self):
@@ -4076,38 +4310,15 @@ class ROIAnnotation(QWidget):
         cropped_footprint, ((x_min, x_max), (y_min, y_max)) = \
             u.crop_to_nonzero(footprint, margin=6)
 
-        near_footprints = dict()
-        for c, f in self.full_footprints.items():
-            if c == cell_id:
-                continue
-
-            # TODO maybe it should overlap by at least a certain number of
-            # pixels? (i.e. pull back bounding box a little)
-            in_display_region = f[x_min:x_max+1, y_min:y_max+1]
-            if (in_display_region > 0).any():
-                near_footprints[c] = in_display_region
+        # TODO maybe it should overlap by at least a certain number of
+        # pixels? (i.e. pull back bounding box a little)
+        near_footprints = self.footprint_index.overlapping(x_min, x_max, y_min,
+            y_max, exclude=cell_id
+        )
 
         mpl_contour = None
-        for ax, row in zip(self.axes.flat,
-            self.metadata.sort_values('odor_onset_frame').itertuples()):
-
-            odor_onset_frame = row.odor_onset_frame
-            odor_offset_frame = row.odor_offset_frame
-            curr_start_frame = odor_onset_frame - self.background_frames
-            curr_stop_frame = odor_onset_frame + self.response_frames
-
-            # TODO off by one?
-            trial_background = self.movie[
-                curr_start_frame:odor_onset_frame, x_min:x_max + 1,
-                y_min:y_max + 1].mean(axis=0)
-
-            # TODO divide by zero issues? how to avoid? suppress
-            # warning if turn to NaN OK?
-            # TODO TODO this order of operations is fine b/c
-            # linearity of expectation, right?
-            trial_dff = (self.movie[odor_onset_frame:curr_stop_frame,
-                x_min:x_max + 1, y_min:y_max + 1].mean(axis=0)
-                - trial_background) / trial_background
+        for ax, trial_dff in zip(self.axes.flat,
+            self.trial_dff_stack[:, x_min:x_max + 1, y_min:y_max + 1]):
 
             # TODO maybe just set_data? and delete / clear contour artist?
             ax.clear()
@@ -4150,8 +4361,11 @@ class ROIAnnotation(QWidget):
 
         # TODO TODO TODO downsample!!! (or do w/ pg? seems it supports it?)
 
-        self.imv.setImage(self.movie[self.first_frame:self.last_frame + 1,
-            x_min:x_max + 1, y_min:y_max + 1])
+        # Only the displayed part of the (memory mapped) movie is converted.
+        self.imv.setImage(np.asarray(self.movie[
+            self.first_frame:self.last_frame + 1, x_min:x_max + 1,
+            y_min:y_max + 1], dtype=np.float32
+        ))
 
         # TODO TODO how to keep roi on top, prevent it from being modified, and
         # clear them before next drawing?
@@ -4454,7 +4668,7 @@ def main():
     ]
     recordings_meta = presentations[rec_meta_cols].drop_duplicates()
 
-    footprints = pd.read_sql('cells', conn)
+    footprints = u.decode_footprint_columns(pd.read_sql('cells', conn))
     footprints = footprints.merge(recordings_meta, on='recording_from')
     footprints.set_index(u.recording_cols, inplace=True)
 
@@ -19,7 +19,12 @@ from pprint import pprint
 import glob
 import re
 import hashlib
+import json
 import time
+import threading
+import contextlib
+import functools
+import struct
 # TODO delete if custom Unpickler doesn't work
 import io
 
@@ -118,6 +123,52 @@ def get_db_conn():
         return conn
 
 
+# Set (per-thread) within `db_transaction`.
+_thread_db = threading.local()
+
+def current_db_conn():
+    """Returns connection of enclosing `db_transaction`, else global engine.
+
+    Only the upload functions (`to_sql_with_duplicates`, `upload_analysis_info`,
+    etc) use this, so they can be grouped into one transaction.
+    """
+    connection = getattr(_thread_db, 'connection', None)
+    if connection is not None:
+        return connection
+    return get_db_conn()
+
+
+@contextlib.contextmanager
+def db_transaction(connection=None):
+    """Runs upload functions called (in this thread) within in one transaction.
+
+    Commits if the block finishes without error, otherwise rolls back.
+    Uses `connection` if passed, otherwise a new connection from the engine.
+    """
+    if getattr(_thread_db, 'connection', None) is not None:
+        raise RuntimeError('db_transaction can not be nested')
+
+    close = connection is None
+    if close:
+        connection = get_db_conn().connect()
+    try:
+        with connection.begin():
+            _thread_db.connection = connection
+            try:
+                yield connection
+            except BaseException:
+                # Cached IDs may be of rows inserted in this transaction, which
+                # are rolled back.
+                _code_version_ids.clear()
+                invalidate_lookup_cache()
+                raise
+            finally:
+                _thread_db.connection = None
+    finally:
+        if close:
+            connection.close()
+
+
 # was too much trouble upgrading my python 3.6 caiman conda env to 3.7
 '''
 # This is a Python >=3.7 feature only.
@@ -194,6 +245,399 @@ def stimfile_root():
     return join(data_root(), 'stimulus_data_files')
 
 
+# Module level cache.
+_cache_root = None
+def cache_root():
+    """
+    Returns a local directory for caches of derived data, creating it if needed.
+
+    Set the HONG_2P_CACHE environment variable to override the default of
+    ~/.cache/hong2p. Unlike `data_root`, this should be on a local disk.
+    """
+    global _cache_root
+    if _cache_root is None:
+        cache_root_key = 'HONG_2P_CACHE'
+        if cache_root_key in os.environ:
+            _cache_root = os.environ[cache_root_key]
+        else:
+            _cache_root = join(os.path.expanduser('~'), '.cache', 'hong2p')
+
+        os.makedirs(_cache_root, exist_ok=True)
+
+    return _cache_root
+
+
+def offline():
+    """
+    Returns True if the HONG_2P_OFFLINE environment variable is set to a
+    non-empty value other than '0'.
+
+    Code that would otherwise need network access should serve from local
+    caches in this case, and fail if there is nothing cached.
+    """
+    return os.getenv('HONG_2P_OFFLINE', '0') not in ('', '0')
+
+
+# Set HONG_2P_PROFILE to a non-empty value other than '0' to enable recording
+# of stage timing (see `instrumented`). If HONG_2P_PROFILE_LOG is also set, the
+# records are written there (.json or .csv) at exit, after a summary is printed.
+_instrumentation_enabled = os.getenv('HONG_2P_PROFILE', '0') not in ('', '0')
+_stage_records = []
+_stage_records_lock = threading.Lock()
+_instrumented_recording = threading.local()
+
+def _clear_stage_records_in_child():
+    # So forked workers (e.g. of a multiprocessing.Pool) only report their own
+    # stages, rather than also returning copies of the parent's records.
+    global _stage_records_lock
+    _stage_records_lock = threading.Lock()
+    _stage_records.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_clear_stage_records_in_child)
+
+
+def enable_instrumentation(enabled=True):
+    global _instrumentation_enabled
+    _instrumentation_enabled = enabled
+
+
+def instrumentation_enabled():
+    return _instrumentation_enabled
+
+
+def _bytes_read_so_far():
+    """
+    Returns bytes this process has read via read syscalls (including from the
+    page cache), or None if not available (non-Linux).
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    if sys.platform == 'darwin':
+        return peak / 1024**2
+    return peak / 1024
+
+
+@contextlib.contextmanager
+def instrumented_recording(recording):
+    """
+    Within this context (in this thread), stages are recorded as part of
+    `recording` (e.g. the output of `format_keys` or a TIFF path), unless they
+    specify one themselves.
+    """
+    prev = getattr(_instrumented_recording, 'value', None)
+    _instrumented_recording.value = recording
+    try:
+        yield
+    finally:
+        _instrumented_recording.value = prev
+
+
+@contextlib.contextmanager
+def stage(name, recording=None):
+    """
+    Records wall time, bytes read and (process) peak RSS for the enclosed code,
+    under stage `name`. Does nothing unless instrumentation is enabled.
+
+    Nested stages are each recorded, so their times are not exclusive.
+    """
+    if not _instrumentation_enabled:
+        yield
+        return
+
+    if recording is None:
+        recording = getattr(_instrumented_recording, 'value', None)
+
+    bytes_before = _bytes_read_so_far()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_s = time.perf_counter() - start
+        bytes_after = _bytes_read_so_far()
+        record = {
+            'stage': name,
+            'recording': None if recording is None else str(recording),
+            'pid': os.getpid(),
+            'wall_s': wall_s,
+            'bytes_read': (None if bytes_before is None else
+                bytes_after - bytes_before
+            ),
+            'peak_rss_mb': _peak_rss_mb()
+        }
+        with _stage_records_lock:
+            _stage_records.append(record)
+
+
+def instrumented(stage_name, recording_arg=None):
+    """
+    Decorator to record each call of the function as stage `stage_name`.
+
+    If `recording_arg` is the name of an argument, its value is used to label
+    the recording, for this stage and any nested in it. When instrumentation is
+    disabled, the only overhead is one global flag check per call.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _instrumentation_enabled:
+                return fn(*args, **kwargs)
+
+            recording = None
+            if recording_arg is not None:
+                if recording_arg in kwargs:
+                    recording = kwargs[recording_arg]
+                else:
+                    # Assuming positional parameters are not keyword-only.
+                    names = fn.__code__.co_varnames[:fn.__code__.co_argcount]
+                    if recording_arg in names:
+                        i = names.index(recording_arg)
+                        if i < len(args):
+                            recording = args[i]
+
+            if recording is None:
+                with stage(stage_name):
+                    return fn(*args, **kwargs)
+
+            # So stages nested in this call are labelled with the same
+            # recording.
+            with instrumented_recording(recording), stage(stage_name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def stage_records(clear=False):
+    """Returns a DataFrame with one row per recorded stage.
+    """
+    with _stage_records_lock:
+        df = pd.DataFrame(_stage_records, columns=['stage', 'recording', 'pid',
+            'wall_s', 'bytes_read', 'peak_rss_mb'
+        ])
+        if clear:
+            _stage_records.clear()
+    return df
+
+
+def add_stage_records(records):
+    """
+    Adds records (e.g. `stage_records()` output sent back from worker
+    processes) to those of this process.
+    """
+    if isinstance(records, pd.DataFrame):
+        records = records.to_dict('records')
+
+    with _stage_records_lock:
+        _stage_records.extend(records)
+
+
+def stage_summary(records=None):
+    """
+    Returns a DataFrame summarizing time, bytes read, and peak RSS within each
+    stage, sorted by total time.
+    """
+    if records is None:
+        records = stage_records()
+
+    if len(records) == 0:
+        return pd.DataFrame()
+
+    summary = records.groupby('stage').agg(
+        n_calls=('wall_s', 'size'),
+        n_recordings=('recording', 'nunique'),
+        total_s=('wall_s', 'sum'),
+        mean_s=('wall_s', 'mean'),
+        max_s=('wall_s', 'max'),
+        mb_read=('bytes_read', lambda x: x.sum(min_count=1) / 1024**2),
+        max_peak_rss_mb=('peak_rss_mb', 'max')
+    ).sort_values('total_s', ascending=False)
+    return summary
+
+
+def print_stage_summary(records=None):
+    summary = stage_summary(records)
+    if len(summary) == 0:
+        return
+
+    print('Time spent in instrumented stages (nested stages overlap):')
+    print(summary.to_string(float_format='%.2f'))
+
+
+def write_stage_log(path, records=None):
+    """Writes stage records to `path`, as CSV or JSON, depending on extension.
+    """
+    if records is None:
+        records = stage_records()
+
+    if path.endswith('.csv'):
+        records.to_csv(path, index=False)
+    elif path.endswith('.json'):
+        records.to_json(path, orient='records', indent=2)
+    else:
+        raise ValueError('stage log path must end with .csv or .json')
+
+
+def _report_stages_at_exit():
+    if not _instrumentation_enabled:
+        return
+
+    print_stage_summary()
+    log_path = os.getenv('HONG_2P_PROFILE_LOG')
+    if log_path:
+        write_stage_log(log_path)
+        print(f'Wrote stage timing log to {log_path}')
+
+atexit.register(_report_stages_at_exit)
+
+
+def approx_nbytes(obj):
+    """Returns approximate memory (in bytes) used by `obj`.
+
+    Shallow for DataFrames / Series (object column contents not counted), and
+    sums over the elements of tuples, lists and dicts. Memory mapped arrays
+    count as 0, since their pages can be dropped by the OS.
+    """
+    if isinstance(obj, np.memmap):
+        return 0
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        nbytes = obj.memory_usage(index=True, deep=False)
+        return int(nbytes.sum() if isinstance(obj, pd.DataFrame) else nbytes)
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, (tuple, list)):
+        return sum(approx_nbytes(x) for x in obj)
+    elif isinstance(obj, dict):
+        return sum(approx_nbytes(x) for x in obj.values())
+    elif obj is None:
+        return 0
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """Dict-like cache, evicting least recently used items over a size limit.
+
+    Items are evicted once their total size (from `sizeof`, `approx_nbytes` by
+    default) exceeds `max_bytes`, or there are more than `max_items` of them.
+    Either limit can be None. Counts hits, misses and evictions (see `stats`).
+    """
+    def __init__(self, max_bytes=None, max_items=None, sizeof=None,
+        name='cache'):
+
+        from collections import OrderedDict
+
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.sizeof = approx_nbytes if sizeof is None else sizeof
+        self.name = name
+
+        self._data = OrderedDict()
+        self._sizes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # Does not count as a hit / miss, or change recency.
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._sizes.pop(key)
+                del self._data[key]
+
+            self._data[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+
+            # Always keeping the newest item, even if it alone is over limit.
+            while len(self._data) > 1 and (
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)
+                or (self.max_items is not None and
+                len(self._data) > self.max_items)):
+
+                old_key, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+            self.nbytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Returns dict with hits, misses, evictions, items and nbytes.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'items': len(self._data),
+            'nbytes': self.nbytes
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def report(self, stats=None):
+        """Prints `stats` (this cache's `stats()` by default).
+        """
+        s = self.stats() if stats is None else stats
+        print(f'{self.name}: {s["hits"]} hits, {s["misses"]} misses, '
+            f'{s["evictions"]} evictions ({s["items"]} items, '
+            f'{s["nbytes"] / 2**20:.1f} MiB)'
+        )
+
+
 def format_date(date):
     """
     Takes a pandas Timestamp or something that can be used to construct one
@@ -343,6 +787,7 @@ def is_array_sorted(array):
 
 
 # TODO maybe just wrap get_matfile_var?
+@instrumented('timing_info_load', recording_arg='mat_file')
 def load_mat_timing_info(mat_file, use_matlab_engine=None):
     """Loads and returns timing information from .mat output of Remy's script.
 
@@ -357,14 +802,16 @@ def load_mat_timing_info(mat_file, use_matlab_engine=None):
     - 'odor_onset_frames'
     - 'odor_offset_frames'
 
-    All `*_frames` variables use 0 to refer to the first frame, and so on from
-    there.
+    If the file also has the ThorSync sample indices of the odor valve edges
+    (`stim_ic_idx` / `stim_fc_idx`), they are returned too, as
+    'odor_onset_samples' / 'odor_offset_samples'.
+
+    All `*_frames` (and `*_samples`) variables use 0 to refer to the first
+    frame (sample), and so on from there.
 
     Raises `AssertionError` if the data seems inconsistent with itself.
     Raises `matlab.engine.MatlabExecutionError` when MATLAB engine calls do.
     """
-    from scipy import stats
-
     if use_matlab_engine is None:
         use_matlab_engine = not NO_MATLAB_ENGINE
 
@@ -402,19 +849,29 @@ def load_mat_timing_info(mat_file, use_matlab_engine=None):
     else:
         from scipy.io import loadmat
 
-        data = loadmat(mat_file, variable_names=['ti'])['ti']
-        # TODO check this is all still necessary w/ all combinations of loadmat
-        # args + latest version
-        varnames = data.dtype.names
-        assert data.shape == (1, 1)
-        assert data[0].shape == (1,)
-        vardata = data[0][0]
-        assert len(varnames) == len(vardata)
-        # TODO is it even guaranteed that order of names is same as this
-        # order? do some sanity checks (at least) until i can get an answer on
-        # this... (inspection of one example in ipdb seemed to have everything
-        # in order though)
-        ti = {n: d for n, d in zip(varnames, vardata)}
+        try:
+            data = loadmat(mat_file, variable_names=['ti'])['ti']
+
+        # v7.3 (HDF5) .mat files, which `save_timing_info_mat` can also write
+        # `ti` to.
+        except NotImplementedError:
+            import h5py
+            with h5py.File(mat_file, 'r') as f:
+                # (transposed because MATLAB arrays are column-major)
+                ti = {n: d[()].T for n, d in f['ti'].items()}
+        else:
+            # TODO check this is all still necessary w/ all combinations of
+            # loadmat args + latest version
+            varnames = data.dtype.names
+            assert data.shape == (1, 1)
+            assert data[0].shape == (1,)
+            vardata = data[0][0]
+            assert len(varnames) == len(vardata)
+            # TODO is it even guaranteed that order of names is same as this
+            # order? do some sanity checks (at least) until i can get an answer
+            # on this... (inspection of one example in ipdb seemed to have
+            # everything in order though)
+            ti = {n: d for n, d in zip(varnames, vardata)}
 
     # TODO check on first element? subtract first element so it starts at t=0.0?
     frame_times = ti['frame_times'].astype('float64').flatten()
@@ -446,8 +903,42 @@ def load_mat_timing_info(mat_file, use_matlab_engine=None):
     odor_onset_frames = ti['stim_on'].astype(np.uint32).flatten() - 1
     odor_offset_frames = ti['stim_off'].astype(np.uint32).flatten() - 1
 
+    # Older outputs don't have these.
+    valve_samples = dict()
+    if 'stim_ic_idx' in ti:
+        valve_samples['odor_onset_samples'] = \
+            ti['stim_ic_idx'].astype(np.int64).flatten() - 1
+        valve_samples['odor_offset_samples'] = \
+            ti['stim_fc_idx'].astype(np.int64).flatten() - 1
+
     # TODO maybe warn if there are keys in `ti` that will not be returned? opt?
 
+    ti = {
+        'frame_times': frame_times,
+        'block_first_frames': block_first_frames,
+        'block_last_frames': block_last_frames,
+        'odor_onset_frames': odor_onset_frames,
+        'odor_offset_frames': odor_offset_frames,
+    }
+    ti.update(valve_samples)
+    check_timing_info(ti)
+    return ti
+
+
+def check_timing_info(ti):
+    """Raises `AssertionError` if timing info seems inconsistent with itself.
+
+    `ti` should be a dict as returned by `load_mat_timing_info` or
+    `thorsync_timing_info`.
+    """
+    from scipy import stats
+
+    frame_times = ti['frame_times']
+    block_first_frames = ti['block_first_frames']
+    block_last_frames = ti['block_last_frames']
+    odor_onset_frames = ti['odor_onset_frames']
+    odor_offset_frames = ti['odor_offset_frames']
+
     assert len(block_first_frames) == len(block_last_frames)
     assert len(odor_onset_frames) == len(odor_offset_frames)
 
@@ -505,14 +996,6 @@ def load_mat_timing_info(mat_file, use_matlab_engine=None):
         assert np.allclose(dts, mode, rtol=3e-3), \
             'block first/last frames likely wrong'
 
-    return {
-        'frame_times': frame_times,
-        'block_first_frames': block_first_frames,
-        'block_last_frames': block_last_frames,
-        'odor_onset_frames': odor_onset_frames,
-        'odor_offset_frames': odor_offset_frames,
-    }
-
 
 # TODO use in unit test on a representative subset of my data so far
 # (comparing matlab engine and scipy.io.loadmat ways to load the data)
@@ -526,130 +1009,720 @@ def _check_timing_info_equal(ti0, ti1):
         assert np.array_equal(ti0[k], ti1[k])
 
 
-def check_movie_timing_info(movie, frame_times, block_first_frames,
-    block_last_frames):
-    """Checks that `movie` and `ti` refer to the same number of frames.
+# ThorSync's 'Global/GCtr' sample counter counts ticks of this clock.
+thorsync_clock_hz = 20e6
+# Number of samples (per channel) read from the ThorSync HDF5 at once.
+thorsync_chunk_size = int(os.environ.get('HONG_2P_THORSYNC_CHUNK_SIZE',
+    2**22
+))
+# Line names vary somewhat across acquisitions (e.g. 'FrameOut' vs
+# 'Frame Out'), so they are compared after `_normalize_thorsync_name`.
+thorsync_frame_channel = 'frame_out'
+thorsync_scope_channel = 'scope_pin'
+thorsync_odor_channel = 'olf_disp_pin'
+# Volts. Digital / counter lines are considered high if > 0.
+thorsync_analog_threshold = 2.5
 
-    Raises `AssertionError` if the check fails.
+
+def get_thorsync_h5(thorsync_dir):
+    """Returns path to the single HDF5 file in a ThorSync output directory.
     """
-    total_block_frames = sum([e - s + 1 for s, e in
-        zip(block_first_frames, block_last_frames)
-    ])
-    n_frames = movie.shape[0]
-    # TODO may need to replace this with a warning (at least optionally), given
-    # comment in gui.py that did so because failure (described in cthulhu:190520
-    # bug text file)
-    assert len(frame_times) == n_frames
-    # TODO may need to remove this assert to handle cases where there is a
-    # partial block (stopped early). leave assert after slicing tho.
-    # (warn instead, probably)
-    assert total_block_frames == n_frames, \
-        '{} != {}'.format(total_block_frames, n_frames)
+    h5_files = glob.glob(join(thorsync_dir, '*.h5'))
+    if len(h5_files) == 0:
+        raise IOError(f'no .h5 file in ThorSync directory {thorsync_dir}')
+    assert len(h5_files) == 1, f'multiple .h5 files in {thorsync_dir}'
+    return h5_files[0]
 
 
-def print_block_frames(block_first_frames, block_last_frames):
-    """Prints block numbers and the corresponding start / stop frames.
+def _normalize_thorsync_name(name):
+    return name.lower().replace(' ', '').replace('_', '')
 
-    For subsetting TIFF in ImageJ / other manual analysis.
 
-    Prints frame numbers 1-indexed, but takes 0-indexed frames.
+def thorsync_channel_path(h5, channel):
+    """Returns '<group>/<dataset>' for ThorSync line named ~`channel`.
+
+    `h5` is an open `h5py.File`. Looks in the analog ('AI'), digital ('DI') and
+    counter ('CI') groups, ignoring case, spaces and underscores.
     """
-    print('Block frames:')
-    for i, (b_first, b_last) in enumerate(zip(block_first_frames,
-        block_last_frames)):
-        # Adding one to index frames as in ImageJ.
-        print('{}: {} - {}'.format(i, b_first + 1, b_last + 1))
-    print('')
+    target = _normalize_thorsync_name(channel)
+    matches = []
+    for group in ('AI', 'DI', 'CI'):
+        if group not in h5:
+            continue
+        for name in h5[group].keys():
+            if _normalize_thorsync_name(name) == target:
+                matches.append(f'{group}/{name}')
 
+    if len(matches) == 0:
+        available = {g: list(h5[g].keys()) for g in ('AI', 'DI', 'CI')
+            if g in h5
+        }
+        raise KeyError(f'no ThorSync line matching {channel}. available: '
+            f'{available}'
+        )
+    assert len(matches) == 1, f'multiple lines matching {channel}: {matches}'
+    return matches[0]
 
-def md5(fname):
-    """Calculates MD5 hash on file with name `fname`.
-    """
-    hash_md5 = hashlib.md5()
-    with open(fname, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
 
+def _thorsync_n_samples(h5):
+    return h5['Global']['GCtr'].shape[0]
 
-def format_timestamp(timestamp):
-    """Returns human-readable str for timestamp accepted by `pd.Timestamp`.
+
+def thorsync_samplerate(h5):
+    """Returns ThorSync sample rate (Hz), from the first + last counter values.
     """
-    return str(pd.Timestamp(timestamp))[:16]
+    gctr = h5['Global']['GCtr']
+    n = gctr.shape[0]
+    first = float(np.asarray(gctr[0]).flat[0])
+    last = float(np.asarray(gctr[n - 1]).flat[0])
+    return (n - 1) / ((last - first) / thorsync_clock_hz)
 
 
-# TODO TODO can to_sql with pg_upsert replace this? what extra features did this
-# provide?
-def to_sql_with_duplicates(new_df, table_name, index=False, verbose=False):
-    from sqlalchemy import MetaData, Table
+def thorsync_edges(h5, channels, analog_threshold=None, chunk_size=None):
+    """Returns dict of channel -> (rising, falling) edge sample indices & times.
 
-    # TODO TODO document what index means / delete
+    Reads the ThorSync HDF5 (`h5`, an open `h5py.File`) in chunks of
+    `chunk_size` samples, thresholding and differencing each chunk, so memory
+    use does not scale with recording length. Values are
+    `(rising_samples, falling_samples, rising_times, falling_times)`, with
+    times in seconds (from 'Global/GCtr').
 
-    # TODO TODO if this fails and time won't be saved on reinsertion, any rows
-    # that have been inserted already should be deleted to avoid confusion
-    # (mainly, for the case where the program is interrupted while this is
-    # running)
-    # TODO TODO maybe have some cleaning step that checks everything in database
-    # has the correct number of rows? and maybe prompts to delete?
+    A line that is already high on the first sample gets a rising edge there.
+    """
+    if analog_threshold is None:
+        analog_threshold = thorsync_analog_threshold
 
-    global conn
-    if conn is None:
-        conn = get_db_conn()
+    if chunk_size is None:
+        chunk_size = thorsync_chunk_size
 
-    # Other columns should be generated by database anyway.
-    cols = list(new_df.columns)
-    if index:
-        cols += list(new_df.index.names)
-    table_cols = ', '.join(cols)
+    paths = [thorsync_channel_path(h5, c) for c in channels]
+    thresholds = [analog_threshold if p.startswith('AI/') else 0
+        for p in paths
+    ]
+    datasets = [h5[p] for p in paths]
+    gctr = h5['Global']['GCtr']
+    n_samples = gctr.shape[0]
+
+    rising = [[] for _ in channels]
+    falling = [[] for _ in channels]
+    rising_t = [[] for _ in channels]
+    falling_t = [[] for _ in channels]
+    last_high = [False for _ in channels]
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        chunk_gctr = None
+        for i, (ds, thresh) in enumerate(zip(datasets, thresholds)):
+            high = np.asarray(ds[start:stop]).reshape(-1) > thresh
+            d = np.diff(high.astype(np.int8), prepend=np.int8(last_high[i]))
+            last_high[i] = bool(high[-1])
+
+            r = np.flatnonzero(d == 1)
+            f = np.flatnonzero(d == -1)
+            if len(r) == 0 and len(f) == 0:
+                continue
 
-    md = MetaData()
-    table = Table(table_name, md, autoload_with=conn)
-    dtypes = {c.name: c.type for c in table.c}
+            # Only reading the counter for chunks where it is needed.
+            if chunk_gctr is None:
+                chunk_gctr = np.asarray(gctr[start:stop]).reshape(-1)
 
-    if verbose:
-        print('SQL column types:')
-        pprint(dtypes)
-   
-    df_types = new_df.dtypes.to_dict()
-    if index:
-        df_types.update({n: new_df.index.get_level_values(n).dtype
-            for n in new_df.index.names})
+            rising[i].append(r + start)
+            falling[i].append(f + start)
+            rising_t[i].append(chunk_gctr[r] / thorsync_clock_hz)
+            falling_t[i].append(chunk_gctr[f] / thorsync_clock_hz)
 
-    if verbose:
-        print('\nOld dataframe column types:')
-        pprint(df_types)
+    def _cat(arrs, dtype):
+        if len(arrs) == 0:
+            return np.array([], dtype=dtype)
+        return np.concatenate(arrs).astype(dtype)
 
-    sqlalchemy2pd_type = {
-        'INTEGER()': np.dtype('int32'),
-        'SMALLINT()': np.dtype('int16'),
-        'REAL()': np.dtype('float32'),
-        'DOUBLE_PRECISION(precision=53)': np.dtype('float64'),
-        'DATE()': np.dtype('<M8[ns]')
+    return {c: (
+        _cat(rising[i], np.int64), _cat(falling[i], np.int64),
+        _cat(rising_t[i], np.float64), _cat(falling_t[i], np.float64)
+        ) for i, c in enumerate(channels)
     }
-    if verbose:
-        print('\nSQL types to cast:')
-        pprint(sqlalchemy2pd_type)
 
-    new_df_types = {n: sqlalchemy2pd_type[repr(t)] for n, t in dtypes.items()
-        if repr(t) in sqlalchemy2pd_type}
-
-    if verbose:
-        print('\nNew dataframe column types:')
-        pprint(new_df_types)
 
-    # TODO how to get around converting things to int if they have NaN.
-    # possible to not convert?
-    new_column_types = dict()
-    new_index_types = dict()
-    for k, t in new_df_types.items():
-        if k in new_df.columns and not new_df[k].isnull().any():
-            new_column_types[k] = t
+def saved_frame_times(frame_times, thorimage_dir):
+    """Returns times of the frames (volumes, if z > 1) ThorImage saved.
 
-        # TODO or is it always true that index level can't be NaN anyway?
-        elif (k in new_df.index.names and
-            not new_df.index.get_level_values(k).isnull().any()):
+    `frame_times` should have the times of all frame out pulses. If there is
+    one pulse per frame in the raw output, they are returned as-is for
+    single plane recordings. With averaging (`averageMode` 1), if there is a
+    pulse for each of the `averageNum` frames averaged into each saved frame,
+    each saved frame gets the time of the last of those. For volumes, each
+    volume gets the time of the pulse for its first plane, so frame indices
+    computed from the output index volumes, as in `read_movie` output.
 
-            new_index_types[k] = t
+    Raises `ValueError` if the number of pulses matches none of these.
+    """
+    xml = get_thorimage_xmlroot(thorimage_dir)
+    lsm_attribs = xml.find('LSM').attrib
+    n_averaged = 1
+    if int(lsm_attribs['averageMode']) != 0:
+        n_averaged = int(lsm_attribs['averageNum'])
+
+    _, z, _ = get_thorimage_dims_xml(xml)
+    n_flyback = get_thorimage_n_flyback_xml(xml)
+    # Includes flyback frames.
+    n_saved = int(xml.find('Streaming').attrib['frames'])
+
+    n_pulses = len(frame_times)
+    if n_averaged > 1 and n_pulses == n_saved * n_averaged:
+        frame_times = frame_times[(n_averaged - 1)::n_averaged]
+
+    elif n_pulses != n_saved:
+        raise ValueError(f'{n_pulses} frame out pulses, but {thorimage_dir} '
+            f'has {n_saved} frames (averaging {n_averaged} frames each)'
+        )
+
+    z_total = z + n_flyback
+    if z_total > 1:
+        if n_saved % z_total != 0:
+            raise ValueError(f'{n_saved} frames in {thorimage_dir} not a '
+                f'multiple of {z} planes + {n_flyback} flyback frames'
+            )
+        frame_times = frame_times[::z_total]
+
+    return frame_times
+
+
+@instrumented('timing_info_load', recording_arg='thorsync_dir')
+def thorsync_timing_info(thorsync_dir, frame_channel=None, scope_channel=None,
+    odor_channel=None, analog_threshold=None, chunk_size=None,
+    return_samples=False, check=True, thorimage_dir=None):
+    """Returns timing information computed from ThorSync HDF5 output.
+
+    Python replacement for the MATLAB `thorsync_h5_to_mat` + `get_stiminfo`
+    steps. Returns a dict with the same keys (and conventions) as
+    `load_mat_timing_info`:
+    - 'frame_times': time (s) of each frame out rising edge
+    - 'block_first_frames' / 'block_last_frames': first / last frames within
+      each period the scope pin was high
+    - 'odor_onset_frames': first frame at / after each odor valve opening
+    - 'odor_offset_frames': last frame at / before each valve closing
+
+    If `return_samples` is True, the ThorSync sample indices of the odor valve
+    edges ('odor_onset_samples', 'odor_offset_samples') and the sample rate
+    ('samplerate') are also returned. These are what the MATLAB code calls
+    `stim_ic_idx` / `stim_fc_idx`.
+
+    If `thorimage_dir` is passed, frame times are converted to times of the
+    frames / volumes in the movie (see `saved_frame_times`), which is needed
+    for recordings with averaging or flyback frames. Otherwise, there is
+    assumed to be one frame out pulse per saved frame.
+
+    Raises `AssertionError` (via `check_timing_info`) if `check` is True and
+    the output seems inconsistent with itself.
+    """
+    import h5py
+
+    if frame_channel is None:
+        frame_channel = thorsync_frame_channel
+    if scope_channel is None:
+        scope_channel = thorsync_scope_channel
+    if odor_channel is None:
+        odor_channel = thorsync_odor_channel
+
+    h5_file = get_thorsync_h5(thorsync_dir)
+    with h5py.File(h5_file, 'r') as h5:
+        edges = thorsync_edges(h5, [frame_channel, scope_channel,
+            odor_channel], analog_threshold=analog_threshold,
+            chunk_size=chunk_size
+        )
+        n_samples = _thorsync_n_samples(h5)
+        if return_samples:
+            samplerate = thorsync_samplerate(h5)
+
+        # So periods still high at the end of the recording have an end.
+        gctr = h5['Global']['GCtr']
+        end_time = float(np.asarray(gctr[n_samples - 1]).flat[0]
+            ) / thorsync_clock_hz
+
+    frame_times = edges[frame_channel][2]
+    if thorimage_dir is not None:
+        frame_times = saved_frame_times(frame_times, thorimage_dir)
+
+    _, _, scope_on, scope_off = edges[scope_channel]
+    if len(scope_off) < len(scope_on):
+        scope_off = np.append(scope_off, end_time)
+    assert len(scope_on) == len(scope_off)
+
+    block_first_frames = np.searchsorted(frame_times, scope_on, side='left')
+    block_last_frames = np.searchsorted(frame_times, scope_off,
+        side='right') - 1
+
+    # Scope pin high periods without any frames.
+    nonempty = block_last_frames >= block_first_frames
+    block_first_frames = block_first_frames[nonempty]
+    block_last_frames = block_last_frames[nonempty]
+
+    on_samples, off_samples, odor_on, odor_off = edges[odor_channel]
+    if len(odor_off) < len(odor_on):
+        off_samples = np.append(off_samples, n_samples - 1)
+        odor_off = np.append(odor_off, end_time)
+    assert len(odor_on) == len(odor_off)
+
+    odor_onset_frames = np.searchsorted(frame_times, odor_on, side='left')
+    odor_offset_frames = np.maximum(
+        np.searchsorted(frame_times, odor_off, side='right') - 1,
+        odor_onset_frames
+    )
+
+    ti = {
+        'frame_times': frame_times,
+        'block_first_frames': block_first_frames.astype(np.uint32),
+        'block_last_frames': block_last_frames.astype(np.uint32),
+        'odor_onset_frames': odor_onset_frames.astype(np.uint32),
+        'odor_offset_frames': odor_offset_frames.astype(np.uint32),
+    }
+    if check:
+        check_timing_info(ti)
+
+    if return_samples:
+        ti['odor_onset_samples'] = on_samples
+        ti['odor_offset_samples'] = off_samples
+        ti['samplerate'] = samplerate
+
+    return ti
+
+
+def _thorsync_timing_info_star(args):
+    thorsync_dir, kwargs = args
+    try:
+        return thorsync_timing_info(thorsync_dir, **kwargs)
+    except (AssertionError, IOError, KeyError, ValueError) as err:
+        return err
+
+
+def thorsync_timing_infos(thorsync_dirs, n_workers=None, thorimage_dirs=None,
+    **kwargs):
+    """Returns list of `thorsync_timing_info` outputs, computed in parallel.
+
+    Each recording is processed in its own worker process. Where
+    `thorsync_timing_info` failed (with an `AssertionError`, `IOError`,
+    `KeyError` or `ValueError`), the list has the exception instead.
+
+    `thorimage_dirs`, if passed, should be the same length as `thorsync_dirs`,
+    and each is passed as `thorimage_dir`. `kwargs` are passed to
+    `thorsync_timing_info`.
+    """
+    import multiprocessing as mp
+
+    if thorimage_dirs is None:
+        args = [(d, kwargs) for d in thorsync_dirs]
+    else:
+        assert len(thorimage_dirs) == len(thorsync_dirs)
+        args = [(d, dict(kwargs, thorimage_dir=i))
+            for d, i in zip(thorsync_dirs, thorimage_dirs)
+        ]
+    if n_workers == 1 or len(args) <= 1:
+        return [_thorsync_timing_info_star(a) for a in args]
+
+    with mp.Pool(n_workers) as pool:
+        return pool.map(_thorsync_timing_info_star, args)
+
+
+def compare_timing_info(ti, ti_ref, frame_time_atol=1e-3):
+    """Raises `AssertionError` describing any differences between `ti`s.
+
+    For validating `thorsync_timing_info` output (`ti`) against the output of
+    `load_mat_timing_info` (`ti_ref`). Frame times are compared relative to the
+    first frame, since the two may use a different time origin.
+    """
+    errs = []
+    ft = ti['frame_times']
+    ft_ref = ti_ref['frame_times']
+    if len(ft) != len(ft_ref):
+        errs.append(f'{len(ft)} frame times != {len(ft_ref)} (reference)')
+    else:
+        max_dt = np.max(np.abs((ft - ft[0]) - (ft_ref - ft_ref[0])))
+        if max_dt > frame_time_atol:
+            errs.append(f'frame times differ by up to {max_dt:.4f}s')
+
+    for k in ('block_first_frames', 'block_last_frames', 'odor_onset_frames',
+        'odor_offset_frames'):
+
+        if not np.array_equal(ti[k], ti_ref[k]):
+            errs.append(f'{k} differ:\n{ti[k]}\n(reference)\n{ti_ref[k]}')
+
+    assert len(errs) == 0, '\n'.join(errs)
+
+
+def save_timing_info_mat(mat_file, ti, ti_code_version=None):
+    """Saves `ti` to .mat, as the `ti` struct `load_mat_timing_info` reads.
+
+    Frame indices are converted back to MATLAB's 1-based indexing. Any other
+    variables already in `mat_file` are kept. If `mat_file` is an existing v7.3
+    (HDF5) file, which scipy can not write, `ti` is added to it with h5py.
+    """
+    from scipy.io import loadmat, savemat
+
+    mat_ti = {
+        'frame_times': np.asarray(ti['frame_times'], dtype=np.float64),
+        'block_start_frame': np.asarray(ti['block_first_frames'],
+            dtype=np.float64) + 1,
+        'block_end_frame': np.asarray(ti['block_last_frames'],
+            dtype=np.float64) + 1,
+        'stim_on': np.asarray(ti['odor_onset_frames'], dtype=np.float64) + 1,
+        'stim_off': np.asarray(ti['odor_offset_frames'], dtype=np.float64) + 1
+    }
+    if 'odor_onset_samples' in ti:
+        mat_ti['stim_ic_idx'] = np.asarray(ti['odor_onset_samples'],
+            dtype=np.float64) + 1
+        mat_ti['stim_fc_idx'] = np.asarray(ti['odor_offset_samples'],
+            dtype=np.float64) + 1
+
+    data = {'ti': mat_ti}
+    if ti_code_version is not None:
+        # savemat can't save None
+        data['ti_code_version'] = {k: '' if v is None else v
+            for k, v in ti_code_version.items()
+        }
+
+    if exists(mat_file):
+        try:
+            old_data = loadmat(mat_file)
+        # scipy can't read (or write) v7.3 (HDF5) .mat files, and rewriting
+        # it without the other variables would lose them.
+        except NotImplementedError:
+            import h5py
+            with h5py.File(mat_file, 'r+') as f:
+                for name, value in data.items():
+                    _write_v73_mat_var(f, name, value)
+            return
+
+        data = {**{k: v for k, v in old_data.items() if not k.startswith('__')},
+            **data
+        }
+
+    os.makedirs(split(mat_file)[0], exist_ok=True)
+    savemat(mat_file, data)
+
+
+def _write_v73_mat_var(group, name, value):
+    """Writes `value` to an h5py `group`, as MATLAB would in a v7.3 .mat file.
+
+    Only handles what `save_timing_info_mat` saves: dicts of values (as
+    structs), strings and numeric arrays (as doubles). Replaces any existing
+    `name` in `group`.
+    """
+    import h5py
+
+    if name in group:
+        del group[name]
+
+    if isinstance(value, dict):
+        struct = group.create_group(name)
+        struct.attrs['MATLAB_class'] = np.bytes_('struct')
+        fields = np.empty(len(value), dtype=object)
+        fields[:] = [np.array(list(k), dtype='S1') for k in value]
+        struct.attrs.create('MATLAB_fields', fields,
+            dtype=h5py.vlen_dtype(np.dtype('S1'))
+        )
+        for k, v in value.items():
+            _write_v73_mat_var(struct, k, v)
+        return
+
+    if isinstance(value, str):
+        matlab_class = 'char'
+        array = np.array([ord(c) for c in value], dtype=np.uint16)
+    else:
+        matlab_class = 'double'
+        array = np.asarray(value, dtype=np.float64)
+
+    if array.size == 0:
+        # MATLAB saves the dimensions of empty arrays in place of their data.
+        dataset = group.create_dataset(name,
+            data=np.zeros(max(array.ndim, 2), dtype=np.uint64)
+        )
+        dataset.attrs['MATLAB_empty'] = np.uint8(1)
+    else:
+        # MATLAB arrays are column-major (and at least 2D), so a 1xN row
+        # vector is saved with shape (N, 1).
+        dataset = group.create_dataset(name, data=np.atleast_2d(array).T)
+    dataset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+
+
+def matfile_varnames(mat_file):
+    """Returns set of names of variables saved in a .mat file.
+
+    Works on v7.3 (HDF5) .mat files too, without the MATLAB engine.
+    """
+    from scipy.io import whosmat
+
+    try:
+        return {name for name, _, _ in whosmat(mat_file)}
+    except NotImplementedError:
+        import h5py
+        with h5py.File(mat_file, 'r') as f:
+            return {k for k in f.keys() if not k.startswith('#')}
+
+
+pid_channel = 'pid'
+_pid_cache_version = 2
+_pid_windows = dict()
+def load_pid_windows(thorsync_dir, pre_s=2.0, post_s=10.0, target_hz=100.0,
+    channel=None, onset_samples=None, use_cache=True, chunk_size=None):
+    """Returns (DataFrame of PID signal around each odor onset, sample rate).
+
+    Rows are presentations, in order ('order' index), and columns are time
+    from odor onset (s, 'from_onset'), as in the trace tables. Only the
+    `pre_s` + `post_s` window around each onset is read from the ThorSync
+    HDF5 (one hyperslab per presentation). Windows are block averaged down to
+    ~`target_hz` (the actual rate, which is returned, is the ThorSync sample
+    rate over the nearest integer factor), and padded with NaN where they
+    extend past the ends of the recording.
+
+    `onset_samples` are ThorSync sample indices of odor onsets (`stim_ic_idx`
+    in the MATLAB timing info). If not passed, they are found from the odor
+    valve line (see `thorsync_edges`).
+
+    Results are cached in memory and under `cache_root()`, keyed by the HDF5
+    path, size, mtime and the other arguments.
+    """
+    import h5py
+
+    if channel is None:
+        channel = pid_channel
+
+    h5_file = get_thorsync_h5(thorsync_dir)
+    st = os.stat(h5_file)
+    onsets_key = None if onset_samples is None else tuple(
+        int(x) for x in onset_samples
+    )
+    key = (_pid_cache_version, os.path.abspath(h5_file), st.st_size,
+        st.st_mtime_ns, pre_s, post_s, target_hz, channel, onsets_key
+    )
+
+    if use_cache and key in _pid_windows:
+        df, pid_samplerate = _pid_windows[key]
+        return df.copy(), pid_samplerate
+
+    cache_file = join(cache_root(), 'pid',
+        hashlib.md5(repr(key).encode()).hexdigest() + '.p'
+    )
+    if use_cache and exists(cache_file):
+        df, pid_samplerate = pd.read_pickle(cache_file)
+        _pid_windows[key] = (df, pid_samplerate)
+        return df.copy(), pid_samplerate
+
+    with h5py.File(h5_file, 'r') as h5:
+        if onset_samples is None:
+            onset_samples = thorsync_edges(h5, [thorsync_odor_channel],
+                chunk_size=chunk_size)[thorsync_odor_channel][0]
+
+        samplerate = thorsync_samplerate(h5)
+        ds = h5[thorsync_channel_path(h5, channel)]
+        n_samples = ds.shape[0]
+
+        factor = max(1, int(round(samplerate / target_hz)))
+        n_pre = int(round(pre_s * samplerate / factor)) * factor
+        n_post = int(round(post_s * samplerate / factor)) * factor
+        window_len = n_pre + n_post
+
+        windows = np.full((len(onset_samples), window_len), np.nan)
+        for i, onset in enumerate(onset_samples):
+            start = int(onset) - n_pre
+            stop = int(onset) + n_post
+            read_start = max(start, 0)
+            read_stop = min(stop, n_samples)
+            if read_stop <= read_start:
+                continue
+            windows[i, read_start - start:read_stop - start] = \
+                np.asarray(ds[read_start:read_stop]).reshape(-1)
+
+    # NaN padding propagates into any partially padded downsampled bins.
+    windows = windows.reshape(len(onset_samples), -1, factor).mean(axis=-1)
+    from_onset = (np.arange(windows.shape[1]) * factor - n_pre) / samplerate
+
+    df = pd.DataFrame(windows,
+        index=pd.Index(np.arange(len(windows)), name='order'),
+        columns=pd.Index(from_onset, name='from_onset')
+    )
+    pid_samplerate = samplerate / factor
+
+    if use_cache:
+        os.makedirs(split(cache_file)[0], exist_ok=True)
+        tmp_file = cache_file + f'.{os.getpid()}.tmp'
+        pd.to_pickle((df, pid_samplerate), tmp_file)
+        os.replace(tmp_file, cache_file)
+        _pid_windows[key] = (df, pid_samplerate)
+
+    return df.copy(), pid_samplerate
+
+
+def check_movie_timing_info(movie, frame_times, block_first_frames,
+    block_last_frames):
+    """Checks that `movie` and `ti` refer to the same number of frames.
+
+    Raises `AssertionError` if the check fails.
+    """
+    total_block_frames = sum([e - s + 1 for s, e in
+        zip(block_first_frames, block_last_frames)
+    ])
+    n_frames = movie.shape[0]
+    # TODO may need to replace this with a warning (at least optionally), given
+    # comment in gui.py that did so because failure (described in cthulhu:190520
+    # bug text file)
+    assert len(frame_times) == n_frames
+    # TODO may need to remove this assert to handle cases where there is a
+    # partial block (stopped early). leave assert after slicing tho.
+    # (warn instead, probably)
+    assert total_block_frames == n_frames, \
+        '{} != {}'.format(total_block_frames, n_frames)
+
+
+def print_block_frames(block_first_frames, block_last_frames):
+    """Prints block numbers and the corresponding start / stop frames.
+
+    For subsetting TIFF in ImageJ / other manual analysis.
+
+    Prints frame numbers 1-indexed, but takes 0-indexed frames.
+    """
+    print('Block frames:')
+    for i, (b_first, b_last) in enumerate(zip(block_first_frames,
+        block_last_frames)):
+        # Adding one to index frames as in ImageJ.
+        print('{}: {} - {}'.format(i, b_first + 1, b_last + 1))
+    print('')
+
+
+def md5(fname):
+    """Calculates MD5 hash on file with name `fname`.
+    """
+    hash_md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def format_timestamp(timestamp):
+    """Returns human-readable str for timestamp accepted by `pd.Timestamp`.
+    """
+    return str(pd.Timestamp(timestamp))[:16]
+
+
+sqlalchemy2pd_type = {
+    'INTEGER()': np.dtype('int32'),
+    'SMALLINT()': np.dtype('int16'),
+    'REAL()': np.dtype('float32'),
+    'DOUBLE_PRECISION(precision=53)': np.dtype('float64'),
+    'DATE()': np.dtype('<M8[ns]')
+}
+
+# Table name -> (column name -> SQLAlchemy type, list of primary key columns).
+# Schema doesn't change while we are running, so only reflecting each once.
+_sql_table_info = dict()
+def sql_table_info(table_name):
+    """Returns (dict of column name -> SQLAlchemy type, primary key col names).
+    """
+    from sqlalchemy import MetaData, Table
+
+    if table_name in _sql_table_info:
+        return _sql_table_info[table_name]
+
+    conn = current_db_conn()
+
+    md = MetaData()
+    table = Table(table_name, md, autoload_with=conn)
+    dtypes = {c.name: c.type for c in table.c}
+
+    # TODO change to just get column names?
+    query = '''
+    SELECT a.attname, format_type(a.atttypid, a.atttypmod) AS data_type
+    FROM   pg_index i
+    JOIN   pg_attribute a ON a.attrelid = i.indrelid
+        AND a.attnum = ANY(i.indkey)
+    WHERE  i.indrelid = '{}'::regclass
+    AND    i.indisprimary;
+    '''.format(table_name)
+    result = conn.execute(query)
+    pk_cols = [n for n, _ in result]
+
+    _sql_table_info[table_name] = (dtypes, pk_cols)
+    return dtypes, pk_cols
+
+
+# TODO TODO can to_sql with pg_upsert replace this? what extra features did this
+# provide?
+@instrumented('sql_upload')
+def to_sql_with_duplicates(new_df, table_name, index=False, verbose=False,
+    returning=None):
+    """Inserts rows of `new_df` not conflicting with existing primary keys.
+
+    If `returning` is a list of column names, returns a DataFrame with those
+    columns for each row in the table with a primary key in `new_df`, whether
+    it was just inserted or already there. Only these rows are read back, so
+    the cost doesn't grow with the size of the table. Generated columns (like
+    serial IDs) can be included. All primary key columns must be in `new_df`.
+
+    Runs in the enclosing `db_transaction`, or in one of its own if there is
+    none. (SQLAlchemy only autocommits statements starting with INSERT, so
+    the `returning` query would otherwise never be committed.)
+    """
+    if getattr(_thread_db, 'connection', None) is None:
+        with db_transaction():
+            return to_sql_with_duplicates(new_df, table_name, index=index,
+                verbose=verbose, returning=returning
+            )
+
+    # TODO TODO document what index means / delete
+
+    # TODO TODO if this fails and time won't be saved on reinsertion, any rows
+    # that have been inserted already should be deleted to avoid confusion
+    # (mainly, for the case where the program is interrupted while this is
+    # running)
+    # TODO TODO maybe have some cleaning step that checks everything in database
+    # has the correct number of rows? and maybe prompts to delete?
+
+    conn = current_db_conn()
+
+    # Other columns should be generated by database anyway.
+    cols = list(new_df.columns)
+    if index:
+        cols += list(new_df.index.names)
+    table_cols = ', '.join(cols)
+
+    dtypes, pk_col_list = sql_table_info(table_name)
+
+    if verbose:
+        print('SQL column types:')
+        pprint(dtypes)
+   
+    df_types = new_df.dtypes.to_dict()
+    if index:
+        df_types.update({n: new_df.index.get_level_values(n).dtype
+            for n in new_df.index.names})
+
+    if verbose:
+        print('\nOld dataframe column types:')
+        pprint(df_types)
+
+    if verbose:
+        print('\nSQL types to cast:')
+        pprint(sqlalchemy2pd_type)
+
+    new_df_types = {n: sqlalchemy2pd_type[repr(t)] for n, t in dtypes.items()
+        if repr(t) in sqlalchemy2pd_type}
+
+    if verbose:
+        print('\nNew dataframe column types:')
+        pprint(new_df_types)
+
+    # TODO how to get around converting things to int if they have NaN.
+    # possible to not convert?
+    new_column_types = dict()
+    new_index_types = dict()
+    for k, t in new_df_types.items():
+        if k in new_df.columns and not new_df[k].isnull().any():
+            new_column_types[k] = t
+
+        # TODO or is it always true that index level can't be NaN anyway?
+        elif (k in new_df.index.names and
+            not new_df.index.get_level_values(k).isnull().any()):
+
+            new_index_types[k] = t
 
         # TODO print types being skipped b/c nan?
 
@@ -669,21 +1742,12 @@ def to_sql_with_duplicates(new_df, table_name, index=False, verbose=False):
     if index:
         print('writing to temporary table temp_{}...'.format(table_name))
 
-    # TODO figure out how to profile
-    new_df.to_sql('temp_' + table_name, conn, if_exists='replace', index=index,
-        dtype=dtypes)
+    with stage('sql_temp_table_write'):
+        new_df.to_sql('temp_' + table_name, conn, if_exists='replace',
+            index=index, dtype=dtypes
+        )
 
-    # TODO change to just get column names?
-    query = '''
-    SELECT a.attname, format_type(a.atttypid, a.atttypmod) AS data_type
-    FROM   pg_index i
-    JOIN   pg_attribute a ON a.attrelid = i.indrelid
-        AND a.attnum = ANY(i.indkey)
-    WHERE  i.indrelid = '{}'::regclass
-    AND    i.indisprimary;
-    '''.format(table_name)
-    result = conn.execute(query)
-    pk_cols = ', '.join([n for n, _ in result])
+    pk_cols = ', '.join(pk_col_list)
 
     # TODO TODO TODO modify so on conflict the new row replaces the old one!
     # (for updates to analysis, if exact code version w/ uncommited changes and
@@ -705,17 +1769,100 @@ def to_sql_with_duplicates(new_df, table_name, index=False, verbose=False):
         print('inserting into {} from temporary table... '.format(table_name),
             end='')
 
-    # TODO let this happen async in the background? (don't need result)
-    conn.execute(query)
-
-    # TODO flag to read back and check insertion stored correct data?
+    if returning is None:
+        # TODO let this happen async in the background? (don't need result)
+        conn.execute(query)
+        # Since we don't know which rows this inserted.
+        invalidate_lookup_cache(table_name)
+    else:
+        missing_pk_cols = set(pk_col_list) - set(cols)
+        if len(missing_pk_cols) > 0:
+            raise ValueError(f'returning requires all primary key columns '
+                f'of {table_name}. missing: {missing_pk_cols}'
+            )
+        # The outer SELECT sees the table as it was before the INSERT in the
+        # CTE, so the second part only gets rows that already existed (and
+        # thus were not inserted), and no row is returned twice.
+        ret_cols = ', '.join(returning)
+        qualified_ret_cols = ', '.join(f'{table_name}.{c}' for c in returning)
+        query = (f'WITH inserted AS ({query} RETURNING {ret_cols}) '
+            f'SELECT {ret_cols} FROM inserted UNION ALL '
+            f'SELECT {qualified_ret_cols} FROM {table_name} '
+            f'JOIN temp_{table_name} USING ({pk_cols})'
+        )
+        returned = pd.read_sql_query(query, conn)
 
     if index:
         print('done')
 
+    if returning is not None:
+        return returned
+
     # TODO drop staging table
 
 
+def check_inserted(new_df, db_df, key_cols):
+    """Raises IOError if rows of `db_df` differ from those in `new_df`.
+
+    Rows are matched on `key_cols`. `db_df` should have (at least) all columns
+    in `new_df`, as from `to_sql_with_duplicates(..., returning=...)`.
+    """
+    db_df = db_df.astype(new_df[key_cols].dtypes.to_dict())
+    db_df = db_df.set_index(key_cols).reindex(
+        pd.MultiIndex.from_frame(new_df[key_cols])
+    ).reset_index()
+    db_df = db_df[new_df.columns]
+    new_df = new_df.reset_index(drop=True)
+
+    diff = diff_dataframes(new_df, db_df)
+    if diff is not None:
+        print(diff)
+        raise IOError('SQL insertion failed')
+
+
+# Table name -> dict of (primary key values) -> generated ID, for small tables
+# like odors, whose rows are referenced by ID many times.
+_lookup_cache = dict()
+def invalidate_lookup_cache(table_name=None):
+    """Clears cached IDs for `table_name` (or all tables if None).
+    """
+    if table_name is None:
+        _lookup_cache.clear()
+    else:
+        _lookup_cache.pop(table_name, None)
+
+
+def lookup_ids(df, table_name, id_col):
+    """Returns list of `id_col` values for rows of `df`, inserting as needed.
+
+    Each row of `df` should have all primary key columns of `table_name`. Only
+    rows without cached IDs are inserted / read back.
+    """
+    dtypes, pk_cols = sql_table_info(table_name)
+    # So keys compare equal to those read back (e.g. REAL columns round trip
+    # through float32).
+    key_types = {c: sqlalchemy2pd_type[repr(dtypes[c])] for c in pk_cols
+        if repr(dtypes[c]) in sqlalchemy2pd_type
+    }
+    def key_tuples(kdf):
+        kdf = kdf[pk_cols].astype(key_types)
+        return [tuple(row) for row in kdf.itertuples(index=False)]
+
+    keys = key_tuples(df)
+
+    key2id = _lookup_cache.setdefault(table_name, dict())
+    missing = [k not in key2id for k in keys]
+    if any(missing):
+        new_df = df[missing].drop_duplicates(subset=pk_cols)
+        db_df = to_sql_with_duplicates(new_df, table_name,
+            returning=pk_cols + [id_col]
+        )
+        for k, i in zip(key_tuples(db_df), db_df[id_col]):
+            key2id[k] = i
+
+    return [key2id[k] for k in keys]
+
+
 def pg_upsert(table, conn, keys, data_iter):
     from sqlalchemy.dialects import postgresql
     # https://github.com/pandas-dev/pandas/issues/14553
@@ -782,11 +1929,189 @@ def odorset_name(df_or_odornames):
     return odor_set
 
 
+# Increment if the contents of catalog entries change. Changes to the code
+# that computes the entries are detected separately (see
+# `_stimfile_catalog_code_hash`).
+_stimfile_catalog_version = 2
+
+_stimfile_catalog_code_hash_str = None
+def _stimfile_catalog_code_hash():
+    """Returns hash of the source of the functions computing catalog entries.
+    """
+    global _stimfile_catalog_code_hash_str
+    if _stimfile_catalog_code_hash_str is None:
+        import inspect
+        h = hashlib.md5()
+        for fn in (_odor_metadata, _stimfile_odorset, odorset_name,
+            split_odor_w_conc):
+
+            h.update(inspect.getsource(fn).encode())
+        _stimfile_catalog_code_hash_str = h.hexdigest()[:12]
+
+    return _stimfile_catalog_code_hash_str
+
+
+def _stimfile_catalog_filename():
+    return join(cache_root(), f'stimfile_catalog_v{_stimfile_catalog_version}'
+        f'_{_stimfile_catalog_code_hash()}.p'
+    )
+
+
+# normalized stimfile path -> entry (see `_parse_stimfile`). Loaded from (and
+# saved to) `_stimfile_catalog_filename()`.
+_stimfile_catalog = None
+# Keys of entries added since the catalog was last saved.
+_stimfile_catalog_unsaved = set()
+def _read_stimfile_catalog():
+    catalog_file = _stimfile_catalog_filename()
+    if not exists(catalog_file):
+        return dict()
+
+    try:
+        with open(catalog_file, 'rb') as f:
+            return pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, AttributeError,
+        ImportError) as e:
+        warnings.warn(f'could not load stimfile catalog {catalog_file}: {e}')
+        return dict()
+
+
+def _load_stimfile_catalog():
+    global _stimfile_catalog
+    if _stimfile_catalog is None:
+        _stimfile_catalog = _read_stimfile_catalog()
+    return _stimfile_catalog
+
+
+def _save_stimfile_catalog():
+    """Writes entries added by this process into the catalog on disk.
+    """
+    if len(_stimfile_catalog_unsaved) == 0:
+        return
+
+    # Re-reading, so entries other processes added since we loaded it are
+    # kept.
+    catalog = _read_stimfile_catalog()
+    catalog.update({k: _stimfile_catalog[k]
+        for k in _stimfile_catalog_unsaved
+    })
+    catalog_file = _stimfile_catalog_filename()
+    # Writing to a temporary file first so readers (possibly in other
+    # processes) never see a partially written catalog.
+    tmp_file = f'{catalog_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(catalog, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_file, catalog_file)
+    _stimfile_catalog_unsaved.clear()
+
+# Single new entries (e.g. from `load_stimfile`) are only saved at exit (or
+# with the next `stimfile_catalog` call), so adding N entries doesn't rewrite
+# the catalog N times.
+atexit.register(_save_stimfile_catalog)
+
+
+def _parse_stimfile(stimfile_path, st, data=None):
+    """Returns catalog entry for a stimfile, unpickling it if `data` is None.
+    """
+    if data is None:
+        with open(stimfile_path, 'rb') as f:
+            data = pickle.load(f)
+
+    def outcome(fn, *args, **kwargs):
+        # Errors are stored, to be raised when the entry is used.
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            return e
+
+    # Same derived values as `load_odor_metadata` and `movie_blocks` compute.
+    metadata = outcome(_odor_metadata, data)
+    summary = dict()
+    if not isinstance(metadata, Exception):
+        summary = {k: metadata[k] for k in ('pair_case', 'n_repeats',
+            'presentations_per_repeat', 'presentations_per_block')
+        }
+        summary['n_presentations'] = len(metadata['odor_list'])
+
+    # Not storing `data` itself, so the catalog stays small enough to load
+    # quickly. `load_stimfile` unpickles (and memoizes) the stimfile when that
+    # is needed.
+    return {
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'odor_set': outcome(_stimfile_odorset, data, stimfile_path),
+        'odor_set_nonstrict': outcome(_stimfile_odorset, data, stimfile_path,
+            strict=False
+        ),
+        **summary
+    }
+
+
+def _stimfile_catalog_entry(stimfile_path, data=None):
+    """Returns catalog entry, parsing the stimfile only if new or changed.
+
+    `data` can be the already unpickled contents of the stimfile.
+    """
+    catalog = _load_stimfile_catalog()
+    key = normpath(os.path.abspath(stimfile_path))
+    st = os.stat(key)
+    entry = catalog.get(key)
+    if (entry is None or entry['mtime_ns'] != st.st_mtime_ns or
+        entry['size'] != st.st_size):
+
+        entry = _parse_stimfile(key, st, data=data)
+        catalog[key] = entry
+        _stimfile_catalog_unsaved.add(key)
+
+    return entry
+
+
+def stimfile_catalog(stimfiles=None):
+    """Returns a DataFrame summarizing stimfiles, indexed by filename.
+
+    Defaults to all stimfiles (*.p) under `stimfile_root()`. Only stimfiles
+    that are new or changed (by mtime or size) since they were last cataloged
+    are unpickled.
+
+    Columns are odor_set (None if it could not be determined), pair_case,
+    n_repeats, presentations_per_repeat, presentations_per_block, and
+    n_presentations, as `load_odor_metadata` would compute them.
+    """
+    if stimfiles is None:
+        stimfiles = sorted(glob.glob(join(stimfile_root(), '*.p')))
+
+    rows = []
+    for stimfile in stimfiles:
+        entry = _stimfile_catalog_entry(stimfile)
+        odor_set = entry['odor_set_nonstrict']
+        rows.append({
+            'stimfile': split(stimfile)[1],
+            'odor_set': None if isinstance(odor_set, Exception) else odor_set,
+            **{k: entry.get(k) for k in ('pair_case', 'n_repeats',
+                'presentations_per_repeat', 'presentations_per_block',
+                'n_presentations')
+            }
+        })
+
+    _save_stimfile_catalog()
+
+    return pd.DataFrame(rows, columns=['stimfile', 'odor_set', 'pair_case',
+        'n_repeats', 'presentations_per_repeat', 'presentations_per_block',
+        'n_presentations']).set_index('stimfile')
+
+
+# (normalized path, mtime_ns, size) -> unpickled stimfile, so each version
+# of a stimfile is only unpickled once per process.
+_stimfile_data = dict()
 def load_stimfile(stimfile_path):
     """Loads odor metadata stored in a pickle.
 
     These metadata files are generated by scripts under
     `ejhonglab/cutpast_arduino_stimuli`.
+
+    Memoized (until the file changes). Returns a shallow copy, so keys can be
+    added or replaced, but the values should not be modified in place.
     """
     # TODO better check for path already containing stimfile_root?
     # string prefix check might be too fragile...
@@ -800,9 +2125,19 @@ def load_stimfile(stimfile_path):
             stimfile_just_fname, stimfile_root
         ))
 
-    with open(stimfile_path, 'rb') as f:
-        data = pickle.load(f)
-    return data
+    key = normpath(os.path.abspath(stimfile_path))
+    st = os.stat(key)
+    memo_key = (key, st.st_mtime_ns, st.st_size)
+    data = _stimfile_data.get(memo_key)
+    if data is None:
+        with open(key, 'rb') as f:
+            data = pickle.load(f)
+        _stimfile_data[memo_key] = data
+
+        # Cataloging it now, since it's already unpickled.
+        _stimfile_catalog_entry(key, data=data)
+
+    return dict(data)
 
 
 # TODO delete (subsuming contents into load_experiment) if i'd never want to
@@ -813,7 +2148,14 @@ def load_odor_metadata(stimfile_path):
     Additional values are added into the dictionary loaded from the pickle.
     In some cases, this can overwrite the loaded values.
     """
-    data = load_stimfile(stimfile_path)
+    return _odor_metadata(load_stimfile(stimfile_path))
+
+
+def _odor_metadata(data):
+    # Only top level keys are added / replaced below, so this is enough to not
+    # modify the input.
+    data = dict(data)
+
     # TODO infer from data if no stimfile and not specified in
     # metadata (is there actually any value in this? maybe if we have
     # a sufficient amount of other data about the odor order in metadata
@@ -1126,6 +2468,7 @@ def tiff_ijroi_filename(tiff, confirm=None,
 # TODO TODO TODO may want to change how this fn operates (so it operates on
 # blocks rather than all of them concatenated + to provide different baselining
 # options)
+@instrumented('df_over_f')
 def calculate_df_over_f(raw_f, trial_start_frames, odor_onset_frames,
     trial_stop_frames):
     # TODO TODO maybe factor this into some kind of util fn that applies
@@ -1161,7 +2504,150 @@ def calculate_df_over_f(raw_f, trial_start_frames, odor_onset_frames,
 
     # TODO some check that no value in df_over_f are currently NaN?
 
-    return df_over_f
+    return df_over_f
+
+
+def ijrois_by_plane(ijrois):
+    """Returns dict of z index -> list of (name, ROI) in that plane.
+
+    Uses the automatic ImageJ ROI naming convention for TIFFs created by
+    `write_tiff` (where names start with the 1-based Z index, as in
+    `ijrois2masks`).
+    """
+    planes = dict()
+    for name, roi in ijrois:
+        z_index = int(name.split('-')[0]) - 1
+        planes.setdefault(z_index, []).append((name, roi))
+    return planes
+
+
+def _process_volume_plane_star(args):
+    return process_volume_plane(*args)
+
+
+def process_volume_plane(thorimage_dir, z, ijrois=None, trial_start_frames=None,
+    odor_onset_frames=None, trial_stop_frames=None, template_data=None,
+    chunk_frames=1000, fit_kwargs=None, frames=None):
+    """Processes one z plane of a volumetric recording, as its own movie.
+
+    The plane is a view of the memory mapped raw data, read `chunk_frames` at
+    a time. If `frames` (a slice of volumes) is passed, only those volumes are
+    used, and trial frame numbers are relative to its start.
+
+    If `ijrois` is None, ROIs are fit to the plane average with
+    `fit_circle_rois` (with `template_data` and `fit_kwargs`). Unless
+    `fit_kwargs` says otherwise, `min_n_rois` is None, since the
+    `fit_circle_rois` default (meant for a whole recording) is more cells than
+    one plane will typically have. A plane that still gets no ROIs warns and
+    has no rows.
+
+    Returns (plane average, DataFrame w/ one row per ROI). Rows have 'z',
+    'roi' (index within the plane), 'name', 'raw_f' and (if trial frames are
+    passed) 'df_over_f' columns, the last two holding arrays.
+    """
+    movie = raw_movie_memmap(thorimage_dir)[:, z]
+    if frames is not None:
+        movie = movie[frames]
+    n_frames = movie.shape[0]
+    frame_shape = movie.shape[1:]
+
+    avg = np.zeros(frame_shape)
+    for start in range(0, n_frames, chunk_frames):
+        avg += movie[start:(start + chunk_frames)].sum(axis=0, dtype=np.float64)
+    avg /= n_frames
+
+    if ijrois is None:
+        fit_kwargs = dict() if fit_kwargs is None else dict(fit_kwargs)
+        fit_kwargs.setdefault('min_n_rois', None)
+        xmlroot = get_thorimage_xmlroot(thorimage_dir)
+        try:
+            centers, radii, _, _ = fit_circle_rois(None, template_data,
+                avg=avg, _um_per_pixel_xy=get_thorimage_pixelsize_xml(xmlroot),
+                **fit_kwargs
+            )
+        except RuntimeError as e:
+            warnings.warn(f'z={z}: fitting ROIs failed ({e})')
+            centers = np.empty((0, 2))
+            radii = np.empty(0)
+
+        names = [f'{z + 1}-{i}' for i in range(len(centers))]
+        footprints = SparseFootprints.from_circles(centers, radii, frame_shape,
+            names=names
+        )
+    else:
+        footprints = ijrois2masks(ijrois, frame_shape, sparse=True)
+
+    df = pd.DataFrame({
+        'z': z,
+        'roi': np.arange(len(footprints)),
+        'name': footprints.names
+    })
+    if len(footprints) == 0:
+        if ijrois is None:
+            warnings.warn(f'z={z}: no ROIs fit')
+        df['raw_f'] = []
+        return avg, df
+
+    raw_f = _extract_traces_sparse_footprints(movie, footprints,
+        chunk_frames=chunk_frames, verbose=False
+    )
+    df['raw_f'] = list(raw_f.T)
+    if trial_start_frames is not None:
+        df_over_f = calculate_df_over_f(raw_f, trial_start_frames,
+            odor_onset_frames, trial_stop_frames
+        )
+        df['df_over_f'] = list(df_over_f.T)
+
+    return avg, df
+
+
+def process_volume(thorimage_dir, ijrois=None, trial_start_frames=None,
+    odor_onset_frames=None, trial_stop_frames=None, template_data=None,
+    n_workers=None, chunk_frames=1000, fit_kwargs=None, frames=None):
+    """Processes each z plane of a volumetric recording in parallel.
+
+    Each plane is processed by `process_volume_plane`, in its own worker
+    process, as if it were a single plane recording (trial frame numbers are
+    in volumes, relative to the start of the `frames` slice, if passed).
+    `ijrois` (for all planes, named as `ijrois_by_plane` expects) are split by
+    plane. If None, ROIs are fit to each plane average (see
+    `process_volume_plane` for the `fit_kwargs` defaults).
+
+    Used by `load_recording` for volumetric recordings.
+
+    Returns ((z, x, y) array of plane averages, DataFrame with the rows for
+    all planes, keyed by 'z' and 'roi').
+    """
+    import multiprocessing as mp
+
+    _, _, n_planes, _, _, _ = load_thorimage_metadata(thorimage_dir)
+    if n_planes <= 1:
+        raise ValueError(f'{thorimage_dir} is not a volumetric recording')
+
+    plane_ijrois = None
+    if ijrois is not None:
+        plane_ijrois = ijrois_by_plane(ijrois)
+        # (a plane with no ROIs should be skipped, rather than fit)
+        plane_ijrois = [plane_ijrois.get(z, []) for z in range(n_planes)]
+
+    if template_data is None and ijrois is None:
+        # Loaded once here, rather than in each worker.
+        template_data = load_template_data(err_if_missing=True)
+
+    args = [(thorimage_dir, z,
+        None if plane_ijrois is None else plane_ijrois[z], trial_start_frames,
+        odor_onset_frames, trial_stop_frames, template_data,
+        chunk_frames, fit_kwargs, frames) for z in range(n_planes)
+    ]
+    if n_workers == 1:
+        results = [_process_volume_plane_star(a) for a in args]
+    else:
+        with mp.Pool(n_workers) as pool:
+            results = pool.map(_process_volume_plane_star, args)
+
+    avgs = np.stack([avg for avg, _ in results])
+    df = pd.concat([df for _, df in results], ignore_index=True)
+    return avgs, df
 
 
 def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
@@ -1174,7 +2660,6 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
     """
     May raise errors if some part of the loading fails.
     """
-    import tifffile
     import ijroi
     from scipy.sparse import coo_matrix
 
@@ -1316,10 +2801,11 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
             (list(set(data['odor_lists'])) + ['no_second_odor'])
         ])
 
-    to_sql_with_duplicates(odors, 'odors')
-
-    # TODO make unique id before insertion? some way that wouldn't require
-    # the IDs, but would create similar tables?
+    # Only inserts / reads back odors whose IDs are not already cached.
+    # Only has the rows of the odors table relevant to this recording.
+    db_odors = odors.assign(odor_id=lookup_ids(odors, 'odors', 'odor_id')
+        ).drop_duplicates(subset='odor_id').set_index(['name', 'log10_conc_vv'])
+    odor_key2id = db_odors.odor_id.to_dict()
 
     first_presentation = first_block * presentations_per_block
     last_presentation = (last_block + 1) * presentations_per_block - 1
@@ -1327,13 +2813,6 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
     odor_list = odor_list[first_presentation:(last_presentation + 1)]
     assert (len(odor_list) % (presentations_per_repeat * n_repeats) == 0)
 
-    # TODO set gui segmentation widget self.db_odors w/ this value at return /
-    # recompute out there
-    db_odors = pd.read_sql('odors', conn)
-    db_odors.set_index(['name', 'log10_conc_vv'],
-        verify_integrity=True, inplace=True
-    )
-
     # TODO invert to check
     # TODO is this sql table worth anything if both keys actually need to be
     # referenced later anyway? (?)
@@ -1343,27 +2822,19 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
     # problem?)
     # TODO only add as many as there were blocks from thorsync timing info?
     if pair_case:
-        # TODO this rounding to 5 decimal places always work?
-        o2c = odors.set_index('name', verify_integrity=True
-            ).log10_conc_vv.round(decimals=5)
+        o2c = odors.set_index('name', verify_integrity=True).log10_conc_vv
 
-        odor1_ids = [db_odors.at[(o1, o2c[o1]), 'odor_id']
-            for o1, _ in odor_list
-        ]
-        odor2_ids = [db_odors.at[(o2, o2c[o2]), 'odor_id']
-            for _, o2 in odor_list
-        ]
+        odor1_ids = [odor_key2id[(o1, o2c[o1])] for o1, _ in odor_list]
+        odor2_ids = [odor_key2id[(o2, o2c[o2])] for _, o2 in odor_list]
         del o2c
     else:
-        odor1_ids = [db_odors.at[tuple(split_odor_w_conc(o)),
-            'odor_id'] for o in odor_list
+        odor1_ids = [odor_key2id[tuple(split_odor_w_conc(o))]
+            for o in odor_list
         ]
 
         # TODO fix db to represent arbitrary mixtures more generally,
         # so this hack isn't necessary
-        no_second_odor_id = db_odors.at[
-            ('no_second_odor', 0.0), 'odor_id'
-        ]
+        no_second_odor_id = odor_key2id[('no_second_odor', 0.0)]
         odor2_ids = [no_second_odor_id] * len(odor1_ids)
 
     # TODO make unique first. only need order for filling in the
@@ -1487,9 +2958,11 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
     # it was still a part of gui.py)?
     print('Loading TIFF {}...'.format(tiff), end='', flush=True)
     start = time.time()
-    # TODO maybe just load a range of movie (if not all blocks/frames used)?
+    # Memory mapped (in the TIFF's dtype) where possible. Only the frames
+    # traces are extracted from are read (and converted to float), in chunks.
     # TODO is cnmf expecting float to be in range [0,1], like skimage?
-    movie = tifffile.imread(tiff).astype('float32')
+    with stage('raw_read', recording=tiff):
+        movie = memmap_tiff(tiff)
     end = time.time()
     print(' done')
     print('Loading TIFF took {:.3f} seconds'.format(end - start))
@@ -1629,10 +3102,23 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
 
     ijrois = ijroi.read_roi_zip(ijroiset_filename)
 
-    frame_shape = movie.shape[1:]
-    footprints = ijrois2masks(ijrois, frame_shape)
+    if len(movie.shape) == 4:
+        # Each plane is processed as its own movie (in parallel), from the raw
+        # data the TIFF was converted from (see hack above), rather than
+        # treating all of a volume's ROIs as one mask.
+        _, volume_df = process_volume(image_dir, ijrois=ijrois,
+            frames=slice(drop_first_n_frames, last_frame + 1)
+        )
+        if len(volume_df) == 0:
+            raise ValueError(f'no ROIs in any plane of {ijroiset_filename}')
+        # Cells are ordered by plane, then by ROI within each plane.
+        raw_f = np.stack(volume_df.raw_f, axis=-1)
+        del volume_df
+    else:
+        frame_shape = movie.shape[1:]
+        footprints = ijrois2masks(ijrois, frame_shape, sparse=True)
 
-    raw_f = extract_traces_boolean_footprints(movie, footprints)
+        raw_f = extract_traces_boolean_footprints(movie, footprints)
     #n_footprints = raw_f.shape[1]
 
     df_over_f = calculate_df_over_f(raw_f, trial_start_frames,
@@ -2105,7 +3591,7 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
     # TODO TODO write a dict pointing to this, to also include PID
     # information in another variable?? or at least stuff to index
     # the PID information?
-    comparison_df.to_pickle(df_filename)
+    write_trace_pickle(comparison_df, df_filename)
     print(' done', flush=True)
 
     # TODO TODO TODO only return dataframes?
@@ -2113,7 +3599,17 @@ def load_recording(tiff, allow_gsheet_to_restrict_blocks=True,
 
 
 def stimfile_odorset(stimfile_path, strict=True):
-    data = load_stimfile(stimfile_path)
+    if not stimfile_path.startswith(stimfile_root()):
+        stimfile_path = join(stimfile_root(), stimfile_path)
+
+    entry = _stimfile_catalog_entry(stimfile_path)
+    odor_set = entry['odor_set' if strict else 'odor_set_nonstrict']
+    if isinstance(odor_set, Exception):
+        raise odor_set
+    return odor_set
+
+
+def _stimfile_odorset(data, stimfile_path, strict=True):
 
     # TODO did i use some other indicator elsewhere? anything more robust than
     # this?
@@ -2162,14 +3658,9 @@ def stimfile_odorset(stimfile_path, strict=True):
 
 
 def print_all_stimfile_odorsets() -> None:
-    stimfiles = sorted(glob.glob(join(stimfile_root(), '*.p')))
-    stimfile_odorsets = [stimfile_odorset(sf, strict=False)
-        for sf in stimfiles
-    ]
+    odor_sets = stimfile_catalog().odor_set
     # TODO maybe print grouped by day
-    pprint([(split(f)[1], s)
-        for f, s in zip(stimfiles, stimfile_odorsets) if s
-    ])
+    pprint([(f, s) for f, s in odor_sets.items() if s])
 
 
 solvents = ('pfo', 'water')
@@ -2300,70 +3791,303 @@ def gsheet_csv_export_link(file_with_edit_link): #, add_default_gid=True):
     return gsheet_link
 
 
-# TODO TODO for this and other stuff that depends on network access (if not
-# cached), fallback to cache (unless explicitly prevented?), and warn
-# that we are doing so (unless cached version explicitly requested)
-_mb_team_gsheet = None
-def mb_team_gsheet(use_cache=False, natural_odors_only=False,
+def _download_mb_team_sheets():
+    """Returns dict of sheet name -> raw DataFrame, downloaded from gsheet.
+    """
+    # TODO TODO maybe env var pointing to this? or w/ link itself?
+    # TODO maybe just get relative path from __file__ w/ /.. or something?
+    # TODO TODO TODO give this an [add_]default_gid=True (set to False here)
+    # so other code of mine can use this function
+    gsheet_link = gsheet_csv_export_link('mb_team_sheet_link.txt')
+
+    # If you want to add more sheets, when you select the new sheet in your
+    # browser, the GID will be at the end of the URL in the address bar.
+    sheet_gids = {
+        'fly_preps': '269082112',
+        'recordings': '0',
+        'daily_settings': '229338960'
+    }
+
+    sheets = dict()
+    for df_name, gid in sheet_gids.items():
+        df = pd.read_csv(gsheet_link + gid)
+
+        # TODO convert any other dtypes?
+        if 'date' in df.columns:
+            df['date'] = pd.to_datetime(df['date'])
+
+        df.drop(columns=[c for c in df.columns
+            if c.startswith('Unnamed: ')], inplace=True)
+
+        if 'fly_num' in df.columns:
+            last_with_fly_num = df.fly_num.notnull()[::-1].idxmax()
+            df.drop(df.iloc[(last_with_fly_num + 1):].index, inplace=True)
+
+        sheets[df_name] = df
+
+    boolean_columns = {
+        'attempt_analysis',
+        'raw_data_discarded',
+        'raw_data_lost'
+    }
+    na_cols = list(set(sheets['recordings'].columns) - boolean_columns)
+    sheets['recordings'].dropna(how='all', subset=na_cols, inplace=True)
+
+    return sheets
+
+
+def _existing_dirs(dirs):
+    """Returns set of the (normalized) paths in `dirs` that are directories.
+
+    Lists the parent directory of each candidate once, so that checking many
+    candidates for existence is one `scandir` per parent, rather than one
+    `isdir` per candidate (which is slow on the NAS). Candidates can be nested
+    any number of levels below each other.
+    """
+    dirs = {normpath(d) for d in dirs}
+    existing = set()
+    for parent_dir in {split(d)[0] for d in dirs}:
+        try:
+            with os.scandir(parent_dir) as it:
+                existing.update(join(parent_dir, e.name) for e in it
+                    if e.is_dir()
+                )
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+    return dirs & existing
+
+
+# Increment if processing in `_process_mb_team_sheets` changes, so that old
+# snapshots are not used.
+_gsheet_snapshot_version = 2
+# Snapshots older than this many seconds will be refreshed (synchronously, or in
+# a background thread, depending on `mb_team_gsheet` kwargs).
+gsheet_snapshot_ttl_s = float(os.getenv('HONG_2P_GSHEET_TTL_S', 15 * 60))
+
+def _gsheet_snapshot_filename(drop_nonexistant_dirs):
+    # The data root is included since processing checks for directories there.
+    key = repr((drop_nonexistant_dirs, normpath(raw_data_root())))
+    key_hash = hashlib.md5(key.encode()).hexdigest()[:10]
+    return join(cache_root(),
+        f'mb_team_gsheet_v{_gsheet_snapshot_version}_{key_hash}.p'
+    )
+
+
+def _load_gsheet_snapshot(snapshot_file):
+    """Returns snapshot dict, or None if missing / from another version.
+    """
+    if not exists(snapshot_file):
+        return None
+
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        warnings.warn(f'could not load gsheet snapshot {snapshot_file}: {e}')
+        return None
+
+    if snapshot.get('version') != _gsheet_snapshot_version:
+        return None
+
+    return snapshot
+
+
+def _save_gsheet_snapshot(snapshot_file, df, flies):
+    snapshot = {
+        'version': _gsheet_snapshot_version,
+        'created_at': time.time(),
+        'df': df,
+        # Processed 'fly_preps' sheet, for `_upload_gsheet_flies`.
+        'flies': flies
+    }
+    # Writing to a temporary file first so readers (possibly in other
+    # processes) never see a partially written snapshot.
+    tmp_file = f'{snapshot_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_file, snapshot_file)
+    return snapshot
+
+
+# (snapshot created_at, flies) not yet uploaded by this process, and
+# created_at of those that have been.
+_gsheet_flies_to_upload = []
+_uploaded_gsheet_flies = set()
+def _upload_gsheet_flies():
+    """Uploads the flies of snapshots this process made or loaded, once each.
+
+    Only called from `mb_team_gsheet`, so it runs in the caller's thread (never
+    the background refresh thread), in the caller's `db_transaction` if there
+    is one, otherwise in a transaction on its own connection.
+    """
+    while len(_gsheet_flies_to_upload) > 0:
+        created_at, flies = _gsheet_flies_to_upload.pop(0)
+        if created_at in _uploaded_gsheet_flies:
+            continue
+
+        flies = flies.rename(columns={'date': 'prep_date'})
+        if getattr(_thread_db, 'connection', None) is not None:
+            to_sql_with_duplicates(flies, 'flies')
+        else:
+            with db_transaction():
+                to_sql_with_duplicates(flies, 'flies')
+
+        _uploaded_gsheet_flies.add(created_at)
+
+
+def _refresh_gsheet_snapshot(drop_nonexistant_dirs, **process_kwargs):
+    """Downloads and processes the sheets, and saves a new snapshot.
+
+    Safe to call from a background thread. Does not access the database.
+    """
+    sheets = _download_mb_team_sheets()
+    df = _process_mb_team_sheets(sheets,
+        drop_nonexistant_dirs=drop_nonexistant_dirs, **process_kwargs
+    )
+    snapshot = _save_gsheet_snapshot(
+        _gsheet_snapshot_filename(drop_nonexistant_dirs), df,
+        sheets['fly_preps']
+    )
+    _gsheet_flies_to_upload.append((snapshot['created_at'], snapshot['flies']))
+    _mb_team_gsheet[drop_nonexistant_dirs] = df
+    return df
+
+
+_gsheet_refresh_threads = dict()
+def _background_refresh_gsheet_snapshot(drop_nonexistant_dirs):
+    thread = _gsheet_refresh_threads.get(drop_nonexistant_dirs)
+    if thread is not None and thread.is_alive():
+        return
+
+    def refresh():
+        try:
+            _refresh_gsheet_snapshot(drop_nonexistant_dirs,
+                print_excluded_on_disk=False
+            )
+        except Exception as e:
+            warnings.warn(f'background gsheet refresh failed: {e}')
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    _gsheet_refresh_threads[drop_nonexistant_dirs] = thread
+    thread.start()
+
+
+# Keys are `drop_nonexistant_dirs`, the only kwarg that changes the output.
+_mb_team_gsheet = dict()
+def mb_team_gsheet(use_cache=False,
     drop_nonexistant_dirs=True, show_inferred_paths=False,
-    print_excluded_on_disk=True, verbose=False):
-    '''Returns a pandas.DataFrame with data on flies and MB team recordings.
-    '''
-    global _mb_team_gsheet
-    if _mb_team_gsheet is not None:
-        return _mb_team_gsheet
+    print_excluded_on_disk=True, verbose=False, ttl_s=None,
+    background_refresh=False, offline_only=None):
+    """Returns a pandas.DataFrame with data on flies and MB team recordings.
 
-    gsheet_cache_file = '.gsheet_cache.p'
-    if use_cache and exists(gsheet_cache_file):
-        print('Loading MB team sheet data from cache at {}'.format(
-            gsheet_cache_file))
+    The fully processed output is memoized per process, and also saved to a
+    versioned snapshot under `cache_root()`, so other processes can skip
+    downloading and processing the sheets (and checking the NAS for each
+    recording's directories).
 
-        with open(gsheet_cache_file, 'rb') as f:
-            sheets = pickle.load(f)
+    Unless offline, the flies from the 'fly_preps' sheet are uploaded to the
+    database (in this thread), once per snapshot made or loaded.
 
-    else:
-        # TODO TODO maybe env var pointing to this? or w/ link itself?
-        # TODO maybe just get relative path from __file__ w/ /.. or something?
-        # TODO TODO TODO give this an [add_]default_gid=True (set to False here)
-        # so other code of mine can use this function
-        gsheet_link = gsheet_csv_export_link('mb_team_sheet_link.txt')
-
-        # If you want to add more sheets, when you select the new sheet in your
-        # browser, the GID will be at the end of the URL in the address bar.
-        sheet_gids = {
-            'fly_preps': '269082112',
-            'recordings': '0',
-            'daily_settings': '229338960'
-        }
+    Only recordings from the 'natural_odors' project are returned.
+
+    Args:
+    use_cache (bool): if True, use any existing snapshot regardless of its age.
+
+    ttl_s (float or None): snapshots older than this are refreshed. Defaults to
+        `gsheet_snapshot_ttl_s` (HONG_2P_GSHEET_TTL_S, 15 minutes if unset).
+        Pass 0 to always download.
+
+    background_refresh (bool): if True, a stale snapshot is returned
+        immediately, and a refreshed snapshot is computed in a daemon thread.
+        Later calls in this process will get the refreshed data once it is
+        done.
+
+    offline_only (bool or None): if True, never access the network (or
+        database). Uses a snapshot of any age, or (if none exists) processes
+        the legacy `.gsheet_cache.p` raw sheets in the current directory.
+        Defaults to the value of `offline()`.
+
+    `show_inferred_paths` and `print_excluded_on_disk` only have an effect when
+    the sheets are actually processed, not when a snapshot is loaded.
+    """
+    if offline_only is None:
+        offline_only = offline()
+
+    if drop_nonexistant_dirs in _mb_team_gsheet:
+        # Including any from a finished background refresh.
+        if not offline_only:
+            _upload_gsheet_flies()
+        return _mb_team_gsheet[drop_nonexistant_dirs]
+
+    if ttl_s is None:
+        ttl_s = gsheet_snapshot_ttl_s
+
+    process_kwargs = dict(
+        drop_nonexistant_dirs=drop_nonexistant_dirs,
+        show_inferred_paths=show_inferred_paths,
+        print_excluded_on_disk=print_excluded_on_disk,
+        verbose=verbose
+    )
+
+    snapshot_file = _gsheet_snapshot_filename(drop_nonexistant_dirs)
+    snapshot = _load_gsheet_snapshot(snapshot_file)
+    if snapshot is not None:
+        age_s = time.time() - snapshot['created_at']
+        fresh = age_s <= ttl_s
 
-        sheets = dict()
-        for df_name, gid in sheet_gids.items():
-            df = pd.read_csv(gsheet_link + gid)
+        if fresh or use_cache or offline_only or background_refresh:
+            if verbose or not fresh:
+                print(f'Loading MB team sheet data from snapshot at '
+                    f'{snapshot_file} ({age_s:.0f}s old)'
+                )
 
-            # TODO convert any other dtypes?
-            if 'date' in df.columns:
-                df['date'] = pd.to_datetime(df['date'])
+            df = snapshot['df']
+            _mb_team_gsheet[drop_nonexistant_dirs] = df
 
-            df.drop(columns=[c for c in df.columns
-                if c.startswith('Unnamed: ')], inplace=True)
+            if not offline_only:
+                _gsheet_flies_to_upload.append(
+                    (snapshot['created_at'], snapshot['flies'])
+                )
+                _upload_gsheet_flies()
 
-            if 'fly_num' in df.columns:
-                last_with_fly_num = df.fly_num.notnull()[::-1].idxmax()
-                df.drop(df.iloc[(last_with_fly_num + 1):].index, inplace=True)
+            if not (fresh or use_cache or offline_only):
+                _background_refresh_gsheet_snapshot(drop_nonexistant_dirs)
 
-            sheets[df_name] = df
+            return df
 
-        boolean_columns = {
-            'attempt_analysis',
-            'raw_data_discarded',
-            'raw_data_lost'
-        }
-        na_cols = list(set(sheets['recordings'].columns) - boolean_columns)
-        sheets['recordings'].dropna(how='all', subset=na_cols, inplace=True)
+    if offline_only:
+        legacy_cache_file = '.gsheet_cache.p'
+        if not exists(legacy_cache_file):
+            raise IOError('offline, and no MB team sheet snapshot at '
+                f'{snapshot_file} (or legacy cache at {legacy_cache_file})'
+            )
+
+        print('Loading MB team sheet data from cache at {}'.format(
+            legacy_cache_file))
+
+        with open(legacy_cache_file, 'rb') as f:
+            sheets = pickle.load(f)
 
-        with open(gsheet_cache_file, 'wb') as f:
-            pickle.dump(sheets, f) 
+        df = _process_mb_team_sheets(sheets, **process_kwargs)
+        _mb_team_gsheet[drop_nonexistant_dirs] = df
+        return df
 
+    df = _refresh_gsheet_snapshot(**process_kwargs)
+    _upload_gsheet_flies()
+    return df
+
+
+def _process_mb_team_sheets(sheets, drop_nonexistant_dirs=True,
+    show_inferred_paths=False, print_excluded_on_disk=True, verbose=False):
+    """
+    Takes dict of raw sheets from `_download_mb_team_sheets` and returns the
+    recordings DataFrame `mb_team_gsheet` should return.
+
+    Modifies the DataFrames in `sheets`. After this, `sheets['fly_preps']` has
+    the rows `_upload_gsheet_flies` uploads.
+    """
     # TODO maybe make df some merge of the three sheets?
     df = sheets['recordings']
 
@@ -2658,13 +4382,6 @@ def mb_team_gsheet(use_cache=False, natural_odors_only=False,
     flies['date'] = flies['date'].fillna(method='ffill')
     flies.dropna(subset=['date','fly_num'], inplace=True)
 
-    # TODO maybe flag to not update database? or just don't?
-    # TODO groups all inserts into transactions across tables, and as few as
-    # possible (i.e. only do this later)?
-    to_sql_with_duplicates(flies.rename(
-        columns={'date': 'prep_date'}), 'flies'
-    )
-
     # For manual sanity checking that important data isn't being excluded
     # inappropriately.
     if print_excluded_on_disk:
@@ -2700,12 +4417,25 @@ def mb_team_gsheet(use_cache=False, natural_odors_only=False,
             pprint(ts_ondisk_not_in_df)
             print('')
 
-    fly_dirs = df.apply(lambda r: raw_fly_dir(r.date, r.fly_num), axis=1)
-    abs_thorimage_dirs = fly_dirs.str.cat(others=df.thorimage_dir, sep='/')
-    abs_thorsync_dirs = fly_dirs.str.cat(others=df.thorsync_dir, sep='/')
-    thorimage_exists = abs_thorimage_dirs.apply(isdir)
-    thorsync_exists = abs_thorsync_dirs.apply(isdir)
-    any_dir_missing = ~ (thorimage_exists & thorsync_exists)
+    fly_dirs = [raw_fly_dir(d, f) for d, f in zip(df.date, df.fly_num)]
+    thorimage_paths = [normpath(join(fd, d)) if isinstance(d, str) else None
+        for fd, d in zip(fly_dirs, df.thorimage_dir)
+    ]
+    thorsync_paths = [normpath(join(fd, d)) if isinstance(d, str) else None
+        for fd, d in zip(fly_dirs, df.thorsync_dir)
+    ]
+    existing_dirs = _existing_dirs(
+        [p for p in thorimage_paths + thorsync_paths if p is not None]
+    )
+    thorimage_exists = np.array([p in existing_dirs for p in thorimage_paths],
+        dtype=bool
+    )
+    thorsync_exists = np.array([p in existing_dirs for p in thorsync_paths],
+        dtype=bool
+    )
+    any_dir_missing = pd.Series(~ (thorimage_exists & thorsync_exists),
+        index=df.index
+    )
 
     any_missing_marked_attempt = (any_dir_missing & df.attempt_analysis)
     # TODO maybe an option to just warn here, rather than failing
@@ -2729,8 +4459,6 @@ def mb_team_gsheet(use_cache=False, natural_odors_only=False,
     # (not critical apart from value as test case, b/c all stuff used from
     # that day has explicit paths in gsheet)
 
-    _mb_team_gsheet = df
-
     # TODO handle case where database is empty but gsheet cache still exists
     # (all inserts will probably fail, for lack of being able to reference fly
     # table)
@@ -3025,9 +4753,59 @@ def git_hash(repo_file):
 # TODO TODO maybe check that remote seems to be valid, and fail if not.
 # don't want to assume we have an online (backed up) record of git repo when we
 # don't...
+# path passed to version_info -> git.Repo
+_git_repos = dict()
+# (git dir, index file stat) -> paths of files in the index
+_git_index_paths = dict()
+# (working tree, HEAD hash, worktree fingerprint) -> version_info output
+# (without used_for)
+_version_info_cache = dict()
+
+def _worktree_fingerprint(repo):
+    """Returns a hash of the stats of the index and all files it tracks.
+
+    Changes whenever `git diff` output could have, without reading any file
+    contents. Returns None if any of these files were modified too recently
+    for their mtimes to be trusted to change on the next modification (as
+    with git's "racily clean" entries).
+    """
+    index_file = join(repo.git_dir, 'index')
+    try:
+        st = os.stat(index_file)
+        index_stat = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        index_stat = None
+
+    paths_key = (repo.git_dir, index_stat)
+    if paths_key not in _git_index_paths:
+        _git_index_paths[paths_key] = sorted({p for p, _ in repo.index.entries})
+    paths = _git_index_paths[paths_key]
+
+    # Coarsest mtime resolution of filesystems we might be on (FAT).
+    racy_ns = 2 * 10**9
+    newest_ok = time.time_ns() - racy_ns
+    if index_stat is not None and index_stat[0] > newest_ok:
+        return None
+
+    h = hashlib.sha1(repr(index_stat).encode())
+    for path in paths:
+        try:
+            st = os.stat(join(repo.working_tree_dir, path))
+        except FileNotFoundError:
+            h.update(f'{path}\0\n'.encode())
+            continue
+        if st.st_mtime_ns > newest_ok:
+            return None
+        h.update(f'{path}\0{st.st_mtime_ns}\0{st.st_size}\n'.encode())
+    return h.hexdigest()
+
+
 def version_info(*args, used_for='', force_git=False):
     """Takes module or string path to file in Git repo to a dict with version
     information (with keys and values the database will accept).
+
+    Git information is computed once per process for each combination of HEAD
+    and state of the tracked files (see `_worktree_fingerprint`).
     """
     import git
     import pkg_resources
@@ -3051,26 +4829,50 @@ def version_info(*args, used_for='', force_git=False):
         module = None
 
     try:
-        repo = git.Repo(pkg_path, search_parent_directories=True)
-        name = split(repo.working_tree_dir)[-1]
-        remote_urls = list(repo.remotes.origin.urls)
-        assert len(remote_urls) == 1
-        remote_url = remote_urls[0]
+        if pkg_path not in _git_repos:
+            _git_repos[pkg_path] = git.Repo(pkg_path,
+                search_parent_directories=True
+            )
+        repo = _git_repos[pkg_path]
 
         current_hash = repo.head.object.hexsha
-
-        index = repo.index
-        diff = index.diff(None, create_patch=True)
-        changes = ''
-        for d in diff:
-            changes += str(d)
+        fingerprint = _worktree_fingerprint(repo)
+        key = (repo.working_tree_dir, current_hash, fingerprint)
+        if fingerprint is None or key not in _version_info_cache:
+            name = split(repo.working_tree_dir)[-1]
+            remote_urls = list(repo.remotes.origin.urls)
+            assert len(remote_urls) == 1
+            remote_url = remote_urls[0]
+
+            index = repo.index
+            diff = index.diff(None, create_patch=True)
+            changes = ''
+            for d in diff:
+                changes += str(d)
+
+            info = {
+                'name': name,
+                'git_remote': remote_url,
+                'git_hash': current_hash,
+                'git_uncommitted_changes': changes
+            }
+            if fingerprint is not None:
+                _version_info_cache[key] = info
+            # git diff can refresh (and rewrite) the index, without any
+            # change to the files.
+            after = _worktree_fingerprint(repo)
+            if after is not None:
+                _version_info_cache[
+                    (repo.working_tree_dir, current_hash, after)] = info
+        else:
+            info = _version_info_cache[key]
 
         return {
-            'name': name,
+            'name': info['name'],
             'used_for': used_for,
-            'git_remote': remote_url,
-            'git_hash': current_hash,
-            'git_uncommitted_changes': changes
+            'git_remote': info['git_remote'],
+            'git_hash': info['git_hash'],
+            'git_uncommitted_changes': info['git_uncommitted_changes']
         }
 
     except git.exc.InvalidGitRepositoryError:
@@ -3089,39 +4891,83 @@ def version_info(*args, used_for='', force_git=False):
         return {'name': name, 'used_for': used_for, 'version': version}
 
 
+def code_diff_hash(changes):
+    """Returns hex SHA-256 of (uncommitted changes) str, as code_diffs uses.
+    """
+    return hashlib.sha256(changes.encode('utf-8')).hexdigest()
+
+
+def _code_version_key(code_version):
+    """Returns tuple identifying a code_versions row, for lookups.
+    """
+    git_hash = code_version.get('git_hash')
+    diff_hash = None
+    if git_hash is not None:
+        diff_hash = code_version.get('diff_hash')
+        if diff_hash is None:
+            diff_hash = code_diff_hash(
+                code_version.get('git_uncommitted_changes') or ''
+            )
+    return (code_version['name'], code_version.get('used_for'), git_hash,
+        diff_hash, code_version.get('version')
+    )
+
+
+# _code_version_key output -> version_id. Cleared if a db_transaction fails,
+# since IDs inserted in it would no longer exist.
+_code_version_ids = dict()
+
 def upload_code_info(code_versions):
-    """Returns a list of integer IDs for inserted code version rows.
+    """Returns a list of integer IDs for (inserted if new) code version rows.
+
+    code_versions should be a list of dicts, as `version_info` returns.
 
-    code_versions should be a list of dicts, each dict representing a row in the
-    corresponding table.
+    Rows are looked up by (name, git_hash, diff_hash) (or version, if not from
+    Git), and the uncommitted changes are stored once per distinct diff, in
+    code_diffs. IDs are also cached for the rest of the process.
     """
-    global conn
-    if conn is None:
-        conn = get_db_conn()
+    from sqlalchemy import text
+
+    conn = current_db_conn()
 
     if len(code_versions) == 0:
         raise ValueError('code versions can not be empty')
 
-    code_versions_df = pd.DataFrame(code_versions)
-    # TODO delete try/except
-    try:
-        code_versions_df.to_sql('code_versions', conn, if_exists='append',
-            index=False)
-    except:
-        print(code_versions_df)
-        import ipdb; ipdb.set_trace()
+    version_ids = list()
+    for code_version in code_versions:
+        key = _code_version_key(code_version)
+        if key not in _code_version_ids:
+            name, used_for, git_hash, diff_hash, version = key
+            params = {'name': name, 'used_for': used_for, 'git_hash': git_hash,
+                'diff_hash': diff_hash, 'version': version,
+                'git_remote': code_version.get('git_remote')
+            }
+            if git_hash is not None:
+                conn.execute(text('INSERT INTO code_diffs (diff_hash, diff) '
+                    'VALUES (:diff_hash, :diff) ON CONFLICT DO NOTHING'),
+                    {'diff_hash': diff_hash, 'diff':
+                    code_version.get('git_uncommitted_changes') or ''}
+                )
+                where = 'git_hash = :git_hash AND diff_hash = :diff_hash'
+            else:
+                where = 'git_hash IS NULL AND version = :version'
 
-    # TODO maybe only read most recent few / restrict to some other key if i
-    # make one?
-    db_code_versions = pd.read_sql('code_versions', conn)
+            version_id = conn.execute(text('SELECT version_id FROM '
+                f'code_versions WHERE name = :name AND {where} AND '
+                'used_for IS NOT DISTINCT FROM :used_for ORDER BY version_id '
+                'LIMIT 1'), params
+            ).scalar()
 
-    our_version_cols = code_versions_df.columns
-    version_ids = list()
-    for _, row in code_versions_df.iterrows():
-        # This should take the *first* row that is equal.
-        idx = (db_code_versions[code_versions_df.columns] == row).all(
-            axis=1).idxmax()
-        version_id = db_code_versions['version_id'].iat[idx]
+            if version_id is None:
+                version_id = conn.execute(text('INSERT INTO code_versions '
+                    '(name, used_for, git_remote, git_hash, diff_hash, version)'
+                    ' VALUES (:name, :used_for, :git_remote, :git_hash, '
+                    ':diff_hash, :version) RETURNING version_id'), params
+                ).scalar()
+
+            _code_version_ids[key] = version_id
+
+        version_id = _code_version_ids[key]
         assert version_id not in version_ids
         version_ids.append(version_id)
 
@@ -3133,9 +4979,7 @@ def upload_analysis_info(*args) -> None:
     Requires that corresponding row in analysis_runs table already exists,
     if only two args are passed.
     """
-    global conn
-    if conn is None:
-        conn = get_db_conn()
+    conn = current_db_conn()
 
     have_ids = False
     if len(args) == 2:
@@ -3171,6 +5015,212 @@ def upload_analysis_info(*args) -> None:
     to_sql_with_duplicates(analysis_code, 'analysis_code')
 
 
+def upload_presentation_responses(presentation_df, response_df, key_cols):
+    """Uploads one presentation, then its responses w/ the generated ID.
+    """
+    # Only reads back the row for this presentation.
+    db_presentation = to_sql_with_duplicates(presentation_df, 'presentations',
+        returning=(list(presentation_df.columns) + ['presentation_id'])
+    )
+    assert len(db_presentation) == 1, \
+        'presentation_id could not be determined uniquely'
+
+    check_inserted(presentation_df, db_presentation, key_cols)
+    presentation_id = db_presentation.presentation_id.iat[0]
+
+    response_df = response_df.copy()
+    response_df['presentation_id'] = presentation_id
+    to_sql_with_duplicates(response_df, 'responses')
+
+
+def upload_segmentation_run(run_at, fig_mpl, fig_png, fig_svg, run_len_seconds):
+    """Uploads a segmentation run, with its figure as a pickle, PNG and SVG.
+
+    The figure is rendered by the caller, since this usually runs in an upload
+    worker thread, and matplotlib rendering is not thread-safe.
+    """
+    # TODO TODO failed a few times on this insert, possibly b/c fig size
+    # try inserting one at a time? fallback to saving to nas and including
+    # filepath in another column?
+    segmentation_run = pd.DataFrame({
+        'run_at': [run_at],
+        'output_fig_png': fig_png,
+        'output_fig_svg': fig_svg,
+        'output_fig_mpl': fig_mpl,
+        'run_len_seconds': run_len_seconds
+    })
+    segmentation_run.set_index('run_at').to_sql('segmentation_runs',
+        current_db_conn(), if_exists='append', method=pg_upsert
+    )
+
+
+def _upsert(df, table_name):
+    df.to_sql(table_name, current_db_conn(), if_exists='append',
+        method=pg_upsert
+    )
+
+
+# Names of functions that steps of upload jobs can call. Names, rather than the
+# functions, are stored in the journal, so it can be read by later versions.
+upload_step_fns = {
+    'to_sql_with_duplicates': to_sql_with_duplicates,
+    'upsert': _upsert,
+    'analysis_info': upload_analysis_info,
+    'presentation_responses': upload_presentation_responses,
+    'segmentation_run': upload_segmentation_run
+}
+
+def upload_queue_dir():
+    """Returns directory with the journal of uploads not yet in the database.
+    """
+    return join(cache_root(), 'upload_queue')
+
+
+def enqueue_upload(steps, description=None):
+    """Saves an upload job, to be run by `process_upload_queue`.
+
+    `steps` is a list of (step name, *args) tuples, with names from
+    `upload_step_fns`. All steps of a job are run in one transaction, in order.
+
+    Returns the path to the job's journal file.
+    """
+    for step in steps:
+        if step[0] not in upload_step_fns:
+            raise ValueError(f'unknown upload step {step[0]}')
+
+    queue_dir = upload_queue_dir()
+    os.makedirs(queue_dir, exist_ok=True)
+    # Sorting by name gives the order jobs were queued in.
+    job_file = join(queue_dir, f'{time.time_ns()}_{os.getpid()}.p')
+    job = {
+        'queued_at': datetime.now(),
+        'description': description,
+        'steps': steps
+    }
+    tmp_file = job_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(job, f)
+    os.replace(tmp_file, job_file)
+    return job_file
+
+
+def pending_uploads():
+    """Returns list of journal files of jobs waiting to be uploaded, in order.
+    """
+    return sorted(glob.glob(join(upload_queue_dir(), '*.p')))
+
+
+def failed_uploads():
+    return sorted(glob.glob(join(upload_queue_dir(), '*.p.failed')))
+
+
+def _in_progress_upload_dir():
+    return join(upload_queue_dir(), 'in_progress')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def requeue_abandoned_uploads():
+    """Moves jobs claimed by processes that no longer exist back to the queue.
+
+    Their transactions never committed (the process died first), so they
+    can be run again.
+    """
+    for claimed in glob.glob(join(_in_progress_upload_dir(), '*.p.*')):
+        job_name, pid = split(claimed)[1].rsplit('.', 1)
+        if not _pid_alive(int(pid)):
+            try:
+                os.rename(claimed, join(upload_queue_dir(), job_name))
+            # Another process requeued it first.
+            except FileNotFoundError:
+                pass
+
+
+def process_upload_queue(progress_callback=None, job_callback=None):
+    """Uploads all pending jobs, each in its own transaction, over one connection.
+
+    Each job is first claimed by renaming (atomically) its journal file into
+    the 'in_progress' subdirectory, with this process's PID appended, so
+    multiple processes (e.g. two gui instances) never upload the same job.
+    Jobs other processes claimed first are skipped.
+
+    Jobs that fail are rolled back and renamed to end with '.failed' (see
+    `failed_uploads`), with the traceback saved next to them ('.err'), so that
+    later jobs can still run. Rename them back to retry.
+
+    `progress_callback`, if passed, is called as
+    `progress_callback(n_done, n_total, description)` after each job.
+    `job_callback`, if passed, is called as `job_callback(job_file, tb)` after
+    each job this process ran, with `job_file` as returned by `enqueue_upload`
+    and `tb` the traceback str if it failed, otherwise None.
+
+    Returns list of (job file, traceback str) for jobs that failed.
+    """
+    import traceback
+
+    requeue_abandoned_uploads()
+    job_files = pending_uploads()
+    failures = []
+    if len(job_files) == 0:
+        return failures
+
+    in_progress_dir = _in_progress_upload_dir()
+    os.makedirs(in_progress_dir, exist_ok=True)
+
+    connection = get_db_conn().connect()
+    try:
+        for i, job_file in enumerate(job_files):
+            claimed = join(in_progress_dir,
+                f'{split(job_file)[1]}.{os.getpid()}'
+            )
+            try:
+                os.rename(job_file, claimed)
+            except FileNotFoundError:
+                # Another process claimed it.
+                continue
+
+            with open(claimed, 'rb') as f:
+                job = pickle.load(f)
+            tb = None
+            try:
+                with stage('upload_job'):
+                    with db_transaction(connection):
+                        for step in job['steps']:
+                            upload_step_fns[step[0]](*step[1:])
+
+            except Exception:
+                tb = traceback.format_exc()
+                with open(job_file + '.err', 'w') as f:
+                    f.write(tb)
+                os.replace(claimed, job_file + '.failed')
+                failures.append((job_file, tb))
+            # e.g. KeyboardInterrupt. The transaction was rolled back, so the
+            # job can just be run again later.
+            except BaseException:
+                os.replace(claimed, job_file)
+                raise
+            else:
+                os.remove(claimed)
+
+            if job_callback is not None:
+                job_callback(job_file, tb)
+
+            if progress_callback is not None:
+                progress_callback(i + 1, len(job_files), job['description'])
+    finally:
+        connection.close()
+
+    return failures
+
+
 def motion_corrected_tiff_filename(date, fly_num, thorimage_id):
     """Takes vars identifying recording to the name of a motion corrected TIFF
     for it. Non-rigid preferred over rigid. Relies on naming convention.
@@ -4213,6 +6263,113 @@ def cnmf_metadata_from_thor(filename):
     return {'fr': fps, 'dxy': dxy}
 
 
+# Number of processes for CNMF runs on memory mapped data. None (if
+# HONG_2P_CNMF_N_PROCESSES is unset or 0) lets CaImAn pick (# CPUs - 1).
+cnmf_n_processes = int(os.environ.get('HONG_2P_CNMF_N_PROCESSES', 0)) or None
+# Frames read from the TIFF (and written to the memmap) at a time.
+cnmf_memmap_chunk_frames = 500
+
+def cnmf_memmap_dir():
+    return join(cache_root(), 'cnmf_memmap')
+
+
+def cnmf_memmap(tiff, start_frame=0, stop_frame=None, chunk_frames=None,
+    verbose=True):
+    """Returns path to a C-order CaImAn memmap of `tiff[start_frame:stop_frame]`.
+
+    Written under `cnmf_memmap_dir()` the first time, and reused as long as the
+    TIFF's size and modification time are the same. The TIFF is read
+    `chunk_frames` at a time, so the whole movie is never in memory.
+
+    The filename follows CaImAn's convention, so the output can be loaded with
+    `caiman.load_memmap` (or `load_cnmf_memmap`).
+    """
+    import tifffile
+
+    if chunk_frames is None:
+        chunk_frames = cnmf_memmap_chunk_frames
+
+    st = os.stat(tiff)
+    with tifffile.TiffFile(tiff) as tif:
+        n_pages = len(tif.pages)
+        frame_shape = tif.pages[0].shape
+        if len(frame_shape) != 2:
+            raise NotImplementedError('only single plane TIFFs supported')
+
+        if stop_frame is None:
+            stop_frame = n_pages
+        assert 0 <= start_frame < stop_frame <= n_pages
+        n_frames = stop_frame - start_frame
+
+        key = (os.path.abspath(tiff), st.st_size, st.st_mtime_ns, start_frame,
+            stop_frame
+        )
+        key_hash = hashlib.md5(repr(key).encode()).hexdigest()[:10]
+        base = os.path.splitext(split(tiff)[1])[0]
+        d1, d2 = frame_shape
+        # CaImAn parses dimensions + order from this.
+        mmap_fname = join(cnmf_memmap_dir(), f'{base}_{key_hash}_d1_{d1}_d2_'
+            f'{d2}_d3_1_order_C_frames_{n_frames}_.mmap'
+        )
+        if exists(mmap_fname):
+            return mmap_fname
+
+        os.makedirs(cnmf_memmap_dir(), exist_ok=True)
+        if verbose:
+            print(f'Writing CNMF memmap {mmap_fname}...', end='', flush=True)
+
+        tmp_fname = f'{mmap_fname}.{os.getpid()}.tmp'
+        # Pixels (in Fortran order, as CaImAn expects) by frames.
+        Yr = np.memmap(tmp_fname, mode='w+', dtype=np.float32,
+            shape=(d1 * d2, n_frames), order='C'
+        )
+        try:
+            for t0 in range(start_frame, stop_frame, chunk_frames):
+                t1 = min(t0 + chunk_frames, stop_frame)
+                frames = tif.asarray(key=range(t0, t1))
+                Yr[:, (t0 - start_frame):(t1 - start_frame)] = np.reshape(
+                    frames, (t1 - t0, d1 * d2), order='F').T
+            Yr.flush()
+            del Yr
+            os.replace(tmp_fname, mmap_fname)
+        except:
+            del Yr
+            os.remove(tmp_fname)
+            raise
+
+    if verbose:
+        print(' done')
+
+    return mmap_fname
+
+
+def load_cnmf_memmap(mmap_fname):
+    """Returns read-only (t, x, y) view of a memmap from `cnmf_memmap`.
+    """
+    from caiman import load_memmap
+
+    Yr, dims, n_frames = load_memmap(mmap_fname)
+    return np.reshape(Yr.T, [n_frames] + list(dims), order='F')
+
+
+def start_cnmf_cluster(n_processes=None):
+    """Returns (dview, n_processes) for a local CaImAn process cluster.
+
+    Pass the dview to `caiman.stop_server` when done.
+    """
+    import caiman
+
+    if n_processes is None:
+        n_processes = cnmf_n_processes
+
+    # In case a previous run didn't stop its cluster.
+    caiman.stop_server()
+    _, dview, n_processes = caiman.cluster.setup_cluster(backend='local',
+        n_processes=n_processes, single_thread=False
+    )
+    return dview, n_processes
+
+
 def get_thorimage_n_flyback_xml(xml):
     streaming = xml.find('Streaming')
     assert streaming.attrib['enable'] == '1'
@@ -4254,9 +6411,24 @@ def load_thorimage_metadata(thorimage_directory, return_xml=False):
 
 
 # TODO rename to indicate a thor (+raw?) format
+@instrumented('raw_read', recording_arg='thorimage_dir')
 def read_movie(thorimage_dir, discard_flyback=True):
     """Returns (t,[z,]x,y) indexed timeseries as a numpy array.
     """
+    return _load_raw_movie(thorimage_dir, discard_flyback=discard_flyback)
+
+
+def raw_movie_memmap(thorimage_dir, discard_flyback=True):
+    """Like `read_movie`, but the (read-only) array is memory mapped.
+
+    So frames are only read from disk as they are indexed.
+    """
+    return _load_raw_movie(thorimage_dir, discard_flyback=discard_flyback,
+        memmap=True
+    )
+
+
+def _load_raw_movie(thorimage_dir, discard_flyback=True, memmap=False):
     fps, xy, z, c, n_flyback, imaging_file, xml = \
         load_thorimage_metadata(thorimage_dir, return_xml=True)
 
@@ -4265,8 +6437,11 @@ def read_movie(thorimage_dir, discard_flyback=True):
     # From ThorImage manual: "unsigned, 16-bit, with little-endian byte-order"
     dtype = np.dtype('<u2')
 
-    with open(imaging_file, 'rb') as f:
-        data = np.fromfile(f, dtype=dtype)
+    if memmap:
+        data = np.memmap(imaging_file, dtype=dtype, mode='r')
+    else:
+        with open(imaging_file, 'rb') as f:
+            data = np.fromfile(f, dtype=dtype)
 
     # TODO maybe just don't read the data known to be flyback frames?
 
@@ -4335,7 +6510,9 @@ def write_tiff(tiff_filename, movie):
     # TODO actually make sure any metadata we use is the same
     # TODO maybe just always do test from test_readraw here?
     # (or w/ flag to disable the check)
-    tifffile.imsave(tiff_filename, movie, imagej=True)
+    # (imsave was removed from newer tifffile versions)
+    imwrite = getattr(tifffile, 'imwrite', None) or tifffile.imsave
+    imwrite(tiff_filename, movie, imagej=True)
 
 
 def full_frame_avg_trace(movie):
@@ -4388,12 +6565,460 @@ def crop_to_nonzero(matrix, margin=0):
     return crop_to_coord_bbox(matrix, coords, margin=margin)
 
 
+class FootprintBBoxIndex:
+    """Bounding boxes of footprints, for finding those near a region quickly.
+
+    Boxes are (inclusive) ((x_min, x_max), (y_min, y_max)) of nonzero pixels,
+    as `crop_to_nonzero` returns w/ margin=0.
+    """
+    def __init__(self, footprints):
+        """footprints: dict of ID -> 2D array, all of the same shape.
+        """
+        self.footprints = footprints
+        self.ids = []
+        bboxes = []
+        for fid, footprint in footprints.items():
+            coords = np.argwhere(footprint > 0)
+            if len(coords) == 0:
+                continue
+            self.ids.append(fid)
+            (x_min, y_min), (x_max, y_max) = (coords.min(axis=0),
+                coords.max(axis=0)
+            )
+            bboxes.append((x_min, x_max, y_min, y_max))
+
+        self.ids = np.array(self.ids)
+        self.bboxes = np.array(bboxes, dtype=np.int64).reshape(-1, 4)
+
+    def overlapping(self, x_min, x_max, y_min, y_max, exclude=None):
+        """Returns dict of ID -> footprint cropped to (inclusive) region.
+
+        Only includes footprints with nonzero pixels in the region. Bounding
+        boxes narrow the candidates, so only a few footprints are checked.
+        """
+        b = self.bboxes
+        candidates = self.ids[
+            (b[:, 0] <= x_max) & (b[:, 1] >= x_min) &
+            (b[:, 2] <= y_max) & (b[:, 3] >= y_min)
+        ]
+        near = dict()
+        for fid in candidates:
+            if exclude is not None and fid == exclude:
+                continue
+            in_region = self.footprints[fid][x_min:x_max+1, y_min:y_max+1]
+            if (in_region > 0).any():
+                near[fid] = in_region
+        return near
+
+
+def trial_dff_images(movie, odor_onset_frames, background_frames,
+    response_frames):
+    """Returns (trial, x, y) stack of mean response dF/F images.
+
+    For each onset, (mean of `response_frames` from onset - mean of the
+    `background_frames` before it) / that background mean. Only the frames in
+    these windows are read, so `movie` can be a memmap.
+    """
+    stack = np.empty((len(odor_onset_frames),) + movie.shape[1:],
+        dtype=np.float32
+    )
+    for i, onset in enumerate(odor_onset_frames):
+        background = np.asarray(movie[(onset - background_frames):onset],
+            dtype=np.float64).mean(axis=0)
+        response = np.asarray(movie[onset:(onset + response_frames)],
+            dtype=np.float64).mean(axis=0)
+        # TODO divide by zero issues? how to avoid? suppress
+        # warning if turn to NaN OK?
+        stack[i] = (response - background) / background
+    return stack
+
+
+def memmap_tiff(tiff):
+    """Returns read-only memmap of TIFF, or loads it if it can't be mapped.
+    """
+    import tifffile
+    try:
+        return tifffile.memmap(tiff, mode='r')
+    # tifffile raises this if data is not stored contiguously (e.g. compressed)
+    except ValueError:
+        return tifffile.imread(tiff)
+
+
+class SparseFootprints:
+    """
+    Set of footprints stored as pixel indices, with one CSR row per footprint.
+
+    `indices[indptr[i]:indptr[i + 1]]` are the sorted (C order) flat indices,
+    into a frame of `frame_shape`, of the pixels in footprint i. `weights` has
+    the corresponding values, or is None for boolean masks.
+
+    Has `shape` and `dtype` like the dense (frame_shape + (n_footprints,))
+    arrays `ijrois2masks` returns, and `to_dense` to get one of those.
+    """
+    def __init__(self, frame_shape, indptr, indices, weights=None,
+        names=None):
+
+        self.frame_shape = tuple(int(x) for x in frame_shape)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        if weights is not None:
+            weights = np.asarray(weights)
+            assert weights.shape == self.indices.shape
+        self.weights = weights
+        self.names = names
+        assert self.indptr[-1] == len(self.indices)
+
+    @classmethod
+    def from_dense(cls, footprints, names=None):
+        """Takes array of shape (frame_shape + (n_footprints,)).
+        """
+        frame_shape = footprints.shape[:-1]
+        flat = np.reshape(footprints, (-1, footprints.shape[-1])).T
+        n_footprints, flat_idx = np.nonzero(flat)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(n_footprints,
+            minlength=flat.shape[0]))
+        ))
+        weights = None
+        if footprints.dtype != np.bool_:
+            weights = flat[n_footprints, flat_idx]
+        return cls(frame_shape, indptr, flat_idx, weights=weights, names=names)
+
+    @classmethod
+    def from_ijrois(cls, ijrois, shape):
+        """Rasterizes ROIs from my ijroi fork, as `ijrois2masks` does.
+
+        Each ROI is only drawn within its bounding box, so no full-frame
+        arrays are made.
+        """
+        import cv2
+        if len(shape) != 2:
+            return cls.from_dense(ijrois2masks(ijrois, shape),
+                names=[n for n, _ in ijrois]
+            )
+
+        names = []
+        index_arrays = []
+        for name, contour in ijrois:
+            # (x, y) points, w/ x indexing the first dimension of the output,
+            # as after `imagej2py_coords` in `ijrois2masks`.
+            contour = np.reshape(contour, (-1, 2)).astype(np.int32)
+            bbox_min = contour.min(axis=0)
+            bbox_max = contour.max(axis=0)
+            w, h = bbox_max - bbox_min + 1
+            mask = np.zeros((h, w), np.uint8)
+            cv2.drawContours(mask, [contour - bbox_min], 0, 1, -1)
+            ys, xs = np.nonzero(mask)
+            xs = xs + bbox_min[0]
+            ys = ys + bbox_min[1]
+            in_frame = (xs >= 0) & (xs < shape[0]) & (ys >= 0) & (ys < shape[1])
+            index_arrays.append(np.sort(np.ravel_multi_index(
+                (xs[in_frame], ys[in_frame]), shape
+            )))
+            names.append(name)
+
+        indptr = np.concatenate(([0], np.cumsum([len(x) for x in index_arrays])
+        ))
+        indices = (np.concatenate(index_arrays) if len(index_arrays) > 0
+            else np.array([], dtype=np.int64)
+        )
+        return cls(shape, indptr, indices, names=names)
+
+    @classmethod
+    def from_circles(cls, centers, radii, shape, names=None):
+        """Makes boolean footprints of circles, as `fit_circle_rois` returns.
+
+        Centers are indexed the same way as ijroi points are (so the first
+        coordinate indexes the first dimension of the footprints).
+        """
+        centers = np.reshape(centers, (-1, 2))
+        radii = np.broadcast_to(radii, (len(centers),))
+        index_arrays = []
+        for (cx, cy), r in zip(centers, radii):
+            xs = np.arange(max(int(np.floor(cx - r)), 0),
+                min(int(np.ceil(cx + r)) + 1, shape[0])
+            )
+            ys = np.arange(max(int(np.floor(cy - r)), 0),
+                min(int(np.ceil(cy + r)) + 1, shape[1])
+            )
+            inside = ((xs[:, None] - cx)**2 + (ys[None, :] - cy)**2) <= r**2
+            ix, iy = np.nonzero(inside)
+            # (already sorted, since nonzero is in C order)
+            index_arrays.append(np.ravel_multi_index((xs[ix], ys[iy]), shape))
+
+        indptr = np.concatenate(([0], np.cumsum([len(x) for x in index_arrays])
+        ))
+        indices = (np.concatenate(index_arrays) if len(index_arrays) > 0
+            else np.array([], dtype=np.int64)
+        )
+        return cls(shape, indptr, indices, names=names)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def shape(self):
+        return self.frame_shape + (len(self),)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.bool_) if self.weights is None else self.weights.dtype
+
+    def n_pixels(self):
+        """Returns array with number of nonzero pixels in each footprint.
+        """
+        return np.diff(self.indptr)
+
+    def _data(self):
+        if self.weights is None:
+            return np.ones(len(self.indices), dtype=np.bool_)
+        return self.weights
+
+    def csr(self):
+        """Returns (n_footprints, n_frame_pixels) scipy.sparse.csr_matrix.
+        """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self._data(), self.indices, self.indptr),
+            shape=(len(self), int(np.prod(self.frame_shape)))
+        )
+
+    def coords(self, i):
+        """Returns (tuple of coordinate arrays, weights) of footprint i.
+        """
+        s = slice(self.indptr[i], self.indptr[i + 1])
+        coords = np.unravel_index(self.indices[s], self.frame_shape)
+        return coords, self._data()[s]
+
+    def select(self, which):
+        """Returns SparseFootprints with only footprints at integer `which`.
+        """
+        which = np.atleast_1d(which)
+        starts = self.indptr[which]
+        stops = self.indptr[which + 1]
+        take = (np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)])
+            if len(which) > 0 else np.array([], dtype=np.int64)
+        )
+        indptr = np.concatenate(([0], np.cumsum(stops - starts)))
+        weights = None if self.weights is None else self.weights[take]
+        names = (None if self.names is None
+            else [self.names[i] for i in which]
+        )
+        return SparseFootprints(self.frame_shape, indptr, self.indices[take],
+            weights=weights, names=names
+        )
+
+    def footprint(self, name):
+        """Returns dense footprint (of `frame_shape`) with `name`.
+        """
+        if getattr(self, '_name2index', None) is None:
+            self._name2index = {n: i for i, n in enumerate(self.names)}
+        return self.to_dense(which=[self._name2index[name]])[..., 0]
+
+    def to_dense(self, which=None):
+        """Returns array of (frame_shape + (n_footprints,)).
+
+        `which` (integer indices) only densifies those footprints.
+        """
+        fps = self if which is None else self.select(which)
+        dense = np.zeros((len(fps), int(np.prod(self.frame_shape))),
+            dtype=self.dtype
+        )
+        rows = np.repeat(np.arange(len(fps)), fps.n_pixels())
+        dense[rows, fps.indices] = fps._data()
+        return np.moveaxis(dense.reshape((len(fps),) + self.frame_shape), 0,
+            -1
+        )
+
+    def label_image(self):
+        """Returns int32 image w/ 0 as background and i + 1 in footprint i.
+
+        Raises ValueError if any footprints overlap.
+        """
+        if len(np.unique(self.indices)) != len(self.indices):
+            raise ValueError('footprints overlap, so can not be represented '
+                'by a label image'
+            )
+        labels = np.zeros(int(np.prod(self.frame_shape)), dtype=np.int32)
+        labels[self.indices] = np.repeat(np.arange(1, len(self) + 1),
+            self.n_pixels()
+        )
+        return labels.reshape(self.frame_shape)
+
+    def to_flat_cnmf_dims(self):
+        """Returns (n_pixels, n_footprints) scipy.sparse.csc_matrix, as CNMF A.
+
+        Same layout as `footprints_to_flat_cnmf_dims` on the dense array.
+        """
+        from scipy.sparse import csc_matrix
+        coords = np.unravel_index(self.indices, self.frame_shape)
+        f_order_indices = np.ravel_multi_index(coords, self.frame_shape,
+            order='F'
+        )
+        # csc_matrix sorts indices within columns as needed.
+        A = csc_matrix((self._data().astype(np.float64), f_order_indices,
+            self.indptr), shape=(int(np.prod(self.frame_shape)), len(self))
+        )
+        A.sort_indices()
+        return A
+
+
+def iter_footprint_coords(footprints):
+    """Yields (tuple of coordinate arrays, weights) for each footprint.
+
+    Takes either a `SparseFootprints` or a dense array of
+    (frame_shape + (n_footprints,)).
+    """
+    if isinstance(footprints, SparseFootprints):
+        for i in range(len(footprints)):
+            yield footprints.coords(i)
+    else:
+        slices = (slice(None),) * (len(footprints.shape) - 1)
+        for i in range(footprints.shape[-1]):
+            footprint = footprints[slices + (i,)]
+            coords = np.nonzero(footprint)
+            yield coords, footprint[coords]
+
+
+# Packed `cells.footprint` (bytea) format. Little endian header of
+# (format version, kind, n), then:
+# - weighted kind: n int16 x coords, n int16 y coords, n float32 weights
+# - rle kind: bounding box (int16 x_min, int16 y_min, uint16 x extent,
+#   uint16 y extent), then n uint32 run lengths alternating between pixels
+#   outside and inside the footprint, over the C order flattened bounding box
+#   (starting with pixels outside, which can be a run of 0).
+footprint_format_version = 1
+_footprint_header = struct.Struct('<BBI')
+_footprint_bbox = struct.Struct('<hhHH')
+_weighted_footprint = 0
+_rle_footprint = 1
+
+def encode_footprint(x_coords, y_coords, weights=None, rle=None):
+    """Returns bytes for the `footprint` column of the cells table.
+
+    rle (bool or None): whether to run length encode the footprint as a
+        boolean mask. By default, this is done if there are no `weights` or
+        they are all 1 (and there are no duplicate coordinates).
+    """
+    x_coords = np.asarray(x_coords, dtype=np.int16)
+    y_coords = np.asarray(y_coords, dtype=np.int16)
+    assert x_coords.shape == y_coords.shape
+    n = len(x_coords)
+
+    if rle is None:
+        rle = (n > 0 and (weights is None or (np.asarray(weights) == 1).all())
+            and len(set(zip(x_coords.tolist(), y_coords.tolist()))) == n
+        )
+
+    if not rle:
+        if weights is None:
+            weights = np.ones(n)
+        weights = np.asarray(weights, dtype='<f4')
+        assert weights.shape == x_coords.shape
+        return b''.join([
+            _footprint_header.pack(footprint_format_version,
+                _weighted_footprint, n
+            ),
+            x_coords.astype('<i2').tobytes(),
+            y_coords.astype('<i2').tobytes(),
+            weights.tobytes()
+        ])
+
+    x_min, y_min = int(x_coords.min()), int(y_coords.min())
+    x_extent = int(x_coords.max()) - x_min + 1
+    y_extent = int(y_coords.max()) - y_min + 1
+    mask = np.zeros(x_extent * y_extent, dtype=np.int8)
+    mask[(x_coords - x_min).astype(np.int64) * y_extent + (y_coords - y_min)
+        ] = 1
+    # Indices where the mask changes value, bounded by start and end.
+    changes = np.flatnonzero(np.diff(mask)) + 1
+    bounds = np.concatenate(([0], changes, [len(mask)]))
+    runs = np.diff(bounds)
+    if mask[0] == 1:
+        runs = np.concatenate(([0], runs))
+    return b''.join([
+        _footprint_header.pack(footprint_format_version, _rle_footprint,
+            len(runs)
+        ),
+        _footprint_bbox.pack(x_min, y_min, x_extent, y_extent),
+        runs.astype('<u4').tobytes()
+    ])
+
+
+def decode_footprint(buf):
+    """Returns (x_coords, y_coords, weights) arrays from `encode_footprint` bytes.
+    """
+    buf = bytes(buf)
+    version, kind, n = _footprint_header.unpack_from(buf)
+    if version != footprint_format_version:
+        raise ValueError(f'unsupported footprint format version {version}')
+    offset = _footprint_header.size
+
+    if kind == _weighted_footprint:
+        x_coords = np.frombuffer(buf, dtype='<i2', count=n, offset=offset)
+        y_coords = np.frombuffer(buf, dtype='<i2', count=n,
+            offset=offset + 2 * n
+        )
+        weights = np.frombuffer(buf, dtype='<f4', count=n,
+            offset=offset + 4 * n
+        )
+        return (x_coords.astype(np.int16), y_coords.astype(np.int16),
+            weights.astype(np.float32)
+        )
+
+    elif kind == _rle_footprint:
+        x_min, y_min, x_extent, y_extent = \
+            _footprint_bbox.unpack_from(buf, offset)
+        runs = np.frombuffer(buf, dtype='<u4', count=n,
+            offset=offset + _footprint_bbox.size
+        ).astype(np.int64)
+        # Odd runs are the pixels inside the footprint.
+        values = np.arange(len(runs)) % 2 == 1
+        flat = np.flatnonzero(np.repeat(values, runs))
+        x_coords = (flat // y_extent + x_min).astype(np.int16)
+        y_coords = (flat % y_extent + y_min).astype(np.int16)
+        return x_coords, y_coords, np.ones(len(flat), dtype=np.float32)
+
+    else:
+        raise ValueError(f'unknown footprint encoding kind {kind}')
+
+
+def decode_footprint_columns(df):
+    """Fills x_coords, y_coords and weights from any packed `footprint` values.
+
+    For DataFrames read from the cells table. Rows w/o a `footprint` (uploaded
+    before it existed) keep their x_coords, y_coords and weights arrays, so
+    all rows can be used the same way afterwards. The `footprint` column is
+    dropped.
+    """
+    if 'footprint' not in df.columns:
+        return df
+
+    df = df.copy()
+    packed = df.footprint.notnull()
+    for col in ('x_coords', 'y_coords', 'weights'):
+        if col not in df.columns:
+            df[col] = None
+        df[col] = df[col].astype(object)
+
+    if packed.any():
+        decoded = [decode_footprint(b) for b in df.footprint[packed]]
+        for i, col in enumerate(('x_coords', 'y_coords', 'weights')):
+            df.loc[packed, col] = pd.Series([d[i] for d in decoded],
+                index=df.index[packed], dtype=object
+            )
+
+    return df.drop(columns='footprint')
+
+
 # TODO better name?
 def db_row2footprint(db_row, shape=None):
     """Returns dense array w/ footprint from row in cells table.
     """
     from scipy.sparse import coo_matrix
-    weights, x_coords, y_coords = db_row[['weights','x_coords','y_coords']]
+    if 'footprint' in db_row.index and db_row['footprint'] is not None:
+        x_coords, y_coords, weights = decode_footprint(db_row['footprint'])
+    else:
+        weights, x_coords, y_coords = \
+            db_row[['weights','x_coords','y_coords']]
     # TODO maybe read shape from db / metadata on disk? / merging w/ other
     # tables (possible?)?
     footprint = np.array(coo_matrix((weights, (x_coords, y_coords)),
@@ -4404,8 +7029,67 @@ def db_row2footprint(db_row, shape=None):
 def db_footprints2array(df, shape):
     """Returns footprints in an array of dims (shape + (n_footprints,)).
     """
-    return np.stack([db_row2footprint(r, shape) for _, r in df.iterrows()],
-        axis=-1)
+    return db_footprints2sparse(df, shape).to_dense()
+
+
+def db_footprints2sparse(df, shape, transpose=True):
+    """Returns `SparseFootprints` w/ all rows from the cells table at once.
+
+    The coordinate arrays of all rows are concatenated and converted to one
+    sparse (footprints x pixels) matrix, rather than decoding row by row.
+
+    transpose (bool): if True, footprints are indexed as `db_row2footprint`
+        returns them (i.e. the transpose of the (x_coords, y_coords) array of
+        `shape`). Otherwise, they are indexed by (x_coords, y_coords).
+
+    Footprints are named by the `cell` column (or the index, if there is no
+    such column).
+    """
+    from scipy.sparse import coo_matrix
+    df = decode_footprint_columns(df)
+    shape = tuple(shape)
+    lengths = df.x_coords.map(len).values
+    if len(df) > 0 and lengths.sum() > 0:
+        x_coords = np.concatenate(df.x_coords.values).astype(np.int64)
+        y_coords = np.concatenate(df.y_coords.values).astype(np.int64)
+        weights = np.concatenate(df.weights.values).astype(np.float64)
+    else:
+        x_coords = y_coords = np.array([], dtype=np.int64)
+        weights = np.array([], dtype=np.float64)
+
+    if transpose:
+        frame_shape = shape[::-1]
+        coords = (y_coords, x_coords)
+    else:
+        frame_shape = shape
+        coords = (x_coords, y_coords)
+
+    rows = np.repeat(np.arange(len(df)), lengths)
+    # Converting to CSR sums any duplicate coordinates, as densifying each
+    # coo_matrix in db_row2footprint did.
+    footprints = coo_matrix((weights, (rows,
+        np.ravel_multi_index(coords, frame_shape))),
+        shape=(len(df), int(np.prod(frame_shape)))
+    ).tocsr()
+    footprints.sort_indices()
+
+    names = list(df.cell if 'cell' in df.columns else df.index)
+    return SparseFootprints(frame_shape, footprints.indptr,
+        footprints.indices, weights=footprints.data, names=names
+    )
+
+
+def db_footprints_by_run(df, shape, transpose=True):
+    """Returns dict of segmentation_run -> `SparseFootprints` for those rows.
+
+    `shape` can also be a dict of segmentation_run -> shape, for runs on
+    movies of different shapes. See `db_footprints2sparse`.
+    """
+    return {run: db_footprints2sparse(run_df,
+            shape[run] if isinstance(shape, dict) else shape,
+            transpose=transpose
+        ) for run, run_df in df.groupby('segmentation_run', sort=False)
+    }
 
 
 # TODO test w/ mpl / cv2 contours that never see ij to see if transpose is
@@ -4429,11 +7113,16 @@ def contour2mask(contour, shape):
     return mask.astype('bool')
 
 
-def ijrois2masks(ijrois, shape):
+def ijrois2masks(ijrois, shape, sparse=False):
     """
     Transforms ROIs loaded from my ijroi fork to an array full of boolean masks,
     of dimensions (shape + (n_rois,)).
+
+    If `sparse` is True, returns a `SparseFootprints` instead.
     """
+    if sparse:
+        return SparseFootprints.from_ijrois(ijrois, shape)
+
     # TODO maybe index final pandas thing by ijroi name (before .roi prefix)
     # (or just return np array indexed as CNMF "A" is) (?)
     if len(shape) == 2:
@@ -4504,6 +7193,9 @@ def footprints_to_flat_cnmf_dims(footprints):
     There is more than one way this reshaping can be done, and this produces
     output as CNMF expects it.
     """
+    if isinstance(footprints, SparseFootprints):
+        return footprints.to_flat_cnmf_dims()
+
     frame_pixels = np.prod(footprints.shape[:-1])
     n_footprints = footprints.shape[-1]
     # TODO TODO is this supposed to be order='F' or order='C' matter?
@@ -4512,12 +7204,20 @@ def footprints_to_flat_cnmf_dims(footprints):
     return np.reshape(footprints, (frame_pixels, n_footprints), order='F')
 
 
+@instrumented('trace_extraction')
 def extract_traces_boolean_footprints(movie, footprints,
     footprint_framenums=None, verbose=True):
     """
     Averages the movie within each boolean mask in footprints
     to make a matrix of traces (n_frames x n_footprints).
+
+    `footprints` can also be a boolean `SparseFootprints`.
     """
+    if isinstance(footprints, SparseFootprints):
+        return _extract_traces_sparse_footprints(movie, footprints,
+            verbose=verbose
+        )
+
     assert footprints.dtype.kind != 'f', 'float footprints are not boolean'
     assert footprints.max() == 1, 'footprints not boolean'
     assert footprints.min() == 0, 'footprints not boolean'
@@ -4550,6 +7250,39 @@ def extract_traces_boolean_footprints(movie, footprints,
     return traces
 
 
+def _extract_traces_sparse_footprints(movie, footprints, chunk_frames=1000,
+    verbose=True):
+    assert footprints.weights is None, 'footprints not boolean'
+    assert movie.shape[1:] == footprints.frame_shape
+    n_pixels = footprints.n_pixels()
+    assert (n_pixels > 0).all(), 'some zero footprints'
+
+    if verbose:
+        print('extracting traces from sparse boolean masks...', end='',
+            flush=True
+        )
+
+    from scipy.sparse import csr_matrix
+    # Each row averages the pixels in one footprint.
+    averager = csr_matrix((np.repeat(1 / n_pixels, n_pixels),
+        footprints.indices, footprints.indptr),
+        shape=(len(footprints), int(np.prod(footprints.frame_shape)))
+    )
+    n_frames = movie.shape[0]
+    flat_movie = movie.reshape(n_frames, -1)
+    traces = np.empty((n_frames, len(footprints)))
+    # In chunks, so only a chunk of frames needs to be copied for the sparse
+    # product (and the movie can be a memmap).
+    for start in range(0, n_frames, chunk_frames):
+        chunk = np.asarray(flat_movie[start:(start + chunk_frames)])
+        traces[start:(start + len(chunk))] = (averager @ chunk.T).T
+
+    if verbose:
+        print(' done')
+
+    return traces
+
+
 def exp_decay(t, scale, tau, offset):
     # TODO is this the usual definition of tau (as in RC time constant?)
     return scale * np.exp(-t / tau) + offset
@@ -4596,6 +7329,189 @@ def fit_exp_decay(signal, sampling_rate=None, times=None, numerical_scale=1.0):
     return (scale / numerical_scale, tau, offset / numerical_scale), sigmas
 
 
+def _exp_decay_jacobian(t, scale, tau):
+    """Returns (..., n_samples, 3) derivatives of `exp_decay` wrt its params.
+    """
+    e = np.exp(-t / tau[..., None])
+    return np.stack([e, scale[..., None] * e * t / tau[..., None]**2,
+        np.ones_like(e)], axis=-1
+    )
+
+
+def _initial_exp_decay_params(signals, times, valid):
+    """Returns (n_series, 3) initial guesses from log-linear regressions.
+
+    The offset is guessed as a bit beyond the mean of the last quarter of each
+    signal, and log(|signal - offset|) is then fit linearly against time.
+    """
+    n_valid = valid.sum(axis=1)
+    idx = np.arange(signals.shape[1])
+    # Assumes NaN (invalid) samples are all at the end of each series.
+    tail = valid & (idx >= (n_valid * 3 // 4)[:, None])
+    head = valid & (idx < np.maximum(n_valid // 4, 1)[:, None])
+    tail_mean = np.nanmean(np.where(tail, signals, np.nan), axis=1)
+    head_mean = np.nanmean(np.where(head, signals, np.nan), axis=1)
+
+    sign = np.where(head_mean >= tail_mean, 1.0, -1.0)
+    span = np.nanmax(signals, axis=1) - np.nanmin(signals, axis=1)
+    offset = tail_mean - sign * 0.05 * np.where(span > 0, span, 1.0)
+
+    shifted = sign[:, None] * (signals - offset[:, None])
+    w = (valid & (shifted > 0)).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(w > 0, np.log(np.where(w > 0, shifted, 1.0)), 0.0)
+
+    # Weighted least squares fit of z = intercept + slope * t.
+    tz = np.where(w > 0, times, 0.0)
+    sw = w.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_mean = (w * tz).sum(axis=1) / sw
+        z_mean = (w * z).sum(axis=1) / sw
+        slope = ((w * (tz - t_mean[:, None]) * (z - z_mean[:, None])).sum(
+            axis=1) / (w * (tz - t_mean[:, None])**2).sum(axis=1)
+        )
+    intercept = z_mean - slope * t_mean
+
+    t_span = np.nanmax(np.where(valid, times, np.nan), axis=1)
+    # Fall back to a slow decay if the regression doesn't give one.
+    bad = ~ (np.isfinite(slope) & (slope < 0))
+    tau = np.where(bad, t_span, -1 / np.where(bad, -1.0, slope))
+    scale = sign * np.where(np.isfinite(intercept), np.exp(intercept),
+        np.where(span > 0, span, 1.0)
+    )
+    return np.stack([scale, tau, offset], axis=1)
+
+
+def fit_exp_decays(signals, times, numerical_scale=1.0, p0=None,
+    max_iter=100, tol=1e-10, fallback=True):
+    """Fits `exp_decay` to each row of `signals` at once.
+
+    Each series is refined with Levenberg-Marquardt, with all series stepped
+    together as arrays, starting from log-linear initial guesses (or `p0`).
+    Series that don't converge are re-fit w/ `fit_exp_decay` (`curve_fit`) if
+    `fallback` is True.
+
+    Args:
+        signals (np.ndarray): (n_series, n_samples), each beginning at decay
+            onset. Series can be padded with trailing NaN to share a length.
+        times (np.ndarray): (n_samples,) times shared by all series, or
+            (n_series, n_samples) times for each.
+        p0 (array-like): (3,) or (n_series, 3) initial (scale, tau, offset),
+            in units of the input signals.
+
+    Returns (params, sigmas, converged), where params and sigmas are
+    (n_series, 3) arrays in the same order as `fit_exp_decay` returns them,
+    and converged is an (n_series,) bool array. Parameters of series that
+    could not be fit at all are NaN.
+    """
+    signals = np.array(signals, dtype=np.float64, ndmin=2) * numerical_scale
+    n_series, n_samples = signals.shape
+    times = np.broadcast_to(np.asarray(times, dtype=np.float64),
+        signals.shape
+    )
+    valid = np.isfinite(signals) & np.isfinite(times)
+    # Masked samples contribute 0 to residuals and the Jacobian.
+    y = np.where(valid, signals, 0.0)
+    t = np.where(valid, times, 0.0)
+    n_valid = valid.sum(axis=1)
+
+    if p0 is None:
+        p = _initial_exp_decay_params(np.where(valid, signals, np.nan), t,
+            valid
+        )
+    else:
+        p = np.array(np.broadcast_to(p0, (n_series, 3)), dtype=np.float64)
+        p[:, [0, 2]] *= numerical_scale
+
+    def cost(p, rows):
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            r = np.where(valid[rows], y[rows] - exp_decay(t[rows], p[:, :1],
+                p[:, 1:2], p[:, 2:]), 0.0
+            )
+            c = (r**2).sum(axis=1)
+        return r, np.where(np.isfinite(c), c, np.inf)
+
+    r, c = cost(p, slice(None))
+    lam = np.full(n_series, 1e-3)
+    converged = np.zeros(n_series, dtype=bool)
+    active = (n_valid > 3) & np.isfinite(c)
+    eye = np.eye(3)
+    for _ in range(max_iter):
+        if not active.any():
+            break
+
+        pa = p[active]
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            J = _exp_decay_jacobian(t[active], pa[:, 0], pa[:, 1]) * \
+                valid[active][..., None]
+        JTJ = np.einsum('nmi,nmj->nij', J, J)
+        g = np.einsum('nmi,nm->ni', J, r[active])
+
+        A = JTJ + lam[active, None, None] * (JTJ * eye + 1e-12 * eye)
+        try:
+            delta = np.linalg.solve(A, g[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = np.einsum('nij,nj->ni', np.linalg.pinv(A), g)
+
+        new_p = pa + delta
+        new_r, new_c = cost(new_p, active)
+        accept = new_c < c[active]
+
+        idx = np.flatnonzero(active)
+        acc_idx = idx[accept]
+        rel_change = (c[acc_idx] - new_c[accept]) / np.maximum(c[acc_idx],
+            np.finfo(float).tiny
+        )
+        p[acc_idx] = new_p[accept]
+        r[acc_idx] = new_r[accept]
+        c[acc_idx] = new_c[accept]
+        lam[acc_idx] /= 10
+        lam[idx[~ accept]] *= 10
+
+        step_small = np.all(np.abs(delta[accept]) <= 1e-10 * (np.abs(
+            p[acc_idx]) + 1e-10), axis=1
+        )
+        done = acc_idx[(rel_change < tol) | step_small]
+        converged[done] = True
+        # Stuck, i.e. no step in any direction reduces the cost.
+        converged[idx[~ accept][lam[idx[~ accept]] > 1e10]] = True
+        active[done] = False
+        active[lam > 1e10] = False
+
+    converged &= np.isfinite(p).all(axis=1) & np.isfinite(c)
+
+    sigmas = np.full((n_series, 3), np.nan)
+    dof = n_valid - 3
+    ok = converged & (dof > 0)
+    if ok.any():
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            J = _exp_decay_jacobian(t[ok], p[ok, 0], p[ok, 1]) * \
+                valid[ok][..., None]
+        JTJ = np.einsum('nmi,nmj->nij', J, J)
+        # Same scaling of the covariance as curve_fit w/ absolute_sigma=False
+        pcov = np.linalg.pinv(JTJ) * (c[ok] / dof[ok])[:, None, None]
+        sigmas[ok] = np.sqrt(np.abs(np.diagonal(pcov, axis1=1, axis2=2)))
+
+    p[:, [0, 2]] /= numerical_scale
+    sigmas[:, [0, 2]] /= numerical_scale
+    p[~ converged] = np.nan
+
+    if fallback:
+        for i in np.flatnonzero(~ converged):
+            v = valid[i]
+            try:
+                params, s = fit_exp_decay(signals[i, v] / numerical_scale,
+                    times=times[i, v], numerical_scale=numerical_scale
+                )
+            except (RuntimeError, ValueError, TypeError):
+                continue
+            p[i] = params
+            sigmas[i] = s
+            converged[i] = np.isfinite(p[i]).all()
+
+    return p, sigmas, converged
+
+
 def latest_analysis(verbose=False):
     global conn
     if conn is None:
@@ -4749,7 +7665,7 @@ def latest_analysis_footprints(analysis_run_df):
     footprints = pd.read_sql_query(
         'SELECT * FROM cells WHERE segmentation_run IN ' +
         sql_timestamp_list(analysis_run_df), conn)
-    return footprints
+    return decode_footprint_columns(footprints)
 
 
 def latest_analysis_traces(df):
@@ -5151,191 +8067,594 @@ def drop_incomplete_presentations():
     raise NotImplementedError
 
 
-def smooth(x, window_len=11, window='hanning'):
-    """smooth the data using a window with requested size.
-    
-    This method is based on the convolution of a scaled window with the signal.
-    The signal is prepared by introducing reflected copies of the signal 
-    (with the window size) in both ends so that transient parts are minimized
-    in the begining and end part of the output signal.
-    
-    input:
-        x: the input signal 
-        window_len: the dimension of the smoothing window; should be an odd
-            integer
-        window: the type of window from 'flat', 'hanning', 'hamming',
-            'bartlett', 'blackman' flat window will produce a moving average
-            smoothing.
+def smooth(x, window_len=11, window='hanning'):
+    """smooth the data using a window with requested size.
+    
+    This method is based on the convolution of a scaled window with the signal.
+    The signal is prepared by introducing reflected copies of the signal 
+    (with the window size) in both ends so that transient parts are minimized
+    in the begining and end part of the output signal.
+    
+    input:
+        x: the input signal 
+        window_len: the dimension of the smoothing window; should be an odd
+            integer
+        window: the type of window from 'flat', 'hanning', 'hamming',
+            'bartlett', 'blackman' flat window will produce a moving average
+            smoothing.
+
+    output:
+        the smoothed signal
+        
+    example:
+
+    t=linspace(-2,2,0.1)
+    x=sin(t)+randn(len(t))*0.1
+    y=smooth(x)
+    
+    see also: 
+    
+    numpy.hanning, numpy.hamming, numpy.bartlett, numpy.blackman, numpy.convolve
+    scipy.signal.lfilter
+ 
+    TODO: the window parameter could be the window itself if an array instead of
+    a string
+    NOTE: length(output) != length(input), to correct this: return
+    y[(window_len/2-1):-(window_len/2)] instead of just y.
+    """
+    if x.ndim != 1:
+        raise ValueError("smooth only accepts 1 dimension arrays.")
+
+    if x.size < window_len:
+        raise ValueError("Input vector needs to be bigger than window size.")
+
+
+    if window_len<3:
+        return x
+
+
+    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
+        raise ValueError("Window is on of 'flat', 'hanning', " +
+            "'hamming', 'bartlett', 'blackman'")
+
+
+    # is this necessary?
+    #s = np.r_[x[window_len-1:0:-1],x,x[-2:-window_len-1:-1]]
+
+    #print(len(s))
+    if window == 'flat': #moving average
+        w = np.ones(window_len, 'd')
+    else:
+        w = eval('np.' + window + '(window_len)')
+
+    #y = np.convolve(w/w.sum(), s, mode='valid')
+    # not sure what to change above to get this to work...
+
+    y = np.convolve(w/w.sum(), x, mode='same')
+    return y
+
+
+def _wrap_displacements(n):
+    """Returns displacement of each index of a circular (FFT) axis of length n.
+    """
+    i = np.arange(n)
+    return np.where(i > n // 2, i - n, i)
+
+
+def _register_ffts(F, template_fft, allowed, upsample_factor=10):
+    """Returns (displacements (..., 2), peak values (...)) of frames to template.
+
+    F and template_fft are 2D FFTs (over the last two axes) of the frames and
+    template. The displacement is that maximizing their (circular) cross
+    correlation, among those where `allowed` (a boolean mask broadcastable to
+    the correlation) is True. Integer peaks are then refined to
+    1 / `upsample_factor` pixels by evaluating the inverse DFT on an upsampled
+    grid around them (as NoRMCorre / dftregistration do).
+
+    Peak values are normalized by the norms of the frames and template.
+
+    Displacements d are such that frame(p) ~= template(p - d).
+    """
+    # (whitening, as in phase correlation, did worse on small patches, where
+    # the patch edges make a strong peak at zero displacement)
+    R = F * np.conj(template_fft)
+    # Excluding the DC term is equivalent to subtracting the means first.
+    R[..., 0, 0] = 0
+    r = np.fft.ifft2(R).real
+    nx, ny = r.shape[-2:]
+    flat = np.where(allowed, r, -np.inf).reshape(r.shape[:-2] + (-1,))
+    ix, iy = np.unravel_index(flat.argmax(axis=-1), (nx, ny))
+    dx = _wrap_displacements(nx)[ix].astype(np.float64)
+    dy = _wrap_displacements(ny)[iy].astype(np.float64)
+
+    def power(X):
+        return (np.abs(X)**2).sum(axis=(-2, -1)) - np.abs(X[..., 0, 0])**2
+
+    norm = np.sqrt(power(F) * power(template_fft)) / (nx * ny)
+
+    peak = np.take_along_axis(flat, (ix * ny + iy)[..., None], -1)[..., 0]
+    if upsample_factor <= 1:
+        return np.stack([dx, dy], axis=-1), peak / norm
+
+    # 1.5 pixels on either side of the integer peak.
+    offsets = np.arange(-1.5 * upsample_factor, 1.5 * upsample_factor + 1
+        ) / upsample_factor
+    def kernel(d, n):
+        # (..., n_offsets, n) inverse DFT terms at the points d + offsets
+        return np.exp(2j * np.pi * (d[..., None] + offsets)[..., None] *
+            np.fft.fftfreq(n)
+        ) / n
+
+    R = np.broadcast_to(R, np.broadcast_shapes(R.shape, ix.shape + (nx, ny)))
+    up = np.matmul(np.matmul(kernel(dx, nx), R),
+        np.swapaxes(kernel(dy, ny), -1, -2)
+    ).real
+    up_flat = up.reshape(up.shape[:-2] + (-1,))
+    i = up_flat.argmax(axis=-1)
+    ux, uy = np.unravel_index(i, up.shape[-2:])
+    peak = np.take_along_axis(up_flat, i[..., None], -1)[..., 0]
+    return np.stack([dx + offsets[ux], dy + offsets[uy]], axis=-1), peak / norm
+
+
+def _fourier_shift(F, displacements):
+    """Returns frames (from FFTs `F`) resampled at p + displacement.
+    """
+    nx, ny = F.shape[-2:]
+    kx = np.fft.fftfreq(nx)[:, None]
+    ky = np.fft.fftfreq(ny)[None, :]
+    phase = np.exp(2j * np.pi * (kx * displacements[:, 0, None, None] +
+        ky * displacements[:, 1, None, None])
+    )
+    return np.fft.ifft2(F * phase).real
+
+
+def _patch_starts(n, patch_size, stride):
+    if patch_size >= n:
+        return np.array([0]), n
+    starts = list(range(0, n - patch_size + 1, stride))
+    if starts[-1] != n - patch_size:
+        starts.append(n - patch_size)
+    return np.array(starts), patch_size
+
+
+def _interpolation_weights(n, centers):
+    """Returns (lower grid index, upper grid index, weight of upper) per pixel.
+    """
+    u = np.interp(np.arange(n), centers, np.arange(len(centers)))
+    if len(centers) == 1:
+        i0 = np.zeros(n, dtype=np.int64)
+        return i0, i0, np.zeros(n)
+    i0 = np.minimum(np.floor(u).astype(np.int64), len(centers) - 2)
+    return i0, i0 + 1, u - i0
+
+
+class _MotionCorrector:
+    """Registration of batches of frames to one template.
+
+    Rigid registration is by cross correlation of whole frames. If `nonrigid`,
+    frames are then split into overlapping patches, each registered (all
+    patches of a batch of frames at once) within `max_dev` pixels of the rigid
+    displacement of its frame. The patch displacements are interpolated to a
+    displacement for each pixel.
+    """
+    def __init__(self, template, max_shift=15, upsample_factor=10,
+        nonrigid=False, grid_size=(64, 64), overlap=32, max_dev=3):
+
+        self.template = np.asarray(template, dtype=np.float64)
+        nx, ny = self.template.shape
+        self.template_fft = np.fft.fft2(self.template)
+        self.max_shift = max_shift
+        self.upsample_factor = upsample_factor
+        dx = np.abs(_wrap_displacements(nx))
+        dy = np.abs(_wrap_displacements(ny))
+        self.allowed = (dx[:, None] <= max_shift) & (dy[None, :] <= max_shift)
+        self.nonrigid = nonrigid
+        self.max_dev = max_dev
+        if not nonrigid:
+            return
+
+        self.x_starts, px = _patch_starts(nx, grid_size[0] + overlap,
+            grid_size[0]
+        )
+        self.y_starts, py = _patch_starts(ny, grid_size[1] + overlap,
+            grid_size[1]
+        )
+        self.patch_shape = (px, py)
+        self.patch_centers = (self.x_starts + (px - 1) / 2,
+            self.y_starts + (py - 1) / 2
+        )
+        self.template_patch_fft = np.fft.fft2(self._patches(
+            self.template[None])[0]
+        )
+        self.x_weights = _interpolation_weights(nx, self.patch_centers[0])
+        self.y_weights = _interpolation_weights(ny, self.patch_centers[1])
+        self.patch_dx = _wrap_displacements(px)
+        self.patch_dy = _wrap_displacements(py)
+        self.grid = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+
+    def _patches(self, frames):
+        """Returns (n_frames, n_x_patches, n_y_patches, px, py) patches.
+        """
+        px, py = self.patch_shape
+        return np.stack([np.stack([frames[:, x:(x + px), y:(y + py)]
+            for y in self.y_starts], axis=1) for x in self.x_starts], axis=1
+        )
+
+    def register(self, frames):
+        """Returns (corrected frames, rigid displacements, peaks, patch
+        displacements (None if not nonrigid)).
+        """
+        frames = np.asarray(frames, dtype=np.float64)
+        F = np.fft.fft2(frames)
+        shifts, peaks = _register_ffts(F, self.template_fft, self.allowed,
+            self.upsample_factor
+        )
+        # (refinement can otherwise go up to 1.5 pixels past the limits)
+        shifts = np.clip(shifts, -self.max_shift, self.max_shift)
+        if not self.nonrigid:
+            return _fourier_shift(F, shifts), shifts, peaks, None
+
+        from scipy.ndimage import map_coordinates
+
+        rigid = np.round(shifts).astype(np.int64)
+        ax = ((np.abs(self.patch_dx[None] - rigid[:, :1]) <= self.max_dev) &
+            (np.abs(self.patch_dx[None]) <= self.max_shift)
+        )
+        ay = ((np.abs(self.patch_dy[None] - rigid[:, 1:]) <= self.max_dev) &
+            (np.abs(self.patch_dy[None]) <= self.max_shift)
+        )
+        allowed = (ax[:, None, None, :, None] & ay[:, None, None, None, :])
+        patch_shifts, _ = _register_ffts(
+            np.fft.fft2(self._patches(frames)), self.template_patch_fft[None],
+            allowed, self.upsample_factor
+        )
+        patch_shifts = np.clip(patch_shifts,
+            np.maximum(rigid - self.max_dev, -self.max_shift)[:, None, None],
+            np.minimum(rigid + self.max_dev, self.max_shift)[:, None, None]
+        )
+
+        (x0, x1, fx), (y0, y1, fy) = self.x_weights, self.y_weights
+        fx = fx[:, None, None]
+        fy = fy[None, :, None]
+        S = patch_shifts
+        field = ((1 - fx) * (1 - fy) * S[:, x0[:, None], y0[None, :]] +
+            fx * (1 - fy) * S[:, x1[:, None], y0[None, :]] +
+            (1 - fx) * fy * S[:, x0[:, None], y1[None, :]] +
+            fx * fy * S[:, x1[:, None], y1[None, :]]
+        )
+        gx, gy = self.grid
+        corrected = np.empty_like(frames)
+        for i in range(len(frames)):
+            corrected[i] = map_coordinates(frames[i], [gx + field[i, ..., 0],
+                gy + field[i, ..., 1]], order=1, mode='nearest'
+            )
+        return corrected, shifts, peaks, patch_shifts
+
+
+def _open_movie(source):
+    if isinstance(source, np.ndarray):
+        return source
+    if isdir(source):
+        movie = raw_movie_memmap(source)
+    else:
+        movie = memmap_tiff(source)
+    # (single plane "volumes")
+    if len(movie.shape) == 4 and movie.shape[1] == 1:
+        movie = movie[:, 0]
+    return movie
+
+
+def _motion_correct_chunk(args):
+    """Registers frames [start, stop) of `source`, in batches.
+
+    If `output` is a path, corrected frames are written to that memmap (of
+    `output_shape`). Otherwise, if `return_frames`, they are returned.
+    """
+    (source, start, stop, template, corrector_kwargs, output, output_shape,
+        return_frames, batch_frames) = args
+
+    movie = _open_movie(source)
+    corrector = _MotionCorrector(template, **corrector_kwargs)
+    out = None
+    if output is not None:
+        out = np.memmap(output, dtype='>u2', mode='r+', shape=output_shape)
+
+    centered_template = template - template.mean()
+    template_norm = np.sqrt((centered_template**2).sum())
+
+    shifts, peaks, corrs, patch_shifts, frames = [], [], [], [], []
+    frame_sum = np.zeros(template.shape)
+    for b_start in range(start, stop, batch_frames):
+        b_stop = min(b_start + batch_frames, stop)
+        corrected, s, p, ps = corrector.register(movie[b_start:b_stop])
+        shifts.append(s)
+        peaks.append(p)
+        if ps is not None:
+            patch_shifts.append(ps.astype(np.float32))
+
+        centered = corrected - corrected.mean(axis=(1, 2), keepdims=True)
+        corrs.append((centered * centered_template).sum(axis=(1, 2)) /
+            (np.sqrt((centered**2).sum(axis=(1, 2))) * template_norm)
+        )
+        frame_sum += corrected.sum(axis=0)
+
+        if out is not None or return_frames:
+            corrected = np.clip(np.round(corrected), 0, np.iinfo(np.uint16).max
+                ).astype(np.uint16)
+            if out is not None:
+                out[b_start:b_stop] = corrected
+            else:
+                frames.append(corrected)
+
+    if out is not None:
+        out.flush()
+
+    return {
+        'shifts': np.concatenate(shifts),
+        'peaks': np.concatenate(peaks),
+        'corrs': np.concatenate(corrs),
+        'patch_shifts': (np.concatenate(patch_shifts) if len(patch_shifts) > 0
+            else None
+        ),
+        'frame_sum': frame_sum,
+        'frames': np.concatenate(frames) if len(frames) > 0 else None
+    }
+
+
+def motion_correct_movie(source, output=None, nonrigid=False, n_workers=None,
+    max_shift=15, upsample_factor=10, bin_width=50, init_batch=100, n_iter=2,
+    n_template_bins=10, chunk_frames=500, batch_frames=25, grid_size=(64, 64),
+    overlap=32, max_dev=3, verbose=True):
+    """Motion corrects a (t, x, y) movie, streaming frames from disk.
+
+    Registers frames to a template by FFT cross correlation (rigid, or
+    piecewise-rigid if `nonrigid`), in the manner of NoRMCorre.
+
+    The template starts as the registered mean of the first `init_batch`
+    frames. For each of the first `n_iter - 1` passes over the movie, bins of
+    `bin_width` frames are registered and the template is updated to the mean
+    of the last `n_template_bins` registered bin means. Each round registers
+    one bin per worker against the current template. In the last pass, the
+    template is fixed and chunks of `chunk_frames` frames are registered in
+    parallel, in a pool of `n_workers` processes.
+
+    Args:
+        source: path to a ThorImage directory (raw data is memory mapped) or
+            TIFF (memory mapped if possible), or a (t, x, y) array (in which
+            case only one process is used).
+        output: path to write corrected frames to, as a big-endian uint16
+            memmap (suitable for `write_tiff`). If None, corrected frames are
+            returned in memory.
+
+    Returns (corrected movie, info), where info is a dict with:
+    - 'template': final template
+    - 'avg': mean of the corrected frames
+    - 'shifts': DataFrame w/ the displacement of each frame relative to the
+      template (x_shift, y_shift), the normalized cross correlation peak, and
+      the correlation of the corrected frame with the template
+    - 'patch_shifts': (t, n_x_patches, n_y_patches, 2) displacements of each
+      patch (None if not `nonrigid`)
+    - 'patch_centers': (x centers, y centers) of the patches (or None)
+    """
+    import multiprocessing as mp
+    from collections import deque
+
+    movie = _open_movie(source)
+    if len(movie.shape) != 3:
+        raise ValueError('can only motion correct (t, x, y) movies')
+    n_frames = movie.shape[0]
+
+    if isinstance(source, np.ndarray):
+        # (would have to pickle the whole movie to each worker, even if it is
+        # a memmap)
+        n_workers = 1
+    elif n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    corrector_kwargs = dict(max_shift=max_shift,
+        upsample_factor=upsample_factor, nonrigid=nonrigid
+    )
+    if nonrigid:
+        corrector_kwargs.update(grid_size=grid_size, overlap=overlap,
+            max_dev=max_dev
+        )
+
+    def run(chunks, template, pool, **kwargs):
+        args = [(source, start, stop, template, corrector_kwargs,
+            kwargs.get('output'), movie.shape, kwargs.get('return_frames',
+            False), batch_frames) for start, stop in chunks
+        ]
+        if pool is None:
+            return [_motion_correct_chunk(a) for a in args]
+        return pool.map(_motion_correct_chunk, args)
+
+    pool = mp.Pool(n_workers) if n_workers > 1 else None
+    try:
+        init_stop = min(init_batch, n_frames)
+        template = np.asarray(movie[:init_stop], dtype=np.float64).mean(axis=0)
+        # Rigid registration of the initial frames to their own mean, twice.
+        rigid_kwargs = dict(max_shift=max_shift,
+            upsample_factor=upsample_factor
+        )
+        for _ in range(2):
+            result = _motion_correct_chunk((movie, 0, init_stop, template,
+                rigid_kwargs, None, None, False, batch_frames
+            ))
+            template = result['frame_sum'] / init_stop
+
+        bins = [(s, min(s + bin_width, n_frames))
+            for s in range(0, n_frames, bin_width)
+        ]
+        for i in range(n_iter - 1):
+            if verbose:
+                print(f'motion correction template pass {i + 1}/{n_iter - 1}'
+                    '...', flush=True
+                )
+            bin_means = deque(maxlen=n_template_bins)
+            for r in range(0, len(bins), n_workers):
+                round_bins = bins[r:(r + n_workers)]
+                for (start, stop), result in zip(round_bins,
+                    run(round_bins, template, pool)):
+                    bin_means.append(result['frame_sum'] / (stop - start))
+                template = np.mean(bin_means, axis=0)
+
+        if verbose:
+            print('registering frames...', end='', flush=True)
 
-    output:
-        the smoothed signal
-        
-    example:
+        if output is not None:
+            # Workers open this in r+ mode and each fill their own frames.
+            np.memmap(output, dtype='>u2', mode='w+', shape=movie.shape).flush()
 
-    t=linspace(-2,2,0.1)
-    x=sin(t)+randn(len(t))*0.1
-    y=smooth(x)
-    
-    see also: 
-    
-    numpy.hanning, numpy.hamming, numpy.bartlett, numpy.blackman, numpy.convolve
-    scipy.signal.lfilter
- 
-    TODO: the window parameter could be the window itself if an array instead of
-    a string
-    NOTE: length(output) != length(input), to correct this: return
-    y[(window_len/2-1):-(window_len/2)] instead of just y.
-    """
-    if x.ndim != 1:
-        raise ValueError("smooth only accepts 1 dimension arrays.")
+        chunks = [(s, min(s + chunk_frames, n_frames))
+            for s in range(0, n_frames, chunk_frames)
+        ]
+        results = run(chunks, template, pool, output=output,
+            return_frames=output is None
+        )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    if x.size < window_len:
-        raise ValueError("Input vector needs to be bigger than window size.")
+    if verbose:
+        print(' done')
 
+    if output is not None:
+        corrected = np.memmap(output, dtype='>u2', mode='r', shape=movie.shape)
+    else:
+        corrected = np.concatenate([r['frames'] for r in results])
+
+    shifts = np.concatenate([r['shifts'] for r in results])
+    shift_df = pd.DataFrame({
+        'frame': np.arange(n_frames),
+        'x_shift': shifts[:, 0],
+        'y_shift': shifts[:, 1],
+        'peak': np.concatenate([r['peaks'] for r in results]),
+        'corr': np.concatenate([r['corrs'] for r in results])
+    })
+    patch_shifts = None
+    patch_centers = None
+    if nonrigid:
+        patch_shifts = np.concatenate([r['patch_shifts'] for r in results])
+        patch_centers = _MotionCorrector(template,
+            **corrector_kwargs).patch_centers
+
+    info = {
+        'template': template,
+        'avg': sum(r['frame_sum'] for r in results) / n_frames,
+        'shifts': shift_df,
+        'patch_shifts': patch_shifts,
+        'patch_centers': patch_centers
+    }
+    return corrected, info
 
-    if window_len<3:
-        return x
 
+def motion_correct_to_tiffs(thorimage_dir, output_dir, tiff=None, rigid=True,
+    nonrigid=True, overwrite=False, n_workers=None, verbose=True, **kwargs):
+    """Writes rigid / nonrigid motion corrected TIFFs, averages and shift logs.
 
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise ValueError("Window is on of 'flat', 'hanning', " +
-            "'hamming', 'bartlett', 'blackman'")
+    Outputs are under `<output_dir>/tif_stacks`, named as the MATLAB NoRMCorre
+    based registration named them (`<thorimage_id>_rig.tif`, `_nr.tif`, and
+    `AVG/<rigid|nonrigid>/AVG<thorimage_id>_<rig|nr>.tif`). Frame shifts (for
+    QC) go to `<thorimage_id>_<rig|nr>_shifts.csv`, and patch shifts of the
+    nonrigid correction to `<thorimage_id>_nr_patch_shifts.npz`. The versions
+    of the code that did the correction go to
+    `<thorimage_id>_<rig|nr>_code_versions.json` (see `mocorr_code_versions`).
 
+    Frames are read from `tiff` if passed, otherwise from the raw data in
+    `thorimage_dir`. Other kwargs are passed to `motion_correct_movie`.
 
-    # is this necessary?
-    #s = np.r_[x[window_len-1:0:-1],x,x[-2:-window_len-1:-1]]
+    Returns (whether rigid outputs were written, same for nonrigid).
+    """
+    import tifffile
 
-    #print(len(s))
-    if window == 'flat': #moving average
-        w = np.ones(window_len, 'd')
-    else:
-        w = eval('np.' + window + '(window_len)')
+    _, thorimage_id = split(normpath(thorimage_dir))
+    source = tiff if tiff is not None else thorimage_dir
+    stack_dir = join(output_dir, 'tif_stacks')
 
-    #y = np.convolve(w/w.sum(), s, mode='valid')
-    # not sure what to change above to get this to work...
+    updated = []
+    for do, suffix, avg_subdir, is_nonrigid in ((rigid, 'rig', 'rigid', False),
+        (nonrigid, 'nr', 'nonrigid', True)):
 
-    y = np.convolve(w/w.sum(), x, mode='same')
-    return y
+        tif = join(stack_dir, f'{thorimage_id}_{suffix}.tif')
+        avg_tif = join(stack_dir, 'AVG', avg_subdir,
+            f'AVG{thorimage_id}_{suffix}.tif'
+        )
+        if not do or (not overwrite and exists(tif) and exists(avg_tif)):
+            updated.append(False)
+            continue
 
+        os.makedirs(split(avg_tif)[0], exist_ok=True)
+        if verbose:
+            print(f'{"nonrigid" if is_nonrigid else "rigid"} motion correction'
+                f' of {source}'
+            )
 
-# TODO finish translating. was directly translating matlab registration script
-# to python.
-"""
-def motion_correct_to_tiffs(thorimage_dir, output_dir):
-    # TODO only read this if at least one motion correction would be run
-    movie = read_movie(thorimage_dir)
+        tmp_movie = tif + '.tmp.dat'
+        try:
+            corrected, info = motion_correct_movie(source, output=tmp_movie,
+                nonrigid=is_nonrigid, n_workers=n_workers, verbose=verbose,
+                **kwargs
+            )
+            # Written to temporary paths first, so an existing output is only
+            # replaced by a complete one.
+            write_tiff(tif + '.tmp', corrected)
+            del corrected
+            os.replace(tif + '.tmp', tif)
+        finally:
+            if exists(tmp_movie):
+                os.remove(tmp_movie)
+
+        imwrite = getattr(tifffile, 'imwrite', None) or tifffile.imsave
+        imwrite(avg_tif, info['avg'].astype(np.float32), imagej=True)
+
+        info['shifts'].to_csv(join(stack_dir,
+            f'{thorimage_id}_{suffix}_shifts.csv'), index=False
+        )
+        with open(join(stack_dir, f'{thorimage_id}_{suffix}_code_versions.json'
+            ), 'w') as f:
 
-    # TODO do i really want to basically just copy the matlab version?
-    # opportunity for some refactoring?
+            json.dump([version_info(sys.modules[__name__],
+                used_for='motion correction')], f
+            )
+        if is_nonrigid:
+            np.savez_compressed(join(stack_dir,
+                f'{thorimage_id}_nr_patch_shifts.npz'),
+                patch_shifts=info['patch_shifts'],
+                patch_x_centers=info['patch_centers'][0],
+                patch_y_centers=info['patch_centers'][1]
+            )
+        updated.append(True)
 
-    output_subdir = 'tif_stacks'
+    return tuple(updated)
 
-    _, thorimage_id = split(thorimage_dir)
 
-    rig_tif = join(output_dir, output_subdir, thorimage_id + '_rig.tif')
-    avg_rig_tif = join(output_dir, output_subdir, 'AVG', 'rigid',
-        'AVG{}_rig.tif'.format(thorimage_id))
+def mocorr_code_versions(tif, matfile=None):
+    """Returns list of code version dicts for the motion correction of `tif`.
 
-    nr_tif = join(output_dir, output_subdir, thorimage_id + '_nr.tif')
-    avg_nr_tif = join(output_dir, output_subdir, 'AVG', 'nonrigid',
-        'AVG{}_nr.tif'.format(thorimage_id))
+    Reads the `<thorimage_id>_<rig|nr>_code_versions.json` written next to
+    `tif` by `motion_correct_to_tiffs`. If that doesn't exist and `matfile` is
+    passed, falls back to the `<rig|nr>_code_versions` variable the MATLAB
+    pipeline saved there. Returns an empty list if neither has them.
+    """
+    prefix = tif[:-len('.tif')] if tif.endswith('.tif') else tif
+    sidecar = prefix + '_code_versions.json'
+    if exists(sidecar):
+        with open(sidecar, 'r') as f:
+            return json.load(f)
 
-    need_rig_tif = not exist(rig_tif)
-    need_avg_rig_tif = not exist(avg_rig_tif)
-    need_nr_tif = not exist(nr_tif)
-    need_avg_nr_tif = not exist(avg_nr_tif)
+    if matfile is None:
+        return []
 
-    if not (need_rig_tif or need_avg_rig_tif or need_nr_tif or need_avg_nr_tif):
-        print('All registration already done.')
-        return
+    if tif.endswith('_nr.tif'):
+        varname = 'nr_code_versions'
+    elif tif.endswith('_rig.tif'):
+        varname = 'rig_code_versions'
+    else:
+        raise ValueError(f'{tif} is not a _rig.tif or _nr.tif')
 
-    # Remy: this seems like it might just be reading in the first frame?
-    ###Y = input_tif_path
-    # TODO maybe can just directly use filename for python version though? raw
-    # even?
-
-    # rigid moco (normcorre)
-    # TODO just pass filename instead of Y, and compute dimensions or whatever
-    # separately, so that normcorre can (hopefully?) take up less memory
-    if need_rig_tif:
-        MC_rigid = MotionCorrection(Y)
-
-        options_rigid = NoRMCorreSetParms('d1',MC_rigid.dims(1),
-            'd2',MC_rigid.dims(2),
-            'bin_width',50,
-            'max_shift',15,
-            'phase_flag', 1,
-            'us_fac', 50,
-            'init_batch', 100,
-            'plot_flag', false,
-            'iter', 2) 
-
-        # TODO so is nothing actually happening in parallel?
-        ## rigid moco
-        MC_rigid.motionCorrectSerial(options_rigid)  # can also try parallel
-        # TODO which (if any) of these do i still want?
-        MC_rigid.computeMean()
-        MC_rigid.correlationMean()
-        #####MC_rigid.crispness()
-        print('normcorre done')
-
-        ## plot shifts
-        #plt.plot(MC_rigid.shifts_x)
-        #plt.plot(MC_rigid.shifts_y)
-
-        # save .tif
-        M = MC_rigid.M
-        M = uint16(M) 
-        tiffoptions.overwrite = true
-
-        print(['saving tiff to ' rig_tif])
-        saveastiff(M, rig_tif, tiffoptions)
-
-    if need_avg_rig_tif:
-        ##
-        # save average image
-        #AVG = single(mean(MC_rigid.M,3))
-        AVG = single(MC_rigid.template)
-        tiffoptions.overwrite = true
-
-        print(['saving tiff to ' avg_rig_tif])
-        saveastiff(AVG, avg_rig_tif, tiffoptions)
-
-    if need_nr_tif:
-        MC_nonrigid = MotionCorrection(Y)
-        options_nonrigid = NoRMCorreSetParms('d1',MC_nonrigid.dims(1),
-            'd2',MC_nonrigid.dims(2),
-            'grid_size',[64,64],
-            'mot_uf',4,
-            'bin_width',50,
-            'max_shift',[15 15],
-            'max_dev',3,
-            'us_fac',50,
-            'init_batch',200,
-            'iter', 2)
-
-        MC_nonrigid.motionCorrectParallel(options_nonrigid)
-        MC_nonrigid.computeMean()
-        MC_nonrigid.correlationMean()
-        MC_nonrigid.crispness()
-        print('non-rigid normcorre done')
-
-        # save .tif
-        M = uint16(MC_nonrigid.M)
-        tiffoptions.overwrite  = true
-        print(['saving tiff to ' nr_tif])
-        saveastiff(M, nr_tif, tiffoptions)
-
-    if need_avg_nr_tif:
-        # TODO flag to disable saving this average
-        #AVG = single(mean(MC_nonrigid.M,3))
-        AVG = single(MC_nonrigid.template)
-        tiffoptions.overwrite = true
-        print(['saving tiff to ' avg_nr_tif])
-        saveastiff(AVG, avg_nr_tif, tiffoptions)
+    return get_matfile_var(matfile, varname, require=False)
 
-    raise NotImplementedError
-"""
 
 def cell_ids(df):
     """Takes a DataFrame with 'cell' in MultiIndex or columns to unique values.
@@ -5631,88 +8950,753 @@ def matshow(df, title=None, ticklabels=None, xticklabels=None,
     xticklabels, xstep, xoffset = grouped_labels_info(xticklabels)
     yticklabels, ystep, yoffset = grouped_labels_info(yticklabels)
 
-    if xticklabels is not None:
-        # TODO nan / None value aren't supported in ticklabels are they?
-        # (couldn't assume len is defined if so)
-        if xtickrotation is None:
-            if all([len(x) == 1 for x in xticklabels]):
-                xtickrotation = 'horizontal'
-            else:
-                xtickrotation = 'vertical'
+    if xticklabels is not None:
+        # TODO nan / None value aren't supported in ticklabels are they?
+        # (couldn't assume len is defined if so)
+        if xtickrotation is None:
+            if all([len(x) == 1 for x in xticklabels]):
+                xtickrotation = 'horizontal'
+            else:
+                xtickrotation = 'vertical'
+
+        ax.set_xticklabels(xticklabels, fontsize=fontsize,
+            fontweight=fontweight, rotation=xtickrotation)
+        #    rotation='horizontal' if group_ticklabels else 'vertical')
+        ax.set_xticks(np.arange(0, len(df.columns), xstep) + xoffset)
+
+    if yticklabels is not None:
+        ax.set_yticklabels(yticklabels, fontsize=fontsize,
+            fontweight=fontweight, rotation='horizontal')
+        #    rotation='vertical' if group_ticklabels else 'horizontal')
+        ax.set_yticks(np.arange(0, len(df), ystep) + yoffset)
+
+    # TODO test this doesn't change rotation if we just set rotation above
+
+    # this doesn't seem like it will work, since it seems to clear the default
+    # ticklabels that there actually were...
+    #ax.set_yticklabels(ax.get_yticklabels(), fontsize=fontsize,
+    #    fontweight=fontweight)
+
+    # didn't seem to do what i was expecting
+    #ax.spines['bottom'].set_visible(False)
+    ax.tick_params(bottom=False)
+
+    if title is not None:
+        ax.set_xlabel(title, fontsize=(fontsize + 1.5), labelpad=12)
+
+    if made_fig:
+        plt.tight_layout()
+        return fig
+    else:
+        return cax
+
+
+# TODO TODO call this in gui / factor into plot_odor_corrs (though it would
+# require accesss to df...) and call that there
+def add_missing_odor_cols(df, missing_df):
+    """
+    """
+    # TODO maybe check cols are indeed describing odors in missing_df?
+
+    # TODO delete / change note to be relevant here. copied from original
+    # implementation in gui
+    # This + pivot_table w/ dropna=False won't work until this bug:
+    # https://github.com/pandas-dev/pandas/issues/18030 is fixed.
+    '''
+    window_trial_means = pd.concat([window_trial_means,
+        missing_dff.set_index(window_trial_means.index.names
+        ).df_over_f
+    ])
+    '''
+    missing_dff = df[df.df_over_f.isnull()][
+        missing_df.columns.names + ['cell', 'df_over_f']
+    ]
+    # Hack to workaround pivot NaN behavior bug mentioned above.
+    assert missing_dff.df_over_f.isnull().all()
+    missing_dff.df_over_f = missing_dff.df_over_f.fillna(0)
+    extra_cols = missing_dff.pivot_table(
+        index='cell', values='df_over_f',
+        columns=['name1','name2','repeat_num','order']
+    )
+    extra_cols.iloc[:] = np.nan
+
+    assert (len(missing_df.columns.drop_duplicates()) ==
+        len(missing_df.columns))
+
+    missing_df = pd.concat([missing_df, extra_cols], axis=1)
+
+    assert (len(missing_df.columns.drop_duplicates()) ==
+        len(missing_df.columns))
+
+    missing_df.sort_index(axis='columns', inplace=True)
+    # end of the hack to workaround pivot NaN behavior
+
+    return missing_df
+
+
+# 0 means figures are saved synchronously, in the calling thread. Default
+# leaves one CPU for whatever is making the figures.
+figure_export_workers = int(os.environ.get('HONG_2P_FIGURE_EXPORT_WORKERS',
+    min(4, (os.cpu_count() or 1) - 1)
+))
+# 'process', 'fork' or 'thread' (see `FigureExporter`). None picks based on
+# whether this is a daemonic process. Scripts whose __main__ module can't be
+# re-imported by worker processes (work done at module level, without an
+# `if __name__ == '__main__'` guard) should set this to 'fork', and call
+# `figure_exporter` before starting any threads.
+figure_export_kind = os.environ.get('HONG_2P_FIGURE_EXPORT_KIND') or None
+# rcParams (by prefix) that affect saved output, so they can be applied in the
+# export workers too.
+_savefig_rc_prefixes = ('savefig.', 'pdf.', 'ps.', 'svg.', 'pgf.')
+
+def _pickle_figure(fig):
+    # If the figure is managed by pyplot, unpickling would create a new pyplot
+    # figure (w/ the default, possibly GUI, backend) wherever it's unpickled.
+    manager = fig.canvas.manager
+    fig.canvas.manager = None
+    try:
+        return pickle.dumps(fig, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        fig.canvas.manager = manager
+
+
+def _init_figure_export_process():
+    mpl.use('Agg', force=True)
+
+
+def _export_figure(fig_bytes, fname, rc, savefig_kwargs, input_hash=None):
+    fig = pickle.loads(fig_bytes)
+    with mpl.rc_context(rc):
+        fig.savefig(fname, **savefig_kwargs)
+
+    if input_hash is not None:
+        record_figure_hash(fname, input_hash)
+    return fname
+
+
+def _render_figure(fig, fname, savefig_kwargs):
+    """Returns bytes of `fig` saved in the format `fname` would get.
+    """
+    if 'format' not in savefig_kwargs:
+        fmt = os.path.splitext(fname)[1][1:].lower()
+        savefig_kwargs = dict(savefig_kwargs, format=fmt or None)
+
+    buff = io.BytesIO()
+    fig.savefig(buff, **savefig_kwargs)
+    return buff.getvalue()
+
+
+def _write_figure(data, fname, input_hash=None):
+    with open(fname, 'wb') as f:
+        f.write(data)
+
+    if input_hash is not None:
+        record_figure_hash(fname, input_hash)
+    return fname
+
+
+class FigureExporter:
+    """Saves figures in background workers, one task per output file.
+
+    Figures are pickled when submitted, so callers may close or modify them
+    right after `submit` returns. `submit` only blocks if `max_pending` files
+    are already waiting to be written.
+
+    `kind` is 'process' (Agg worker processes) or 'thread'. Daemonic
+    processes (e.g. `multiprocessing.Pool` workers) can't have child
+    processes, so 'thread' is used there if `kind` is None (or
+    `figure_export_kind`, if that is set).
+
+    Process workers are started by a forkserver, so they don't inherit
+    locks / threads (e.g. Qt's) of the submitting process. They still
+    re-import the `__main__` module, which must be safe to import.
+
+    `kind='fork'` is also 'process', but the workers are all forked when the
+    exporter is created, so `__main__` is not re-imported. It must be created
+    before the calling process starts any threads (or opens any GUI figures).
+
+    Matplotlib rendering is not thread-safe, so with 'thread' each figure is
+    rendered in the thread calling `submit`, and only writing the files
+    happens in the background. Figures are still copied on submit (via
+    pickling) in the 'process' case, and rendered in the workers.
+    """
+    def __init__(self, n_workers=None, max_pending=None, kind=None):
+        import multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        if n_workers is None:
+            n_workers = max(1, figure_export_workers)
+
+        if max_pending is None:
+            max_pending = 2 * n_workers
+
+        if kind is None:
+            kind = figure_export_kind
+
+        if kind is None:
+            kind = 'thread' if mp.current_process().daemon else 'process'
+
+        if kind == 'process':
+            ctx = mp.get_context('forkserver')
+            # So the server process only imports this module, rather than also
+            # running the __main__ module once itself.
+            ctx.set_forkserver_preload([__name__])
+        elif kind == 'fork':
+            ctx = mp.get_context('fork')
+
+        if kind in ('process', 'fork'):
+            # Workers only unpickle + save figures, w/o pyplot.
+            self._executor = ProcessPoolExecutor(n_workers, mp_context=ctx,
+                initializer=_init_figure_export_process
+            )
+            if kind == 'fork':
+                # The executor only forks its workers (all at once, before
+                # starting its own thread) on the first submit.
+                self._executor.submit(int).result()
+            kind = 'process'
+        elif kind == 'thread':
+            self._executor = ThreadPoolExecutor(n_workers)
+        else:
+            raise ValueError("kind must be 'process', 'fork' or 'thread'")
+
+        self.kind = kind
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def _release(self, future):
+        self._slots.release()
+
+    def submit(self, fig, fnames, input_hash=None, **savefig_kwargs):
+        """Queues `fig` to be saved to each of `fnames` (format from extension).
+
+        If `input_hash` is passed, it is recorded for each file once saved
+        (see `figures_up_to_date`).
+
+        Returns list of `concurrent.futures.Future`s, one per filename.
+        """
+        if isinstance(fnames, str):
+            fnames = [fnames]
+
+        if self.kind == 'process':
+            fig_bytes = _pickle_figure(fig)
+            rc = {k: v for k, v in mpl.rcParams.items()
+                if k.startswith(_savefig_rc_prefixes)
+            }
+
+        futures = []
+        for fname in fnames:
+            self._slots.acquire()
+            try:
+                if self.kind == 'process':
+                    future = self._executor.submit(_export_figure, fig_bytes,
+                        fname, rc, savefig_kwargs, input_hash
+                    )
+                else:
+                    data = _render_figure(fig, fname, savefig_kwargs)
+                    future = self._executor.submit(_write_figure, data, fname,
+                        input_hash
+                    )
+            except BaseException:
+                self._slots.release()
+                raise
+
+            future.add_done_callback(self._release)
+            futures.append(future)
+
+        with self._lock:
+            self._futures.extend(futures)
+        return futures
+
+    def wait(self):
+        """Blocks until all submitted figures are saved.
+
+        Raises the first exception from any failed save.
+        """
+        from concurrent.futures import wait
+
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+
+        wait(futures)
+        for f in futures:
+            err = f.exception()
+            if err is not None:
+                raise err
+
+    def shutdown(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+
+_figure_exporter = None
+def figure_exporter():
+    """Returns this process's shared `FigureExporter`, or None if disabled.
+
+    Disabled if `figure_export_workers` (env var
+    HONG_2P_FIGURE_EXPORT_WORKERS) is 0.
+    """
+    global _figure_exporter
+    if figure_export_workers <= 0:
+        return None
+
+    if _figure_exporter is None:
+        _figure_exporter = FigureExporter()
+        atexit.register(_figure_exporter.shutdown)
+    return _figure_exporter
+
+
+def savefig_async(fig, fnames, input_hash=None, **savefig_kwargs):
+    """Saves `fig` to each of `fnames`, in the background if enabled.
+
+    See `FigureExporter`. Call `wait_for_figures` before using the outputs.
+    """
+    exporter = figure_exporter()
+    if exporter is None:
+        if isinstance(fnames, str):
+            fnames = [fnames]
+        for fname in fnames:
+            fig.savefig(fname, **savefig_kwargs)
+            if input_hash is not None:
+                record_figure_hash(fname, input_hash)
+        return
+
+    exporter.submit(fig, fnames, input_hash=input_hash, **savefig_kwargs)
+
+
+def wait_for_figures():
+    """Blocks until all figures passed to `savefig_async` are saved.
+    """
+    if _figure_exporter is not None:
+        _figure_exporter.wait()
+
+
+def _update_hash(h, obj):
+    import inspect
+
+    if isinstance(obj, pd.DataFrame):
+        h.update(b'DataFrame')
+        _update_hash(h, [list(obj.columns), list(obj.columns.names),
+            list(obj.index.names), [str(d) for d in obj.dtypes]
+        ])
+        try:
+            h.update(pd.util.hash_pandas_object(obj, index=True
+                ).values.tobytes()
+            )
+        # e.g. array elements
+        except TypeError:
+            h.update(pickle.dumps(obj, protocol=4))
+
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        h.update(type(obj).__name__.encode())
+        _update_hash(h, [obj.name, list(obj.index.names) if
+            isinstance(obj, pd.Series) else list(obj.names), str(obj.dtype)
+        ])
+        try:
+            h.update(pd.util.hash_pandas_object(obj).values.tobytes())
+        except TypeError:
+            h.update(pickle.dumps(obj, protocol=4))
+
+    elif isinstance(obj, np.ndarray):
+        h.update(f'ndarray{obj.dtype.str}{obj.shape}'.encode())
+        if obj.dtype.hasobject:
+            h.update(pickle.dumps(obj, protocol=4))
+        else:
+            h.update(np.ascontiguousarray(obj).view(np.uint8))
+
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj.keys(), key=repr):
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for x in obj:
+            _update_hash(h, x)
+
+    elif isinstance(obj, (set, frozenset)):
+        h.update(b'set')
+        for x in sorted(obj, key=repr):
+            _update_hash(h, x)
+
+    elif callable(obj):
+        # So changes to plotting code also change the hash.
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            h.update(getattr(obj, '__qualname__', repr(obj)).encode())
+    else:
+        h.update(repr(obj).encode())
+
+
+def hash_inputs(*objs):
+    """Returns hex digest depending only on the contents of `objs`.
+
+    Handles (nested) DataFrames, Series, arrays, dicts, lists, tuples, sets,
+    functions (hashed by their source) and anything with a stable `repr`.
+    """
+    h = hashlib.sha1()
+    _update_hash(h, objs)
+    return h.hexdigest()
+
+
+def _figure_hash_record_path(fname):
+    parent, name = split(fname)
+    return join(parent, '.input_hashes', name + '.json')
+
+
+def record_figure_hash(fname, input_hash):
+    """Records that saved figure `fname` was made from inputs w/ `input_hash`.
 
-        ax.set_xticklabels(xticklabels, fontsize=fontsize,
-            fontweight=fontweight, rotation=xtickrotation)
-        #    rotation='horizontal' if group_ticklabels else 'vertical')
-        ax.set_xticks(np.arange(0, len(df.columns), xstep) + xoffset)
+    The record is only valid as long as the file is not modified.
+    """
+    st = os.stat(fname)
+    record_path = _figure_hash_record_path(fname)
+    os.makedirs(split(record_path)[0], exist_ok=True)
+    tmp_path = f'{record_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'input_hash': input_hash, 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns}, f
+        )
+    os.replace(tmp_path, record_path)
 
-    if yticklabels is not None:
-        ax.set_yticklabels(yticklabels, fontsize=fontsize,
-            fontweight=fontweight, rotation='horizontal')
-        #    rotation='vertical' if group_ticklabels else 'horizontal')
-        ax.set_yticks(np.arange(0, len(df), ystep) + yoffset)
 
-    # TODO test this doesn't change rotation if we just set rotation above
+def figure_input_hash(fname):
+    """Returns input hash recorded for saved figure `fname`, or None.
 
-    # this doesn't seem like it will work, since it seems to clear the default
-    # ticklabels that there actually were...
-    #ax.set_yticklabels(ax.get_yticklabels(), fontsize=fontsize,
-    #    fontweight=fontweight)
+    None if there is no record, or the file is missing / changed since.
+    """
+    try:
+        with open(_figure_hash_record_path(fname), 'r') as f:
+            record = json.load(f)
+        st = os.stat(fname)
+    except (IOError, ValueError):
+        return None
 
-    # didn't seem to do what i was expecting
-    #ax.spines['bottom'].set_visible(False)
-    ax.tick_params(bottom=False)
+    if record['size'] != st.st_size or record['mtime_ns'] != st.st_mtime_ns:
+        return None
+    return record['input_hash']
 
-    if title is not None:
-        ax.set_xlabel(title, fontsize=(fontsize + 1.5), labelpad=12)
 
-    if made_fig:
-        plt.tight_layout()
-        return fig
-    else:
-        return cax
+def figures_up_to_date(fnames, input_hash):
+    """True if each of `fnames` was saved from inputs with `input_hash`.
+    """
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    return all(figure_input_hash(f) == input_hash for f in fnames)
 
 
-# TODO TODO call this in gui / factor into plot_odor_corrs (though it would
-# require accesss to df...) and call that there
-def add_missing_odor_cols(df, missing_df):
+def _rank_cells(responses):
     """
+    Returns average ranks of each stimulus' responses across cells (axis -2),
+    with NaN where input is NaN (so ranks are over non-NaN cells).
     """
-    # TODO maybe check cols are indeed describing odors in missing_df?
+    from scipy.stats import rankdata
 
-    # TODO delete / change note to be relevant here. copied from original
-    # implementation in gui
-    # This + pivot_table w/ dropna=False won't work until this bug:
-    # https://github.com/pandas-dev/pandas/issues/18030 is fixed.
-    '''
-    window_trial_means = pd.concat([window_trial_means,
-        missing_dff.set_index(window_trial_means.index.names
-        ).df_over_f
-    ])
-    '''
-    missing_dff = df[df.df_over_f.isnull()][
-        missing_df.columns.names + ['cell', 'df_over_f']
-    ]
-    # Hack to workaround pivot NaN behavior bug mentioned above.
-    assert missing_dff.df_over_f.isnull().all()
-    missing_dff.df_over_f = missing_dff.df_over_f.fillna(0)
-    extra_cols = missing_dff.pivot_table(
-        index='cell', values='df_over_f',
-        columns=['name1','name2','repeat_num','order']
+    nan = np.isnan(responses)
+    # Since these sort last, the ranks of non-NaN values are unaffected.
+    ranks = rankdata(np.where(nan, np.inf, responses), method='average',
+        axis=-2
     )
-    extra_cols.iloc[:] = np.nan
+    ranks[nan] = np.nan
+    return ranks
+
+
+def batch_corr(responses):
+    """
+    Takes array of shape (..., cell, stimulus) and returns array of shape
+    (..., stimulus, stimulus) with Pearson correlations between stimuli
+    (across cells) for each leading index.
+
+    NaN are handled like `pd.DataFrame.corr`, only using cells where both
+    stimuli are non-NaN (so padding cells / missing stimuli can be NaN).
+    """
+    mask = np.isfinite(responses)
+    n_valid = mask.sum(axis=-2, keepdims=True)
+    # Centering does not change the result, but reduces cancellation error in
+    # the sums below.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(mask, responses, 0).sum(axis=-2, keepdims=True) / \
+            n_valid
+
+    x = np.where(mask, responses - np.nan_to_num(means), 0)
+    m = mask.astype(x.dtype)
+
+    # Each of these is (..., stimulus, stimulus), where element [a, b] only
+    # sums over cells with both a and b non-NaN.
+    xt = np.swapaxes(x, -1, -2)
+    mt = np.swapaxes(m, -1, -2)
+    n = mt @ m
+    sa = xt @ m
+    sb = mt @ x
+    saa = (xt**2) @ m
+    sbb = mt @ (x**2)
+    sab = xt @ x
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = sab - sa * sb / n
+        var_a = saa - sa**2 / n
+        var_b = sbb - sb**2 / n
+        corr = cov / np.sqrt(var_a * var_b)
+
+    corr[n < 2] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+class OdorCorrelations:
+    """
+    Stimulus x stimulus correlations (across cells) for many flies at once.
+
+    Takes `responses` of shape (fly, cell, stimulus), with flies that have
+    fewer cells padded with NaN cells, and NaN for any stimuli a fly did not
+    get. Use `from_long` to build from a Series like `window_trial_stats`.
+
+    Ranked / z-scored intermediates and correlation matrices are computed once
+    and cached, so plots that share them do not recompute them.
+    """
+    def __init__(self, responses, flies=None, stimuli=None):
+        responses = np.asarray(responses, dtype=np.float64)
+        if len(responses.shape) != 3:
+            raise ValueError('responses must be of shape (fly, cell, stimulus)')
+
+        self.responses = responses
+        self.flies = flies
+        self.stimuli = stimuli
+        self._cache = dict()
+
+    @classmethod
+    def from_long(cls, ser, stim_cols, fly_cols=('prep_date', 'fly_num'),
+        cell_col='cell'):
+        """
+        Takes a Series with `fly_cols`, `cell_col` and `stim_cols` all in its
+        index (e.g. `df_over_f` summarized within each trial), and returns an
+        instance with one row per fly.
+        """
+        fly_cols = list(fly_cols)
+        stim_cols = list(stim_cols)
+
+        wide = ser.reset_index().pivot_table(index=fly_cols + [cell_col],
+            columns=stim_cols, values=ser.name, dropna=False
+        )
+        # For consistency with stacking trial x cell matrices one fly at a
+        # time.
+        wide = wide.dropna(how='all', axis='index')
 
-    assert (len(missing_df.columns.drop_duplicates()) ==
-        len(missing_df.columns))
+        flies = wide.index.droplevel(cell_col).drop_duplicates()
+        n_cells = wide.groupby(fly_cols, sort=False).size()
+        max_n_cells = n_cells.max()
 
-    missing_df = pd.concat([missing_df, extra_cols], axis=1)
+        responses = np.full((len(flies), max_n_cells, wide.shape[1]), np.nan)
+        for i, (_, fdf) in enumerate(wide.groupby(fly_cols, sort=False)):
+            responses[i, :len(fdf)] = fdf.values
 
-    assert (len(missing_df.columns.drop_duplicates()) ==
-        len(missing_df.columns))
+        return cls(responses, flies=flies, stimuli=wide.columns)
 
-    missing_df.sort_index(axis='columns', inplace=True)
-    # end of the hack to workaround pivot NaN behavior
+    def n_cells(self):
+        """Returns array with number of (non-padding) cells for each fly.
+        """
+        return np.isfinite(self.responses).any(axis=-1).sum(axis=-1)
 
-    return missing_df
+    def _inputs(self, method):
+        if method == 'pearson':
+            return self.responses
+
+        elif method == 'spearman':
+            key = ('ranks',)
+            if key not in self._cache:
+                self._cache[key] = _rank_cells(self.responses)
+            return self._cache[key]
+
+        else:
+            raise ValueError("method must be either 'pearson' or 'spearman'")
+
+    def zscored(self, method='pearson'):
+        """
+        Returns (fly, cell, stimulus) array of responses (or ranks, for
+        Spearman) z-scored across the non-NaN cells for each stimulus.
+        """
+        key = ('zscored', method)
+        if key not in self._cache:
+            x = self._inputs(method)
+            with warnings.catch_warnings(), np.errstate(invalid='ignore',
+                divide='ignore'):
+
+                # All-NaN slices for missing stimuli.
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self._cache[key] = (x - np.nanmean(x, axis=-2, keepdims=True)
+                    ) / np.nanstd(x, axis=-2, ddof=1, keepdims=True)
+
+        return self._cache[key]
+
+    def corr(self, method='pearson'):
+        """Returns (fly, stimulus, stimulus) array of correlations.
+        """
+        key = ('corr', method)
+        if key in self._cache:
+            return self._cache[key]
+
+        x = self._inputs(method)
+        stim_finite = np.isfinite(x).any(axis=-2, keepdims=True)
+        cell_finite = np.isfinite(x).any(axis=-1, keepdims=True)
+        # When only whole cells (padding) and whole stimuli (missing odors) are
+        # NaN, the correlation matrix is just a product of z-scored matrices.
+        # Otherwise, fall back to only using cells with both stimuli non-NaN.
+        if np.array_equal(np.isfinite(x), stim_finite & cell_finite):
+            z = self.zscored(method)
+            # Stimuli that are missing, or constant across cells.
+            missing = ~ (np.isfinite(z) | ~ cell_finite).all(axis=-2,
+                keepdims=True
+            )
+            z = np.nan_to_num(z)
+            n = cell_finite.sum(axis=-2, keepdims=True)
+            corr = np.clip((np.swapaxes(z, -1, -2) @ z) / (n - 1), -1, 1)
+
+            corr[np.broadcast_to(missing, corr.shape)] = np.nan
+            corr[np.broadcast_to(np.swapaxes(missing, -1, -2), corr.shape)
+                ] = np.nan
+        else:
+            corr = batch_corr(x)
+
+        self._cache[key] = corr
+        return corr
+
+    def corr_df(self, fly_index, method='pearson'):
+        """
+        Returns correlations for one fly as a DataFrame indexed by stimuli on
+        both axes, as `plot_odor_corrs` expects.
+        """
+        return pd.DataFrame(self.corr(method)[fly_index], index=self.stimuli,
+            columns=self.stimuli
+        )
+
+    def _index_or_range(self, index, n, name):
+        if index is None:
+            return pd.RangeIndex(n, name=name)
+        return index
+
+    def corr_ser(self, method='pearson', suffixes=('_a', '_b')):
+        """
+        Returns Series ('corr') of correlations for all flies, in long format.
+
+        Index has the levels of `flies`, then those of `stimuli` with each of
+        `suffixes` appended (one for each stimulus of the pair). Both orders
+        of each pair are included, as with `melt_symmetric` in
+        kc_mix_analysis. NaN correlations (e.g. missing stimuli) are dropped.
+        """
+        corr = self.corr(method)
+        n_flies, n_stim, _ = corr.shape
+        flies = self._index_or_range(self.flies, n_flies, 'fly')
+        stimuli = self._index_or_range(self.stimuli, n_stim, 'stimulus')
+
+        fly_idx, a_idx, b_idx = np.nonzero(np.isfinite(corr))
+        parts = [flies[fly_idx].to_frame(index=False)]
+        for suffix, stim_idx in zip(suffixes, (a_idx, b_idx)):
+            stim_df = stimuli[stim_idx].to_frame(index=False)
+            stim_df.columns = [f'{c}{suffix}' for c in stim_df.columns]
+            parts.append(stim_df)
+
+        index = pd.MultiIndex.from_frame(pd.concat(parts, axis=1))
+        return pd.Series(corr[fly_idx, a_idx, b_idx], index=index, name='corr')
+
+    def mean_corr_df(self, method='pearson', level=None, fly_mask=None):
+        """
+        Returns DataFrame of correlations averaged across flies, ignoring NaN.
+
+        If `level` is passed, those means are then averaged across stimuli
+        with the same value of that level of `stimuli` (e.g. 'name1', to
+        average over repeats). `fly_mask` selects flies to average over.
+        """
+        def nanmean_sum(sums, counts):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return sums / counts
+
+        corr = self.corr(method)
+        if fly_mask is not None:
+            corr = corr[np.asarray(fly_mask)]
+
+        finite = np.isfinite(corr)
+        mean = nanmean_sum(np.where(finite, corr, 0).sum(axis=0),
+            finite.sum(axis=0)
+        )
+
+        stimuli = self._index_or_range(self.stimuli, corr.shape[-1],
+            'stimulus'
+        )
+        if level is None:
+            index = stimuli
+        else:
+            codes, uniques = pd.factorize(stimuli.get_level_values(level))
+            index = pd.Index(uniques, name=level)
+            # (stimulus, group) indicator matrix, to sum within groups.
+            groups = np.zeros((len(codes), len(uniques)))
+            groups[np.arange(len(codes)), codes] = 1
+            finite = np.isfinite(mean)
+            mean = nanmean_sum(groups.T @ np.where(finite, mean, 0) @ groups,
+                groups.T @ finite @ groups
+            )
+
+        return pd.DataFrame(mean, index=index, columns=index)
+
+    def bootstrap(self, n_boot=1000, method='pearson', ci=95, seed=None,
+        chunk_size=50, return_samples=False):
+        """
+        Resamples cells (with replacement) within each fly, and returns
+        (lower, upper) arrays of shape (fly, stimulus, stimulus) for the
+        central `ci` percent confidence interval on each correlation.
+
+        All flies and `chunk_size` resamples are computed together in each
+        batched step. If `return_samples` is True, the (n_boot, fly,
+        stimulus, stimulus) array of resampled correlations is also returned,
+        e.g. to get intervals on means across flies.
+        """
+        rng = np.random.default_rng(seed)
+
+        n_flies, max_n_cells, n_stim = self.responses.shape
+        n_cells = self.n_cells()
+        # Padding cells (if any) are after all real cells of each fly.
+        assert np.array_equal(np.isfinite(self.responses).any(axis=-1),
+            np.arange(max_n_cells)[None, :] < n_cells[:, None]
+        ), 'padding cells must come after all real cells of each fly'
+
+        fly_idx = np.arange(n_flies)[None, :, None]
+        samples = np.empty((n_boot, n_flies, n_stim, n_stim))
+        for start in range(0, n_boot, chunk_size):
+            b = min(chunk_size, n_boot - start)
+            # For flies with fewer cells, indices past their number of cells
+            # point at padding (all NaN) cells, which are then ignored.
+            cell_idx = (rng.random((b, n_flies, max_n_cells)) *
+                n_cells[None, :, None]
+            ).astype(np.int64)
+            cell_idx = np.where(
+                np.arange(max_n_cells)[None, None, :] < n_cells[None, :, None],
+                cell_idx, np.minimum(n_cells, max_n_cells - 1)[None, :, None]
+            )
+            resampled = self.responses[fly_idx, cell_idx]
+            if method == 'spearman':
+                resampled = _rank_cells(resampled)
+            elif method != 'pearson':
+                raise ValueError(
+                    "method must be either 'pearson' or 'spearman'"
+                )
+
+            samples[start:(start + b)] = batch_corr(resampled)
+
+        alpha = (100 - ci) / 2
+        with warnings.catch_warnings():
+            # All-NaN slices for missing stimuli.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanpercentile(samples, [alpha, 100 - alpha],
+                axis=0
+            )
+
+        if return_samples:
+            return lower, upper, samples
+
+        return lower, upper
 
 
 # TODO should i actually compute correlations in here too? check input, and
@@ -6676,6 +10660,7 @@ def baselined_normed_u8(img):
     return (u8_max * normed).astype(np.uint8)
 
 
+@instrumented('template_matching')
 def template_match(scene, template, method_str='cv2.TM_CCOEFF', hist=False,
     debug=False):
 
@@ -6792,7 +10777,7 @@ def template_match(scene, template, method_str='cv2.TM_CCOEFF', hist=False,
         print('')
         hist = True
 
-    method = eval(method_str)
+    method = _cv2_match_method(method_str)
     res = cv2.matchTemplate(vscaled_scene, vscaled_template, method)
 
     # b/c for sqdiff[_normed], find minima. for others, maxima.
@@ -6807,6 +10792,105 @@ def template_match(scene, template, method_str='cv2.TM_CCOEFF', hist=False,
     return res
 
 
+def _cv2_match_method(method_str):
+    """Returns cv2 constant for a str like 'cv2.TM_CCOEFF_NORMED'.
+    """
+    import cv2
+
+    prefix = 'cv2.'
+    name = method_str[len(prefix):] if method_str.startswith(prefix) else \
+        method_str
+
+    if not name.startswith('TM_'):
+        raise ValueError(f'invalid template matching method: {method_str}')
+
+    return getattr(cv2, name)
+
+
+def baselined_normed_f32(img):
+    """Like `baselined_normed_u8`, but in [0, 1] without quantizing to 256 levels.
+    """
+    img = img.astype(np.float32)
+    baselined = img - img.min()
+    return baselined / baselined.max()
+
+
+class MultiscaleTemplateMatcher:
+    """
+    Matches several templates against scenes of one shape, normalizing each
+    scene only once, and preparing the templates only once (on construction).
+
+    `match(scene)` returns a list with one match image per template, of the same
+    shapes / values as `template_match` would return for each, so output can be
+    passed to `greedy_roi_packing`.
+
+    If `keep_float` is True, scenes and templates are scaled to [0, 1] float32
+    rather than to uint8, avoiding quantization. Thresholds for
+    'cv2.TM_CCOEFF_NORMED' are comparable across the two, but those for
+    (unnormalized) 'cv2.TM_CCOEFF' are not.
+    """
+    def __init__(self, templates, scene_shape, method_str='cv2.TM_CCOEFF',
+        keep_float=False):
+
+        self.method_str = method_str
+        self.method = _cv2_match_method(method_str)
+        self.keep_float = keep_float
+        self.scene_shape = tuple(scene_shape)
+
+        self._normalize = baselined_normed_f32 if keep_float else \
+            baselined_normed_u8
+
+        self.templates = [self._normalize(t) for t in templates]
+        for t in self.templates:
+            if any(td > sd for td, sd in zip(t.shape, self.scene_shape)):
+                raise ValueError(f'template of shape {t.shape} larger than '
+                    f'scene of shape {self.scene_shape}'
+                )
+
+    @instrumented('template_matching')
+    def match(self, scene):
+        import cv2
+
+        if scene.shape != self.scene_shape:
+            raise ValueError(f'scene shape {scene.shape} != '
+                f'{self.scene_shape} this matcher was constructed for'
+            )
+
+        prepared_scene = self._normalize(scene)
+        match_images = [cv2.matchTemplate(prepared_scene, t, self.method)
+            for t in self.templates
+        ]
+        # b/c for sqdiff[_normed], find minima. for others, maxima.
+        if 'SQDIFF' in self.method_str:
+            match_images = [-m for m in match_images]
+
+        return match_images
+
+
+# To reuse prepared templates across calls (e.g. per-frame calls to
+# `fit_circle_rois` in tracking), keyed by a hash of the templates + settings.
+_max_cached_template_matchers = 16
+_template_matchers = LRUCache(max_items=_max_cached_template_matchers,
+    sizeof=lambda m: sum(t.nbytes for t in m.templates),
+    name='template matcher cache'
+)
+def _get_template_matcher(templates, scene_shape, method_str, keep_float):
+    h = hashlib.md5()
+    for t in templates:
+        h.update(str(t.shape).encode())
+        h.update(np.ascontiguousarray(t).tobytes())
+
+    key = (h.hexdigest(), tuple(scene_shape), method_str, keep_float)
+    matcher = _template_matchers.get(key)
+    if matcher is None:
+        matcher = MultiscaleTemplateMatcher(templates, scene_shape,
+            method_str=method_str, keep_float=keep_float
+        )
+        _template_matchers[key] = matcher
+
+    return matcher
+
+
 def euclidean_dist(v1, v2):
     # Without the conversions to float 64 (or at least something else signed),
     # uint inputs lead to wraparound -> big distances occasionally.
@@ -6833,6 +10917,7 @@ def u8_color(draw_on):
 # TODO make sure match criteria is comparable across scales (one threshold
 # ideally) (possible? using one of normalized metrics sufficient? test this
 # on fake test data?)
+@instrumented('roi_packing')
 def greedy_roi_packing(match_images, ds, radii_px, thresholds=None, ns=None, 
     exclusion_radius_frac=0.7, min_dist2neighbor_px=15, min_neighbors=3,
     exclusion_mask=None,
@@ -7599,11 +11684,14 @@ def fit_circle_rois(tif, template_data=None, avg=None, movie=None,
     roi_diams_um=None, roi_diams_from_kmeans_k=None,
     multiscale_strategy='one_order', template_d2match_value_scale_fn=None,
     allow_duplicate_px_scales=False, _show_scaled_templates=False, 
-    verbose=False, **kwargs):
+    keep_float=False, verbose=False, **kwargs):
     """
     Even if movie or avg is passed in, tif is used to find metadata and
     determine where to save ImageJ ROIs.
 
+    keep_float (bool): if True, match on float32 images scaled to [0, 1]
+    rather than on uint8 images. See `MultiscaleTemplateMatcher`.
+
     _um_per_pixel_xy only used for testing. Normally, XML is found from `tif`,
     and that is loaded to get this value.
 
@@ -7811,7 +11899,7 @@ def fit_circle_rois(tif, template_data=None, avg=None, movie=None,
     d, d2 = template.shape
     assert d == d2
 
-    match_images = []
+    scaled_templates = []
     template_ds = []
     per_scale_radii_px = []
     for i, roi_diam_um in enumerate(roi_diams_um):
@@ -7839,9 +11927,6 @@ def fit_circle_rois(tif, template_data=None, avg=None, movie=None,
             radius_px_before_scaling = int(round((d - 2 * margin) / 2))
         '''
 
-        match_image = template_match(scaled_avg, scaled_template,
-            method_str=method_str
-        )
         if debug:
             print(f'scaled_template_cell_diam_px: '
                 f'{scaled_template_cell_diam_px}'
@@ -7856,10 +11941,17 @@ def fit_circle_rois(tif, template_data=None, avg=None, movie=None,
                 template_d2match_value_scale_fn(template_d)
             )
 
-        match_images.append(match_image)
+        scaled_templates.append(scaled_template)
         template_ds.append(template_d)
         per_scale_radii_px.append(scaled_radius_px)
 
+    # The scene is normalized and transformed once, and matched against all
+    # template scales together.
+    matcher = _get_template_matcher(scaled_templates, scaled_avg.shape,
+        method_str, keep_float
+    )
+    match_images = matcher.match(scaled_avg)
+
     if debug:
         print('template_ds:', template_ds)
 
@@ -8137,8 +12229,7 @@ def movie_blocks(tif, movie=None, allow_gsheet_to_restrict_blocks=True,
             stimfile_root)
         )
 
-    with open(stimfile_path, 'rb') as f:
-        data = pickle.load(f)
+    data = load_stimfile(stimfile_path)
 
     # TODO just infer from data if no stimfile and not specified in
     # metadata_file
@@ -9041,84 +13132,82 @@ def stable_rois(lr_matches, verbose=False):
     return stable_cells, new_lost
 
 
-# TODO try to numba this
-def renumber_rois2(matches_list, centers_list):
-    id2frame_bounds = dict()
-    id2indices = dict()
-    next_id = 0
-    seen_at_i = dict()
-    for i in range(len(matches_list) + 1):
-        if i not in seen_at_i:
-            seen_at_i[i] = set()
-
-        m = matches_list[min(i, len(matches_list) - 1)]
-        for left, right in m:
-            if i < len(matches_list):
-                if left in seen_at_i[i]:
-                    continue
-                seen_at_i[i].add(left)
-                roi_indices_across_frames = [left]
-            else:
-                if right in seen_at_i[i]:
-                    continue
-                roi_indices_across_frames = []
-
-            first_frame = i
-            # So that the frame counter increments as soon as we have one
-            # "right" element (every match row must correspond to at least
-            # two timepoints).
-            j = i + 1
-            while j <= len(matches_list):
-                roi_indices_across_frames.append(right)
-                last_frame = j
-
-                if j in seen_at_i:
-                    seen_at_i[j].add(right)
-                else:
-                    seen_at_i[j] = set()
+def link_tracks(matches_list, centers_list, dtype=np.float32):
+    """Links ROIs matched across consecutive timepoints into tracks.
 
-                if j == len(matches_list):
-                    break
+    `matches_list[i]` is an (n_matches, 2) array of (index at i, index at i+1)
+    pairs, as `correspond_rois` returns. Every ROI in `centers_list` ends up in
+    exactly one track (unmatched ROIs are length-1 tracks).
 
-                next_matches = matches_list[j]
-                next_row_idx = np.argwhere(next_matches[:, 0] == right)
-                if len(next_row_idx) == 0:
-                    break
+    Returns (tracks, centers_array) where tracks is a DataFrame w/ one row per
+    track ID and columns start_frame, end_frame, and n_frames, and
+    centers_array is (n_timepoints, n_tracks, d) of `dtype`, NaN where a track
+    has no ROI.
 
-                next_row_idx = next_row_idx[0][0]
-                left, right = next_matches[next_row_idx]
-                j += 1
+    Track IDs are in order of (start frame, index of first ROI in that frame).
+    """
+    assert len(matches_list) == len(centers_list) - 1
 
-            assert (last_frame - first_frame + 1 ==
-                len(roi_indices_across_frames)
-            )
-            id2frame_bounds[next_id] = (first_frame, last_frame)
-            id2indices[next_id] = roi_indices_across_frames
-            next_id += 1
+    n_per_frame = np.array([len(c) for c in centers_list])
+    offsets = np.concatenate(([0], np.cumsum(n_per_frame)))
+    n_total = offsets[-1]
+    frames = np.repeat(np.arange(len(centers_list)), n_per_frame)
 
-        if i < len(matches_list):
-            unmatched = np.setdiff1d(np.arange(len(centers_list[i])), m[:,0])
-        else:
-            unmatched = np.setdiff1d(np.arange(len(centers_list[i])), m[:,1])
+    # Indices into flat (all ROIs in all frames) arrays.
+    lefts = [offsets[i] + m[:, 0] for i, m in enumerate(matches_list)
+        if len(m) > 0
+    ]
+    rights = [offsets[i + 1] + m[:, 1] for i, m in enumerate(matches_list)
+        if len(m) > 0
+    ]
+    has_pred = np.zeros(n_total, dtype=bool)
+    if len(rights) > 0:
+        has_pred[np.concatenate(rights)] = True
+        assert not has_pred[offsets[0]:offsets[1]].any()
+
+    starts = np.flatnonzero(~ has_pred)
+    n_tracks = len(starts)
+
+    labels = np.full(n_total, -1, dtype=np.int64)
+    labels[starts] = np.arange(n_tracks)
+    # Labels only need to be propagated forward one frame at a time, since
+    # everything at frame i is labelled before frame i + 1 is reached.
+    for left, right in zip(lefts, rights):
+        labels[right] = labels[left]
+    assert (labels >= 0).all()
+
+    start_frames = frames[starts]
+    end_frames = np.zeros(n_tracks, dtype=np.int64)
+    np.maximum.at(end_frames, labels, frames)
+    n_frames = np.bincount(labels, minlength=n_tracks)
+    # Tracks should never skip frames.
+    assert np.array_equal(n_frames, end_frames - start_frames + 1)
+
+    tracks = pd.DataFrame({
+        'start_frame': start_frames,
+        'end_frame': end_frames,
+        'n_frames': n_frames
+    })
+    tracks.index.name = 'track_id'
 
-        for u in unmatched:
-            # TODO never need to check whether this is in seen, do i?
-            id2frame_bounds[next_id] = (i, i)
-            id2indices[next_id] = [u]
-            next_id += 1
+    d = centers_list[0].shape[1]
+    centers_array = np.full((len(centers_list), n_tracks, d), np.nan,
+        dtype=dtype
+    )
+    if n_total > 0:
+        centers_array[frames, labels] = np.concatenate(centers_list)
 
-    assert set(id2frame_bounds.keys()) == set(id2indices.keys())
-    centers_array = np.empty((len(centers_list), next_id,
-        centers_list[0].shape[1])) * np.nan
+    return tracks, centers_array
 
-    for roi_id in id2frame_bounds.keys():
-        start, end = id2frame_bounds[roi_id]
-        indices = id2indices[roi_id]
-        centers_array[start:end+1, roi_id, :] = \
-            [c[i] for c, i in zip(centers_list[start:end+1], indices)]
 
-    # TODO assert min / max non-nan cover full frame for reasonable test data
+def renumber_rois2(matches_list, centers_list):
+    """Returns (n_timepoints, n_tracks, d) array of centers, re-indexed by track.
 
+    See `link_tracks`. Output has the same (float) dtype as the input centers.
+    """
+    dtype = np.result_type(np.float32, *[c.dtype for c in centers_list])
+    _, centers_array = link_tracks(matches_list, centers_list, dtype=dtype)
+    # TODO assert min / max non-nan cover full frame for reasonable test data
     return centers_array
 
 
@@ -9445,6 +13534,7 @@ def check_no_roi_jumps(roi_xyd, max_cost):
 
 
 # TODO TODO TODO re-enable checks!!!
+@instrumented('roi_correspondence')
 def correspond_and_renumber_rois(roi_xyd_sequence, debug=False, checks=False,
     use_renumber_rois2=True, **kwargs):
 
@@ -9485,6 +13575,194 @@ def correspond_and_renumber_rois(roi_xyd_sequence, debug=False, checks=False,
     return new_roi_xyd
 
 
+class OnlineROITracker:
+    """Tracks ROIs across frames as they come in, w/ a Kalman filter per track.
+
+    Unlike `correspond_and_renumber_rois`, which needs ROIs from all frames up
+    front, this only keeps state for active tracks. Each track has a constant
+    velocity motion model. Detections in each new frame are assigned to the
+    predicted track positions (minimizing total Mahalanobis distance, as in
+    `correspond_rois`), w/ assignments beyond `gate` (or, if passed,
+    `max_cost` pixels) not allowed. Tracks not matched for more than
+    `max_missed` consecutive frames are closed, and returned from the `update`
+    call closing them.
+
+    Closed tracks are returned as a DataFrame with one row per (track, frame
+    it was detected in) and columns track_id, frame, x, y (and diameter, if
+    detections have a third column, as `roi_xyd` elsewhere do). Track IDs
+    increase in order of track start.
+
+    Example:
+        tracker = OnlineROITracker()
+        for frame in frames:
+            closed = tracker.fit_and_update(frame, template_data,
+                um_per_pixel_xy
+            )
+            ...
+        closed = tracker.finish()
+    """
+    # (chi-squared w/ 2 degrees of freedom, p=0.99)
+    default_gate = 9.21
+
+    def __init__(self, max_missed=2, gate=None, max_cost=None,
+        measurement_sigma=1.0, accel_sigma=0.5, initial_velocity_sigma=2.0,
+        min_n_frames=1):
+
+        self.max_missed = max_missed
+        self.gate = self.default_gate if gate is None else gate
+        self.max_cost = max_cost
+        self.min_n_frames = min_n_frames
+
+        # State is (x, y, vx, vy), in pixels and pixels / frame.
+        self.F = np.eye(4)
+        self.F[0, 2] = self.F[1, 3] = 1
+        # Piecewise constant white acceleration noise.
+        q = accel_sigma**2 * np.array([[1/4, 1/2], [1/2, 1]])
+        self.Q = np.zeros((4, 4))
+        self.Q[np.ix_([0, 2], [0, 2])] = q
+        self.Q[np.ix_([1, 3], [1, 3])] = q
+        self.R = measurement_sigma**2 * np.eye(2)
+        self.P0 = np.diag([measurement_sigma**2] * 2 +
+            [initial_velocity_sigma**2] * 2
+        )
+
+        self.frame = 0
+        self.next_id = 0
+        self.n_dims = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.states = np.empty((0, 4))
+        self.covs = np.empty((0, 4, 4))
+        self.n_missed = np.empty(0, dtype=np.int64)
+        # track ID -> list of (frame, *detection) rows
+        self.histories = dict()
+
+    def __len__(self):
+        """Returns the number of active tracks.
+        """
+        return len(self.ids)
+
+    def predicted_centers(self):
+        """Returns (n_active_tracks, 2) predicted centers for the next frame.
+        """
+        return self.states[:, :2] + self.states[:, 2:]
+
+    def _columns(self):
+        return ['track_id', 'frame', 'x', 'y'] + (['diameter']
+            if self.n_dims == 3 else []
+        )
+
+    def _close(self, to_close):
+        rows = []
+        for track_id in self.ids[to_close]:
+            history = self.histories.pop(track_id)
+            if len(history) < self.min_n_frames:
+                continue
+            rows.extend((track_id,) + h for h in history)
+
+        keep = ~ to_close
+        self.ids = self.ids[keep]
+        self.states = self.states[keep]
+        self.covs = self.covs[keep]
+        self.n_missed = self.n_missed[keep]
+        columns = self._columns()
+        # (explicit dtypes, so concatenating w/ empty outputs keeps them)
+        return pd.DataFrame(rows, columns=columns).astype(
+            {c: np.int64 if c in ('track_id', 'frame') else np.float64
+            for c in columns}
+        )
+
+    def update(self, detections):
+        """Takes (n, 2 or 3) detections (x, y[, diameter]) in the next frame.
+
+        Returns DataFrame of any tracks closed by this frame.
+        """
+        from scipy.optimize import linear_sum_assignment
+
+        detections = np.asarray(detections, dtype=np.float64)
+        if detections.size == 0:
+            detections = detections.reshape((0, 2 if self.n_dims is None
+                else self.n_dims
+            ))
+        if self.n_dims is None:
+            self.n_dims = detections.shape[1]
+        elif detections.shape[1] != self.n_dims:
+            raise ValueError('number of detection columns changed')
+
+        centers = detections[:, :2]
+
+        # Predict.
+        self.states = self.states @ self.F.T
+        self.covs = self.F @ self.covs @ self.F.T + self.Q
+
+        # Gated assignment.
+        S = self.covs[:, :2, :2] + self.R
+        S_inv = np.linalg.inv(S)
+        residuals = centers[None, :, :] - self.states[:, None, :2]
+        costs = np.einsum('tdi,tij,tdj->td', residuals, S_inv, residuals)
+        allowed = costs < self.gate
+        if self.max_cost is not None:
+            allowed &= np.linalg.norm(residuals, axis=-1) < self.max_cost
+
+        costs[~ allowed] = self.gate
+        track_idx, det_idx = linear_sum_assignment(costs)
+        ok = allowed[track_idx, det_idx]
+        track_idx = track_idx[ok]
+        det_idx = det_idx[ok]
+
+        # Update matched tracks.
+        if len(track_idx) > 0:
+            P = self.covs[track_idx]
+            K = P[:, :, :2] @ S_inv[track_idx]
+            self.states[track_idx] += (K @ residuals[track_idx, det_idx, :,
+                None])[..., 0]
+            self.covs[track_idx] = P - K @ P[:, :2, :]
+
+        for t, d in zip(self.ids[track_idx], det_idx):
+            self.histories[t].append((self.frame,) + tuple(detections[d]))
+
+        matched = np.zeros(len(self.ids), dtype=bool)
+        matched[track_idx] = True
+        self.n_missed[matched] = 0
+        self.n_missed[~ matched] += 1
+        closed = self._close(self.n_missed > self.max_missed)
+
+        # Start tracks for unmatched detections.
+        new = np.setdiff1d(np.arange(len(detections)), det_idx)
+        new_ids = self.next_id + np.arange(len(new))
+        self.next_id += len(new)
+        self.ids = np.concatenate([self.ids, new_ids])
+        self.states = np.concatenate([self.states,
+            np.concatenate([centers[new], np.zeros((len(new), 2))], axis=1)
+        ])
+        self.covs = np.concatenate([self.covs,
+            np.broadcast_to(self.P0, (len(new), 4, 4))
+        ])
+        self.n_missed = np.concatenate([self.n_missed,
+            np.zeros(len(new), dtype=np.int64)
+        ])
+        for t, d in zip(new_ids, new):
+            self.histories[t] = [(self.frame,) + tuple(detections[d])]
+
+        self.frame += 1
+        return closed
+
+    def fit_and_update(self, frame, template_data, um_per_pixel_xy,
+        **fit_kwargs):
+        """Fits ROIs to `frame` w/ `fit_circle_rois` and calls `update`.
+        """
+        centers, radii, _, _ = fit_circle_rois(None, template_data, avg=frame,
+            _um_per_pixel_xy=um_per_pixel_xy, **fit_kwargs
+        )
+        return self.update(np.concatenate((centers,
+            np.expand_dims(radii * 2, -1)), axis=-1
+        ))
+
+    def finish(self):
+        """Closes and returns all active tracks.
+        """
+        return self._close(np.ones(len(self.ids), dtype=bool))
+
+
 # TODO add nonoverlap constraint? somehow make closer to real data?
 # TODO use this to test gui/fitting/tracking
 def make_test_centers(initial_n=20, nt=100, frame_shape=(256, 256), sigma=3,
@@ -9595,6 +13873,274 @@ def make_test_centers(initial_n=20, nt=100, frame_shape=(256, 256), sigma=3,
     return centers
 
 
+def make_test_movie(n_frames=300, frame_shape=(256, 256), n_cells=50,
+    diam_px=8, baseline=200.0, noise_sd=20.0, response_scale=400.0,
+    seed=None):
+    """Returns (movie, centers, footprints) for a synthetic recording.
+
+    `movie` is (t,x,y) uint16, with `n_cells` planted disk shaped cells of
+    diameter `diam_px` (on a noisy background), each with a random
+    exponentially decaying transient. `centers` is (n_cells, 2) integer
+    (x, y) and `footprints` is (x, y, n_cells) bool, as
+    `extract_traces_boolean_footprints` expects.
+    """
+    rng = np.random.RandomState(seed)
+
+    x, y = frame_shape
+    r = diam_px / 2
+    margin = int(np.ceil(r))
+    centers = np.stack([
+        rng.randint(margin, x - margin, size=n_cells),
+        rng.randint(margin, y - margin, size=n_cells)
+    ], axis=1)
+
+    xx, yy = np.mgrid[:x, :y]
+    footprints = np.empty((x, y, n_cells), dtype=bool)
+    for i, (cx, cy) in enumerate(centers):
+        footprints[:, :, i] = (xx - cx)**2 + (yy - cy)**2 <= r**2
+
+    onsets = rng.randint(0, n_frames, size=n_cells)
+    t = np.arange(n_frames)[:, None]
+    since_onset = t - onsets[None, :]
+    traces = np.where(since_onset >= 0, np.exp(-since_onset / 10.0), 0.0)
+    traces = traces * rng.uniform(0.5, 1.0, size=n_cells) * response_scale
+
+    movie = baseline + noise_sd * rng.randn(n_frames, x, y)
+    # (t, n) x (n, x*y) -> (t, x*y)
+    movie += (traces @ footprints.reshape(x * y, n_cells).T.astype(np.float64)
+        ).reshape(n_frames, x, y)
+
+    movie = np.clip(np.round(movie), 0, 2**16 - 1).astype(np.uint16)
+    return movie, centers, footprints
+
+
+def make_test_template_data(diam_px=8, margin=4, um_per_pixel_xy=0.5,
+    frame_shape=(256, 256)):
+    """Returns synthetic `template_data` (a blurred disk) for `fit_circle_rois`.
+
+    Only has the keys `fit_circle_rois` needs with `multiscale=False`. Pass
+    `_um_per_pixel_xy=um_per_pixel_xy` along with it.
+    """
+    import cv2
+
+    d = int(diam_px) + 2 * margin
+    c = (d - 1) / 2
+    xx, yy = np.mgrid[:d, :d]
+    template = ((xx - c)**2 + (yy - c)**2 <= (diam_px / 2)**2).astype(
+        np.float32)
+    template = cv2.GaussianBlur(template, (3, 3), 0)
+
+    mean_cell_diam_um = diam_px * um_per_pixel_xy
+    return {
+        'template': template,
+        'margin': margin,
+        'mean_cell_diam_um': mean_cell_diam_um,
+        'frame_shape': frame_shape,
+        'all_cell_diams_um': np.array([mean_cell_diam_um]),
+        'kmeans_k2cluster_cell_diams': {1: np.array([mean_cell_diam_um])}
+    }
+
+
+def write_test_thorimage_dir(thorimage_dir, movie, fps=10.0,
+    um_per_pixel_xy=0.5, start_time=None, n_flyback=0):
+    """Writes (t,[z,]x,y) uint16 `movie` as a minimal ThorImage output dir.
+
+    Writes only what `load_thorimage_metadata` / `read_movie` need: an
+    Experiment.xml and an Image_0001_0001.raw file. For volumes, `n_flyback`
+    (zero) flyback frames are written after each volume.
+    """
+    if movie.ndim == 4:
+        n_steps = movie.shape[1]
+        movie = np.concatenate([movie, np.zeros((movie.shape[0], n_flyback) +
+            movie.shape[2:], dtype=movie.dtype)], axis=1
+        ).reshape((-1,) + movie.shape[2:])
+    elif movie.ndim == 3:
+        n_steps = 1
+        n_flyback = 0
+    else:
+        raise NotImplementedError('only (t,[z,]x,y) movies supported')
+
+    if start_time is None:
+        # Whole seconds, so the XML date and uTime agree.
+        start_time = datetime.fromtimestamp(int(time.time()))
+
+    n_frames, x, y = movie.shape
+
+    root = etree.Element('ThorImageExperiment')
+    etree.SubElement(root, 'Date', {
+        'date': start_time.strftime('%m/%d/%Y %H:%M:%S'),
+        'uTime': str(int(start_time.timestamp()))
+    })
+    etree.SubElement(root, 'LSM', {
+        'pixelX': str(x),
+        'pixelY': str(y),
+        'pixelSizeUM': str(um_per_pixel_xy),
+        'frameRate': str(fps),
+        'averageMode': '0',
+        'averageNum': '1'
+    })
+    etree.SubElement(root, 'ZStage', {'steps': str(n_steps)})
+    etree.SubElement(root, 'Streaming', {
+        'enable': '1',
+        'zFastEnable': '1',
+        'flybackFrames': str(n_flyback),
+        'frames': str(n_frames)
+    })
+
+    os.makedirs(thorimage_dir, exist_ok=True)
+    etree.ElementTree(root).write(get_thorimage_xml_path(thorimage_dir))
+
+    # From ThorImage manual: "unsigned, 16-bit, with little-endian byte-order"
+    movie.astype('<u2').tofile(join(thorimage_dir, 'Image_0001_0001.raw'))
+
+
+def write_test_thorsync_dir(thorsync_dir, n_blocks=3, frames_per_block=100,
+    fps=10.0, odor_onset_s=3.0, odor_duration_s=1.0, block_gap_s=5.0,
+    samplerate=1000.0, seed=None):
+    """Writes synthetic ThorSync output, returning the expected timing info.
+
+    The HDF5 file has the counter ('Global/GCtr'), frame out ('DI/FrameOut'),
+    scope pin ('AI/scopePin'), odor valve ('AI/olfDispPin') and PID
+    ('AI/pid') lines `thorsync_timing_info` reads. There is one odor pulse in
+    each block (period of acquisition), `odor_onset_s` after it starts.
+    """
+    import h5py
+
+    rng = np.random.RandomState(seed)
+
+    block_s = frames_per_block / fps
+    total_s = block_gap_s + n_blocks * (block_s + block_gap_s)
+    n_samples = int(round(total_s * samplerate))
+
+    frame_out = np.zeros(n_samples, dtype=np.uint32)
+    scope = np.zeros(n_samples, dtype=np.float64)
+    valve = np.zeros(n_samples, dtype=np.float64)
+
+    frame_samples = []
+    block_first_frames = []
+    block_last_frames = []
+    odor_onset_frames = []
+    odor_offset_frames = []
+    odor_onset_samples = []
+    odor_offset_samples = []
+    for b in range(n_blocks):
+        block_start_s = block_gap_s + b * (block_s + block_gap_s)
+        first_frame = len(frame_samples)
+        block_first_frames.append(first_frame)
+        for i in range(frames_per_block):
+            start = int(round((block_start_s + i / fps) * samplerate))
+            stop = int(round((block_start_s + (i + 0.5) / fps) * samplerate))
+            frame_out[start:stop] = 1
+            frame_samples.append(start)
+        block_last_frames.append(len(frame_samples) - 1)
+
+        scope_on = int(round(block_start_s * samplerate))
+        scope_off = int(round((block_start_s + block_s) * samplerate))
+        scope[scope_on:scope_off] = 5.0
+
+        on = int(round((block_start_s + odor_onset_s) * samplerate))
+        off = int(round((block_start_s + odor_onset_s + odor_duration_s) *
+            samplerate
+        ))
+        valve[on:off] = 5.0
+        odor_onset_samples.append(on)
+        odor_offset_samples.append(off)
+
+        block_frames = np.array(frame_samples[first_frame:])
+        odor_onset_frames.append(first_frame +
+            np.searchsorted(block_frames, on, side='left')
+        )
+        odor_offset_frames.append(first_frame +
+            np.searchsorted(block_frames, off, side='right') - 1
+        )
+
+    # PID rises with a ~0.5s lag + time constant after each valve opening.
+    pid = 0.01 * rng.randn(n_samples)
+    t = np.arange(n_samples)
+    for on, off in zip(odor_onset_samples, odor_offset_samples):
+        lag = int(0.5 * samplerate)
+        since = t[on + lag:] - (on + lag)
+        pid[on + lag:] += np.where(t[on + lag:] < off + lag,
+            1 - np.exp(-since / (0.2 * samplerate)),
+            np.exp(-(t[on + lag:] - (off + lag)) / (0.2 * samplerate)) *
+            (1 - np.exp(-(off - on) / (0.2 * samplerate)))
+        )
+
+    ticks_per_sample = thorsync_clock_hz / samplerate
+    gctr = np.round(np.arange(n_samples) * ticks_per_sample).astype(np.uint64)
+
+    os.makedirs(thorsync_dir, exist_ok=True)
+    with h5py.File(join(thorsync_dir, 'Episode001.h5'), 'w') as h5:
+        h5.create_dataset('Global/GCtr', data=gctr[:, None])
+        h5.create_dataset('DI/FrameOut', data=frame_out[:, None])
+        h5.create_dataset('AI/scopePin', data=scope[:, None])
+        h5.create_dataset('AI/olfDispPin', data=valve[:, None])
+        h5.create_dataset('AI/pid', data=pid[:, None])
+
+    settings = etree.Element('RealTimeDataSettings')
+    etree.ElementTree(settings).write(
+        join(thorsync_dir, 'ThorRealTimeDataSettings.xml')
+    )
+
+    frame_samples = np.array(frame_samples)
+    return {
+        'frame_times': gctr[frame_samples] / thorsync_clock_hz,
+        'block_first_frames': np.array(block_first_frames, dtype=np.uint32),
+        'block_last_frames': np.array(block_last_frames, dtype=np.uint32),
+        'odor_onset_frames': np.array(odor_onset_frames, dtype=np.uint32),
+        'odor_offset_frames': np.array(odor_offset_frames, dtype=np.uint32),
+        'odor_onset_samples': np.array(odor_onset_samples),
+        'odor_offset_samples': np.array(odor_offset_samples),
+        'samplerate': samplerate
+    }
+
+
+def make_test_trace_df(n_flies=2, n_cells=100, n_odors=6, n_repeats=3,
+    n_frames=45, fps=6.0, onset_frame=10, seed=None):
+    """Returns an unexpanded trace table like those in the trace pickles.
+
+    One row per (fly, presentation, cell), with `raw_f`, `df_over_f` and
+    `from_onset` array columns (`expand_array_cols` gives the long format).
+    """
+    rng = np.random.RandomState(seed)
+
+    from_onset = (np.arange(n_frames) - onset_frame) / fps
+    decay = np.where(from_onset >= 0, np.exp(-np.clip(from_onset, 0, None)),
+        0.0)
+
+    # Same odor names across flies, so correlations can be pooled.
+    odors = [f'odor{i}' for i in range(n_odors)]
+    rows = []
+    for fly_num in range(1, n_flies + 1):
+        tuning = rng.gamma(0.5, 1.0, size=(n_cells, n_odors))
+        order = 0
+        for repeat_num in range(n_repeats):
+            for odor_idx in rng.permutation(n_odors):
+                amps = tuning[:, odor_idx] * rng.uniform(0.8, 1.2,
+                    size=n_cells)
+                dff = amps[:, None] * decay[None, :] + \
+                    0.1 * rng.randn(n_cells, n_frames)
+                raw_f = 100.0 * (1 + dff)
+                for cell in range(n_cells):
+                    rows.append({
+                        'prep_date': pd.Timestamp('2020-01-01'),
+                        'fly_num': fly_num,
+                        'thorimage_id': 'fn_0001',
+                        'comparison': 0,
+                        'name1': odors[odor_idx],
+                        'name2': 'paraffin',
+                        'repeat_num': repeat_num,
+                        'order': order,
+                        'cell': cell,
+                        'raw_f': raw_f[cell].astype(np.float32),
+                        'df_over_f': dff[cell].astype(np.float32),
+                        'from_onset': from_onset
+                    })
+                order += 1
+
+    return pd.DataFrame(rows)
+
+
 # Adapted from Vishal's answer at https://stackoverflow.com/questions/287871
 _color_codes = {
     'red': '31',
@@ -9664,6 +14210,129 @@ def latest_trace_pickles():
     return df
 
 
+def load_trace_pickle(trace_pickle):
+    """Returns (df, other_data) from a trace pickle.
+
+    Trace pickles either contain just the trace DataFrame, or a dict with it
+    under 'trace_df', and possibly other data (e.g. PID) under other keys.
+    `other_data` is None if there was no other data.
+    """
+    with open(trace_pickle, 'rb') as f:
+        data = pickle.load(f)
+
+    # not sure this will always work...
+    if isinstance(data, pd.DataFrame):
+        return data, None
+
+    assert type(data) is dict
+    trace_pickle_key = 'trace_df'
+    assert trace_pickle_key in data.keys()
+    df = data[trace_pickle_key]
+    assert isinstance(df, pd.DataFrame)
+    other_data = {k: v for k, v in data.items() if k != trace_pickle_key}
+    if len(other_data) == 0:
+        other_data = None
+    return df, other_data
+
+
+_trace_metadata_version = 1
+def trace_metadata_filename(trace_pickle):
+    """Returns path to the JSON metadata sidecar for a trace pickle.
+    """
+    return os.path.splitext(trace_pickle)[0] + '.meta.json'
+
+
+def trace_df_metadata(df):
+    """Returns small dict summarizing a trace DataFrame.
+
+    Has the recording keys (`recording_cols`), 'odor_set' (None if
+    `odorset_name` fails), 'n_cells', 'n_presentations' and 'n_frames' (per
+    cell, across presentations).
+    """
+    keys = df[recording_cols].drop_duplicates()
+    assert len(keys) == 1
+    keys = keys.iloc[0]
+
+    try:
+        odor_set = odorset_name(df)
+    # e.g. older pair experiments, which don't have an odor set.
+    except ValueError:
+        odor_set = None
+
+    n_cells = int(df.cell.nunique())
+    presentation_cols = [c for c in ('comparison', 'order') if c in df.columns]
+    n_presentations = int(len(df[presentation_cols].drop_duplicates()))
+    return {
+        'prep_date': format_date(keys['prep_date']),
+        'fly_num': int(keys['fly_num']),
+        'thorimage_id': str(keys['thorimage_id']),
+        'odor_set': odor_set,
+        'n_cells': n_cells,
+        'n_presentations': n_presentations,
+        'n_frames': int(len(df) // n_cells)
+    }
+
+
+def write_trace_metadata(trace_pickle, df=None):
+    """Writes metadata sidecar for `trace_pickle`, returning the metadata.
+
+    `df` is loaded from `trace_pickle` if not passed.
+    """
+    if df is None:
+        df, _ = load_trace_pickle(trace_pickle)
+
+    st = os.stat(trace_pickle)
+    metadata = trace_df_metadata(df)
+    sidecar = {
+        'version': _trace_metadata_version,
+        'trace_pickle_size': st.st_size,
+        'trace_pickle_mtime_ns': st.st_mtime_ns,
+        'metadata': metadata
+    }
+    meta_file = trace_metadata_filename(trace_pickle)
+    tmp_file = f'{meta_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    os.replace(tmp_file, meta_file)
+    return metadata
+
+
+def read_trace_metadata(trace_pickle, write_missing=True):
+    """Returns trace pickle metadata (see `trace_df_metadata`) from sidecar.
+
+    If the sidecar is missing or out of date (trace pickle size / mtime
+    changed), the metadata is computed from the pickle, and written to a new
+    sidecar if `write_missing` is True.
+    """
+    meta_file = trace_metadata_filename(trace_pickle)
+    try:
+        with open(meta_file, 'r') as f:
+            sidecar = json.load(f)
+
+        st = os.stat(trace_pickle)
+        if (sidecar['version'] == _trace_metadata_version and
+            sidecar['trace_pickle_size'] == st.st_size and
+            sidecar['trace_pickle_mtime_ns'] == st.st_mtime_ns):
+
+            return sidecar['metadata']
+
+    except (IOError, ValueError, KeyError):
+        pass
+
+    if write_missing:
+        return write_trace_metadata(trace_pickle)
+
+    df, _ = load_trace_pickle(trace_pickle)
+    return trace_df_metadata(df)
+
+
+def write_trace_pickle(df, trace_pickle):
+    """Writes trace DataFrame to pickle, along with its metadata sidecar.
+    """
+    df.to_pickle(trace_pickle)
+    write_trace_metadata(trace_pickle, df=df)
+
+
 def add_group_id(df, group_keys, name=None, start_at_one=True):
     """Adds integer column to df to identify unique combinations of group_keys.
     """
@@ -22,12 +22,19 @@ import pandas as pd
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
 from sklearn.metrics import roc_curve, auc
-import h5py
 
 import chemutils as cu
 
 import hong2p.util as u
 
+# This script does its work at module level, so figure export workers can't
+# be started by a forkserver (which would re-import __main__, re-running all of
+# this). They are forked here instead, before any threads are started, and
+# render all formats of each figure in parallel.
+if u.figure_export_kind is None:
+    u.figure_export_kind = 'fork'
+u.figure_exporter()
+
 # Having all matplotlib-related imports come after `hong2p.util` import,
 # so that I can let `hong2p.util` set the backend, which it seems must be set
 # before the first import of `matplotlib.pyplot`
@@ -148,10 +155,17 @@ parser.add_argument('-j', '--no-parallel-process-traces', default=False,
     action='store_true', help='Disables parallel calls to process_traces. '
     'Useful for debugging internals of that function.'
 )
+parser.add_argument('-l', '--load-pid', default=False, action='store_true',
+    help='Loads PID signal around each odor presentation from ThorSync data.'
+)
 parser.add_argument('-r', '--plot-formats', action='store', default='png,pdf',
     help='Extensions for plot formats to save figures in. Just include what '
     'comes after the period. Use commas to separate multiple format extensions.'
 )
+parser.add_argument('-u', '--no-incremental-figs', default=False,
+    action='store_true', help='Re-saves all figures, even those whose inputs '
+    'have not changed since they were last saved.'
+)
 # TODO TODO add argument that accepts an arbitrary (',' separated?) list of plot
 # type names and only those analyses are performed. also include in help str the
 # full available list. to test the effect of changes on particular outputs
@@ -467,13 +481,78 @@ manual_section2order = dict()
 section2order = dict()
 section2subsection_orders = dict()
 #
-def savefigs(fig, plot_type_prefix, *vargs, odor_set=None, section=None,
-    subsection=None, note=None, exclude_from_latex=False, section_order=None,
-    order=None):
+def plot_type_and_fnames(plot_type_prefix, *vargs, odor_set=None):
+    """Returns (plot_type, recording_info_suffix, plot_fnames) for savefigs.
+    """
+    if len(vargs) == 1:
+        recording_info_suffix = vargs[0]
+        assert not recording_info_suffix.startswith('_')
+    elif len(vargs) == 0:
+        recording_info_suffix = None
+    else:
+        raise ValueError('too many positional arguments')
+
+    plot_type_parts = [plot_type_prefix]
+    if odor_set is not None:
+        plot_type_parts.append(odor_set)
+
+    if recording_info_suffix is not None:
+        plot_type_parts.append(recording_info_suffix)
+
+    plot_type = '_'.join(plot_type_parts)
+
+    plot_fnames = [join(fig_dir, pf, plot_type + '.' + pf)
+        for pf in plot_formats
+    ]
+    return plot_type, recording_info_suffix, plot_fnames
+
+
+def analysis_params():
+    """Returns dict of the (defined) parameters named in `param_names`.
+
+    Always included in the hash of figure `inputs`, so figures are remade when
+    they change, even if the data passed in `inputs` would not.
+    """
+    g = globals()
+    return {n: g[n] for n in param_names if n in g}
+
+
+def figure_inputs_hash(plot_type, inputs):
+    return u.hash_inputs(plot_type, inputs, analysis_params())
+
+
+def figs_up_to_date(plot_type_prefix, *vargs, inputs, odor_set=None):
+    """True if savefigs with the same arguments would not need to save anything.
+
+    Lets callers skip making a figure entirely. Still call savefigs (with
+    fig=None) in this case, so the figure stays in the report.
+    """
+    if not save_figs or args.no_incremental_figs:
+        return False
+
+    plot_type, _, plot_fnames = plot_type_and_fnames(plot_type_prefix, *vargs,
+        odor_set=odor_set
+    )
+    return u.figures_up_to_date(plot_fnames,
+        figure_inputs_hash(plot_type, inputs)
+    )
+
+
+@u.instrumented('figure_saving')
+def savefigs(fig, plot_type_prefix, *vargs, inputs, odor_set=None,
+    section=None, subsection=None, note=None, exclude_from_latex=False,
+    section_order=None, order=None):
     """
     section_order (None or int): If an int, it is used as a sort key to order
         this section relative to the others. Default order start at 0 and
         increases with each section added.
+
+    inputs: All of the data (and any parameters not in `analysis_params`)
+        the figure was made from. Including the plotting function means
+        changes to its code also count. Saving is skipped if the files on disk
+        were already saved from inputs with the same content hash (see
+        `figs_up_to_date`). `fig` may only be None in that case. Required, so
+        no figure is silently remade on every run.
     """
     # TODO maybe rename subsection to figure name or something?
     # (though if section is only thing passed, it has the same meaning...)
@@ -488,39 +567,40 @@ def savefigs(fig, plot_type_prefix, *vargs, odor_set=None, section=None,
     # TODO TODO maybe just monkey patch matplotlib to change the default
     # behavior? (factor into fn and call in util, where backend is selected?)
     # or call just after imports in util?
-    man = plt.get_current_fig_manager()
-    old_title = man.canvas.get_window_title()
-    man.canvas.set_window_title(f'{old_title} ({socket.gethostname()})')
-    del man, old_title
+    if fig is not None:
+        man = plt.get_current_fig_manager()
+        old_title = man.canvas.get_window_title()
+        man.canvas.set_window_title(f'{old_title} ({socket.gethostname()})')
+        del man, old_title
     #
 
     out_strs = []
     if save_figs and (args.save_nonreport_figs or not exclude_from_latex):
-        if len(vargs) == 1:
-            recording_info_suffix = vargs[0]
-            assert not recording_info_suffix.startswith('_')
-        elif len(vargs) == 0:
-            recording_info_suffix = None
-        else:
-            raise ValueError('too many positional arguments')
-
-        plot_type_parts = [plot_type_prefix]
-        if odor_set is not None:
-            plot_type_parts.append(odor_set)
+        plot_type, recording_info_suffix, plot_fnames = plot_type_and_fnames(
+            plot_type_prefix, *vargs, odor_set=odor_set
+        )
 
-        if recording_info_suffix is not None:
-            plot_type_parts.append(recording_info_suffix)
+        input_hash = None
+        up_to_date = False
+        if not args.no_incremental_figs:
+            input_hash = figure_inputs_hash(plot_type, inputs)
+            up_to_date = u.figures_up_to_date(plot_fnames, input_hash)
 
-        plot_type = '_'.join(plot_type_parts)
+        if fig is None and not up_to_date:
+            raise ValueError(f'fig=None, but plots for {plot_type} are not '
+                'up-to-date'
+            )
 
         if verbose_savefig:
-            out_s = f'writing plots for {plot_type}'
+            if up_to_date:
+                out_s = f'plots for {plot_type} up-to-date'
+            else:
+                out_s = f'writing plots for {plot_type}'
             if not in_worker_process():
                 print(out_s)
             out_strs.append(out_s)
 
-        for pf in plot_formats:
-            plot_fname = join(fig_dir, pf, plot_type + '.' + pf)
+        for plot_fname in plot_fnames:
             if print_full_plot_paths:
                 if not in_worker_process():
                     print(plot_fname)
@@ -535,10 +615,15 @@ def savefigs(fig, plot_type_prefix, *vargs, odor_set=None, section=None,
 
             # This should be redundant with check above, but just to be sure.
             assert plot_fname not in plots_made_this_run
-            fig.savefig(plot_fname)
             if not exclude_from_latex:
                 plots_made_this_run.add(plot_fname)
 
+        # Formats are rendered in parallel, in background workers (if enabled),
+        # so this only blocks if too many figures are already waiting to be
+        # saved. u.wait_for_figures() must be called before using the files.
+        if not up_to_date:
+            u.savefig_async(fig, plot_fnames, input_hash=input_hash)
+
         if print_full_plot_paths:
             if not in_worker_process():
                 print('')
@@ -631,7 +716,7 @@ def savefigs(fig, plot_type_prefix, *vargs, odor_set=None, section=None,
                 assert note == prev_latex_data['note']
                 assert paired == prev_latex_data['paired']
 
-    if not show_plots_interactively:
+    if not show_plots_interactively and fig is not None:
         fig_queue.append(fig)
         fignums = plt.get_fignums()
         n_open = len(fignums)
@@ -653,106 +738,103 @@ def savefigs(fig, plot_type_prefix, *vargs, odor_set=None, section=None,
 
 
 def load_pid_data(df):
-    keys = u.recording_df2keys(df)
-    mat = u.matfile(*keys)
-    print(mat)
-    ti = u.load_mat_timing_info(mat)
-    # TODO do all the mat files i'm currently using have these variables?
-    # they seem like what i want. are they?
-    # TODO TODO need to do same kind of painting into blocks i remember doing
-    # in gui at some point w/ frames -> trials?? use same code?
-    stim_ic_idx = ti['stim_ic_idx']
-    stim_fc_idx = ti['stim_fc_idx']
+    """Returns (PID windows around each presentation, their sample rate).
+
+    For recording `df`, or None if they could not be loaded. Index has the
+    presentation metadata of the trace table, and columns are time from odor
+    onset. See `u.load_pid_windows`.
+
+    Presentations are matched to odor pulses by their odor onset frames, and
+    the pulses' ThorSync sample indices come from the timing info
+    (`stim_ic_idx`). Presentations without a real onset frame (missing
+    presentations) get NaN rows.
+    """
+    for c in ('thorsync_path', 'odor_onset_frame'):
+        if c not in df.columns:
+            warnings.warn(f'No {c} in trace DataFrame! Could not load PID '
+                'data!'
+            )
+            return None
 
     ts_paths = df.thorsync_path.unique()
     assert len(ts_paths) == 1
     thorsync_dir = ts_paths[0]
 
-    h5_files = glob.glob(join(thorsync_dir, '*.h5'))
-    if len(h5_files) == 0:
-        warnings.warn(f'No .h5 file found under ThorSync dir {thorsync_dir}! '
-            'Could not load PID data!'
+    rec_keys = df[[fly_keys[0], fly_keys[1], rec_key]].drop_duplicates()
+    assert len(rec_keys) == 1
+    date, fly_num, thorimage_id = rec_keys.iloc[0]
+    try:
+        ti = u.load_mat_timing_info(u.matfile(date, fly_num, thorimage_id),
+            use_matlab_engine=False
+        )
+    except (IOError, KeyError, NotImplementedError) as err:
+        warnings.warn('Could not load timing info for '
+            f'{u.format_keys(date, fly_num, thorimage_id)}: {err}. Could not '
+            'load PID data!'
         )
         return None
-    assert len(h5_files) == 1
-    h5_file = h5_files[0]
-    print(f'loading {h5_file}... ', end='', flush=True)
-    # TODO switch back to context manager after debugging
-    '''
-    with h5py.File(h5_file, 'r') as f:
-        print(f.keys())
-        import ipdb; ipdb.set_trace()
-    '''
-    f = h5py.File(h5_file, 'r')
-    # TODO isn't there timing information? no way here to get times for thorsync
-    # samples?????
-    # TODO otherwise, use xml to get sampling rate i guess?
-    # TODO cases where it was named something slightly different?
-    #print(f.keys())
+
+    if 'odor_onset_samples' not in ti:
+        warnings.warn(f'No stim_ic_idx in timing info for {thorsync_dir}. '
+            'Regenerate it (e.g. with populate_db). Could not load PID data!'
+        )
+        return None
+
+    presentations = df[['order', 'name1', 'name2', 'repeat_num',
+        'odor_onset_frame']].drop_duplicates().sort_values('order')
+
+    # Trace table onset frames are relative to the first frame kept.
+    drop_first_n_frames = u.metadata(date, fly_num, thorimage_id
+        )['drop_first_n_frames']
+    onset_frame2pulse = {f - drop_first_n_frames: i
+        for i, f in enumerate(ti['odor_onset_frames'])
+    }
+    pulses = presentations.odor_onset_frame.map(onset_frame2pulse)
+    real = pulses.notnull().values
+    if not real.any():
+        warnings.warn(f'No presentation onset frames match the timing info for '
+            f'{thorsync_dir}! Could not load PID data!'
+        )
+        return None
+
+    onset_samples = \
+        ti['odor_onset_samples'][pulses[real].astype(np.int64).values]
     try:
-        assert 'pid' in f['AI'].keys()
-    except AssertionError:
-        print('pid not in f["AI"].keys()!')
-        print('f["AI"].keys():', f['AI'].keys())
-        import ipdb; ipdb.set_trace()
-    pid = f['AI']['pid']
-    f.close()
-    print('done')
+        windows, pid_samplerate = u.load_pid_windows(thorsync_dir,
+            onset_samples=onset_samples
+        )
+    except (IOError, KeyError) as err:
+        warnings.warn(f'Could not load PID data from {thorsync_dir}: {err}')
+        return None
 
-    # TODO TODO TODO indexed w/ pandas metadata as current df is
-    import ipdb; ipdb.set_trace()
-    
+    pid = pd.DataFrame(np.nan, index=pd.MultiIndex.from_frame(
+        presentations.drop(columns='odor_onset_frame')),
+        columns=windows.columns
+    )
+    pid.iloc[real] = windows.values
+    return pid, pid_samplerate
 
 
-trace_pickle2df = dict()
-trace_pickle2other_data = dict()
-# TODO maybe flag here + thread through to CLI arg for loading PID stuff if we
-# want to make PID plots
-# TODO maybe move this + caching to util?
+# Each worker process has its own cache (inheriting anything loaded before the
+# pool was started).
+trace_cache = u.LRUCache(
+    max_bytes=int(float(os.environ.get('HONG_2P_TRACE_CACHE_MB', 1024)) *
+    2**20), name='trace pickle cache'
+)
+@u.instrumented('trace_pickle_read', recording_arg='trace_pickle')
 def read_pickle(trace_pickle):
-    had_other_data = False
-    other_data = None
-    if trace_pickle in trace_pickle2df:
-        if trace_pickle in trace_pickle2other_data:
-            other_data = trace_pickle2other_data[trace_pickle]
-            had_other_data = True
-
-        df = trace_pickle2df[trace_pickle]
-    else:
-        with open(trace_pickle, 'rb') as f:
-            data = pickle.load(f)
-            # not sure this will always work...
-            if isinstance(data, pd.DataFrame):
-                df = data
-            else:
-                assert type(data) is dict
-                trace_pickle_key = 'trace_df'
-                assert trace_pickle_key in data.keys()
-                df = data[trace_pickle_key]
-                assert isinstance(data, pd.DataFrame)
-                other_data = {
-                    k: v for k, v in data.items() if k != trace_pickle_key
-                }
-                if len(other_data) == 0:
-                    other_data = None
-                else:
-                    trace_pickle2other_data[trace_pickle] = other_data
-                    had_other_data = True
+    cached = trace_cache.get(trace_pickle)
+    if cached is not None:
+        return cached
 
-        trace_pickle2df[trace_pickle] = df
+    df, other_data = u.load_trace_pickle(trace_pickle)
 
-    if not had_other_data:
-        # TODO uncomment after lab meeting
-        '''
-        other_data = dict()
-        other_data['pid'] = load_pid_data(df)
-        if other_data['pid'] is not None:
-            trace_pickle2other_data[trace_pickle] = other_data
-        else:
-            other_data = None
-        '''
-        other_data = None
+    if other_data is None and args.load_pid:
+        pid_data = load_pid_data(df)
+        if pid_data is not None:
+            other_data = dict(zip(('pid', 'pid_samplerate'), pid_data))
 
+    trace_cache[trace_pickle] = (df, other_data)
     return df, other_data
 
 
@@ -771,23 +853,14 @@ def order_by_odor_sets(trace_pickles, drop_if_missing={'kiwi'},
     fly_keys2odor_sets = dict()
     fly_keys2fnames = dict()
     for tp in trace_pickles:
-        df, _ = read_pickle(tp)
+        # Only reads the small metadata sidecar (written the first time, if
+        # missing), rather than the traces.
+        metadata = u.read_trace_metadata(tp)
 
         # Excluding last recording col, so it just indexes a fly, not a
         # recording.
-        fly_keys = df[u.recording_cols[:-1]].drop_duplicates()
-        assert len(fly_keys) == 1
-        fly_keys = tuple(fly_keys.iloc[0])
-
-        odor_set = u.odorset_name(df)
-        # TODO delete all other add_odorset stuff?
-        assert 'odor_set' not in df.columns
-        # TODO what if anything depended on this being set?
-        # (because it used to be incorrect, w/ rhs = 'odor_set', so anything
-        # dependent may have also behaved incorrectly...
-        # and if nothing is dependent on this, delete it
-        df['odor_set'] = odor_set
-        #
+        fly_keys = (pd.Timestamp(metadata['prep_date']), metadata['fly_num'])
+        odor_set = metadata['odor_set']
 
         if fly_keys not in fly_keys2odor_sets:
             fly_keys2odor_sets[fly_keys] = {odor_set}
@@ -1196,7 +1269,10 @@ def odor_and_fit_plot(odor_cell_stats, weighted_sum, ordered_cells, fname,
     diff_cbar_label = f'{u.dff_latex} difference'
     cax2.set_ylabel(diff_cbar_label)
 
-    savefigs(f3, 'odorandfit', fname, exclude_from_latex=True)
+    savefigs(f3, 'odorandfit', fname, exclude_from_latex=True,
+        inputs=(odor_and_fit_plot, odor_cell_stats, weighted_sum, ordered_cells,
+        title, odor_labels, cbar_label)
+    )
 
 
 # TODO add appropriately formatted descrip of mix to input index cols so it can
@@ -1295,10 +1371,15 @@ def plot_pca(df, fname=None):
     '''
 
     if fname is not None:
-        savefigs(f1a, 'pca_unstandardized', fname, exclude_from_latex=True)
-        savefigs(f1b, 'scree_unstandardized', fname, exclude_from_latex=True)
-        savefigs(f2a, 'pca', fname, exclude_from_latex=True)
-        savefigs(f2b, 'scree', fname, exclude_from_latex=True)
+        inputs = (plot_pca, df)
+        savefigs(f1a, 'pca_unstandardized', fname, exclude_from_latex=True,
+            inputs=inputs
+        )
+        savefigs(f1b, 'scree_unstandardized', fname, exclude_from_latex=True,
+            inputs=inputs
+        )
+        savefigs(f2a, 'pca', fname, exclude_from_latex=True, inputs=inputs)
+        savefigs(f2b, 'scree', fname, exclude_from_latex=True, inputs=inputs)
 
     # TODO TODO TODO return PCA data somehow (4 things, 2 each std/nonstd?)
     # or components, explained variance, and fits (which are what exactly?),
@@ -1382,7 +1463,8 @@ def roc_analysis(window_trial_stats, reliable_responders, fname=None):
                 # generation also works w/ arbitrary extra parts (beyond
                 # glob str, maybe), to also pair on the odor here
                 savefigs(fig, task_fname, odor_fname + '_' + fname,
-                    exclude_from_latex=True
+                    exclude_from_latex=True,
+                    inputs=(roc_analysis, aucs, odor, segmentation)
                 )
 
     # TODO maybe also plot average distributions for segmentation and
@@ -1624,9 +1706,15 @@ def odor_facetgrids(df, plot_fn, xcol, ycol, xlabel, ylabel, title,
         gs.append(g)
 
     # So that saving can be deferred until after any modifications to the plots.
-    def save_fn(file_prefix, **kwargs):
+    # `inputs` should have any data those modifications are made from.
+    def save_fn(file_prefix, inputs, **kwargs):
+        fig_inputs = (odor_facetgrids, df, plot_fn, xcol, ycol, xlabel, ylabel,
+            title, by_fly, mix_facet, sharey, plot_kwargs, inputs
+        )
         for g, oset in zip(gs, odor_set_order):
-            savefigs(g.fig, file_prefix, odor_set=oset, **kwargs)
+            savefigs(g.fig, file_prefix, odor_set=oset, inputs=fig_inputs,
+                **kwargs
+            )
 
     return gs, save_fn
 
@@ -1656,7 +1744,7 @@ def add_odor_id(df):
 def process_traces(df_pickle, mean_zchange_response_thresh=None,
     fly2response_threshold=None, ref_odor=None, ref_response_percent=None,
 '''
-def process_traces(df_pickle, fly2response_threshold=None,
+def _process_traces(df_pickle, fly2response_threshold=None,
     use_existing_abbrevs=False):
     # TODO refactor so there is actually one function for each real analysis
     # contained in here? or does it just benefit too much from the tight
@@ -1693,6 +1781,9 @@ def process_traces(df_pickle, fly2response_threshold=None,
 
     ret_dict = dict()
     out_strs = []
+    # For the `inputs` of figures made below, in addition to the
+    # `analysis_params` that are always included.
+    fig_params = dict()
 
     # TODO also support case here pickle has a dict
     # (w/ this df behind a trace_df key & maybe other data, like PID, behind
@@ -1895,7 +1986,9 @@ def process_traces(df_pickle, fly2response_threshold=None,
         )
 
         out_s = savefigs(rc_hist_fig, 'response_criteria_hists', fname,
-            section='Response criteria histograms'
+            section='Response criteria histograms',
+            inputs=(scalar_response_criteria, fly_mean_zchange_response_thresh,
+            title)
         )
         out_strs.append(out_s)
 
@@ -1926,7 +2019,9 @@ def process_traces(df_pickle, fly2response_threshold=None,
         # find an elbow)?
         # TODO could also use on one / a few flies for tuning, then disable?
         out_s = savefigs(thr_fig, 'threshold_sensitivity', fname,
-            section='Threshold sensitivity'
+            section='Threshold sensitivity',
+            inputs=(resp_frac_over_zthreshes, zthreshes,
+            fly_mean_zchange_response_thresh, title)
         )
         out_strs.append(out_s)
 
@@ -1935,6 +2030,9 @@ def process_traces(df_pickle, fly2response_threshold=None,
     # responsive?
     trial_responders = \
         scalar_response_criteria >= fly_mean_zchange_response_thresh
+    # (differs across flies if fix_ref_odor_response_fracs)
+    fig_params['fly_mean_zchange_response_thresh'] = \
+        fly_mean_zchange_response_thresh
 
     # TODO TODO TODO TODO check these values against those that go into the
     # mean_frac_[barplot/responding] plots below (+ plotting scales are right)
@@ -2044,7 +2142,6 @@ def process_traces(df_pickle, fly2response_threshold=None,
         trial_by_cell_means = u.add_missing_odor_cols(df,
             trial_by_cell_means
         )
-        odor_corrs_from_means = trial_by_cell_means.corr()
 
         window_trial_maxes = window_by_trial.max()
         trial_by_cell_maxes = window_trial_maxes.to_frame().pivot_table(
@@ -2054,7 +2151,15 @@ def process_traces(df_pickle, fly2response_threshold=None,
         trial_by_cell_maxes = u.add_missing_odor_cols(df,
             trial_by_cell_maxes
         )
-        odor_corrs_from_maxes = trial_by_cell_maxes.corr()
+        assert trial_by_cell_means.index.equals(trial_by_cell_maxes.index)
+        assert trial_by_cell_means.columns.equals(trial_by_cell_maxes.columns)
+
+        # Correlating both stats in one batched computation.
+        stat_corrs = u.OdorCorrelations(np.stack([trial_by_cell_means.values,
+            trial_by_cell_maxes.values
+        ]), stimuli=trial_by_cell_means.columns)
+        odor_corrs_from_means = stat_corrs.corr_df(0)
+        odor_corrs_from_maxes = stat_corrs.corr_df(1)
 
         # TODO probably move outside of process_traces?
         if plot_correlations:
@@ -2062,47 +2167,47 @@ def process_traces(df_pickle, fly2response_threshold=None,
             # TODO TODO and are there other plots / outputs that will be
             # affected by missing odors?
             # TODO exclude 3/4 of these from latex / don't compute at all
-            if trial_order_correlations:
-                porder_corr_mean_fig = u.plot_odor_corrs(
-                    odor_corrs_from_means, title_suffix=title_suffix
+            def save_corr_plot(prefix, corrs, savefigs_kwargs, **plot_kwargs):
+                plot_kwargs['title_suffix'] = title_suffix
+                # Including the plotting function, so its source is also
+                # hashed.
+                inputs = (u.plot_odor_corrs, corrs, plot_kwargs, fig_params)
+                if figs_up_to_date(prefix, fname, inputs=inputs):
+                    fig = None
+                else:
+                    fig = u.plot_odor_corrs(corrs, **plot_kwargs)
+
+                return savefigs(fig, prefix, fname, inputs=inputs,
+                    **savefigs_kwargs
                 )
-                out_s = savefigs(porder_corr_mean_fig, 'porder_corr_mean',
-                    fname, exclude_from_latex=True
+
+            if trial_order_correlations:
+                out_s = save_corr_plot('porder_corr_mean',
+                    odor_corrs_from_means, dict(exclude_from_latex=True)
                 )
                 out_strs.append(out_s)
 
-                porder_corr_max_fig = u.plot_odor_corrs(
-                    odor_corrs_from_maxes, trial_stat='max',
-                    title_suffix=title_suffix
-                )
-                out_s = savefigs(porder_corr_max_fig, 'porder_corr_max', fname,
-                    exclude_from_latex=True
+                out_s = save_corr_plot('porder_corr_max', odor_corrs_from_maxes,
+                    dict(exclude_from_latex=True), trial_stat='max'
                 )
                 out_strs.append(out_s)
 
             if odor_order_correlations:
-                oorder_corr_mean_fig = u.plot_odor_corrs(
-                    odor_corrs_from_means, odors_in_order=odor_order,
-                    title_suffix=title_suffix
-                )
-                out_s = savefigs(oorder_corr_mean_fig, 'oorder_corr_mean',
-                    fname, exclude_from_latex=True
+                out_s = save_corr_plot('oorder_corr_mean',
+                    odor_corrs_from_means, dict(exclude_from_latex=True),
+                    odors_in_order=odor_order
                 )
                 out_strs.append(out_s)
 
-                oorder_corr_max_fig = u.plot_odor_corrs(
-                    odor_corrs_from_maxes, trial_stat='max',
-                    odors_in_order=odor_order,
-                    title_suffix=title_suffix
-                )
                 # TODO TODO crop as much as possible from this (and other
                 # above) (w/ tight_layout??), so that they can be fit
                 # side-by-side in PDF w/ minimum amount of whitespace
                 # between!
-                out_s = savefigs(oorder_corr_max_fig, 'oorder_corr_max', fname,
-                    section='Trial-max response correlations',
-                    # A large number to put this at the end.
-                    section_order=200
+                out_s = save_corr_plot('oorder_corr_max', odor_corrs_from_maxes,
+                    dict(section='Trial-max response correlations',
+                        # A large number to put this at the end.
+                        section_order=200
+                    ), trial_stat='max', odors_in_order=odor_order
                 )
                 out_strs.append(out_s)
 
@@ -2167,14 +2272,19 @@ def process_traces(df_pickle, fly2response_threshold=None,
         cbar_label = trial_stat.title() + ' response ' + u.dff_latex
 
         odor_labels = u.matlabels(trial_by_cell_stats_top, u.format_mixture)
-        # TODO fix x/y in this fn... seems T required
-        f1 = u.matshow(trial_by_cell_stats_top.T, xticklabels=odor_labels,
-            group_ticklabels=True, colorbar_label=cbar_label, fontsize=6,
-            title=title
+        inputs = (u.matshow, trial_by_cell_stats_top, odor_labels, cbar_label,
+            title, fig_params
         )
-        ax = plt.gca()
-        ax.set_aspect(0.1)
-        out_s = savefigs(f1, 'trials', fname)
+        f1 = None
+        if not figs_up_to_date('trials', fname, inputs=inputs):
+            # TODO fix x/y in this fn... seems T required
+            f1 = u.matshow(trial_by_cell_stats_top.T, xticklabels=odor_labels,
+                group_ticklabels=True, colorbar_label=cbar_label, fontsize=6,
+                title=title
+            )
+            ax = plt.gca()
+            ax.set_aspect(0.1)
+        out_s = savefigs(f1, 'trials', fname, inputs=inputs)
         out_strs.append(out_s)
 
     odor_cell_stats = trial_by_cell_stats.groupby('name1').mean()
@@ -2404,14 +2514,19 @@ def process_traces(df_pickle, fly2response_threshold=None,
     odor_labels = u.matlabels(odor_cell_stats_top, u.format_mixture)
 
     if odor_matrices:
-        # TODO TODO modify u.matshow to take a fn (x/y)labelfn? to generate
-        # str labels from row/col indices
-        f2 = u.matshow(odor_cell_stats_top.T, xticklabels=odor_labels,
-            colorbar_label=cbar_label, fontsize=6, title=title
+        inputs = (u.matshow, odor_cell_stats_top, odor_labels, cbar_label,
+            title, fig_params
         )
-        ax = plt.gca()
-        ax.set_aspect(0.1)
-        out_s = savefigs(f2, 'avg', fname)
+        f2 = None
+        if not figs_up_to_date('avg', fname, inputs=inputs):
+            # TODO TODO modify u.matshow to take a fn (x/y)labelfn? to generate
+            # str labels from row/col indices
+            f2 = u.matshow(odor_cell_stats_top.T, xticklabels=odor_labels,
+                colorbar_label=cbar_label, fontsize=6, title=title
+            )
+            ax = plt.gca()
+            ax.set_aspect(0.1)
+        out_s = savefigs(f2, 'avg', fname, inputs=inputs)
         out_strs.append(out_s)
 
     if odor_and_fit_matrices:
@@ -2550,7 +2665,9 @@ def process_traces(df_pickle, fly2response_threshold=None,
             a.axis('off')
 
         g.fig.subplots_adjust(top=0.9, left=0.05)
-        out_s = savefigs(g.fig, 'avg_traces', fname)
+        out_s = savefigs(g.fig, 'avg_traces', fname,
+            inputs=(smoothed_df, odor_order, title)
+        )
         out_strs.append(out_s)
 
     # TODO TODO TODO plot pid too
@@ -2570,18 +2687,25 @@ def process_traces(df_pickle, fly2response_threshold=None,
         # in roi / full frame MB fluorescence under each column?
         if odor_matrices:
             odor_cell_stats_top = odor_cell_stats.loc[:, order[:top_n]]
-            fs = u.matshow(odor_cell_stats_top.T,
-                xticklabels=sort_odor_labels, colorbar_label=cbar_label,
-                fontsize=6, title=title
+            inputs = (u.matshow, odor_cell_stats_top, sort_odor_labels,
+                cbar_label, title, fig_params
             )
-            ax = plt.gca()
-            ax.set_aspect(0.1)
+            fs = None
+            if not figs_up_to_date('avg', fname + ss, inputs=inputs):
+                fs = u.matshow(odor_cell_stats_top.T,
+                    xticklabels=sort_odor_labels, colorbar_label=cbar_label,
+                    fontsize=6, title=title
+                )
+                ax = plt.gca()
+                ax.set_aspect(0.1)
             # TODO support? this will prob not work w/ paired inference in
             # savefig.
             # TODO would need to at least check that pairing in report
             # generation also works w/ arbitrary extra parts (beyond
             # glob str, maybe), to also pair on the odor here
-            out_s = savefigs(fs, 'avg', fname + ss, exclude_from_latex=True)
+            out_s = savefigs(fs, 'avg', fname + ss, exclude_from_latex=True,
+                inputs=inputs
+            )
             out_strs.append(out_s)
 
         if odor_and_fit_matrices:
@@ -2599,6 +2723,31 @@ def process_traces(df_pickle, fly2response_threshold=None,
         return ret_dict
 
 
+def process_traces(df_pickle, *args, **kwargs):
+    """
+    Calls `_process_traces`, recording time spent in it (and stages within it)
+    under this recording, if instrumentation is enabled.
+
+    In pool workers, the worker's stage records and trace cache stats (since
+    the last call) are appended to the returned tuple, so the main process can
+    include them in its summaries.
+    """
+    with u.instrumented_recording(df_pickle), u.stage('process_traces'):
+        ret = _process_traces(df_pickle, *args, **kwargs)
+
+    if in_worker_process():
+        # Pool may terminate workers once all results are returned, so any
+        # figures still being saved in the background need to finish first.
+        with u.stage('figure_saving_wait'):
+            u.wait_for_figures()
+
+        cache_stats = trace_cache.stats()
+        trace_cache.reset_stats()
+        ret = ret + (u.stage_records(clear=True), cache_stats)
+
+    return ret
+
+
 pickle_outputs_dir = 'output_pickles'
 if not exists(pickle_outputs_dir):
     os.mkdir(pickle_outputs_dir)
@@ -2640,7 +2789,9 @@ if not args.only_analyze_cached:
     b = time.time()
     # TODO TODO TODO skip this step when using not using
     # fix_ref_odor_response_fracs
-    print('reading all pickles to decide their order... ', end='', flush=True)
+    print('reading trace metadata to decide pickle order... ', end='',
+        flush=True
+    )
     pickles = order_by_odor_sets(pickles)
     print('done ({:.2f}s)'.format(time.time() - b), flush=True)
 
@@ -2718,7 +2869,21 @@ if not args.only_analyze_cached:
         # are returned, they can grow across across calls to process_traces
         # within a particular worker.
         # "Zip is its own inverse" https://stackoverflow.com/questions/12974474
-        ret_dicts, plot_pfx2ltx_data_list, plots_made_list, out_strs = zip(*ret)
+        ret_dicts, plot_pfx2ltx_data_list, plots_made_list, out_strs, \
+            worker_stage_records, worker_cache_stats = zip(*ret)
+
+        for records in worker_stage_records:
+            u.add_stage_records(records)
+        del worker_stage_records
+
+        # items / nbytes are just from the last call in each worker, so they
+        # are not meaningful summed.
+        trace_cache.report({k: sum(s[k] for s in worker_cache_stats)
+            if k in ('hits', 'misses', 'evictions') else
+            max(s[k] for s in worker_cache_stats)
+            for k in worker_cache_stats[0]
+        })
+        del worker_cache_stats
 
         plot_pfx2ltx_data_list = [x for x in plot_pfx2ltx_data_list if x]
         assert all([
@@ -2743,6 +2908,7 @@ if not args.only_analyze_cached:
         ret_dicts = list(starmap(
             process_traces, product(pickles, [fly2response_threshold])
         ))
+        trace_cache.report()
 
     # This filters out any recordings that were used to set some threshold, but
     # were otherwise intentionally skipped from the rest of the analysis.
@@ -3126,7 +3292,8 @@ for i, (fly_gn, fly_gser) in enumerate(responders.groupby(fly_keys)):
             )
             reliable_of_resp_ax.set_xlabel('')
             savefigs(reliable_of_resp_fig, 'reliable_of_resp', fname,
-                section='Response reliability'
+                section='Response reliability',
+                inputs=(rel_of_resp_frac[odor_order], title)
             )
 
         if (of_mix_reliable_to_others_barplot or
@@ -3201,7 +3368,8 @@ for i, (fly_gn, fly_gser) in enumerate(responders.groupby(fly_keys)):
                 )
                 ax.set_xlabel('')
                 savefigs(fig, 'mix_rel_to_others', fname,
-                    section='Mix responder tuning'
+                    section='Mix responder tuning',
+                    inputs=(of_mix_reliable_to_others, title)
                 )
 
             # TODO maybe figure out how to compute something like this
@@ -3228,7 +3396,9 @@ for i, (fly_gn, fly_gser) in enumerate(responders.groupby(fly_keys)):
                     ' responders reliable to other odors (ratio)'
                 )
                 ratio_ax.set_xlabel('')
-                savefigs(ratio_fig, 'ratio_mix_rel_to_others', fname)
+                savefigs(ratio_fig, 'ratio_mix_rel_to_others', fname,
+                    inputs=(of_mix_reliable_to_others_ratio, title)
+                )
             '''
         ########################################################################
         # end section to de-dupe w/ code in first loop
@@ -3479,7 +3649,7 @@ if model_mixture_responses:
 
             fig = u.matshow(adf, title=f'{oset}\nScaled Hallem ORN vectors')
             savefigs(fig, f'{prefix}scaled_orns_{oset}',
-                section='Scaled ORN vectors'
+                section='Scaled ORN vectors', inputs=(u.matshow, adf, oset)
             )
 
             # TODO TODO TODO also get unscaled and scaled hallem abs rates!!!
@@ -3496,7 +3666,8 @@ if model_mixture_responses:
                 title=f'{oset} components\n\nORN correlations'
             )
             savefigs(fig, f'{prefix}model_orn_corrs_{oset}',
-                section='ORN correlations'
+                section='ORN correlations',
+                inputs=(u.plot_odor_corrs, acdf, odor_order, oset)
             )
 
             # TODO TODO TODO TODO plot real kc mean data here, w/o solvents/real
@@ -3524,7 +3695,8 @@ if model_mixture_responses:
                 title=f'{oset} components\n\nModel KC correlations'
             )
             savefigs(fig, f'{prefix}model_kc_corrs_{oset}',
-                section='Model KC correlations'
+                section='Model KC correlations',
+                inputs=(u.plot_odor_corrs, ocdf, odor_order, oset)
             )
         ########################################################################
 
@@ -3628,7 +3800,10 @@ if do_tuning_breadth_vs_shuffle:
         g.fig.subplots_adjust(top=top, hspace=hspace)
         u.fix_facetgrid_axis_labels(g)
         set_shuffle_facet_titles(g)
-        savefigs(g.fig, curr_fname, section=section, order=200 if fly else None)
+        savefigs(g.fig, curr_fname, section=section, order=200 if fly else None,
+            inputs=(tuning_breadth_vs_shuffle, df, curr_title, n_ro_bins,
+            odor_set2color)
+        )
 
     tuning_breadth_vs_shuffle()
     for fly in n_ros_df.fly_id.unique():
@@ -3654,7 +3829,9 @@ if do_tuning_breadth_vs_shuffle:
         set_shuffle_facet_titles(g, say_within_each_fly=False)
         g.fig.subplots_adjust(top=0.86, hspace=hspace, left=0.13)
         u.fix_facetgrid_axis_labels(g)
-        savefigs(g.fig, f'{fname}_{oset}', section=section)
+        savefigs(g.fig, f'{fname}_{oset}', section=section,
+            inputs=(oset_df, title, n_ro_bins, fly_id_palette)
+        )
 
     del n_ros_df
 
@@ -3689,7 +3866,7 @@ g.set_axis_labels('Odor', 'Fraction responding')
 # TODO way to just capitalize?
 g.set_titles('{col_name}')
 savefigs(g.fig, 'mean_frac_responding', section='Mean fraction responding',
-    section_order=-1
+    section_order=-1, inputs=(frac_responder_df, fly_id_palette)
 )
 '''
 
@@ -3760,7 +3937,7 @@ g.set_axis_labels('Odor', 'Fraction responding')
 g.set_titles('{col_name}')
 
 savefigs(g.fig, 'mean_frac_responding', section='Mean fraction responding',
-    section_order=-1
+    section_order=-1, inputs=(frac_responder_df, fly_id_palette)
 )
 
 """
@@ -3883,7 +4060,9 @@ ax.set_ylabel('Fraction KCs responding')
 
 ax.legend(loc='upper left')
 
-savefigs(fig, 'eag_vs_frac_responding', section='EAG vs. KC response fraction')
+savefigs(fig, 'eag_vs_frac_responding', section='EAG vs. KC response fraction',
+    inputs=(mdf,)
+)
 '''
 plt.show()
 import ipdb; ipdb.set_trace()
@@ -3913,7 +4092,9 @@ g.fig.suptitle('Mean fraction responding')
 g.set_titles('{col_name}')
 g.fig.subplots_adjust(left=0.05, top=0.85)
 
-savefigs(g.fig, f'mean_frac_barplot', section='Mean fraction responding')
+savefigs(g.fig, f'mean_frac_barplot', section='Mean fraction responding',
+    inputs=(fdf, ci)
+)
 
 
 old_len = len(responders.index.drop_duplicates())
@@ -3999,7 +4180,9 @@ if hallem_correlations:
             colorbar_label=cbar_label,
             title=f'{oset} components\n\nHallem ORN correlations'
         )
-        savefigs(fig, f'hallem_corrs_{oset}', section='Hallem ORN correlations')
+        savefigs(fig, f'hallem_corrs_{oset}', section='Hallem ORN correlations',
+            inputs=(u.plot_odor_corrs, ocdf, odor_order, oset)
+        )
 
         if any([o not in hdf.index for o in comp_order]):
             odf = odf.dropna()
@@ -4013,52 +4196,60 @@ if hallem_correlations:
                 title=f'{oset} components\n\nHallem ORN correlations'
             )
             savefigs(fig, f'hallem_corrs_nonull_{oset}',
-                exclude_from_latex=True
+                exclude_from_latex=True,
+                inputs=(u.plot_odor_corrs, ocdf, odor_order, oset)
             )
 
 
 if plot_mean_correlations or plot_correlation_consistencency:
+    # Correlations (across cells) of the trial-max responses, computed for all
+    # flies with each odor set together. The same values as
+    # corr_ser_from_maxes, which only has them one recording at a time.
     # TODO lookup which corrs (max / mean) to use from trial_stat, if not gonna
     # delete saving multiple
-    corr_df = u.add_fly_id(corr_ser_from_maxes.reset_index())
-    add_odorset(corr_df)
+    assert response_magnitudes.name.startswith('trialmax_')
+    rmags = u.add_fly_id(add_odorset(response_magnitudes.reset_index()))
+    corr_fly_cols = ['fly_id'] + fly_keys + [rec_key]
+    odorset2corrs = dict()
+    for oset, odf in rmags.groupby('odor_set'):
+        odorset2corrs[oset] = u.OdorCorrelations.from_long(
+            odf.set_index(corr_fly_cols + ['cell', 'name1', 'repeat_num'])[
+            response_magnitudes.name], ['name1', 'repeat_num'],
+            fly_cols=corr_fly_cols
+        )
+    del rmags, odf
+
+    corr_df = pd.concat([oc.corr_ser().reset_index().assign(odor_set=oset)
+        for oset, oc in odorset2corrs.items()], ignore_index=True
+    )
 
 if plot_mean_correlations:
-    cols = ['fly_id','odor_set','name1_a','repeat_num_a','name1_b',
-        'repeat_num_b','corr'
-    ]
     for tstat in ('max',):
         cbar_label = f'Mean of fly {tstat} response {u.dff_latex} correlations'
-        if tstat == 'max':
-            cdf = corr_df
-        else:
-            cdf = u.add_fly_id(corr_ser_from_means.reset_index())
-            add_odorset(cdf)
-
-        # TODO just drop this fly_id earlier so it applies everywhere
-        df = cdf.loc[~ cdf.fly_id.isin(bad_corr_fly_ids), cols].copy()
-        # so we don't need to worry about nanmean / something like that
-        assert not df['corr'].isnull().any()
-
-        n_per_odorset = df.groupby('odor_set').fly_id.nunique()
-
-        # this averages corr over fly_id
-        ser = df.groupby(cols[1:-1])['corr'].mean()
-        name_cols = [c for c in ser.index.names if c.startswith('name1')]
 
         # TODO TODO in the future, maybe turn this into a facetgrid thing
         # somehow, and just share one colorbar to the right? (one facet per
         # odor_set)
-        for go, gser in ser.groupby('odor_set'):
+        for go, oc in odorset2corrs.items():
             odor_order = odor_set2order[go]
-            n = n_per_odorset[go]
 
-            gdf = invert_melt_symmetric(gser)
+            # TODO just drop this fly_id earlier so it applies everywhere
+            fly_ids = oc.flies.get_level_values('fly_id')
+            fly_mask = ~ fly_ids.isin(bad_corr_fly_ids)
+            n = fly_ids[fly_mask].nunique()
+
+            # So that averaging only ignores NaN for odors a fly did not get.
+            presented = np.isfinite(oc.responses[fly_mask]).any(axis=1)
+            assert np.isfinite(oc.corr()[fly_mask][
+                presented[:, :, None] & presented[:, None, :]]).all()
+
+            # Averages over flies (ignoring missing odors).
+            gdf = oc.mean_corr_df(fly_mask=fly_mask)
 
             # TODO TODO TODO TODO for these, should probably not average over
             # the correlations between trials and themselves, right (since they
             # are always 1...)?
-            mdf = invert_melt_symmetric(gser.groupby(name_cols).mean())
+            mdf = oc.mean_corr_df(level='name1', fly_mask=fly_mask)
 
             for no_real in (False, True):
                 noreal_str = '_noreal' if no_real else ''
@@ -4097,7 +4288,8 @@ if plot_mean_correlations:
                 )
                 savefigs(fig, f'mean_trial_corrs_{tstat}_{go}{noreal_str}',
                     section='Mean KC response correlations, trial-by-trial',
-                    exclude_from_latex=no_real
+                    exclude_from_latex=no_real,
+                    inputs=(u.plot_odor_corrs, p_gdf, porder, n)
                 )
 
                 fig = u.plot_odor_corrs(p_mdf, odors_in_order=porder,
@@ -4105,9 +4297,10 @@ if plot_mean_correlations:
                 )
                 savefigs(fig, f'mean_corrs_{tstat}_{go}{noreal_str}',
                     section='Mean KC response correlations',
-                    exclude_from_latex=no_real
+                    exclude_from_latex=no_real,
+                    inputs=(u.plot_odor_corrs, p_mdf, porder, n)
                 )
-    del cols, ser, df, gdf, odor_order, fig, cbar_label
+    del gdf, mdf, odor_order, fig, cbar_label
 
 if plot_correlation_consistencency:
     # TODO TODO TODO uncomment. was just trying to get past an assertion failure
@@ -4128,7 +4321,7 @@ if plot_correlation_consistencency:
 
         # TODO subsection for agg fn? look like what i want in pdf?
         save_fn(f'corrs_{corr_agg_fn}', section='Correlation consistency',
-            subsection=cap_agg_fn, section_order=200
+            subsection=cap_agg_fn, section_order=200, inputs=()
         )
     del keys
     #'''
@@ -4258,7 +4451,8 @@ if mix_v_component_response_plots:
             ax.set_ylim(*os_lim)
             # TODO maybe also set x and y ticks to be the same, so it's just a
             # little more obvious the scales are the same
-    save_fn('mix_v_comp_rmags', section=section_name)
+    # (the axis limits are computed from the plotted data)
+    save_fn('mix_v_comp_rmags', section=section_name, inputs=())
     del keys, rmags
 
 
@@ -4437,7 +4631,9 @@ def linearity_analysis(linearity_cell_df, response_magnitudes, cell_subset=None,
 
     savefigs(g.fig, f'simple_linearity_{cell_subset_fname_str}',
         section='Linearity',
-        subsection=f'Simple linearity, {cell_subset_title_str}'
+        subsection=f'Simple linearity, {cell_subset_title_str}',
+        inputs=(linearity_analysis, mean_rmag_df, curr_odor_set_order,
+        cell_subset_title_str, ci)
     )
 
     # was necesssary to get dodge kwarg to work w/ wrapped stripplot fn
@@ -4473,7 +4669,9 @@ def linearity_analysis(linearity_cell_df, response_magnitudes, cell_subset=None,
 
     savefigs(g.fig, f'flymean_simple_linearity_{cell_subset_fname_str}',
         section='Linearity',
-        subsection=f'Simple linearity, {cell_subset_title_str}'
+        subsection=f'Simple linearity, {cell_subset_title_str}',
+        inputs=(linearity_analysis, mean_rmag_df, curr_odor_set_order,
+        cell_subset_title_str, fly_id_palette)
     )
 
     # This is a flag set up top.
@@ -4543,6 +4741,9 @@ def linearity_analysis(linearity_cell_df, response_magnitudes, cell_subset=None,
         del t1
         xlabel = n_params2latex_eq[n_params]
         ylabel = 'Density of cells'
+        dist_inputs = (linearity_analysis, lin_df, ra_lin_df, linearity_cell_df,
+            diff_col, bins, xlim, two_line_title, curr_odor_set_order
+        )
 
         def compare_odorset_residual_dists(fly=None):
             ctitle = str(title)
@@ -4630,7 +4831,8 @@ def linearity_analysis(linearity_cell_df, response_magnitudes, cell_subset=None,
             # and maybe that should be the default behavior?
             savefigs(fig, cfname, section='Linearity',
                 subsection=f'({n_params} parameter) linearity distributions, '
-                f'{cell_subset_title_str}', order=200 if fly else None
+                f'{cell_subset_title_str}', order=200 if fly else None,
+                inputs=(dist_inputs, fly)
             )
         # End compare_odorset_residual_dists def.
 
@@ -4737,7 +4939,7 @@ def linearity_analysis(linearity_cell_df, response_magnitudes, cell_subset=None,
             f'linearity_dists_per_fly_{cell_subset_fname_str}_'
             f'{n_params}param', section='Linearity',
             subsection=f'({n_params} parameter) linearity distributions, '
-            f'{cell_subset_title_str}'
+            f'{cell_subset_title_str}', inputs=(dist_inputs, fly_id_palette)
         )
 
         # TODO TODO maybe just always show some example cells w/ numerical
@@ -4925,7 +5127,8 @@ if (common_responded_combos or
             # TODO maybe order this section so it's just before linearity
             # section (in the pdf?)
             savefigs(g.fig, fname, section='Responder breakdown',
-                subsection=subsection
+                subsection=subsection,
+                inputs=(df, n_largest_groups, title_str, fg_kwargs)
             )
 
             g = sns.FacetGrid(data=per_fly_df, sharex=False, hue='fly_id',
@@ -4937,7 +5140,8 @@ if (common_responded_combos or
             set_odors_cell_fraction_plot_props(g)
             g.add_legend(title=fly_id_legend_title)
             savefigs(g.fig, 'per_fly_' + fname, section='Responder breakdown',
-                subsection=subsection
+                subsection=subsection, inputs=(per_fly_df, n_largest_groups,
+                title_str, fg_kwargs, fly_id_palette)
             )
     assert largest_reliable_groups is not None
 
@@ -5047,7 +5251,8 @@ if do_roc:
 
     g.fig.subplots_adjust(left=0.08)
     savefigs(g.fig, 'roc_task_and_odorset', section='ROC',
-        subsection='Mean AUC distributions'
+        subsection='Mean AUC distributions',
+        inputs=(auc_df, auc_bins, auc_vline_alpha)
     )
 
     # TODO TODO TODO remove plots that are not that meangingful here and w/
@@ -5062,7 +5267,9 @@ if do_roc:
                 ax.axvline(x=0.5, color='r', alpha=auc_vline_alpha)
             g.fig.subplots_adjust(left=0.05)
 
-        save_fn(f'roc_{task}_by_odor', section='ROC', subsection=task.title())
+        save_fn(f'roc_{task}_by_odor', section='ROC', subsection=task.title(),
+            inputs=(auc_vline_alpha,)
+        )
 
     # TODO anything by fly (averages w/in odor_set?) or just leave it at
     # individual (task, odor) distributions for the per-fly analyses?
@@ -5095,7 +5302,8 @@ if do_pca:
         ax.set_ylabel('Mean ' + ylabel.lower() + f'\n(with {pca_ci:.0f}% CI)')
         savefigs(os_scree_fig, f'scree_{col_prefix}',
             section=f'{section_prefix} PCA',
-            subsection='Mean scree'
+            subsection='Mean scree',
+            inputs=(pca_df, ev_col, pca_xlim, pca_ci, shared_title)
         )
 
         # TODO change back to row if i can fix layout in pdf
@@ -5110,7 +5318,8 @@ if do_pca:
         g.fig.suptitle('Across-fly s' + shared_title)
         g.fig.subplots_adjust(top=0.75)
         savefigs(g.fig, f'acrossfly_scree_{col_prefix}',
-            section=f'{section_prefix} PCA', subsection='Across-fly scree'
+            section=f'{section_prefix} PCA', subsection='Across-fly scree',
+            inputs=(pca_df, ev_col, pca_xlim, shared_title, fly_id_palette)
         )
 
 
@@ -5252,7 +5461,7 @@ if do_adaptation_analysis:
             # existing facetgrid legend somehow
 
         save_fn(f'adaptation_{fname_suffix}', section=title,
-            section_order=adapt_sec_order
+            section_order=adapt_sec_order, inputs=(adaptation_fits,)
         )
 
         # TODO TODO maybe explicitly compare t1 - t0 and t2 - t2 adaptation?
@@ -5380,7 +5589,8 @@ if do_adaptation_analysis:
         ax.set_xlim(xlim)
         ax.legend()
         savefigs(cell_adapt_fig, f'adapt_dist_{fname_suffix}', section=title,
-            section_order=adapt_sec_order
+            section_order=adapt_sec_order,
+            inputs=(cell_adaptation_fits, bins, kde, xlim, title)
         )
 
         cell_adaptation_fits.reset_index(inplace=True)
@@ -5428,7 +5638,8 @@ if do_adaptation_analysis:
         g.fig.suptitle(title)
         g.fig.subplots_adjust(top=0.85)
         savefigs(g.fig, f'adapt_dist_per_odor_{fname_suffix}', section=title,
-            section_order=adapt_sec_order
+            section_order=adapt_sec_order, inputs=(cell_adaptation_fits, title,
+            odor_hues_within_odorset)
         )
 
         # TODO maybe don't use this fixed xlim
@@ -5447,7 +5658,8 @@ if do_adaptation_analysis:
         g.fig.suptitle(title)
         g.fig.subplots_adjust(top=0.85)
         savefigs(g.fig, f'rmag0_v_adapt_{fname_suffix}', section=title,
-            section_order=adapt_sec_order
+            section_order=adapt_sec_order,
+            inputs=(cell_adaptation_fits_noreal, xlim, title)
         )
 
         # The green kinda won out over the pink of the control, so this plot
@@ -5628,6 +5840,7 @@ if not args.no_report_pdf:
         fly_keys2fly_id.iteritems()
     }
     print('')
+    u.wait_for_figures()
     # TODO don't show "Within-fly analysis" section if empty?
     # (same for across fly)
     pdf_fname = generate_pdf_report.main(params=params_for_report,
@@ -19,7 +19,6 @@ import pprint
 import numpy as np
 from scipy.sparse import coo_matrix
 import pandas as pd
-import matlab.engine
 import tifffile
 import matplotlib.pyplot as plt
 
@@ -43,6 +42,13 @@ allow_gsheet_to_restrict_blocks = True
 fail_on_missing_dir_to_attempt = True
 only_do_anything_for_analysis = True
 
+# If False, timing information is calculated from the ThorSync HDF5 in Python
+# (`u.thorsync_timing_info`), rather than with the MATLAB `thorsync_h5_to_mat`
+# and `get_stiminfo` functions. h5 -> .mat conversion is then not needed.
+use_matlab_timing_info = False
+# Number of processes to calculate timing information with, if not using
+# MATLAB. None = number of CPUs.
+timing_info_n_workers = None
 convert_h5 = True
 calc_timing_info = True
 # If timing info ("ti") already exists in .mat, should we recalculate it?
@@ -83,46 +89,62 @@ conn = u.get_db_conn()
 
 analyzed_at = datetime.fromtimestamp(time.time())
 
-# TODO just factor all calls to matlab fns into util and don't even expose
-# engine?
-# TODO future have a bug generally, or only if stopped w/ ctrl-d from ipdb like
-# i had?
-#future = matlab.engine.start_matlab(async=True)
-#evil = None
-evil = u.matlab_engine(force=True)
-
-# To get Git version information to have a record of what analysis was
-# performed.
-matlab_repo_name = 'matlab_kc_plane'
-userpath = evil.userpath()
-matlab_code_path = join(userpath, matlab_repo_name)
-
-matlab_caiman_folder = 'CaImAn-MATLAB_remy'
-mc_on_path = [x for x in evil.path().split(':')
-    if x.endswith(matlab_caiman_folder)]
-
-if len(mc_on_path) > 1:
-    raise ValueError('more than one CaImAn version on MATLAB path. add ' +
-        'versions you do not wish to use to exclude_from_matlab_path, in util')
-
-elif len(mc_on_path) == 0:
-    raise ValueError('MATLAB CaImAn package not found. Put on path or update ' +
-        'matlab_caiman_folder')
-
-matlab_caiman_path = mc_on_path[0]
-matlab_caiman_version = u.version_info(matlab_caiman_path,
-    used_for='motion correction'
+# Only the MATLAB timing information and the steps after the main loop (which
+# load MATLAB CNMF output / timing information) use the MATLAB engine, so it is
+# only started (and imported) for those.
+use_matlab = (use_matlab_timing_info or upload_matlab_cnmf_output or
+    process_time_averages
 )
+if use_matlab:
+    import matlab.engine
+
+    # TODO just factor all calls to matlab fns into util and don't even expose
+    # engine?
+    # TODO future have a bug generally, or only if stopped w/ ctrl-d from ipdb
+    # like i had?
+    #future = matlab.engine.start_matlab(async=True)
+    evil = u.matlab_engine(force=True)
+
+    # To get Git version information to have a record of what analysis was
+    # performed.
+    matlab_repo_name = 'matlab_kc_plane'
+    userpath = evil.userpath()
+    matlab_code_path = join(userpath, matlab_repo_name)
+
+    matlab_caiman_folder = 'CaImAn-MATLAB_remy'
+    mc_on_path = [x for x in evil.path().split(':')
+        if x.endswith(matlab_caiman_folder)]
+
+    if len(mc_on_path) > 1:
+        raise ValueError('more than one CaImAn version on MATLAB path. add ' +
+            'versions you do not wish to use to exclude_from_matlab_path, in '
+            'util'
+        )
+
+    elif len(mc_on_path) == 0:
+        raise ValueError('MATLAB CaImAn package not found. Put on path or '
+            'update matlab_caiman_folder'
+        )
+
+    matlab_caiman_path = mc_on_path[0]
+    matlab_caiman_version = u.version_info(matlab_caiman_path,
+        used_for='motion correction'
+    )
+    #driver_version_info ?
+    matlab_code_version = u.version_info(matlab_code_path)
+    matlab_code_version['used_for'] = 'driving motion correction'
+else:
+    evil = None
 
 this_repo_file = os.path.realpath(__file__)
 # TODO just use util fn that gets this internally
 this_repo_path = split(this_repo_file)[0]
 
-#driver_version_info ?
-matlab_code_version = u.version_info(matlab_code_path)
-curr_ti_code_version = copy.deepcopy(matlab_code_version)
+if use_matlab_timing_info:
+    curr_ti_code_version = copy.deepcopy(matlab_code_version)
+else:
+    curr_ti_code_version = u.version_info(u)
 curr_ti_code_version['used_for'] = 'calculating timing information'
-matlab_code_version['used_for'] = 'driving motion correction'
 
 df = u.mb_team_gsheet(
     use_cache=use_cached_gsheet,
@@ -244,7 +266,7 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
 
     # TODO maybe use regexp to check syncdata / util fn to check for name +
     # stuff in it?
-    if convert_h5:
+    if convert_h5 and use_matlab_timing_info:
         ####print('Converting ThorSync HDF5 files to .mat...')
         for syncdir in glob.glob(join(full_fly_dir, 'SyncData*')):
             print('before calling matlab h5->mat conversion...')
@@ -271,6 +293,9 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
         else:
             get_ti_df = fly_df
 
+        # (thorsync_dir, matfile, thorimage_id) for recordings to calculate
+        # timing information for in Python, all at once after this loop.
+        python_ti_todo = []
         for _, row in get_ti_df[['thorimage_dir','thorsync_dir']].iterrows():
             # TODO delete. for debugging.
             if test_recording is not None:
@@ -305,6 +330,18 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
             # TODO maybe check for existance of SyncData<nnn> first, to have
             # option to be less verbose for stuff that doesn't exist here
 
+            matfile = join(matfile_dir, '{}_cnmf.mat'.format(
+                row['thorimage_dir']))
+
+            if not use_matlab_timing_info:
+                if (update_timing_info or not exists(matfile) or
+                    'ti' not in u.matfile_varnames(matfile)):
+
+                    python_ti_todo.append(
+                        (thorsync_dir, matfile, thorimage_dir)
+                    )
+                continue
+
             print('\nThorImage and ThorSync dirs for call to get_stiminfo:')
             print(thorimage_dir)
             print(thorsync_dir)
@@ -314,9 +351,6 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
                 ).format(date_dir, fly_num, row['thorimage_dir']), end='',
                 flush=True)
 
-            matfile = join(matfile_dir, '{}_cnmf.mat'.format(
-                row['thorimage_dir']))
-
             # TODO TODO check exit code -> save all applicable version info
             # into the same matfile, calling the matlab interface from here
 
@@ -356,6 +390,32 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
 
             print(' done.')
 
+        if len(python_ti_todo) > 0:
+            thorimage_ids = [split(t[2])[1] for t in python_ti_todo]
+            print('getting stimulus timing information for {}, {}, {}...'
+                .format(date_dir, fly_num, thorimage_ids), end='', flush=True
+            )
+            # Passing the ThorImage dirs so frame times account for any
+            # averaging / flyback frames.
+            tis = u.thorsync_timing_infos([t[0] for t in python_ti_todo],
+                n_workers=timing_info_n_workers, return_samples=True,
+                thorimage_dirs=[t[2] for t in python_ti_todo]
+            )
+            print(' done.')
+            for (_, matfile, _), thorimage_id, ti in zip(python_ti_todo,
+                thorimage_ids, tis):
+
+                if isinstance(ti, Exception):
+                    u.print_color('red', f'{thorimage_id}: {ti}')
+                    print('')
+                    continue
+
+                # Adds to existing v7.3 .mat files with h5py, so 'ti' is in
+                # `u.matfile_varnames(matfile)` next time either way.
+                u.save_timing_info_mat(matfile, ti,
+                    ti_code_version=curr_ti_code_version
+                )
+
     tiff_dir = join(full_fly_dir, 'tif_stacks')
     if convert_raw_to_tiffs:
         # TODO only do this for stuff we are going to actually motion correct?
@@ -389,8 +449,7 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
     # maybe avoid searching for thorimage dirs at all if there are no used 
     # rows for this (date,fly) combo, and only_motion_correct_for_analysis
 
-    # TODO use multiple matlab instances to run normcore on different
-    # directories in parallel?
+    # (motion correction of each movie is already parallel across frames)
     # TODO exclude stuff that indicates it's either already avg or motion
     # corrected? (or just always keep them separately?)
     # TODO maybe also look w/o underscore, if that's remy's convention
@@ -405,56 +464,22 @@ for full_fly_dir in glob.glob(raw_data_root + '/*/*/'):
                         thorimage_dir))
                     continue
 
-            matfile = join(matfile_dir, '{}_cnmf.mat'.format(thorimage_dir))
-
-            print('\nRunning normcorre_tiff on', input_tif_path)
+            print('\nMotion correcting', input_tif_path)
             # TODO only register one way by default? nonrigid? args to
             # configure?
             try:
-                rig_updated, nr_updated = evil.normcorre_tiff(
-                    input_tif_path, analysis_fly_dir, nargout=2)
+                rig_updated, nr_updated = u.motion_correct_to_tiffs(
+                    thorimage_dir, analysis_fly_dir, tiff=input_tif_path)
 
-            except matlab.engine.MatlabExecutionError as e:
+            except (IOError, ValueError) as e:
+                print(e)
                 continue
 
-            mocorr_code_versions = [matlab_code_version, matlab_caiman_version]
-
-            # TODO any reason i'm not just/also directly uploading these...?
-            if rig_updated:
-                evil.workspace['rig_code_versions'] = mocorr_code_versions
-                # TODO only append if not exists
-                # (timing info calculation could fail but we still want to
-                # mocorr)
-                if exists(matfile):
-                    evil.save(matfile, 'rig_code_versions', '-append',
-                        nargout=0)
-                else:
-                    evil.save(matfile, 'rig_code_versions', nargout=0)
-
-                # Testing version info is stored correctly.
-                evil.clear(nargout=0)
-                load_output = evil.load(matfile, 'rig_code_versions',
-                    nargout=1)
-
-                rt_mocorr_code_versions = load_output['rig_code_versions']
-                assert mocorr_code_versions == rt_mocorr_code_versions
-                evil.clear(nargout=0)
-
-            if nr_updated:
-                evil.workspace['nr_code_versions'] = mocorr_code_versions
-                if exists(matfile):
-                    evil.save(matfile, 'nr_code_versions', '-append', nargout=0)
-                else:
-                    evil.save(matfile, 'nr_code_versions', nargout=0)
-
-                # Testing version info is stored correctly.
-                evil.clear(nargout=0)
-                load_output = evil.load(matfile, 'nr_code_versions',
-                    nargout=1)
-
-                rt_mocorr_code_versions = load_output['nr_code_versions']
-                assert mocorr_code_versions == rt_mocorr_code_versions
-                evil.clear(nargout=0)
+            # The code versions used are written next to the outputs, in
+            # <thorimage_id>_<rig|nr>_code_versions.json (see
+            # u.mocorr_code_versions), so nothing else needs saving here.
+            if not (rig_updated or nr_updated):
+                print('Motion corrected outputs already existed.')
 
     # TODO and if remy wants, copy thorimage xmls
 
@@ -802,15 +827,12 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
         assert len(odor_pair_list) % presentations_per_block == 0
 
         if ACTUALLY_UPLOAD:
-            u.to_sql_with_duplicates(odors, 'odors')
-
-            # TODO make unique id before insertion? some way that wouldn't
-            # require the IDs, but would create similar tables?
-
-            db_odors = pd.read_sql('odors', conn)
+            # Only inserts / reads back odors not already seen this run.
             # TODO TODO in general, the name alone won't be unique, so use
             # another strategy
-            db_odors.set_index('name', inplace=True)
+            odor2id = dict(zip(odors.name,
+                u.lookup_ids(odors, 'odors', 'odor_id')
+            ))
 
             # TODO test slicing
             # TODO make sure if there are extra trials in matlab, these get
@@ -822,8 +844,8 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
 
             # TODO only add as many as there were blocks from thorsync timing
             # info?
-            odor1_ids = [db_odors.at[o1,'odor_id'] for o1, _ in odor_pair_list]
-            odor2_ids = [db_odors.at[o2,'odor_id'] for _, o2 in odor_pair_list]
+            odor1_ids = [odor2id[o1] for o1, _ in odor_pair_list]
+            odor2_ids = [odor2id[o2] for _, o2 in odor_pair_list]
 
             # TODO TODO make unique first. only need order for filling in the
             # values in responses.
@@ -1135,6 +1157,49 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
         # or odor2_ids
         odor_id_pairs = [(o1,o2) for o1,o2 in zip(odor1_ids, odor2_ids)]
 
+        if process_time_averages:
+            fps = u.get_thorimage_fps(thorimage_dir)
+            # TODO does it really take this long in most cases?
+            rise_time_s = 2.0 #1.5
+            rise_time_frames = int(round(rise_time_s * fps))
+
+            # Exponential decays are fit for all presentations at once, padding
+            # the (slightly different length) traces w/ NaN.
+            decay_dffs = []
+            decay_times = []
+            for start_frame, stop_frame, direct_onset_frame in zip(
+                start_frames, stop_frames, odor_onset_frames):
+
+                decay_start_frame = direct_onset_frame + rise_time_frames
+                # TODO subtract something added to onset_time?
+                decay_times.append(frame_times[decay_start_frame:stop_frame] -
+                    frame_times[direct_onset_frame]
+                )
+                # This still only goes to odor onset, in case rise time is
+                # slightly misspecified.
+                avg_baseline = np.mean(
+                    full_frame_avg_trace[start_frame:direct_onset_frame]
+                )
+                decay_dffs.append((full_frame_avg_trace[
+                    decay_start_frame:stop_frame] - avg_baseline) / avg_baseline
+                )
+
+            max_decay_len = max(len(x) for x in decay_dffs)
+            padded_dffs = np.full((len(decay_dffs), max_decay_len), np.nan)
+            padded_times = np.full((len(decay_dffs), max_decay_len), np.nan)
+            for j, (dff, times) in enumerate(zip(decay_dffs, decay_times)):
+                padded_dffs[j, :len(dff)] = dff
+                padded_times[j, :len(times)] = times
+
+            # TODO TODO catch runtimewarning overflow and turn into error
+            exp_params, exp_sigmas, exp_converged = u.fit_exp_decays(
+                padded_dffs, padded_times, numerical_scale=200
+            )
+            if not exp_converged.all():
+                warnings.warn('exponential decay fit failed for presentations '
+                    f'{np.flatnonzero(~ exp_converged)}'
+                )
+
         comparison_num = -1
 
         for i in range(len(start_frames)):
@@ -1207,10 +1272,6 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
             # concentration of ethyl acetate?) (which would i guess mean any
             # prep checking immediately followed by natural_odors?)
             if process_time_averages:
-                fps = u.get_thorimage_fps(thorimage_dir)
-                # TODO does it really take this long in most cases?
-                rise_time_s = 2.0 #1.5
-                rise_time_frames = int(round(rise_time_s * fps))
                 decay_start_frame = direct_onset_frame + rise_time_frames
 
                 # Relationship between presentation indices and times will
@@ -1246,12 +1307,7 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
                 presentation['avg_dff_5s'] = avg_dff_5s
                 presentation['avg_zchange_5s'] = avg_zchange_5s
 
-                # TODO TODO catch runtimewarning overflow and turn into error
-                (scale, tau, offset), sigmas = u.fit_exp_decay(
-                    avg_df_over_f,
-                    times=decay_frametimes,
-                    numerical_scale=200
-                )
+                (scale, tau, offset), sigmas = exp_params[i], exp_sigmas[i]
                 # TODO TODO test that w/ n * numerical_scale,
                 # scale and offset are scaled by n, and tau is the same
                 # (so that the scaling can be inverted before entering the
@@ -1297,14 +1353,6 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
                 '''
                 #
 
-            if ACTUALLY_UPLOAD:
-                # TODO TODO TODO is this insertion method causing some
-                # parameters to not actually get updated?
-                # use to_sql w/ pg_upsert?
-                u.to_sql_with_duplicates(presentation, 'presentations')
-
-            db_presentations = pd.read_sql('presentations', conn)
-
             # maybe share w/ code that checks distinct to decide whether to
             # load / analyze?
             key_cols = [
@@ -1318,21 +1366,26 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
                 'repeat_num'
             ]
 
-            presentation_ids = (db_presentations[key_cols] ==
-                                presentation[key_cols].iloc[0]).all(axis=1)
-            assert presentation_ids.sum() == 1
-            presentation_id = db_presentations.loc[presentation_ids,
-                'presentation_id'].iat[0]
-
-            # Check correct insertion
-            db_presentation = db_presentations.loc[presentation_ids,
-                presentation.columns].reset_index(drop=True)
-            diff = u.diff_dataframes(presentation, db_presentation)
-            if diff is not None:
-                print(diff)
-                raise IOError('SQL insertion failed')
-
-            if upload_matlab_cnmf_output:
+            presentation_id = None
+            if ACTUALLY_UPLOAD:
+                # TODO TODO TODO is this insertion method causing some
+                # parameters to not actually get updated?
+                # use to_sql w/ pg_upsert?
+                # Only reads back the row for this presentation (whether just
+                # inserted or already there), w/ the generated ID.
+                db_presentation = u.to_sql_with_duplicates(presentation,
+                    'presentations', returning=(list(presentation.columns) +
+                    ['presentation_id'])
+                )
+                assert len(db_presentation) == 1
+                presentation_id = db_presentation.presentation_id.iat[0]
+
+                # Check correct insertion
+                u.check_inserted(presentation, db_presentation, key_cols)
+
+            # Responses reference the presentation by its ID, so they can only
+            # be uploaded along with it.
+            if upload_matlab_cnmf_output and presentation_id is not None:
                 # TODO get remy to save it w/ less than 64 bits of precision?
                 # (or just change matlab code myself)
                 presentation_dff = df_over_f[start_frame:stop_frame, :]
@@ -1354,9 +1407,7 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
                         'raw_f': [[float(x) for x in cell_raw_f]]
                     }))
                 response_df = pd.concat(cell_dfs, ignore_index=True)
-
-                if ACTUALLY_UPLOAD:
-                    u.to_sql_with_duplicates(response_df, 'responses')
+                u.to_sql_with_duplicates(response_df, 'responses')
 
                 # TODO put behind flag?
                 '''
@@ -1380,11 +1431,19 @@ for analysis_dir in glob.glob(analysis_output_root+ '/*/*/'):
 
                 # TODO maybe don't exclude current presentation_id?
                 # TODO TODO TODO uncomment
-                db_curr_odor_presentations = db_presentations[
-                    ~presentation_ids & 
-                    (db_presentations.odor1 == odor1) &
-                    (db_presentations.odor2 == odor2)
-                ]
+                query = ('SELECT * FROM presentations WHERE odor1 = %(odor1)s '
+                    'AND odor2 = %(odor2)s'
+                )
+                params = {'odor1': int(odor1), 'odor2': int(odor2)}
+                # The current presentation is only in the database (to be
+                # excluded) if it was just uploaded.
+                if presentation_id is not None:
+                    query += ' AND presentation_id != %(presentation_id)s'
+                    params['presentation_id'] = int(presentation_id)
+
+                db_curr_odor_presentations = pd.read_sql_query(query, conn,
+                    params=params
+                )
                 # TODO TODO print which odors / concs this is too
 
                 # TODO maybe just return empty df as base case?
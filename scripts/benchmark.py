@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""
+Times the main pipeline stages on synthetic data, so changes can be compared
+across commits without the NAS, a database, or a GPU.
+
+Results are saved as JSON (one file per run, named by time and git commit),
+and can be compared against a previous results file with -c.
+
+Benchmarks in `recording_benchmarks` are also run for each number of
+recordings passed to --n-recordings, to see how they scale with the amount of
+data in an analysis run, rather than just the size of each recording.
+"""
+
+import argparse
+import json
+import os
+from os.path import join, split, exists, abspath, dirname
+import subprocess
+import tempfile
+import time
+import platform
+from datetime import datetime
+
+import numpy as np
+
+import hong2p.util as u
+
+
+# (name, kwargs) for each size. Movie shapes are (t, x, y).
+sizes = {
+    'small': {
+        'n_frames': 200,
+        'frame_shape': (128, 128),
+        'n_cells': 25,
+        'nt': 20,
+        'n_trace_cells': 50
+    },
+    'medium': {
+        'n_frames': 1000,
+        'frame_shape': (256, 256),
+        'n_cells': 100,
+        'nt': 100,
+        'n_trace_cells': 200
+    },
+    'large': {
+        'n_frames': 3000,
+        'frame_shape': (512, 512),
+        'n_cells': 400,
+        'nt': 300,
+        'n_trace_cells': 600
+    }
+}
+
+diam_px = 8
+um_per_pixel_xy = 0.5
+fps = 10.0
+frames_per_trial = 45
+onset_frame = 10
+
+
+def git_commit():
+    repo_dir = dirname(dirname(abspath(__file__)))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=repo_dir, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = len(subprocess.check_output(['git', 'status', '--porcelain',
+            '--untracked-files=no'], cwd=repo_dir).strip()) > 0
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None, None
+    return commit, dirty
+
+
+def time_fn(fn, repeats):
+    """Returns list of wall times (s) for `repeats` calls of `fn`.
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def bench_read_movie(size, tmp_dir, n_recordings=1):
+    movie, _, _ = u.make_test_movie(n_frames=size['n_frames'],
+        frame_shape=size['frame_shape'], n_cells=size['n_cells'],
+        diam_px=diam_px, seed=0
+    )
+    # Separate files for each recording, so they aren't all read from the page
+    # cache after the first.
+    thorimage_dirs = [join(tmp_dir, f'read_movie_{n_recordings}_{i}')
+        for i in range(n_recordings)
+    ]
+    for thorimage_dir in thorimage_dirs:
+        u.write_test_thorimage_dir(thorimage_dir, movie, fps=fps,
+            um_per_pixel_xy=um_per_pixel_xy
+        )
+
+    def fn():
+        for thorimage_dir in thorimage_dirs:
+            u.read_movie(thorimage_dir)
+
+    return fn
+
+
+def bench_extract_traces(size, tmp_dir):
+    movie, _, footprints = u.make_test_movie(n_frames=size['n_frames'],
+        frame_shape=size['frame_shape'], n_cells=size['n_cells'],
+        diam_px=diam_px, seed=0
+    )
+    return lambda: u.extract_traces_boolean_footprints(movie, footprints,
+        verbose=False
+    )
+
+
+def bench_fit_circle_rois(size, tmp_dir):
+    movie, _, _ = u.make_test_movie(n_frames=50,
+        frame_shape=size['frame_shape'], n_cells=size['n_cells'],
+        diam_px=diam_px, seed=0
+    )
+    # Cells are only visible after their onsets, so max is a better image
+    # to fit on than the average here.
+    avg = movie.max(axis=0)
+    template_data = u.make_test_template_data(diam_px=diam_px,
+        um_per_pixel_xy=um_per_pixel_xy, frame_shape=size['frame_shape']
+    )
+    # tif is not used when avg and _um_per_pixel_xy are passed and we
+    # aren't writing ImageJ ROIs.
+    # (TM_CCOEFF defaults to exclude_dark_regions=False. The histogram based
+    # dark region threshold isn't meaningful on these synthetic images.)
+    return lambda: u.fit_circle_rois(None, template_data, avg=avg,
+        _um_per_pixel_xy=um_per_pixel_xy, multiscale=False,
+        method_str='cv2.TM_CCOEFF', min_n_rois=None, max_n_rois=None
+    )
+
+
+def bench_correspond_rois(size, tmp_dir):
+    np.random.seed(0)
+    centers = u.make_test_centers(initial_n=size['n_cells'], nt=size['nt'],
+        frame_shape=size['frame_shape'], sigma=1, p=None, diam_px=diam_px
+    )
+    return lambda: u.correspond_and_renumber_rois(centers)
+
+
+def _trace_df(size, n_recordings):
+    n_trials = len(range(0, size['n_frames'], frames_per_trial))
+    # Some multiple of n_repeats presentations, with ~ as many trials as
+    # would fit in the movie.
+    n_repeats = 3
+    n_odors = max(1, n_trials // n_repeats)
+    # One recording per fly.
+    return u.make_test_trace_df(n_flies=n_recordings, n_cells=size['n_trace_cells'],
+        n_odors=n_odors, n_repeats=n_repeats, n_frames=frames_per_trial,
+        fps=fps, onset_frame=onset_frame, seed=0
+    )
+
+
+def bench_expand_array_cols(size, tmp_dir, n_recordings=2):
+    df = _trace_df(size, n_recordings)
+    # expand_array_cols modifies array columns of its input in place.
+    return lambda: u.expand_array_cols(df.copy())
+
+
+def bench_df_over_f(size, tmp_dir):
+    movie, _, footprints = u.make_test_movie(n_frames=size['n_frames'],
+        frame_shape=size['frame_shape'], n_cells=size['n_cells'],
+        diam_px=diam_px, seed=0
+    )
+    raw_f = u.extract_traces_boolean_footprints(movie, footprints,
+        verbose=False
+    )
+    trial_start_frames = np.arange(0, size['n_frames'], frames_per_trial)
+    odor_onset_frames = trial_start_frames + onset_frame
+    trial_stop_frames = np.append(trial_start_frames[1:] - 1,
+        size['n_frames'] - 1
+    )
+    return lambda: u.calculate_df_over_f(raw_f, trial_start_frames,
+        odor_onset_frames, trial_stop_frames
+    )
+
+
+def bench_odor_correlations(size, tmp_dir, n_recordings=2):
+    # kc_mix_analysis.process_traces can't be imported (script does all its
+    # work at module level), so this times its per-fly response reduction +
+    # correlation step on the same kind of table.
+    df = u.expand_array_cols(_trace_df(size, n_recordings))
+    df = df[df.from_onset >= 0]
+    stim_cols = ['name1', 'repeat_num']
+    fly_cols = ['prep_date', 'fly_num']
+
+    def fn():
+        responses = df.groupby(fly_cols + stim_cols + ['cell']
+            ).df_over_f.mean()
+        corrs = u.OdorCorrelations.from_long(responses, stim_cols,
+            fly_cols=fly_cols
+        )
+        return corrs.corr()
+
+    return fn
+
+
+benchmarks = {
+    'read_movie': bench_read_movie,
+    'extract_traces_boolean_footprints': bench_extract_traces,
+    'fit_circle_rois': bench_fit_circle_rois,
+    'correspond_and_renumber_rois': bench_correspond_rois,
+    'expand_array_cols': bench_expand_array_cols,
+    'calculate_df_over_f': bench_df_over_f,
+    'process_traces_correlations': bench_odor_correlations
+}
+# Benchmarks whose setup functions take `n_recordings`.
+recording_benchmarks = {'read_movie', 'expand_array_cols',
+    'process_traces_correlations'
+}
+
+
+def run(benchmark_names, size_names, repeats, n_recordings_list=(2,),
+    verbose=True):
+    """
+    Benchmarks in `recording_benchmarks` are run once for each element of
+    `n_recordings_list`, the others once per size.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='hong2p_bench_') as tmp_dir:
+        for size_name in size_names:
+            size = sizes[size_name]
+            for name in benchmark_names:
+                if name in recording_benchmarks:
+                    sweep = n_recordings_list
+                else:
+                    sweep = [None]
+
+                for n_recordings in sweep:
+                    # Setup (data generation) is not included in timing.
+                    if n_recordings is None:
+                        fn = benchmarks[name](size, tmp_dir)
+                    else:
+                        fn = benchmarks[name](size, tmp_dir,
+                            n_recordings=n_recordings
+                        )
+                    # One untimed call, so lazy imports / caches don't count.
+                    fn()
+                    times = time_fn(fn, repeats)
+                    result = {
+                        'benchmark': name,
+                        'size': size_name,
+                        'n_recordings': n_recordings,
+                        'params': {k: v for k, v in size.items()},
+                        'repeats': repeats,
+                        'min_s': min(times),
+                        'median_s': float(np.median(times)),
+                        'times_s': times
+                    }
+                    results.append(result)
+                    if verbose:
+                        n_str = '' if n_recordings is None else n_recordings
+                        print(f'{name:<36} {size_name:<7} {n_str:>4} '
+                            f'min={result["min_s"]:.4f}s '
+                            f'median={result["median_s"]:.4f}s'
+                        )
+    return results
+
+
+def compare(results, previous_results, metric='min_s'):
+    # Results from before the --n-recordings sweep have no 'n_recordings'.
+    # Those benchmarks used 2 flies / recordings (or 1, for read_movie).
+    def key(r):
+        if 'n_recordings' in r:
+            n = r['n_recordings']
+        elif r['benchmark'] in recording_benchmarks:
+            n = 1 if r['benchmark'] == 'read_movie' else 2
+        else:
+            n = None
+        return (r['benchmark'], r['size'], n)
+
+    prev = {key(r): r[metric] for r in previous_results}
+    print(f'\n{"benchmark":<36} {"size":<7} {"n":>4} {"before":>9} '
+        f'{"after":>9} {"ratio":>7}'
+    )
+    for r in results:
+        k = key(r)
+        if k not in prev:
+            continue
+        before = prev[k]
+        after = r[metric]
+        n_str = '' if k[2] is None else k[2]
+        print(f'{k[0]:<36} {k[1]:<7} {n_str:>4} {before:>9.4f} '
+            f'{after:>9.4f} {after / before:>7.2f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times pipeline stages on '
+        'synthetic data.'
+    )
+    parser.add_argument('-b', '--benchmarks', default=','.join(benchmarks),
+        help='Comma separated benchmark names. Default: all of ' +
+        ', '.join(benchmarks)
+    )
+    parser.add_argument('-s', '--sizes', default='small,medium',
+        help='Comma separated sizes (from: ' + ', '.join(sizes) + ')'
+    )
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('--n-recordings', default='2',
+        help='Comma separated numbers of recordings to run each of ' +
+        ', '.join(sorted(recording_benchmarks)) + ' with (e.g. 1,4,16). '
+        'Default: 2'
+    )
+    parser.add_argument('-o', '--output-dir',
+        default=join(u.cache_root(), 'benchmarks'),
+        help='Where to save results JSON.'
+    )
+    parser.add_argument('-c', '--compare', default=None,
+        help='Path to previous results JSON to compare against. If "last", '
+        'uses the most recent file in the output directory.'
+    )
+    parser.add_argument('-n', '--no-save', default=False, action='store_true')
+    args = parser.parse_args()
+
+    benchmark_names = args.benchmarks.split(',')
+    size_names = args.sizes.split(',')
+    for n in benchmark_names:
+        if n not in benchmarks:
+            raise ValueError(f'unknown benchmark {n}')
+    for s in size_names:
+        if s not in sizes:
+            raise ValueError(f'unknown size {s}')
+    n_recordings_list = [int(n) for n in args.n_recordings.split(',')]
+    if any(n < 1 for n in n_recordings_list):
+        raise ValueError('--n-recordings must all be positive')
+
+    previous_file = args.compare
+    if previous_file == 'last':
+        previous_files = []
+        if exists(args.output_dir):
+            previous_files = sorted(f for f in os.listdir(args.output_dir)
+                if f.endswith('.json')
+            )
+        if len(previous_files) == 0:
+            raise IOError(f'no previous results in {args.output_dir}')
+        previous_file = join(args.output_dir, previous_files[-1])
+
+    results = run(benchmark_names, size_names, args.repeats,
+        n_recordings_list=n_recordings_list
+    )
+
+    commit, dirty = git_commit()
+    now = datetime.now()
+    data = {
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'created_at': now.isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results
+    }
+
+    if not args.no_save:
+        os.makedirs(args.output_dir, exist_ok=True)
+        commit_str = 'nogit' if commit is None else commit[:8]
+        if dirty:
+            commit_str += '-dirty'
+        out_file = join(args.output_dir,
+            f'{now.strftime("%Y%m%d_%H%M%S")}_{commit_str}.json'
+        )
+        with open(out_file, 'w') as f:
+            json.dump(data, f, indent=2)
+        print(f'\nWrote {out_file}')
+
+    if previous_file is not None:
+        with open(previous_file, 'r') as f:
+            previous = json.load(f)
+        print(f'Comparing to {previous_file} '
+            f'(commit {previous.get("git_commit")})'
+        )
+        compare(results, previous['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+Fills the packed `footprint` column of the cells table for rows uploaded
+before it existed (see the cells section of db/setup.sql, which must be run
+first).
+
+The old x_coords, y_coords and weights columns are left as they are, unless
+--clear-arrays is passed.
+"""
+
+import argparse
+
+import pandas as pd
+from tqdm import tqdm
+
+import hong2p.util as u
+
+
+key_cols = ['recording_from', 'segmentation_run', 'cell']
+
+def main():
+    parser = argparse.ArgumentParser(description='Packs footprints of cells '
+        'table rows that only have the x_coords / y_coords / weights arrays.'
+    )
+    parser.add_argument('-b', '--batch-size', type=int, default=1000)
+    parser.add_argument('-c', '--clear-arrays', default=False,
+        action='store_true', help='Set the array columns to NULL once packed.'
+    )
+    parser.add_argument('-n', '--dry-run', default=False, action='store_true',
+        help='Only print how many rows would be packed.'
+    )
+    args = parser.parse_args()
+
+    from sqlalchemy import text
+
+    engine = u.get_db_conn()
+    n_unpacked = pd.read_sql_query('SELECT count(*) AS n FROM cells WHERE '
+        'footprint IS NULL', engine
+    ).n.iat[0]
+    print(f'{n_unpacked} rows to pack')
+    if args.dry_run or n_unpacked == 0:
+        return
+
+    set_sql = 'footprint = :footprint'
+    if args.clear_arrays:
+        set_sql += ', x_coords = NULL, y_coords = NULL, weights = NULL'
+    update = text(f'UPDATE cells SET {set_sql} WHERE ' +
+        ' AND '.join(f'{c} = :{c}' for c in key_cols)
+    )
+
+    with tqdm(total=n_unpacked) as progress:
+        while True:
+            # Each batch is committed before the next is selected, so packed
+            # rows drop out of this query.
+            with u.db_transaction() as conn:
+                rows = pd.read_sql_query(text('SELECT ' + ', '.join(key_cols) +
+                    ', x_coords, y_coords, weights FROM cells WHERE footprint '
+                    'IS NULL LIMIT :n'), conn, params={'n': args.batch_size}
+                )
+                if len(rows) == 0:
+                    break
+
+                params = []
+                for row in rows.itertuples(index=False):
+                    p = {c: getattr(row, c) for c in key_cols}
+                    p['footprint'] = u.encode_footprint(row.x_coords,
+                        row.y_coords, weights=row.weights
+                    )
+                    params.append(p)
+                conn.execute(update, params)
+
+            progress.update(len(rows))
+
+
+if __name__ == '__main__':
+    main()
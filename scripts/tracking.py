@@ -259,15 +259,30 @@ def show_movie(movie, rois=None, show_surrounding_frame_rois=True,
 # could maybe use this directly w/ starmap
 #def fit_frame(frame_num, frame, tif):
 def fit_frame(args):
-    frame_num, frame, tif = args
+    frame_num, frame, tif, template_data = args
 
-    centers, radii, _, _ = u.fit_circle_rois(tif, avg=frame)
+    # Prepared templates are cached across calls within each worker, so only
+    # the frame itself is normalized and matched here.
+    centers, radii, _, _ = u.fit_circle_rois(tif, template_data, avg=frame)
     rois_xyd = np.concatenate((centers,
         np.expand_dims(radii * 2, -1)), axis=-1
     )
     return frame_num, rois_xyd
 
 
+def tracks_to_roi_xyd(tracks, n_frames):
+    """Takes `OnlineROITracker` output to (n_frames, n_tracks, 3) array.
+    """
+    roi_xyd = np.full((n_frames, tracks.track_id.max() + 1, 3), np.nan)
+    roi_xyd[tracks.frame.values, tracks.track_id.values] = \
+        tracks[['x', 'y', 'diameter']].values
+    return roi_xyd
+
+
+# If True, frames are fit and tracked one at a time, w/ OnlineROITracker,
+# rather than fitting all frames first and using correspond_and_renumber_rois.
+online_tracking = False
+
 def main():
     np.random.seed(7)
     '''
@@ -310,6 +325,20 @@ def main():
     # from first call (all tif should be used for), then passing that 
     # instead of tif (before splitting across processes)
 
+    template_data = u.load_template_data(err_if_missing=True)
+
+    if online_tracking:
+        um_per_pixel_xy = u.get_thorimage_pixelsize_xml(
+            u.get_thorimage_xmlroot(u.thorimage_dir(*keys))
+        )
+        tracker = u.OnlineROITracker()
+        tracks = [tracker.fit_and_update(frame, template_data, um_per_pixel_xy)
+            for frame in tqdm(downsampled)
+        ]
+        tracks = pd.concat(tracks + [tracker.finish()], ignore_index=True)
+        show_movie(downsampled, tracks_to_roi_xyd(tracks, len(downsampled)))
+        return
+
     n_ds_frames = len(downsampled)
     print(f'Fitting ROIs over {n_ds_frames} frames of downsampled movie:')
     before = time.time()
@@ -317,8 +346,9 @@ def main():
     # TODO chunksize affect runtime (test on larger data)?
     # tqdm (grandularity at least)?
     ret_vals = list(tqdm(pool.imap_unordered(fit_frame,
-        [x + (tif,) for x in enumerate(downsampled)]), total=n_ds_frames)
-    )
+        [x + (tif, template_data) for x in enumerate(downsampled)]),
+        total=n_ds_frames
+    ))
     # Sort by frame number (first variable in return value).
     withinblock_center_sequence = [
         x[1] for x in sorted(ret_vals, key=lambda x: x[0])
@@ -459,10 +489,13 @@ def main():
 
 
 
+    template_data = u.load_template_data(err_if_missing=True)
     center_sequence = []
     for i in range(len(blocks)):
         frame = blocks[i].mean(axis=0)
-        centers, radius, _, _ = u.fit_circle_rois(tif, avg=frame)
+        centers, radius, _, _ = u.fit_circle_rois(tif, template_data,
+            avg=frame
+        )
         center_sequence.append(centers)
 
     roi_numbers = False
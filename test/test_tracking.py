@@ -2,6 +2,7 @@
 
 import pytest
 import numpy as np
+import pandas as pd
 from scipy.spatial.distance import pdist
 
 import hong2p.util as u
@@ -237,6 +238,28 @@ def help_test_correspond_and_renumber(nt, verbose=False, **kwargs):
     """
 
 
+def test_link_tracks():
+    centers = [
+        np.array([[0., 0.], [10., 10.], [20., 20.]]),
+        np.array([[11., 11.], [1., 1.]]),
+        np.array([[2., 2.], [30., 30.], [12., 12.]])
+    ]
+    matches = [np.array([[0, 1], [1, 0]]), np.array([[0, 2], [1, 0]])]
+    tracks, centers_array = u.link_tracks(matches, centers)
+
+    assert centers_array.dtype == np.float32
+    assert centers_array.shape == (3, 4, 2)
+    assert tracks.start_frame.tolist() == [0, 0, 0, 2]
+    assert tracks.end_frame.tolist() == [2, 2, 0, 2]
+    assert tracks.n_frames.tolist() == [3, 3, 1, 1]
+    assert np.array_equal(centers_array[:, 0, 0], [0, 1, 2])
+    assert np.array_equal(centers_array[:, 1, 0], [10, 11, 12])
+    assert np.isnan(centers_array[1:, 2]).all()
+    assert np.array_equal(u.renumber_rois2(matches, centers), centers_array,
+        equal_nan=True
+    )
+
+
 def test_correspond_and_renumber(exit_after_first=False):
     # seems like 4,5 match behavior of 3 so farc
     #for nt in (2, 3, 4, 5):
@@ -307,6 +330,41 @@ def test_correspond_and_renumber(exit_after_first=False):
         '''
 
 
+def test_online_roi_tracker():
+    rng = np.random.RandomState(0)
+    nt = 30
+    # Two ROIs moving in opposite directions (crossing in the middle), and
+    # one that disappears after frame 9.
+    starts = np.array([[50.0, 50.0], [50.0, 80.0], [100.0, 100.0]])
+    velocities = np.array([[1.0, 1.0], [1.0, -1.0], [0.0, -0.5]])
+
+    tracker = u.OnlineROITracker(max_missed=2)
+    outputs = []
+    n_detections = 0
+    for t in range(nt):
+        centers = starts + t * velocities + rng.normal(scale=0.2, size=(3, 2))
+        # Object index as the third column, to check tracks against.
+        xyd = np.concatenate((centers, np.arange(3)[:, None]), axis=1)
+        present = np.array([t != 5, t % 4 != 1, t < 10])
+        n_detections += present.sum()
+        closed = tracker.update(xyd[present][::-1])
+        if t == 12:
+            # Closed after missing 3 consecutive frames.
+            assert list(closed.diameter.unique()) == [2.0]
+            assert closed.frame.max() == 9
+        else:
+            assert (closed.diameter != 2).all()
+        outputs.append(closed)
+
+    assert len(tracker) == 2
+    outputs.append(tracker.finish())
+    assert len(tracker) == 0
+    tracks = pd.concat(outputs)
+    assert len(tracks) == n_detections
+    assert (tracks.groupby('track_id').diameter.nunique() == 1).all()
+    assert tracks.track_id.nunique() == 3
+
+
 if __name__ == '__main__':
     #test_correspond_and_renumber(exit_after_first=True)
     test_correspond_and_renumber()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+
 import pytest
 import numpy as np
 import pandas as pd
@@ -126,3 +128,1166 @@ def test_diff_dataframes_arr_naneq():
     assert u.diff_dataframes(df1, df2) is None
 
 
+def _fly_cell_stim_responses(n_cells=(30, 50, 40), n_stim=8, seed=0):
+    rng = np.random.RandomState(seed)
+    responses = np.full((len(n_cells), max(n_cells), n_stim), np.nan)
+    for i, n in enumerate(n_cells):
+        responses[i, :n] = np.round(rng.randn(n, n_stim), 1)
+    # A stimulus one fly did not get.
+    responses[1, :, -1] = np.nan
+    return responses
+
+
+@pytest.mark.parametrize('method', ['pearson', 'spearman'])
+def test_odor_correlations_match_pandas(method):
+    responses = _fly_cell_stim_responses()
+    oc = u.OdorCorrelations(responses)
+    corrs = oc.corr(method)
+    assert corrs.shape == (3, 8, 8)
+    for i in range(len(responses)):
+        fdf = pd.DataFrame(responses[i]).dropna(how='all')
+        assert np.allclose(fdf.corr(method=method).values, corrs[i],
+            equal_nan=True
+        )
+
+
+def test_odor_correlations_long_and_mean():
+    responses = _fly_cell_stim_responses()
+    stimuli = pd.MultiIndex.from_product([['a', 'b', 'c', 'd'], [0, 1]],
+        names=['name1', 'repeat_num']
+    )
+    flies = pd.Index([3, 5, 9], name='fly_id')
+    oc = u.OdorCorrelations(responses, flies=flies, stimuli=stimuli)
+
+    ser = oc.corr_ser()
+    assert list(ser.index.names) == ['fly_id', 'name1_a', 'repeat_num_a',
+        'name1_b', 'repeat_num_b'
+    ]
+    assert not ser.isnull().any()
+    # Fly 5 did not get ('d', 1).
+    assert len(ser) == 3 * 8 * 8 - (2 * 8 - 1)
+    assert np.isclose(ser.loc[(5, 'a', 0, 'c', 1)], oc.corr()[1, 0, 5])
+
+    assert np.allclose(oc.mean_corr_df().values,
+        np.nanmean(oc.corr(), axis=0)
+    )
+    # Same as the groupby means kc_mix_analysis used before: over flies, and
+    # then over repeats.
+    stim_pair_cols = ['name1_a', 'repeat_num_a', 'name1_b', 'repeat_num_b']
+    for fly_mask in (None, flies != 9):
+        fser = ser
+        if fly_mask is not None:
+            fser = ser[ser.index.get_level_values('fly_id').isin(
+                flies[fly_mask])
+            ]
+        expected = fser.groupby(stim_pair_cols).mean().groupby(
+            ['name1_a', 'name1_b']).mean().unstack()
+
+        mdf = oc.mean_corr_df(level='name1', fly_mask=fly_mask)
+        assert mdf.index.equals(pd.Index(['a', 'b', 'c', 'd'], name='name1'))
+        assert np.allclose(mdf.values, expected.values)
+
+
+def test_batch_corr_pairwise_nan():
+    responses = _fly_cell_stim_responses()
+    responses[0, 3, 2] = np.nan
+    corrs = u.batch_corr(responses)
+    for i in range(len(responses)):
+        fdf = pd.DataFrame(responses[i])
+        assert np.allclose(fdf.corr().values, corrs[i], equal_nan=True)
+
+
+def test_odor_correlations_bootstrap():
+    oc = u.OdorCorrelations(_fly_cell_stim_responses())
+    lower, upper = oc.bootstrap(n_boot=200, seed=0)
+    corrs = oc.corr()
+    assert lower.shape == upper.shape == corrs.shape
+    finite = np.isfinite(corrs)
+    assert (np.isnan(lower) == ~ finite).all()
+    off_diag = finite & ~ np.eye(corrs.shape[-1], dtype=bool)[None]
+    assert (lower[off_diag] < upper[off_diag]).all()
+
+
+def _template_scales(diam_pxs=(6, 8, 10), margin=4):
+    import cv2
+    template = u.make_test_template_data(diam_px=8, margin=margin)['template']
+    return [cv2.resize(template, (d + 2 * margin, d + 2 * margin))
+        for d in diam_pxs
+    ]
+
+
+@pytest.mark.parametrize('method_str', ['cv2.TM_CCOEFF',
+    'cv2.TM_CCOEFF_NORMED', 'cv2.TM_SQDIFF']
+)
+def test_multiscale_template_matcher(method_str):
+    movie, _, _ = u.make_test_movie(n_frames=50, frame_shape=(128, 128),
+        n_cells=20, diam_px=8, seed=0
+    )
+    scene = movie.max(axis=0)
+    templates = _template_scales()
+
+    matcher = u.MultiscaleTemplateMatcher(templates, scene.shape,
+        method_str=method_str
+    )
+    for m, t in zip(matcher.match(scene), templates):
+        assert np.array_equal(m, u.template_match(scene, t,
+            method_str=method_str
+        ))
+
+    if method_str == 'cv2.TM_CCOEFF_NORMED':
+        float_matcher = u.MultiscaleTemplateMatcher(templates, scene.shape,
+            method_str=method_str, keep_float=True
+        )
+        for m, fm in zip(matcher.match(scene), float_matcher.match(scene)):
+            assert fm.dtype == np.float32 and fm.shape == m.shape
+            # Only differs by the quantization of the uint8 path.
+            assert np.abs(fm - m).max() < 0.05
+            assert np.corrcoef(fm.flat, m.flat)[0, 1] > 0.999
+
+    with pytest.raises(ValueError):
+        matcher.match(scene[:-1])
+
+
+@pytest.mark.parametrize('multiscale_kwargs', [{'multiscale': False},
+    {'multiscale': True, 'roi_diams_px': [6, 8, 10]}]
+)
+def test_fit_circle_rois_matcher_same_as_template_match(monkeypatch,
+    multiscale_kwargs):
+
+    movie, _, _ = u.make_test_movie(n_frames=50, frame_shape=(128, 128),
+        n_cells=20, diam_px=8, seed=0
+    )
+    avg = movie.max(axis=0)
+    template_data = u.make_test_template_data(diam_px=8, um_per_pixel_xy=0.5,
+        frame_shape=avg.shape
+    )
+    kwargs = dict(avg=avg, _um_per_pixel_xy=0.5, method_str='cv2.TM_CCOEFF',
+        min_n_rois=None, max_n_rois=None, **multiscale_kwargs
+    )
+    monkeypatch.setattr(u, '_template_matchers', u.LRUCache(max_items=16))
+    centers, radii = u.fit_circle_rois(None, template_data, **kwargs)[:2]
+    assert len(centers) > 0
+
+    # Per-call template_match on each scale, as fit_circle_rois did before
+    # MultiscaleTemplateMatcher.
+    class PerScaleMatcher:
+        def __init__(self, templates, method_str):
+            self.templates = templates
+            self.method_str = method_str
+
+        def match(self, scene):
+            return [u.template_match(scene, t, method_str=self.method_str)
+                for t in self.templates
+            ]
+
+    with monkeypatch.context() as m:
+        m.setattr(u, '_get_template_matcher', lambda templates, scene_shape,
+            method_str, keep_float: PerScaleMatcher(templates, method_str)
+        )
+        old_centers, old_radii = u.fit_circle_rois(None, template_data,
+            **kwargs
+        )[:2]
+
+    assert np.array_equal(centers, old_centers)
+    assert np.array_equal(radii, old_radii)
+
+    # Second call reuses the prepared matcher.
+    stats = u._template_matchers.stats()
+    assert stats['misses'] == 1 and stats['hits'] == 0
+    u.fit_circle_rois(None, template_data, **kwargs)
+    assert u._template_matchers.stats()['hits'] == 1
+
+
+def test_template_matcher_cache_lru(monkeypatch):
+    monkeypatch.setattr(u, '_template_matchers', u.LRUCache(max_items=2))
+    templates = _template_scales()
+    shape = (32, 32)
+    a = u._get_template_matcher(templates[:1], shape, 'cv2.TM_CCOEFF', False)
+    b = u._get_template_matcher(templates[1:2], shape, 'cv2.TM_CCOEFF', False)
+    assert u._get_template_matcher(templates[:1], shape, 'cv2.TM_CCOEFF',
+        False) is a
+
+    # Evicts b, the least recently used, rather than clearing everything.
+    c = u._get_template_matcher(templates[2:], shape, 'cv2.TM_CCOEFF', False)
+    assert u._get_template_matcher(templates[:1], shape, 'cv2.TM_CCOEFF',
+        False) is a
+    assert u._template_matchers.stats()['evictions'] == 1
+    assert u._get_template_matcher(templates[1:2], shape, 'cv2.TM_CCOEFF',
+        False) is not b
+
+    # Settings are part of the key.
+    assert u._get_template_matcher(templates[:1], shape, 'cv2.TM_CCOEFF',
+        True).keep_float
+
+
+@u.instrumented('inner_fn', recording_arg='recording')
+def _instrumented_inner(recording, x):
+    with u.stage('innermost'):
+        return x + 1
+
+
+def _instrumented_worker(recording):
+    """Like kc_mix_analysis.process_traces in a pool worker.
+
+    Worker stage records are appended to the returned tuple.
+    """
+    with u.instrumented_recording(recording), u.stage('outer'):
+        ret = (_instrumented_inner(recording, 1),)
+    return ret + (u.stage_records(clear=True),)
+
+
+def test_stage_instrumentation(monkeypatch):
+    import multiprocessing as mp
+
+    monkeypatch.setattr(u, '_instrumentation_enabled', False)
+    monkeypatch.setattr(u, '_stage_records', [])
+    with u.stage('disabled'):
+        assert _instrumented_inner('r0', 1) == 2
+    assert len(u.stage_records()) == 0
+
+    u.enable_instrumentation()
+    with u.instrumented_recording('r0'), u.stage('outer'):
+        _instrumented_inner('r1', 1)
+        # Outside of the inner call, the outer recording applies again.
+        with u.stage('after_inner'):
+            pass
+
+    records = u.stage_records()
+    # Stages are recorded as they finish, innermost first.
+    assert list(records.stage) == ['innermost', 'inner_fn', 'after_inner',
+        'outer'
+    ]
+    assert list(records.recording) == ['r1', 'r1', 'r0', 'r0']
+    assert (records.wall_s >= 0).all()
+    wall_s = records.set_index('stage').wall_s
+    # Nested stage times are not exclusive.
+    assert wall_s['outer'] >= wall_s['inner_fn'] >= wall_s['innermost']
+
+    # Records from worker processes, as kc_mix_analysis merges them.
+    ctx = mp.get_context('fork')
+    with ctx.Pool(2) as pool:
+        ret = pool.map(_instrumented_worker, ['w0', 'w1', 'w2'])
+    assert [r[0] for r in ret] == [2, 2, 2]
+    for r in ret:
+        u.add_stage_records(r[-1])
+
+    records = u.stage_records(clear=True)
+    assert len(u.stage_records()) == 0
+    worker_records = records[records.recording.isin(['w0', 'w1', 'w2'])]
+    assert len(worker_records) == 9
+    assert set(worker_records.pid) != {os.getpid()}
+
+    summary = u.stage_summary(records)
+    assert summary.loc['outer', 'n_calls'] == 4
+    assert summary.loc['outer', 'n_recordings'] == 4
+    assert summary.loc['innermost', 'n_recordings'] == 4
+    assert list(summary.total_s) == sorted(summary.total_s, reverse=True)
+
+
+def test_stage_report_at_exit(tmp_path):
+    import sys
+    import json
+    import subprocess
+
+    log = str(tmp_path / 'stages.json')
+    code = ("import hong2p.util as u\n"
+        "with u.stage('a', recording='r'):\n"
+        "    pass\n"
+    )
+    env = dict(os.environ, HONG_2P_PROFILE='1', HONG_2P_PROFILE_LOG=log)
+    out = subprocess.run([sys.executable, '-c', code], env=env,
+        stdout=subprocess.PIPE, check=True, universal_newlines=True
+    ).stdout
+    assert 'Time spent in instrumented stages' in out
+    assert f'Wrote stage timing log to {log}' in out
+    with open(log, 'r') as f:
+        records = json.load(f)
+    assert len(records) == 1
+    assert records[0]['stage'] == 'a' and records[0]['recording'] == 'r'
+
+
+@pytest.mark.parametrize('chunk_size', [None, 777])
+def test_thorsync_timing_info(tmp_path, chunk_size):
+    thorsync_dir = str(tmp_path / 'SyncData001')
+    expected = u.write_test_thorsync_dir(thorsync_dir, seed=0)
+    ti = u.thorsync_timing_info(thorsync_dir, chunk_size=chunk_size,
+        return_samples=True
+    )
+    u.compare_timing_info(ti, expected)
+    assert np.array_equal(ti['odor_onset_samples'],
+        expected['odor_onset_samples']
+    )
+
+    mat = str(tmp_path / 'test_cnmf.mat')
+    u.save_timing_info_mat(mat, ti)
+    mat_ti = u.load_mat_timing_info(mat, use_matlab_engine=False)
+    u._check_timing_info_equal({k: ti[k] for k in mat_ti}, mat_ti)
+
+    # Minimal v7.3 .mat file: HDF5, with the MATLAB header in the userblock.
+    import h5py
+    v73_mat = str(tmp_path / 'v73_cnmf.mat')
+    with h5py.File(v73_mat, 'w', userblock_size=512) as f:
+        f['x'] = np.zeros(3)
+    with open(v73_mat, 'r+b') as f:
+        f.write(b'MATLAB 7.3 MAT-file'.ljust(124) + b'\x00\x02IM')
+    u.save_timing_info_mat(v73_mat, ti,
+        ti_code_version={'name': 'hong2p', 'git_uncommitted_changes': None}
+    )
+    assert u.matfile_varnames(v73_mat) == {'x', 'ti', 'ti_code_version'}
+    with h5py.File(v73_mat, 'r') as f:
+        assert np.array_equal(f['x'][()], np.zeros(3))
+        assert f['ti'].attrs['MATLAB_class'] == b'struct'
+        assert f['ti_code_version']['git_uncommitted_changes'].attrs[
+            'MATLAB_empty'
+        ]
+    v73_ti = u.load_mat_timing_info(v73_mat, use_matlab_engine=False)
+    u._check_timing_info_equal(mat_ti, v73_ti)
+
+    # Overwriting with new timing information (as with `update_timing_info` in
+    # populate_db).
+    ti['frame_times'] = ti['frame_times'] + 1.0
+    u.save_timing_info_mat(v73_mat, ti)
+    v73_ti = u.load_mat_timing_info(v73_mat, use_matlab_engine=False)
+    assert np.allclose(v73_ti['frame_times'], mat_ti['frame_times'] + 1.0)
+
+
+def test_saved_frame_times(tmp_path):
+    thorimage_dir = str(tmp_path / 'fn')
+    # 3 planes + 2 flyback frames per volume
+    u.write_test_thorimage_dir(thorimage_dir,
+        np.zeros((4, 3, 2, 2), dtype=np.uint16), n_flyback=2
+    )
+    pulse_times = np.arange(20) / 10
+    assert np.array_equal(u.saved_frame_times(pulse_times, thorimage_dir),
+        pulse_times[::5]
+    )
+    with pytest.raises(ValueError):
+        u.saved_frame_times(pulse_times[:-1], thorimage_dir)
+
+    thorimage_dir = str(tmp_path / 'fn_avg')
+    u.write_test_thorimage_dir(thorimage_dir,
+        np.zeros((5, 2, 2), dtype=np.uint16)
+    )
+    xml_path = u.get_thorimage_xml_path(thorimage_dir)
+    tree = u.etree.parse(xml_path)
+    tree.find('LSM').attrib.update({'averageMode': '1', 'averageNum': '4'})
+    tree.write(xml_path)
+    assert np.array_equal(u.saved_frame_times(pulse_times, thorimage_dir),
+        pulse_times[3::4]
+    )
+    assert np.array_equal(u.saved_frame_times(pulse_times[:5],
+        thorimage_dir), pulse_times[:5]
+    )
+
+
+def test_load_pid_windows(tmp_path):
+    thorsync_dir = str(tmp_path / 'SyncData001')
+    expected = u.write_test_thorsync_dir(thorsync_dir, seed=0)
+    pid, samplerate = u.load_pid_windows(thorsync_dir, pre_s=2.0, post_s=3.0,
+        target_hz=100.0, use_cache=False
+    )
+    assert np.isclose(samplerate, 100.0)
+    assert pid.shape == (len(expected['odor_onset_samples']), 500)
+    assert np.isclose(pid.columns[0], -2.0)
+    baseline = pid.loc[:, pid.columns < 0].values
+    response = pid.loc[:, (pid.columns > 0.6) & (pid.columns < 1.4)].values
+    assert np.abs(baseline).max() < 0.1
+    assert response.min() > 0.3
+
+    # Onsets from the timing info (as load_pid_data passes them), for a subset
+    # of the presentations.
+    subset_pid, _ = u.load_pid_windows(thorsync_dir, pre_s=2.0, post_s=3.0,
+        target_hz=100.0, use_cache=False,
+        onset_samples=expected['odor_onset_samples'][[2, 0]]
+    )
+    assert np.array_equal(subset_pid.values, pid.values[[2, 0]])
+
+
+def test_lru_cache():
+    cache = u.LRUCache(max_bytes=3 * 800)
+    for i in range(3):
+        cache[i] = np.zeros(100)
+    assert cache.get(0) is not None
+    # Evicts 1, the least recently used.
+    cache[3] = np.zeros(100)
+    assert 1 not in cache and 0 in cache
+    assert cache.get(1) is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 1,
+        'items': 3, 'nbytes': 3 * 800
+    }
+
+
+def test_trace_metadata_sidecar(tmp_path):
+    df = u.expand_array_cols(u.make_test_trace_df(n_flies=1, n_cells=5,
+        n_odors=2, n_repeats=2, n_frames=10, seed=0
+    ))
+    df['name1'] = df.name1.map({'odor0': 'eb', 'odor1': 'ep'})
+    trace_pickle = str(tmp_path / 'test.p')
+    u.write_trace_pickle(df, trace_pickle)
+    metadata = u.read_trace_metadata(trace_pickle, write_missing=False)
+    assert metadata['n_cells'] == 5
+    assert metadata['n_presentations'] == 4
+    assert metadata['n_frames'] == 40
+    assert metadata['prep_date'] == '2020-01-01'
+    assert metadata['odor_set'] == 'kiwi'
+    assert metadata == u.trace_df_metadata(df)
+
+
+@pytest.mark.parametrize('kind', ['thread', 'process', 'fork'])
+def test_figure_exporter(tmp_path, kind):
+    from matplotlib.figure import Figure
+
+    exporter = u.FigureExporter(n_workers=2, max_pending=2, kind=kind)
+    if kind == 'process':
+        # Not fork, so workers don't inherit the parent's threads / locks.
+        assert exporter._executor._mp_context.get_start_method() == \
+            'forkserver'
+    elif kind == 'fork':
+        # Already forked (before any threads), and rendering in the workers.
+        assert len(exporter._executor._processes) == 2
+        assert exporter.kind == 'process'
+
+    fnames = []
+    for i in range(3):
+        fig = Figure()
+        ax = fig.add_subplot()
+        ax.plot(np.arange(10) * i)
+        fs = [str(tmp_path / f'{i}.{ext}') for ext in ('png', 'pdf')]
+        exporter.submit(fig, fs)
+        # Changes after submit don't affect the saved output.
+        ax.clear()
+        fnames.extend(fs)
+    exporter.shutdown()
+    for f in fnames:
+        assert (tmp_path / f).stat().st_size > 0
+
+    with open(fnames[0], 'rb') as f:
+        assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+    with open(fnames[1], 'rb') as f:
+        assert f.read(5) == b'%PDF-'
+
+
+def test_figure_input_hashes(tmp_path):
+    from matplotlib.figure import Figure
+
+    df = u.make_test_trace_df(n_flies=1, n_cells=5, n_odors=2, n_repeats=1,
+        n_frames=10, seed=0
+    )
+    h = u.hash_inputs(df, {'b': 1, 'a': np.arange(3)})
+    assert h == u.hash_inputs(df.copy(), {'a': np.arange(3), 'b': 1})
+
+    df2 = df.copy()
+    df2.at[df2.index[0], 'raw_f'] = df2.raw_f.iloc[0] + 1
+    assert h != u.hash_inputs(df2, {'b': 1, 'a': np.arange(3)})
+
+    fname = str(tmp_path / 'x.png')
+    assert not u.figures_up_to_date([fname], h)
+    fig = Figure()
+    fig.add_subplot().plot(np.arange(10))
+    exporter = u.FigureExporter(n_workers=1, kind='thread')
+    exporter.submit(fig, [fname], input_hash=h)
+    exporter.shutdown()
+    assert u.figures_up_to_date([fname], h)
+    assert not u.figures_up_to_date([fname], 'other')
+
+    # Record is invalidated by changes to the file.
+    with open(fname, 'ab') as f:
+        f.write(b'\0')
+    assert u.figure_input_hash(fname) is None
+
+
+def test_check_inserted():
+    new_df = pd.DataFrame({'a': [1, 2], 'b': [0, 0], 'x': [0.5, 1.5],
+        'from_onset': [[0.0, 0.1], [0.0, 0.2]]
+    })
+    # Rows read back in a different order, w/ different integer types and an
+    # extra generated column.
+    db_df = pd.DataFrame({'a': np.array([2, 1], dtype='int16'),
+        'b': np.array([0, 0], dtype='int16'), 'x': [1.5, 0.5],
+        'from_onset': [[0.0, 0.2], [0.0, 0.1]], 'id': [8, 7]
+    })
+    u.check_inserted(new_df, db_df, ['a', 'b'])
+
+    db_df.loc[0, 'x'] = 2.0
+    with pytest.raises(IOError):
+        u.check_inserted(new_df, db_df, ['a', 'b'])
+
+
+def test_to_sql_with_duplicates_returning_commits(monkeypatch):
+    import contextlib
+
+    events = []
+    class FakeConnection:
+        in_transaction = False
+
+        @contextlib.contextmanager
+        def begin(self):
+            self.in_transaction = True
+            yield
+            self.in_transaction = False
+            events.append('commit')
+
+        def close(self):
+            pass
+
+    connection = FakeConnection()
+    class FakeEngine:
+        def connect(self):
+            return connection
+
+    monkeypatch.setattr(u, 'get_db_conn', lambda: FakeEngine())
+    monkeypatch.setattr(u, 'sql_table_info', lambda t: (dict(), ['name']))
+    monkeypatch.setattr(pd.DataFrame, 'to_sql', lambda self, name, conn,
+        **kwargs: events.append(('to_sql', conn.in_transaction))
+    )
+    def read_sql_query(query, conn):
+        assert query.startswith('WITH inserted AS (INSERT INTO odors')
+        events.append(('query', conn.in_transaction))
+        return pd.DataFrame({'name': ['a'], 'odor_id': [3]})
+    monkeypatch.setattr(u.pd, 'read_sql_query', read_sql_query)
+
+    df = pd.DataFrame({'name': ['a']})
+    returned = u.to_sql_with_duplicates(df, 'odors',
+        returning=['name', 'odor_id']
+    )
+    assert list(returned.odor_id) == [3]
+    # The returned rows are committed before they can be used.
+    assert events == [('to_sql', True), ('query', True), 'commit']
+
+    events.clear()
+    with u.db_transaction():
+        u.to_sql_with_duplicates(df, 'odors', returning=['name', 'odor_id'])
+        assert events == [('to_sql', True), ('query', True)]
+    assert events[-1] == 'commit' and len(events) == 3
+
+
+def test_cnmf_memmap(tmp_path, monkeypatch):
+    import tifffile
+
+    monkeypatch.setattr(u, 'cnmf_memmap_dir', lambda: str(tmp_path / 'mmap'))
+    movie = np.random.randint(0, 1000, size=(37, 20, 30)).astype('uint16')
+    tiff = str(tmp_path / 'movie.tif')
+    tifffile.imwrite(tiff, movie)
+
+    mmap_fname = u.cnmf_memmap(tiff, start_frame=2, stop_frame=35,
+        chunk_frames=7, verbose=False
+    )
+    assert u.cnmf_memmap(tiff, start_frame=2, stop_frame=35,
+        verbose=False) == mmap_fname
+
+    # What caiman.load_memmap does, for this filename.
+    Yr = np.memmap(mmap_fname, mode='r', dtype=np.float32, shape=(20 * 30, 33),
+        order='C'
+    )
+    images = np.reshape(Yr.T, (33, 20, 30), order='F')
+    assert np.array_equal(images, movie[2:35])
+
+
+def test_upload_queue(tmp_path, monkeypatch):
+    import contextlib
+
+    class FakeConnection:
+        def __init__(self):
+            self.committed = 0
+            self.rolled_back = 0
+
+        @contextlib.contextmanager
+        def begin(self):
+            try:
+                yield
+            except Exception:
+                self.rolled_back += 1
+                raise
+            self.committed += 1
+
+        def close(self):
+            pass
+
+    connection = FakeConnection()
+    class FakeEngine:
+        def connect(self):
+            return connection
+
+    monkeypatch.setattr(u, 'get_db_conn', lambda: FakeEngine())
+    monkeypatch.setattr(u, 'upload_queue_dir', lambda: str(tmp_path / 'q'))
+
+    uploaded = []
+    def step(x):
+        assert u.current_db_conn() is connection
+        if x == 'bad':
+            raise ValueError(x)
+        uploaded.append(x)
+    monkeypatch.setitem(u.upload_step_fns, 'test', step)
+
+    a = u.enqueue_upload([('test', 1), ('test', 2)], description='a')
+    b = u.enqueue_upload([('test', 3), ('test', 'bad')], description='b')
+    c = u.enqueue_upload([('test', 4)], description='c')
+    assert len(u.pending_uploads()) == 3
+
+    # IDs cached within a transaction that gets rolled back may not exist.
+    u._lookup_cache['odors'] = {('x',): 1}
+
+    progress = []
+    jobs_done = []
+    failures = u.process_upload_queue(
+        progress_callback=lambda *args: progress.append(args),
+        job_callback=lambda job_file, tb: jobs_done.append(
+            (job_file, tb is None)
+        )
+    )
+    # (fake steps don't actually roll back, so 3 is still in uploaded)
+    assert uploaded == [1, 2, 3, 4]
+    assert connection.committed == 2 and connection.rolled_back == 1
+    assert len(failures) == 1 and 'ValueError' in failures[0][1]
+    assert progress == [(1, 3, 'a'), (2, 3, 'b'), (3, 3, 'c')]
+    assert jobs_done == [(a, True), (b, False), (c, True)]
+    assert u.pending_uploads() == []
+    assert u.failed_uploads() == [b + '.failed']
+    assert os.listdir(tmp_path / 'q' / 'in_progress') == []
+    assert u._lookup_cache == dict()
+    assert u.current_db_conn() is not connection
+
+    # A job claimed by another (live) process is left alone, and one claimed
+    # by a process that no longer exists is run again.
+    d = u.enqueue_upload([('test', 5)], description='d')
+    e = u.enqueue_upload([('test', 6)], description='e')
+    in_progress_dir = tmp_path / 'q' / 'in_progress'
+    live_claim = in_progress_dir / (os.path.basename(d) + f'.{os.getppid()}')
+    os.rename(d, live_claim)
+    # Larger than the largest possible Linux PID.
+    os.rename(e, in_progress_dir / (os.path.basename(e) + f'.{2**22 + 1}'))
+
+    jobs_done = []
+    assert u.process_upload_queue(
+        job_callback=lambda job_file, tb: jobs_done.append(job_file)
+    ) == []
+    assert jobs_done == [e]
+    assert uploaded[-1] == 6
+    assert os.listdir(in_progress_dir) == [live_claim.name]
+
+    with pytest.raises(ValueError):
+        u.enqueue_upload([('not_a_step',)])
+
+
+def test_trial_dff_images_and_bbox_index():
+    rng = np.random.RandomState(0)
+    movie = rng.randint(100, 1000, size=(60, 20, 24)).astype(np.uint16)
+    onsets = [10, 40]
+    stack = u.trial_dff_images(movie, onsets, 5, 8)
+    assert stack.shape == (2, 20, 24)
+    x0, x1, y0, y1 = 3, 9, 4, 15
+    for trial_dff, onset in zip(stack, onsets):
+        bg = movie[onset - 5:onset, x0:x1 + 1, y0:y1 + 1].mean(axis=0)
+        expected = (movie[onset:onset + 8, x0:x1 + 1, y0:y1 + 1].mean(axis=0)
+            - bg) / bg
+        assert np.allclose(trial_dff[x0:x1 + 1, y0:y1 + 1], expected)
+
+    footprints = dict()
+    for i, (x, y) in enumerate([(2, 2), (5, 10), (15, 20), (9, 14)]):
+        f = np.zeros((20, 24))
+        f[x:x + 3, y:y + 3] = 1
+        footprints[i] = f
+    index = u.FootprintBBoxIndex(footprints)
+    near = index.overlapping(x0, x1, y0, y1, exclude=1)
+    expected = {c for c, f in footprints.items()
+        if c != 1 and (f[x0:x1 + 1, y0:y1 + 1] > 0).any()
+    }
+    assert set(near) == expected == {0, 3}
+
+
+def test_fit_exp_decays():
+    rng = np.random.RandomState(0)
+    times = np.arange(100) / 10
+    true = np.array([[2.0, 3.0, 0.1], [-1.5, 1.0, 0.5], [0.8, 6.0, -0.2]])
+    signals = u.exp_decay(times, true[:, :1], true[:, 1:2], true[:, 2:]) + \
+        rng.randn(3, len(times)) * 0.01
+    # Shorter series are padded w/ NaN.
+    signals[2, 80:] = np.nan
+
+    params, sigmas, converged = u.fit_exp_decays(signals, times,
+        numerical_scale=200
+    )
+    assert converged.all()
+    assert np.allclose(params, true, rtol=0.05, atol=0.02)
+
+    for i in range(len(signals)):
+        valid = np.isfinite(signals[i])
+        ref_params, ref_sigmas = u.fit_exp_decay(signals[i, valid],
+            times=times[valid], numerical_scale=200
+        )
+        assert np.allclose(params[i], ref_params, rtol=1e-4)
+        assert np.allclose(sigmas[i], ref_sigmas, rtol=1e-3)
+
+
+def test_sparse_footprints(tmp_path):
+    frame_shape = (40, 32)
+    ijrois = [
+        ('a', np.array([[2, 3], [10, 3], [10, 12], [2, 12]])),
+        ('b', np.array([[20, 20], [28, 22], [24, 30]])),
+        # Partially outside of the frame.
+        ('c', np.array([[35, 25], [45, 25], [45, 40], [35, 40]]))
+    ]
+    dense = u.ijrois2masks(ijrois, frame_shape)
+    sparse = u.ijrois2masks(ijrois, frame_shape, sparse=True)
+
+    assert sparse.shape == dense.shape and sparse.dtype == dense.dtype
+    assert np.array_equal(sparse.to_dense(), dense)
+    assert np.array_equal(sparse.to_dense(which=[2, 0]), dense[..., [2, 0]])
+    assert np.array_equal(u.SparseFootprints.from_dense(dense).indices,
+        sparse.indices
+    )
+    assert np.array_equal(u.footprints_to_flat_cnmf_dims(sparse).toarray(),
+        u.footprints_to_flat_cnmf_dims(dense)
+    )
+    labels = sparse.label_image()
+    for i in range(len(sparse)):
+        assert np.array_equal(labels == i + 1, dense[..., i])
+
+    movie = np.random.RandomState(0).rand(7, *frame_shape)
+    assert np.allclose(
+        u.extract_traces_boolean_footprints(movie, sparse, verbose=False),
+        u.extract_traces_boolean_footprints(movie, dense, verbose=False)
+    )
+
+    # As load_recording does it, from a memory mapped (integer) TIFF.
+    import tifffile
+    int_movie = (movie * 1000).astype(np.uint16)
+    tiff = str(tmp_path / 'movie.tif')
+    tifffile.imwrite(tiff, int_movie)
+    mapped = u.memmap_tiff(tiff)
+    assert isinstance(mapped, np.memmap) and mapped.dtype == np.uint16
+    assert np.allclose(
+        u._extract_traces_sparse_footprints(mapped, sparse, chunk_frames=3,
+            verbose=False
+        ),
+        u.extract_traces_boolean_footprints(int_movie.astype('float32'), dense,
+            verbose=False
+        )
+    )
+
+    for (coords, weights), (dcoords, dweights) in zip(
+        u.iter_footprint_coords(sparse), u.iter_footprint_coords(dense)):
+        assert all(np.array_equal(c, d) for c, d in zip(coords, dcoords))
+        assert np.array_equal(weights, dweights)
+
+
+def test_db_footprints2sparse():
+    rng = np.random.RandomState(0)
+    shape = (20, 16)
+    rows = []
+    for run in ('a', 'b'):
+        for cell in range(3):
+            n = rng.randint(1, 30)
+            rows.append({
+                'segmentation_run': run,
+                'cell': cell,
+                'x_coords': list(rng.randint(0, shape[0], size=n)),
+                'y_coords': list(rng.randint(0, shape[1], size=n)),
+                'weights': list(rng.rand(n))
+            })
+    df = pd.DataFrame(rows)
+
+    expected = np.stack([u.db_row2footprint(r, shape) for _, r in df.iterrows()
+        ], axis=-1
+    )
+    # (random coordinates include duplicates, which should be summed)
+    assert np.allclose(u.db_footprints2array(df, shape), expected)
+
+    by_run = u.db_footprints_by_run(df, shape, transpose=False)
+    assert list(by_run) == ['a', 'b']
+    b = by_run['b']
+    assert b.names == [0, 1, 2]
+    assert np.allclose(b.footprint(1), expected[..., 4].T)
+    assert np.allclose(b.csr().T.toarray(),
+        expected[..., 3:].transpose(1, 0, 2).reshape(-1, 3)
+    )
+
+
+def test_footprint_encoding():
+    rng = np.random.RandomState(0)
+    x = rng.randint(0, 256, size=50)
+    y = rng.randint(0, 256, size=50)
+    w = rng.rand(50)
+    dx, dy, dw = u.decode_footprint(u.encode_footprint(x, y, w))
+    assert np.array_equal(dx, x) and np.array_equal(dy, y)
+    assert np.array_equal(dw, w.astype(np.float32))
+
+    # Boolean masks (incl. one touching the bounding box corner) are run
+    # length encoded, and come back in C order.
+    for mask in (np.zeros((30, 20), dtype=bool), np.ones((3, 4), dtype=bool)):
+        mask[5:15, 3:9] = True
+        mask[2, 1] = True
+        mx, my = np.nonzero(mask)
+        buf = u.encode_footprint(mx + 100, my + 7)
+        assert len(buf) < 4 * len(mx)
+        dx, dy, dw = u.decode_footprint(buf)
+        assert np.array_equal(dx, mx + 100) and np.array_equal(dy, my + 7)
+        assert (dw == 1).all()
+
+    shape = (20, 16)
+    old_row = {'cell': 0, 'x_coords': [1, 2], 'y_coords': [3, 3],
+        'weights': [0.5, 0.25], 'footprint': None
+    }
+    new_row = {'cell': 1, 'x_coords': None, 'y_coords': None, 'weights': None,
+        'footprint': u.encode_footprint([4, 4, 5], [0, 1, 0])
+    }
+    df = pd.DataFrame([old_row, new_row])
+    decoded = u.decode_footprint_columns(df)
+    assert 'footprint' not in decoded.columns
+    assert list(decoded.x_coords.iat[1]) == [4, 4, 5]
+    dense = u.db_footprints2array(df, shape)
+    assert dense[3, 1, 0] == 0.5 and dense[..., 1].sum() == 3
+    assert np.array_equal(u.db_row2footprint(df.iloc[1], shape), dense[..., 1])
+
+
+def test_motion_correct_movie(tmp_path, monkeypatch):
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.RandomState(0)
+    template = gaussian_filter(rng.rand(64, 64), 2) * 3000 + 500
+    shifts = rng.uniform(-4, 4, size=(40, 2))
+    kx = np.fft.fftfreq(64)[:, None]
+    ky = np.fft.fftfreq(64)[None, :]
+    # frame(p) = template(p - shift)
+    movie = np.stack([np.fft.ifft2(np.fft.fft2(template) * np.exp(-2j * np.pi *
+        (kx * dx + ky * dy))).real for dx, dy in shifts]
+    ).astype(np.uint16)
+
+    corrected, info = u.motion_correct_movie(movie, bin_width=10,
+        init_batch=20, chunk_frames=15, verbose=False
+    )
+    assert corrected.shape == movie.shape and corrected.dtype == np.uint16
+    est = info['shifts'][['x_shift', 'y_shift']].values
+    # Shifts are relative to the template, which can itself be offset.
+    offset = (est - shifts).mean(axis=0)
+    assert np.abs(est - shifts - offset).max() < 0.2
+    assert (info['shifts']['corr'] > 0.99).all()
+    assert info['patch_shifts'] is None
+
+    output = str(tmp_path / 'nr.dat')
+    corrected, info = u.motion_correct_movie(movie, output=output,
+        nonrigid=True, grid_size=(32, 32), overlap=16, verbose=False
+    )
+    assert corrected.dtype == np.dtype('>u2')
+    assert info['patch_shifts'].shape == (40, 2, 2, 2)
+    # Motion is rigid here, so patches should mostly agree with whole frames.
+    assert np.median(np.abs(info['patch_shifts'] - info['shifts'][
+        ['x_shift', 'y_shift']].values[:, None, None])) < 0.3
+    assert (info['shifts']['corr'] > 0.9).all()
+
+    tiff = str(tmp_path / 'fn.tif')
+    u.write_tiff(tiff, movie)
+    # This checkout may not have an origin remote for version_info to record.
+    monkeypatch.setattr(u, 'version_info', lambda m, used_for=None:
+        {'name': 'hong2p', 'used_for': used_for, 'git_hash': 'abc'}
+    )
+    assert u.motion_correct_to_tiffs(str(tmp_path / 'fn'), str(tmp_path),
+        tiff=tiff, nonrigid=False, n_workers=1, bin_width=10, init_batch=20,
+        verbose=False
+    ) == (True, False)
+    rig_tif = str(tmp_path / 'tif_stacks' / 'fn_rig.tif')
+    assert (tmp_path / 'tif_stacks' / 'fn_rig.tif').exists()
+    versions = u.mocorr_code_versions(rig_tif)
+    assert len(versions) == 1
+    assert versions[0]['used_for'] == 'motion correction'
+
+
+def test_process_volume(tmp_path):
+    rng = np.random.RandomState(0)
+    volume = rng.randint(100, 200, size=(60, 3, 32, 32)).astype(np.uint16)
+    thorimage_dir = str(tmp_path / 'fn')
+    u.write_test_thorimage_dir(thorimage_dir, volume, n_flyback=2)
+    assert np.array_equal(u.read_movie(thorimage_dir), volume)
+
+    square = np.array([[2, 2], [2, 9], [9, 9], [9, 2]])
+    # No ROIs in the last plane.
+    ijrois = [(f'{z + 1}-{i}', square + 12 * i) for z in range(2)
+        for i in range(2)
+    ]
+    starts = np.arange(0, 60, 20)
+    avgs, df = u.process_volume(thorimage_dir, ijrois=ijrois,
+        trial_start_frames=starts, odor_onset_frames=starts + 5,
+        trial_stop_frames=starts + 19, n_workers=2
+    )
+    assert np.allclose(avgs, volume.mean(axis=0))
+    assert list(df.z) == [0, 0, 1, 1] and list(df.roi) == [0, 1, 0, 1]
+    for z in range(2):
+        masks = u.ijrois2masks(ijrois[(2 * z):(2 * z + 2)], (32, 32))
+        raw_f = u.extract_traces_boolean_footprints(volume[:, z], masks,
+            verbose=False
+        )
+        assert np.allclose(np.stack(df[df.z == z].raw_f).T, raw_f)
+        assert np.allclose(np.stack(df[df.z == z].df_over_f).T,
+            u.calculate_df_over_f(raw_f, starts, starts + 5, starts + 19)
+        )
+
+    # As `load_recording` calls it, on the volumes after `drop_first_n_frames`.
+    _, sub_df = u.process_volume(thorimage_dir, ijrois=ijrois,
+        frames=slice(10, 50), n_workers=1
+    )
+    assert np.allclose(np.stack(sub_df.raw_f), np.stack(df.raw_f)[:, 10:50])
+
+    circles = u.SparseFootprints.from_circles([[5, 6], [0, 31]], [2, 3.5],
+        (32, 32)
+    ).to_dense()
+    x, y = np.meshgrid(np.arange(32), np.arange(32), indexing='ij')
+    assert np.array_equal(circles[..., 0], (x - 5)**2 + (y - 6)**2 <= 4)
+    assert np.array_equal(circles[..., 1], x**2 + (y - 31)**2 <= 3.5**2)
+
+
+def test_process_volume_fit_rois(tmp_path):
+    plane = u.make_test_movie(n_frames=20, frame_shape=(64, 64), n_cells=6,
+        diam_px=8, seed=0
+    )[0]
+    # The second plane has nothing to fit ROIs to.
+    volume = np.stack([plane, np.full_like(plane, 200)], axis=1)
+    volume = volume.clip(0, 2**16 - 1).astype(np.uint16)
+    thorimage_dir = str(tmp_path / 'fn')
+    u.write_test_thorimage_dir(thorimage_dir, volume, um_per_pixel_xy=0.5)
+    template_data = u.make_test_template_data(diam_px=8, um_per_pixel_xy=0.5,
+        frame_shape=(64, 64)
+    )
+    fit_kwargs = dict(method_str='cv2.TM_CCOEFF', max_n_rois=None,
+        multiscale=False
+    )
+
+    # (the fit_circle_rois default of min_n_rois=150 would fail on each plane)
+    with pytest.warns(UserWarning, match='z=1'):
+        avgs, df = u.process_volume(thorimage_dir,
+            template_data=template_data, fit_kwargs=fit_kwargs, n_workers=1
+        )
+    assert set(df.z) == {0}
+    centers, radii = u.fit_circle_rois(None, template_data, avg=avgs[0],
+        _um_per_pixel_xy=0.5, min_n_rois=None, **fit_kwargs
+    )[:2]
+    assert len(df) == len(centers) > 0
+    assert list(df.name) == [f'1-{i}' for i in range(len(centers))]
+    masks = u.SparseFootprints.from_circles(centers, radii, (64, 64))
+    assert np.allclose(np.stack(df.raw_f).T,
+        u.extract_traces_boolean_footprints(volume[:, 0], masks.to_dense(),
+            verbose=False
+        )
+    )
+
+
+def test_version_info_cache(tmp_path):
+    import os
+    import time
+    git = pytest.importorskip('git')
+
+    repo = git.Repo.init(str(tmp_path / 'repo'))
+    repo.create_remote('origin', 'https://example.com/repo.git')
+    src = tmp_path / 'repo' / 'a.py'
+    src.write_text('x = 1\n')
+    repo.index.add(['a.py'])
+    repo.index.commit('initial')
+
+    def backdate():
+        # Files modified too recently can't be cached (mtimes may not change).
+        t = time.time() - 60
+        for f in (src, tmp_path / 'repo' / '.git' / 'index'):
+            os.utime(str(f), (t, t))
+    backdate()
+
+    v1 = u.version_info(str(src), used_for='a')
+    assert v1['git_hash'] == repo.head.object.hexsha
+    assert v1['git_uncommitted_changes'] == ''
+    # (git diff may have just rewritten the index)
+    backdate()
+    n_cached = len(u._version_info_cache)
+    v2 = u.version_info(str(src), used_for='b')
+    assert v2['used_for'] == 'b' and v2['git_hash'] == v1['git_hash']
+    assert u.version_info(str(src), used_for='b') == v2
+    assert len(u._version_info_cache) <= n_cached + 1
+
+    src.write_text('x = 2\n')
+    os.utime(str(src), (time.time() - 30, time.time() - 30))
+    v3 = u.version_info(str(src))
+    assert 'x = 2' in v3['git_uncommitted_changes']
+    assert (u._code_version_key(v3)[3] ==
+        u.code_diff_hash(v3['git_uncommitted_changes'])
+    )
+    assert u._code_version_key(v1) != u._code_version_key(v3)
+
+
+def test_stimfile_catalog(tmp_path, monkeypatch):
+    import os
+    import pickle
+
+    stim_dir = tmp_path / 'stimulus_data_files'
+    stim_dir.mkdir()
+    monkeypatch.setattr(u, 'stimfile_root', lambda: str(stim_dir))
+    monkeypatch.setattr(u, 'cache_root', lambda: str(tmp_path / 'cache'))
+    (tmp_path / 'cache').mkdir()
+    monkeypatch.setattr(u, '_stimfile_catalog', None)
+    monkeypatch.setattr(u, '_stimfile_catalog_unsaved', set())
+    monkeypatch.setattr(u, '_stimfile_data', dict())
+
+    odors = ['ethyl butyrate @ -2', 'kiwi approx. @ 0', 'pfo @ 0']
+    mix = {
+        'odor_lists': odors * 2,
+        'odors2pins': {o: i for i, o in enumerate(odors)},
+        'pins2odors': {i: o for i, o in enumerate(odors)},
+        'n_repeats': 2,
+        'presentations_per_block': 6
+    }
+    pairs = {
+        'odor_pair_list': ['a', 'b', 'a+b'] * 2,
+        'n_repeats': 2,
+        'presentations_per_block': 6
+    }
+    for name, data in (('mix.p', mix), ('pairs.p', pairs)):
+        with open(str(stim_dir / name), 'wb') as f:
+            pickle.dump(data, f)
+
+    n_loads = [0]
+    real_pickle_load = pickle.load
+    def counting_load(f):
+        n_loads[0] += 1
+        return real_pickle_load(f)
+    monkeypatch.setattr(u.pickle, 'load', counting_load)
+
+    catalog = u.stimfile_catalog()
+    assert n_loads[0] == 2
+    assert catalog.loc['mix.p', 'odor_set'] == 'kiwi'
+    assert catalog.loc['pairs.p', 'odor_set'] is None
+    assert catalog.loc['pairs.p', 'pair_case']
+    assert catalog.loc['mix.p', 'n_presentations'] == 6
+
+    assert u.stimfile_odorset('mix.p') == 'kiwi'
+    with pytest.raises(ValueError):
+        u.stimfile_odorset('pairs.p')
+    assert u.stimfile_odorset('pairs.p', strict=False) is None
+    assert n_loads[0] == 2
+
+    # The full contents are not in the catalog, so this unpickles the file
+    # (once per process).
+    data = u.load_odor_metadata('mix.p')
+    assert data['presentations_per_block'] == 2 and data['n_repeats'] == 1
+    assert u.load_stimfile('mix.p') == mix
+    assert u.load_odor_metadata('mix.p') == data
+    assert n_loads[0] == 3
+
+    # Another process (with an empty in-memory catalog) uses the saved one.
+    monkeypatch.setattr(u, '_stimfile_catalog', None)
+    u.stimfile_catalog()
+    # +1 for the catalog itself
+    assert n_loads[0] == 4
+
+    mix['odor_lists'] = odors * 3
+    with open(str(stim_dir / 'mix.p'), 'wb') as f:
+        pickle.dump(mix, f)
+    os.utime(str(stim_dir / 'mix.p'), ns=(0, 10**9))
+    catalog_file = u._stimfile_catalog_filename()
+    mtime_before = os.stat(catalog_file).st_mtime_ns
+    # New entries from single lookups are only saved later, not one by one.
+    assert u.stimfile_odorset('mix.p') == 'kiwi'
+    assert n_loads[0] == 5
+    assert os.stat(catalog_file).st_mtime_ns == mtime_before
+    assert len(u._stimfile_catalog_unsaved) == 1
+    # (re-reads the saved catalog, to merge into it)
+    u._save_stimfile_catalog()
+    assert len(u._stimfile_catalog_unsaved) == 0
+    assert n_loads[0] == 6
+
+    monkeypatch.setattr(u, '_stimfile_catalog', None)
+    assert u.stimfile_catalog().loc['mix.p', 'n_presentations'] == 9
+    assert n_loads[0] == 7
+
+    # The memoized contents are also invalidated by the change.
+    assert len(u.load_odor_metadata('mix.p')['odor_list']) == 9
+    assert n_loads[0] == 8
+
+    # A change to the code computing entries means a new catalog.
+    monkeypatch.setattr(u, '_stimfile_catalog_code_hash_str', 'other')
+    assert u._stimfile_catalog_filename() != catalog_file
+
+
+def test_mb_team_gsheet_snapshot(tmp_path, monkeypatch):
+    import threading
+    from contextlib import contextmanager
+
+    monkeypatch.setattr(u, 'cache_root', lambda: str(tmp_path))
+    monkeypatch.setattr(u, '_gsheet_snapshot_filename',
+        lambda drop_nonexistant_dirs: str(tmp_path / 'snapshot.p')
+    )
+    monkeypatch.setattr(u, '_mb_team_gsheet', dict())
+    monkeypatch.setattr(u, '_gsheet_flies_to_upload', [])
+    monkeypatch.setattr(u, '_uploaded_gsheet_flies', set())
+    monkeypatch.delenv('HONG_2P_OFFLINE', raising=False)
+
+    n_downloads = [0]
+    def download():
+        n_downloads[0] += 1
+        return dict()
+    monkeypatch.setattr(u, '_download_mb_team_sheets', download)
+
+    df = pd.DataFrame({'thorimage_dir': ['a', 'b']})
+    flies = pd.DataFrame({'fly_num': [1, 2], 'date': ['2019-01-01'] * 2})
+    def process(sheets, **kwargs):
+        sheets['fly_preps'] = flies
+        return df
+    monkeypatch.setattr(u, '_process_mb_team_sheets', process)
+
+    uploads = []
+    real_upload = u._upload_gsheet_flies
+    def upload():
+        n_pending = len(u._gsheet_flies_to_upload)
+        real_upload()
+        if n_pending:
+            uploads.append(threading.current_thread())
+    monkeypatch.setattr(u, '_upload_gsheet_flies', upload)
+    uploaded = []
+    monkeypatch.setattr(u, 'to_sql_with_duplicates',
+        lambda f, table: uploaded.append((table, list(f.columns)))
+    )
+    @contextmanager
+    def null_transaction():
+        yield
+    monkeypatch.setattr(u, 'db_transaction', null_transaction)
+
+    assert u.mb_team_gsheet().equals(df)
+    assert n_downloads[0] == 1
+    assert (tmp_path / 'snapshot.p').exists()
+    assert uploaded == [('flies', ['fly_num', 'prep_date'])]
+    assert uploads == [threading.main_thread()]
+
+    # Within the TTL, another process loads the snapshot, and uploads its flies
+    # (once) from the calling thread.
+    monkeypatch.setattr(u, '_mb_team_gsheet', dict())
+    monkeypatch.setattr(u, '_uploaded_gsheet_flies', set())
+    assert u.mb_team_gsheet(ttl_s=60).equals(df)
+    assert u.mb_team_gsheet(ttl_s=60).equals(df)
+    assert n_downloads[0] == 1
+    assert len(uploaded) == 2
+    assert uploads == [threading.main_thread()] * 2
+
+    monkeypatch.setattr(u, '_mb_team_gsheet', dict())
+    u.mb_team_gsheet(ttl_s=0)
+    assert n_downloads[0] == 2
+
+    # Offline, a stale snapshot is used, without downloading or uploading.
+    monkeypatch.setattr(u, '_mb_team_gsheet', dict())
+    monkeypatch.setattr(u, '_uploaded_gsheet_flies', set())
+    monkeypatch.setenv('HONG_2P_OFFLINE', '1')
+    n_uploaded = len(uploaded)
+    assert u.mb_team_gsheet(ttl_s=0).equals(df)
+    assert n_downloads[0] == 2
+    assert len(uploaded) == n_uploaded
+
+    monkeypatch.setattr(u, '_mb_team_gsheet', dict())
+    (tmp_path / 'snapshot.p').unlink()
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(IOError):
+        u.mb_team_gsheet()
+
+
+def test_existing_dirs(tmp_path):
+    import os
+
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'a' / 'f').write_text('')
+    dirs = [os.path.join(str(tmp_path), *p) for p in
+        (('a',), ('a', 'b'), ('a', 'f'), ('a', 'c'), ('x', 'y'))
+    ]
+    assert u._existing_dirs(dirs + [dirs[1] + os.sep]) == set(dirs[:2])